@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+import argparse
+import multiprocessing
+import os
+import socket
+import time
+from oc_cdt_queue2.queue_server import QueueServer
+
+"""
+Connection process start methods comparison: time from QueueServer.connect() to the first connection attempt
+and memory of the connection process, with application memory of given size allocated in the parent.
+No broker is needed: a socket accepting connections and never answering stands for it.
+Run as: python benchmarks/start_methods.py [--app-memory MB] [--repeat N]
+"""
+
+
+def _memory(pid):
+    """
+    Resident and proportional set sizes of a process, kB
+    """
+    _result = {'rss': None, 'pss': None}
+
+    try:
+        with open('/proc/%d/smaps_rollup' % pid) as _smaps:
+            for _line in _smaps:
+                _fields = _line.split()
+                if _fields[0] == 'Rss:':
+                    _result['rss'] = int(_fields[1])
+                elif _fields[0] == 'Pss:':
+                    _result['pss'] = int(_fields[1])
+    except (OSError, IndexError, ValueError):
+        pass
+
+    return _result
+
+
+def measure(start_method, listener, repeat):
+    """
+    Connect and disconnect few times, return average start time (ms) and memory of the last connection process
+    """
+    _server = QueueServer()
+    _server.setup('amqp://127.0.0.1:%d/' % listener.getsockname()[1], queue='benchmark.input', start_method=start_method)
+    _server._terminate_delay = 0
+    _times = list()
+    _memory_used = None
+
+    for _attempt in range(0, repeat):
+        _started = time.time()
+        _server.connect()
+        (_conn, _addr) = listener.accept()
+        _times.append(time.time() - _started)
+        # let the process settle
+        time.sleep(0.2)
+        _memory_used = _memory(_server._connection_prcs.pid)
+        _server.disconnect()
+        _conn.close()
+
+    return {'first_ms': _times[0] * 1000, 'next_ms': sum(_times[1:]) * 1000 / max(1, len(_times) - 1),
+            'rss_kb': _memory_used['rss'], 'pss_kb': _memory_used['pss']}
+
+
+def main():
+    _parser = argparse.ArgumentParser(description='Compare connection process start methods')
+    _parser.add_argument('--app-memory', help='Application memory to allocate in parent, MB', default=256, type=int)
+    _parser.add_argument('--repeat', help='Connections per start method', default=5, type=int)
+    _args = _parser.parse_args()
+
+    # application caches loaded before connect()
+    _cache = [os.urandom(1024 * 1024) for _i in range(0, _args.app_memory)]
+    _listener = socket.socket()
+    _listener.bind(('127.0.0.1', 0))
+    _listener.listen(8)
+
+    print("%-12s %12s %12s %12s %12s" % ('method', 'first, ms', 'next, ms', 'RSS, MB', 'PSS, MB'))
+
+    for _method in multiprocessing.get_all_start_methods():
+        _result = measure(_method, _listener, _args.repeat)
+        print("%-12s %12.1f %12.1f %12.1f %12.1f" % (_method, _result['first_ms'], _result['next_ms'],
+                                                      (_result['rss_kb'] or 0) / 1024.0, (_result['pss_kb'] or 0) / 1024.0))
+
+    return len(_cache) and 0
+
+
+if __name__ == '__main__':
+    exit(main())
@@ -0,0 +1,400 @@
+#!/usr/bin/env python
+
+import argparse
+import collections
+import importlib
+import logging
+import os
+import struct
+import threading
+import time
+from .ipc_messages import IpcMessage
+from .ipc_messages import IpcMessageResult
+from .latency import Histogram
+
+"""
+Capture of messages delivered to QueueServer and its replay into a handler without broker,
+for comparing handler versions on real traffic.
+Run as: python -m oc_cdt_queue2.capture <capture file> --handler <module>:<class> [options] [handler options]
+"""
+
+
+CaptureRecord = collections.namedtuple('CaptureRecord', ['received', 'duration', 'result', 'redelivered', 'queue',
+                                                         'properties', 'body'])
+CaptureRecord.__doc__ = """
+Message captured: arrival time (seconds since epoch), seconds from arrival to result,
+result (one of CaptureWriter.results), redelivered flag, queue consumed from, pika.BasicProperties and body
+"""
+
+
+class CaptureWriter(object):
+    """
+    Appends captured messages to a binary file: a signature, then a record per message of a fixed header
+    followed by queue name, AMQP-encoded properties and body. Records are buffered, the file is complete
+    as of the last flush(); a record torn by process crash is skipped on reading. Thread-safe.
+    """
+
+    signature = b'OCQCAP\x00\x01'
+    results = ('ack', 'requeue', 'reject', 'retry')
+    # received, duration, result, flags, queue name length, properties length, body length
+    _header = struct.Struct('<ddBBHII')
+    _redelivered = 0x01
+
+    def __init__(self, path, buffer_size=1024 * 1024):
+        """
+        Main initialization
+        :param path: file to append to, created if missing
+        :type path: str
+        :param buffer_size: bytes to buffer before writing
+        :type buffer_size: int
+        """
+        self.path = path
+        self.count = 0
+        self._lock = threading.Lock()
+        self._file = open(path, 'ab', buffering=buffer_size)
+
+        if not self._file.tell():
+            self._file.write(self.signature)
+
+    @classmethod
+    def result(cls, ack, requeue, retry_queue=None):
+        """
+        Result name of message processing result reported
+        :param ack: message is acked
+        :type ack: boolean
+        :param requeue: message is requeued if not acked
+        :type requeue: boolean
+        :param retry_queue: message is re-published to this retry queue
+        :type retry_queue: str
+        :returns: str, one of results
+        """
+        if ack:
+            return 'ack'
+
+        if retry_queue:
+            return 'retry'
+
+        return 'requeue' if requeue else 'reject'
+
+    def write(self, received, duration, result, properties, body, queue=None, redelivered=False):
+        """
+        Append a message
+        :param received: arrival time, seconds since epoch
+        :type received: float
+        :param duration: seconds from arrival to result
+        :type duration: float
+        :param result: one of results
+        :type result: str
+        :param properties: message properties
+        :type properties: pika.BasicProperties
+        :param body: message body
+        :type body: bytes
+        :param queue: queue the message was consumed from
+        :type queue: str
+        :param redelivered: message was delivered before
+        :type redelivered: boolean
+        """
+        _queue = (queue or '').encode('utf-8')
+        _properties = b''.join(properties.encode()) if properties is not None else b''
+        body = body or b''
+        _header = self._header.pack(received, duration, self.results.index(result),
+                                    self._redelivered if redelivered else 0, len(_queue), len(_properties), len(body))
+
+        with self._lock:
+            self._file.write(_header + _queue + _properties)
+            self._file.write(body)
+            self.count += 1
+
+    def flush(self):
+        """
+        Write buffered records to the file
+        """
+        with self._lock:
+            if not self._file.closed:
+                self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def read_capture(path):
+    """
+    Read messages captured
+    :param path: capture file
+    :type path: str
+    :returns: generator of CaptureRecord
+    :raises ValueError: if the file is not a capture
+    """
+    # pika is needed for properties decoding only
+    import pika
+
+    _header = CaptureWriter._header
+
+    with open(path, 'rb') as _file:
+        if _file.read(len(CaptureWriter.signature)) != CaptureWriter.signature:
+            raise ValueError("Not a capture file: %s" % path)
+
+        while True:
+            _data = _file.read(_header.size)
+
+            if len(_data) < _header.size:
+                break
+
+            (_received, _duration, _result, _flags, _queue_length, _properties_length, _body_length) = \
+                _header.unpack(_data)
+            _length = _queue_length + _properties_length + _body_length
+            _data = _file.read(_length)
+
+            if len(_data) < _length:
+                logging.warning("Capture %s ends with incomplete record, skipping it", path)
+                break
+
+            _properties = pika.BasicProperties()
+
+            if _properties_length:
+                _properties.decode(_data[_queue_length:_queue_length + _properties_length])
+
+            yield CaptureRecord(received=_received, duration=_duration, result=CaptureWriter.results[_result],
+                                redelivered=bool(_flags & CaptureWriter._redelivered),
+                                queue=_data[:_queue_length].decode('utf-8') or None,
+                                properties=_properties, body=_data[_queue_length + _properties_length:])
+
+
+class _ResultCollector(object):
+    """
+    Stands for interprocess queue to connection process: takes processing results reported
+    """
+
+    def __init__(self, replay):
+        self._replay = replay
+
+    def put(self, msg):
+        if isinstance(msg, IpcMessageResult):
+            self._replay._on_result(msg)
+
+
+class CaptureReplay(object):
+    """
+    Feeds captured messages to QueueServer (or any descendant) in-process, bypassing broker and connection process.
+    Messages go through the same processing path they do when consumed: batches, concurrent processing,
+    chunked payloads and retries set up are in effect, results reported are collected instead of being sent.
+    Latency of a message is time from its arrival to its result: arrival is scheduled by capture time
+    with original pace, it is the time message is passed to the server otherwise.
+    """
+
+    def __init__(self, server, pace=True, speed=1.0):
+        """
+        Main initialization
+        :param server: server set up, not connected
+        :type server: QueueServer
+        :param pace: pass messages at original pace, as fast as possible otherwise
+        :type pace: boolean
+        :param speed: original pace multiplier
+        :type speed: float
+        """
+        if speed <= 0:
+            raise ValueError("Speed should be positive")
+
+        self.server = server
+        self.pace = pace
+        self.speed = speed
+        self.latency = Histogram()
+        self.captured = Histogram()
+        self.results = dict((_result, 0) for _result in CaptureWriter.results)
+        self.changed = 0
+        self.counter_messages = 0
+        self.elapsed = 0
+        # delivery tag: (arrival time, captured result)
+        self._pending = dict()
+
+    def _on_result(self, msg):
+        """
+        Count result reported by server
+        :param msg: result
+        :type msg: IpcMessageResult
+        """
+        _now = time.time()
+        _tags = [msg.delivery_tag]
+
+        if msg.multiple:
+            _tags = [_tag for _tag in self._pending if _tag <= msg.delivery_tag]
+
+        _result = CaptureWriter.result(msg.ack, msg.requeue, msg.retry_queue)
+
+        for _tag in _tags:
+            _pending = self._pending.pop(_tag, None)
+
+            if _pending is None:
+                continue
+
+            (_arrival, _captured) = _pending
+            self.latency.record(_now - _arrival)
+            self.results[_result] += 1
+
+            if _result != _captured:
+                self.changed += 1
+
+    def _serve(self, timeout=0):
+        """
+        Report results of messages processed concurrently and process a batch if it is due,
+        waiting for the first of them up to timeout
+        """
+        _server = self.server
+
+        if _server._batch:
+            _wait = _server._batch_wait()
+
+            if _wait == 0 or _server.batch_timeout == 0:
+                _server._process_batch()
+                return
+
+            timeout = min(timeout, _wait)
+
+        if _server._executor_pending():
+            _server._process_completed(timeout)
+        elif timeout > 0:
+            time.sleep(timeout)
+
+    def run(self, records):
+        """
+        Replay messages
+        :param records: messages captured
+        :type records: iterable of CaptureRecord
+        :returns: report, see report()
+        """
+        _server = self.server
+        _server.prepare()
+        _ipc_q_out = getattr(_server, '_ipc_q_out', None)
+        _server._ipc_q_out = _ResultCollector(self)
+        _started = time.time()
+        _first = None
+
+        try:
+            for (_tag, _record) in enumerate(records, 1):
+                _arrival = time.time()
+
+                if _server._batch_wait() == 0:
+                    _server._process_batch()
+
+                if self.pace:
+                    if _first is None:
+                        _first = _record.received
+
+                    _arrival = _started + (_record.received - _first) / self.speed
+
+                    while time.time() < _arrival:
+                        self._serve(_arrival - time.time())
+
+                if _server._keyed_executor is not None:
+                    _server._process_completed()
+
+                    while _server._keyed_executor.full():
+                        _server._process_completed(0.01)
+
+                self._pending[_tag] = (_arrival if self.pace else time.time(), _record.result)
+                self.counter_messages += 1
+                _server._process_message(_tag, _record.properties, _record.body,
+                                         delivery=IpcMessage(_tag, _record.properties, _record.body,
+                                                             redelivered=_record.redelivered, queue=_record.queue,
+                                                             received=_arrival))
+                self.captured.record(_record.duration)
+
+            _server._process_batch()
+
+            while _server._executor_pending():
+                _server._process_completed(0.01)
+
+            _server._process_completed()
+        finally:
+            self.elapsed = time.time() - _started
+            _server._ipc_q_out = _ipc_q_out
+
+        return self.report()
+
+    def report(self):
+        """
+        Replay results
+        :returns: {'messages', 'elapsed', 'throughput', 'latency': Histogram.as_dict(),
+                   'captured': Histogram.as_dict() of latency captured, 'results': {result: count},
+                   'changed': number of messages with result other than captured one}
+        """
+        return {'messages': self.counter_messages,
+                'elapsed': self.elapsed,
+                'throughput': self.counter_messages / self.elapsed if self.elapsed else None,
+                'latency': self.latency.as_dict(),
+                'captured': self.captured.as_dict(),
+                'results': dict(self.results),
+                'changed': self.changed}
+
+
+def _load_handler(name):
+    """
+    Class by '<module>:<class>' name
+    """
+    if ':' not in name:
+        raise ValueError("Handler should be in form <module>:<class>: %s" % name)
+
+    (_module, _class) = name.split(':', 1)
+    return getattr(importlib.import_module(_module), _class)
+
+
+def _print_histogram(title, histogram):
+    if not histogram['count']:
+        print("%-10s no messages" % title)
+        return
+
+    print("%-10s avg %.6f p50 %.6f p90 %.6f p99 %.6f max %.6f" % (
+        title, histogram['sum'] / histogram['count'], histogram['p50'], histogram['p90'], histogram['p99'],
+        histogram['max']))
+
+
+def main(cmdline=None):
+    """
+    Command-line entry point. Options not known are passed to the handler parser,
+    so it is set up as it would be for consuming
+
+    :param cmdline: Command line parameters array for debug purposes
+    :returns: return code for exit()
+    """
+    _parser = argparse.ArgumentParser(description='Replay captured messages into a handler')
+    _parser.add_argument('capture', help='Capture file written by QueueServer with --capture')
+    _parser.add_argument('--handler', help='Handler class as <module>:<class>', required=True)
+    _parser.add_argument('--fast', help='Replay as fast as possible instead of original pace',
+                         default=False, action='store_true')
+    _parser.add_argument('--speed', help='Original pace multiplier', default=1.0, type=float)
+    _parser.add_argument('--limit', help='Replay first N messages only, 0 for all of them', default=0, type=int)
+    (_args, _rest) = _parser.parse_known_args(cmdline)
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s:%(name)s:%(levelname)s:%(message)s')
+
+    if not os.path.exists(_args.capture):
+        _parser.error("Capture file not found: %s" % _args.capture)
+
+    _server = _load_handler(_args.handler)()
+    _server.parser = _server.prepare_parser() if hasattr(_server, 'prepare_parser') else \
+        argparse.ArgumentParser(description='Handler')
+    _server.basic_args()
+    _server.args = _server.parser.parse_args(_rest)
+    _server.setup_from_args()
+
+    if hasattr(_server, 'init'):
+        _server.init(_server.args)
+
+    _records = read_capture(_args.capture)
+
+    if _args.limit:
+        _records = (_record for (_index, _record) in zip(range(0, _args.limit), _records))
+
+    _report = CaptureReplay(_server, pace=not _args.fast, speed=_args.speed).run(_records)
+
+    print("%-10s %d in %.3f s, %.1f msg/s" % ('messages', _report['messages'], _report['elapsed'],
+                                              _report['throughput'] or 0))
+    _print_histogram('latency', _report['latency'])
+    _print_histogram('captured', _report['captured'])
+    print("%-10s %s, %d changed" % ('results', ', '.join('%s %d' % (_result, _report['results'][_result])
+                                                         for _result in CaptureWriter.results), _report['changed']))
+    return 0
+
+
+if __name__ == '__main__':
+    exit(main())
@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+
+import logging
+import os
+import re
+import signal
+import sys
+import threading
+import time
+
+"""
+CPU profiler for message processing
+"""
+
+# CPU time of the calling thread, process one before Python 3.7
+_thread_time = getattr(time, 'thread_time', time.process_time)
+
+
+class _Sampler(object):
+    """
+    Thread taking stacks of another thread regularly while it is marked active
+    """
+
+    def __init__(self, interval, depth=64):
+        self.interval = interval
+        self.depth = depth
+        self._thread_id = None
+        self._lock = threading.Lock()
+        # stacks taken since the last take(): list of tuples of function names, the innermost last
+        self._stacks = list()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def activate(self, thread_id):
+        with self._lock:
+            self._thread_id = thread_id
+
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='cpu-profile-sampler')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def take(self):
+        """
+        Stop sampling, return stacks taken since activation
+        """
+        with self._lock:
+            self._thread_id = None
+            _stacks = self._stacks
+            self._stacks = list()
+
+        return _stacks
+
+    @staticmethod
+    def function(code):
+        return '%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            with self._lock:
+                if self._thread_id is None:
+                    continue
+
+                _frame = sys._current_frames().get(self._thread_id)
+                _stack = list()
+
+                while _frame is not None and len(_stack) < self.depth:
+                    _stack.append(self.function(_frame.f_code))
+                    _frame = _frame.f_back
+
+                if _stack:
+                    self._stacks.append(tuple(reversed(_stack)))
+
+    def stop(self):
+        self._stop.set()
+
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+class CpuProfiler(object):
+    """
+    Profiles message processing and aggregates it by a key (published function).
+    'cprofile' method runs cProfile during every message: exact call counts and times, but processing is
+    slowed down noticeably. 'sample' method takes stack of processing thread every interval from a background
+    thread: overhead is low and does not depend on the code profiled, results are statistical.
+    Wall and CPU time are counted for every message with both methods.
+    Messages are to be processed by the thread calling begin() and end().
+    """
+
+    methods = ['cprofile', 'sample']
+
+    def __init__(self, method='cprofile', report_every=0, output=None, interval=0.005, top=20, report_signal=None):
+        """
+        Main initialization
+        :param method: 'cprofile' or 'sample'
+        :type method: str
+        :param report_every: log report and write output every K messages, 0 to do it on signal only
+        :type report_every: int
+        :param output: file to write stats to: pstats for 'cprofile' (and a file per key with key suffix),
+                       collapsed stacks with key as root frame for 'sample'. '{pid}' is replaced with process id
+        :type output: str
+        :param interval: seconds between samples for 'sample' method
+        :type interval: float
+        :param top: functions number to report per key
+        :type top: int
+        :param report_signal: signal to report on, e.g. signal.SIGUSR2. None to not install handler
+        :type report_signal: int
+        """
+        if method not in self.methods:
+            raise ValueError("Unsupported CPU profile method: %s" % method)
+
+        if interval <= 0:
+            raise ValueError("CPU profile interval should be positive")
+
+        self.method = method
+        self.interval = interval
+        self.report_every = report_every
+        self.output = output
+        self.top = top
+        self._messages = 0
+        self._report_requested = False
+        self._reported_at = 0
+        # key: [messages, wall seconds, CPU seconds]
+        self._times = dict()
+        # key: pstats.Stats for 'cprofile', {stack: samples} for 'sample'
+        self._stats = dict()
+        self._sampler = _Sampler(interval) if method == 'sample' else None
+
+        if report_signal is not None:
+            self.install_signal(report_signal)
+
+    def install_signal(self, signum):
+        """
+        Report on the signal given. Report is written on the next message or main loop iteration,
+        not from the signal handler itself
+        :param signum: signal number
+        :type signum: int
+        """
+        try:
+            signal.signal(signum, self._on_signal)
+        except ValueError as e:
+            # not the main thread
+            logging.warning("Unable to install CPU profile report signal handler: %s", e)
+
+    def _on_signal(self, signum, frame):
+        self._report_requested = True
+
+    def begin(self):
+        """
+        Call before message processing
+        :returns: state to pass to end()
+        """
+        self._messages += 1
+        _profile = None
+
+        if self._sampler is not None:
+            self._sampler.activate(threading.current_thread().ident)
+        else:
+            import cProfile
+            _profile = cProfile.Profile()
+            _profile.enable()
+
+        return (_profile, time.time(), _thread_time())
+
+    def end(self, state, key):
+        """
+        Call after message processing
+        :param state: begin() result
+        :param key: key to aggregate stats by, e.g. published function name
+        :type key: str
+        """
+        (_profile, _started, _cpu_started) = state
+
+        if _profile is not None:
+            _profile.disable()
+
+        _times = self._times.setdefault(key, [0, 0.0, 0.0])
+        _times[0] += 1
+        _times[1] += time.time() - _started
+        _times[2] += _thread_time() - _cpu_started
+
+        if _profile is not None:
+            import pstats
+
+            if key in self._stats:
+                self._stats[key].add(_profile)
+            else:
+                self._stats[key] = pstats.Stats(_profile)
+
+            return
+
+        _stacks = self._stats.setdefault(key, dict())
+
+        for _stack in self._sampler.take():
+            _stacks[_stack] = _stacks.get(_stack, 0) + 1
+
+    def report_due(self):
+        """
+        Check if report is to be written now: requested by signal or K messages passed
+        :returns: boolean
+        """
+        if self._report_requested:
+            return True
+
+        return bool(self.report_every and self._messages - self._reported_at >= self.report_every)
+
+    def _top_functions(self, key):
+        """
+        The most expensive functions of the key
+        :returns: list of (own, cumulative, calls or None, function), times in seconds for 'cprofile', samples otherwise
+        """
+        _stats = self._stats.get(key)
+
+        if not _stats:
+            return list()
+
+        _functions = list()
+
+        if self._sampler is None:
+            for ((_file, _line, _name), (_cc, _nc, _tt, _ct, _callers)) in _stats.stats.items():
+                _functions.append((_tt, _ct, _nc, '%s (%s:%d)' % (_name, os.path.basename(_file), _line)))
+        else:
+            _own = dict()
+            _cumulative = dict()
+
+            for (_stack, _samples) in _stats.items():
+                _own[_stack[-1]] = _own.get(_stack[-1], 0) + _samples
+
+                # recursive function is counted once per sample
+                for _function in set(_stack):
+                    _cumulative[_function] = _cumulative.get(_function, 0) + _samples
+
+            _functions = [(_own.get(_function, 0), _samples, None, _function)
+                          for (_function, _samples) in _cumulative.items()]
+
+        return sorted(_functions, key=lambda _x: (-_x[0], -_x[1]))[:self.top]
+
+    def report(self):
+        """
+        Build report text
+        :returns: str
+        """
+        self._report_requested = False
+        self._reported_at = self._messages
+        _lines = ["CPU profile (%s, %d messages):" % (self.method, self._messages)]
+
+        for (_key, (_messages, _wall, _cpu)) in sorted(self._times.items(), key=lambda _x: -_x[1][2]):
+            _lines.append("  %s: %d messages, %.3f s wall, %.3f s CPU, %.6f s CPU per message" %
+                          (_key, _messages, _wall, _cpu, _cpu / _messages))
+
+            for (_own, _cumulative, _calls, _function) in self._top_functions(_key):
+                if _calls is None:
+                    _lines.append("    %8d %8d samples  %s" % (_own, _cumulative, _function))
+                else:
+                    _lines.append("    %10.6f %10.6f s %8d calls  %s" % (_own, _cumulative, _calls, _function))
+
+        return '\n'.join(_lines)
+
+    def dump(self):
+        """
+        Write stats to output file if it is set
+        :returns: path written, None if output is not set
+        """
+        if not self.output:
+            return None
+
+        _path = self.output.replace('{pid}', str(os.getpid()))
+
+        if self._sampler is None:
+            import pstats
+            _all = pstats.Stats()
+
+            for (_key, _stats) in self._stats.items():
+                _stats.dump_stats('%s.%s' % (_path, re.sub(r'[^\w.-]', '_', _key)))
+                _all.add(_stats)
+
+            _all.dump_stats(_path + '.tmp')
+        else:
+            with open(_path + '.tmp', 'w') as _file:
+                for (_key, _stacks) in sorted(self._stats.items()):
+                    for (_stack, _samples) in _stacks.items():
+                        _file.write('%s %d\n' % (';'.join((_key,) + _stack), _samples))
+
+        # readers never see a file half-written
+        os.replace(_path + '.tmp', _path)
+        return _path
+
+    def log_report(self, force=False):
+        """
+        Log report and write output if it is due
+        :param force: do it anyway
+        :type force: boolean
+        :returns: boolean, report is written
+        """
+        if not force and not self.report_due():
+            return False
+
+        logging.info(self.report())
+
+        try:
+            _path = self.dump()
+        except (OSError, TypeError) as e:
+            logging.error("Unable to write CPU profile: %s", e)
+        else:
+            if _path:
+                logging.info("CPU profile is written to %s", _path)
+
+        return True
+
+    def close(self):
+        """
+        Stop sampling thread
+        """
+        if self._sampler is not None:
+            self._sampler.stop()
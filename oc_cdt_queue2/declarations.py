@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+import json
+
+"""
+Queues topology declarations bookkeeping
+"""
+
+
+class DeclarationCache(object):
+    """
+    Declarations confirmed by brokers: used to skip re-declaring the same topology on reconnect.
+    Declaration is a (channel method name, keyword arguments) pair, it is stored as a text key
+    so the keys may be passed between processes safely.
+    """
+
+    def __init__(self):
+        # broker key: set of declaration keys
+        self._confirmed = dict()
+
+    @staticmethod
+    def broker_key(params):
+        """
+        Broker identity for connection parameters given
+        :param params: connection parameters
+        :type params: pika.URLParameters
+        :returns: str
+        """
+        return '%s:%s/%s' % (params.host, params.port, params.virtual_host)
+
+    @staticmethod
+    def declaration_key(method, kwargs):
+        """
+        Key for a declaration
+        :param method: channel method name, e.g. 'queue_declare'
+        :type method: str
+        :param kwargs: method arguments, callback is ignored
+        :type kwargs: dict
+        :returns: str
+        """
+        _kwargs = dict((_k, _v) for _k, _v in kwargs.items() if _k != 'callback')
+        return '%s:%s' % (method, json.dumps(_kwargs, sort_keys=True, default=str))
+
+    @classmethod
+    def topology_keys(cls, topology):
+        """
+        Keys for all declarations of a topology
+        :param topology: list of (method, kwargs) pairs
+        :returns: frozenset
+        """
+        return frozenset(cls.declaration_key(_method, _kwargs) for (_method, _kwargs) in topology)
+
+    def confirmed(self, params):
+        """
+        Declaration keys confirmed by the broker
+        :param params: connection parameters
+        :type params: pika.URLParameters
+        :returns: frozenset
+        """
+        return frozenset(self._confirmed.get(self.broker_key(params), frozenset()))
+
+    def is_confirmed(self, params, keys):
+        """
+        Check all the declarations given were confirmed by the broker
+        :param params: connection parameters
+        :type params: pika.URLParameters
+        :param keys: declaration keys
+        :type keys: iterable
+        :returns: boolean
+        """
+        return self._confirmed.get(self.broker_key(params), set()).issuperset(keys)
+
+    def add(self, params, keys):
+        """
+        Remember declarations confirmed by the broker
+        :param params: connection parameters
+        :type params: pika.URLParameters
+        :param keys: declaration keys
+        :type keys: iterable
+        """
+        self._confirmed.setdefault(self.broker_key(params), set()).update(keys)
+
+    def forget(self, params=None):
+        """
+        Forget declarations for the broker given, or for all brokers.
+        To be called when topology may be changed outside: queue deleted, arguments mismatch
+        :param params: connection parameters, None for all brokers
+        :type params: pika.URLParameters
+        """
+        if params is None:
+            self._confirmed = dict()
+            return
+
+        self._confirmed.pop(self.broker_key(params), None)
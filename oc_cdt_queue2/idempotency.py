@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+import collections
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import time
+
+"""
+Cache of processed messages keys used to skip duplicate deliveries
+"""
+
+
+class IdempotencyCache(object):
+    """
+    Bounded LRU cache of processed message keys with optional expiration.
+    May be persisted to a memory-mapped file to survive restarts:
+    the file is a ring of last 'size' keys added (not touched), so it never grows.
+    Keys are stored as 16-byte digests.
+    """
+
+    _magic = b'OCIDEMP1'
+    _header = struct.Struct('<8sII')    # magic, size, next record position
+    _record = struct.Struct('<16sd')    # key digest, time added
+
+    def __init__(self, size, ttl=0, path=None):
+        """
+        Main initialization
+        :param size: max keys number to keep
+        :type size: int
+        :param ttl: seconds to keep a key, 0 for no expiration
+        :type ttl: float
+        :param path: file to persist keys to, None to keep them in memory only
+        :type path: str
+        """
+        if size < 1:
+            raise ValueError("Cache size should be positive")
+
+        self.size = size
+        self.ttl = ttl
+        self._keys = collections.OrderedDict()
+        self._file = None
+        self._mmap = None
+        self._position = 0
+
+        if path:
+            self._open(path)
+
+    @staticmethod
+    def digest(key):
+        """
+        Convert key to the fixed-size form it is stored in
+        :param key: message key
+        :type key: str or bytes
+        :returns: bytes
+        """
+        if not isinstance(key, bytes):
+            key = str(key).encode('utf-8')
+
+        return hashlib.blake2b(key, digest_size=16).digest()
+
+    def _expired(self, added, now):
+        return self.ttl > 0 and now - added > self.ttl
+
+    def _open(self, path):
+        """
+        Open or create persistence file and load keys from it
+        """
+        _length = self._header.size + self._record.size * self.size
+        _exists = os.path.exists(path) and os.path.getsize(path) == _length
+        self._file = open(path, 'r+b' if _exists else 'w+b')
+
+        if not _exists:
+            self._file.truncate(_length)
+
+        self._mmap = mmap.mmap(self._file.fileno(), _length)
+        (_magic, _size, _position) = self._header.unpack_from(self._mmap, 0)
+
+        if _magic != self._magic or _size != self.size:
+            logging.debug("Initializing idempotency cache file %s", path)
+            self._mmap[:] = b'\x00' * _length
+            self._header.pack_into(self._mmap, 0, self._magic, self.size, 0)
+            return
+
+        self._position = _position % self.size
+        _now = time.time()
+
+        # load from the oldest record to the newest one
+        for _index in list(range(self._position, self.size)) + list(range(0, self._position)):
+            (_digest, _added) = self._record.unpack_from(self._mmap, self._header.size + self._record.size * _index)
+
+            if _added and not self._expired(_added, _now):
+                self._keys[_digest] = _added
+
+        logging.debug("Loaded %d keys from idempotency cache file %s", len(self._keys), path)
+
+    def _persist(self, digest, added):
+        """
+        Write the key to the next ring position
+        """
+        self._record.pack_into(self._mmap, self._header.size + self._record.size * self._position, digest, added)
+        self._position = (self._position + 1) % self.size
+        self._header.pack_into(self._mmap, 0, self._magic, self.size, self._position)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        _digest = self.digest(key)
+        _added = self._keys.get(_digest)
+
+        if _added is None:
+            return False
+
+        if self._expired(_added, time.time()):
+            del self._keys[_digest]
+            return False
+
+        self._keys.move_to_end(_digest)
+        return True
+
+    def add(self, key):
+        """
+        Remember the key as processed
+        :param key: message key
+        :type key: str or bytes
+        """
+        _digest = self.digest(key)
+        _added = time.time()
+        self._keys[_digest] = _added
+        self._keys.move_to_end(_digest)
+
+        while len(self._keys) > self.size:
+            self._keys.popitem(last=False)
+
+        if self._mmap is not None:
+            self._persist(_digest, _added)
+
+    def close(self):
+        """
+        Flush and close persistence file if any
+        """
+        if self._mmap is not None:
+            self._mmap.flush()
+            self._mmap.close()
+            self._mmap = None
+
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+import argparse
+import subprocess
+import sys
+
+"""
+Import time report.
+Runs 'python -X importtime' for a module in a clean interpreter
+and summarizes time spent in this package own modules and in its dependencies.
+Run as: python -m oc_cdt_queue2.importtime [module ...]
+"""
+
+_package = 'oc_cdt_queue2'
+
+
+def measure(module):
+    """
+    Import module in a separate interpreter and collect '-X importtime' records
+
+    :param module: absolute module name
+    :type module: str
+    :returns: list of (module name, nesting depth, self microseconds, cumulative microseconds),
+              in import finish order
+    :raises subprocess.CalledProcessError: if import fails
+    """
+    _proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import %s' % module],
+                           stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    _records = list()
+
+    for _line in _proc.stderr.splitlines():
+        if not _line.startswith('import time:'):
+            continue
+
+        _fields = _line[len('import time:'):].split('|')
+
+        if len(_fields) != 3 or not _fields[0].strip().isdigit():
+            # table header
+            continue
+
+        # nested imports are indented by two spaces per level
+        _name = _fields[2].rstrip()
+        _depth = (len(_name) - len(_name.lstrip()) - 1) // 2
+        _records.append((_name.strip(), _depth, int(_fields[0]), int(_fields[1])))
+
+    return _records
+
+
+def summary(records):
+    """
+    Split import time between this package and everything else
+
+    :param records: result of measure()
+    :returns: dict with 'own' and 'total' microseconds, 'modules' - own modules self times
+              and 'dependencies' - cumulative times of top-level modules imported by own ones
+    """
+    _own = dict()
+    _dependencies = dict()
+    _total = 0
+    # is module on each nesting level own one
+    _stack = list()
+
+    # records come in import finish order, so the nested ones go before their importer;
+    # walk backwards to know whom a module was imported by
+    for (_name, _depth, _self, _cumulative) in reversed(records):
+        _total += _self
+        _is_own = _name == _package or _name.startswith(_package + '.')
+        del _stack[_depth:]
+
+        if _is_own:
+            _own[_name] = _self
+        elif _depth > 0 and _stack[-1]:
+            _dependencies[_name] = _dependencies.get(_name, 0) + _cumulative
+
+        _stack.append(_is_own)
+
+    return {'own': sum(_own.values()), 'total': _total, 'modules': _own, 'dependencies': _dependencies}
+
+
+def main(cmdline=None):
+    """
+    Command-line entry point
+
+    :param cmdline: Command line parameters array for debug purposes
+    :returns: return code for exit()
+    """
+    _parser = argparse.ArgumentParser(description='Report import time of %s modules' % _package)
+    _parser.add_argument('modules', nargs='*', default=['%s.queue_client' % _package],
+                         help='Modules to import, default is %(default)s')
+    _args = _parser.parse_args(cmdline)
+
+    for _module in _args.modules:
+        _summary = summary(measure(_module))
+        print("%s: total %.1f ms, own modules %.1f ms" % (_module, _summary['total'] / 1000.0, _summary['own'] / 1000.0))
+
+        for _name, _time in sorted(_summary['modules'].items(), key=lambda _x: -_x[1]):
+            print("    %-50s %8.1f ms" % (_name, _time / 1000.0))
+
+        for _name, _time in sorted(_summary['dependencies'].items(), key=lambda _x: -_x[1]):
+            print("    [dep] %-44s %8.1f ms" % (_name, _time / 1000.0))
+
+    return 0
+
+
+if __name__ == '__main__':
+    exit(main())
@@ -34,7 +34,8 @@ class IpcMessage(object):
     Helper class to excnange messages between processes
     """
 
-    def __init__(self, delivery_tag, properties, body):
+    def __init__(self, delivery_tag, properties, body, redelivered=False, exchange=None, routing_key=None,
+                 inflight=0, inflight_bytes=0, paused=False, queue=None, received=None):
         """
         Main initialization
         :param delivery_tag: delivery tag
@@ -43,10 +44,34 @@ class IpcMessage(object):
         :type properties: pika.Spec.BasicProperties
         :param body: message body
         :type body: bytes
+        :param redelivered: message was delivered before but not acknowledged
+        :type redelivered: boolean
+        :param exchange: exchange the message was published to
+        :type exchange: str
+        :param routing_key: routing key the message was published with
+        :type routing_key: str
+        :param inflight: messages passed to the worker and not reported back yet, this one included
+        :type inflight: int
+        :param inflight_bytes: total body size of those messages
+        :type inflight_bytes: int
+        :param paused: consuming is paused since in-flight limits are reached
+        :type paused: boolean
+        :param queue: queue the message was consumed from, if known
+        :type queue: str
+        :param received: time the message was received from the broker, seconds since epoch
+        :type received: float
         """
         self.delivery_tag = delivery_tag
         self.properties = properties
         self.body = body
+        self.redelivered = redelivered
+        self.exchange = exchange
+        self.routing_key = routing_key
+        self.inflight = inflight
+        self.inflight_bytes = inflight_bytes
+        self.paused = paused
+        self.queue = queue
+        self.received = received
 
 
 class IpcMessageResult(object):
@@ -54,7 +79,8 @@ class IpcMessageResult(object):
     Helper class to set message processing result
     """
 
-    def __init__(self, delivery_tag, ack, requeue, time_delta=0):
+    def __init__(self, delivery_tag, ack, requeue, time_delta=0, retry_queue=None, retry_count=0, multiple=False,
+                 reported=None):
         """
         Main initialization
         :param delivery_tag: the message delivery tag
@@ -65,8 +91,71 @@ class IpcMessageResult(object):
         :type requeue: boolean
         :param time_delta:
         :type time_delta: float
+        :param retry_queue: re-publish the message to this delayed retry queue instead of nack
+        :type retry_queue: str
+        :param retry_count: retries number to set in re-published message headers
+        :type retry_count: int
+        :param multiple: ack all unacknowledged messages up to the delivery tag
+        :type multiple: boolean
+        :param reported: time the result was reported, seconds since epoch. Set to get acknowledgement latency back
+        :type reported: float
         """
         self.delivery_tag = delivery_tag
         self.ack = ack
         self.requeue = requeue
         self.time_delta = time_delta
+        self.retry_queue = retry_queue
+        self.retry_count = retry_count
+        self.multiple = multiple
+        self.reported = reported
+
+
+class IpcDeclared(object):
+    """
+    Helper class to report declarations confirmed by the broker
+    """
+
+    def __init__(self, keys):
+        """
+        Main initialization
+        :param keys: declaration keys, see DeclarationCache
+        :type keys: frozenset
+        """
+        self.keys = keys
+
+
+class IpcLatency(object):
+    """
+    Helper class to report acknowledgement latency back
+    """
+
+    def __init__(self, samples):
+        """
+        Main initialization
+        :param samples: (queue, seconds from result reported to acknowledgement sent) for each result
+        :type samples: list
+        """
+        self.samples = samples
+
+
+class IpcQueueStats(object):
+    """
+    Helper class to report queue depth probed by passive declaration
+    """
+
+    def __init__(self, queue, messages, consumers, probed):
+        """
+        Main initialization
+        :param queue: queue name
+        :type queue: str
+        :param messages: messages ready for delivery
+        :type messages: int
+        :param consumers: consumers of the queue
+        :type consumers: int
+        :param probed: time of the probe, seconds since epoch
+        :type probed: float
+        """
+        self.queue = queue
+        self.messages = messages
+        self.consumers = consumers
+        self.probed = probed
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+
+import codecs
+import json
+import re
+
+"""
+Incremental decoding of large JSON arrays: elements are decoded one by one while iterating
+"""
+
+_whitespace = re.compile(r'[ \t\n\r]*')
+# characters a number may go on with: one decoded at the end of the window may be a part of a longer one
+_number_chars = frozenset('0123456789.eE+-')
+# top-level array start of UTF-8 body, with byte order mark json.loads() accepts also
+_array_start = re.compile(b'(?:\xef\xbb\xbf)?[ \t\n\r]*\\[')
+_array_start_text = re.compile(r'[ \t\n\r]*\[')
+
+
+def is_json_array(body):
+    """
+    Check if JSON body is an array without decoding it
+    :param body: message body
+    :type body: bytes or str
+    :returns: boolean
+    """
+    return (_array_start_text if isinstance(body, str) else _array_start).match(body) is not None
+
+
+def _text_chunks(data, chunk_size):
+    """
+    Text of data in chunks, decoded from UTF-8 if it is bytes
+    """
+    if isinstance(data, str):
+        for _start in range(0, len(data), chunk_size):
+            yield data[_start:_start + chunk_size]
+
+        return
+
+    # multibyte characters split between chunks are kept by decoder till the next one
+    _decoder = codecs.getincrementaldecoder('utf-8-sig')()
+
+    for _start in range(0, len(data), chunk_size):
+        _text = _decoder.decode(data[_start:_start + chunk_size])
+
+        if _text:
+            yield _text
+
+    _decoder.decode(b'', final=True)
+
+
+class JsonArrayStream(object):
+    """
+    Decodes JSON array element by element with JSONDecoder.raw_decode() over a window of text: memory used
+    depends on the size of an element, not of the whole array. Iterating gives elements of the top-level array,
+    next_array() allows reading a nested one the same way.
+    Malformed JSON raises ValueError when the element it is in is reached.
+    """
+
+    def __init__(self, data, chunk_size=65536):
+        """
+        Main initialization
+        :param data: JSON text, UTF-8 encoded if bytes
+        :type data: bytes or str
+        :param chunk_size: text is decoded by this number of bytes (characters for str)
+        :type chunk_size: int
+        """
+        if chunk_size <= 0:
+            raise ValueError("Chunk size should be positive")
+
+        self.data = data
+        self.chunk_size = chunk_size
+        self._chunks = _text_chunks(data, chunk_size)
+        self._exhausted = False
+        self._buffer = ''
+        self._position = 0
+        self._started = False
+        # for every array entered: whether an element of it is read already
+        self._levels = list()
+        self._decoder = json.JSONDecoder()
+
+    def reopen(self):
+        """
+        Stream reading the same data from the start
+        :returns: JsonArrayStream
+        """
+        return JsonArrayStream(self.data, chunk_size=self.chunk_size)
+
+    def _read(self):
+        """
+        Append at least a chunk of text to the window, and not less than its unconsumed part:
+        an element not fitting the window is retried with it doubled.
+        :returns: boolean, anything is read
+        """
+        if self._exhausted:
+            return False
+
+        _wanted = max(self.chunk_size, len(self._buffer) - self._position)
+        _parts = [self._buffer[self._position:]]
+        _read = 0
+
+        while _read < _wanted:
+            _text = next(self._chunks, None)
+
+            if _text is None:
+                self._exhausted = True
+                break
+
+            _parts.append(_text)
+            _read += len(_text)
+
+        self._buffer = ''.join(_parts)
+        self._position = 0
+        return _read > 0
+
+    def _peek(self):
+        """
+        Skip whitespace
+        :returns: the next character, '' at the end of data
+        """
+        while True:
+            self._position = _whitespace.match(self._buffer, self._position).end()
+
+            if self._position < len(self._buffer):
+                return self._buffer[self._position]
+
+            if not self._read():
+                return ''
+
+    def _decode(self):
+        """
+        Decode value at the current position
+        """
+        self._peek()
+
+        while True:
+            try:
+                (_value, _end) = self._decoder.raw_decode(self._buffer, self._position)
+            except ValueError:
+                if self._exhausted:
+                    raise
+            else:
+                if self._exhausted or (_end < len(self._buffer) and self._buffer[_end] not in _number_chars):
+                    self._position = _end
+                    return _value
+
+            self._read()
+
+    def _enter(self):
+        """
+        Enter array at the current position
+        """
+        if self._peek() != '[':
+            raise ValueError("JSON array expected at %d" % self._position)
+
+        self._position += 1
+        self._levels.append(False)
+
+    def _next(self):
+        """
+        Move to the next element of the current array
+        :returns: boolean, False if the array is over: it is left then
+        """
+        if not self._started:
+            self._started = True
+            self._enter()
+
+        if not self._levels:
+            return False
+
+        _char = self._peek()
+
+        if not _char:
+            raise ValueError("Unterminated JSON array")
+
+        if _char == ']':
+            self._position += 1
+            self._levels.pop()
+
+            if not self._levels and self._peek():
+                raise ValueError("Extra data after JSON array")
+
+            return False
+
+        if self._levels[-1]:
+            if _char != ',':
+                raise ValueError("Expecting ',' delimiter in JSON array at %d" % self._position)
+
+            self._position += 1
+        else:
+            self._levels[-1] = True
+
+        return True
+
+    def items(self):
+        """
+        Elements of the current array: the top-level one or the one entered with next_array()
+        :returns: generator
+        """
+        while self._next():
+            yield self._decode()
+
+    def __iter__(self):
+        return self.items()
+
+    def next_value(self):
+        """
+        Decode the next element of the current array
+        :returns: element value
+        :raises ValueError: if the array is over
+        """
+        if not self._next():
+            raise ValueError("JSON array has no more elements")
+
+        return self._decode()
+
+    def next_array(self):
+        """
+        Enter the next element of the current array, which should be an array itself
+        :returns: generator of its elements, see items()
+        :raises ValueError: if the array is over or the element is not an array
+        """
+        if not self._next():
+            raise ValueError("JSON array has no more elements")
+
+        self._enter()
+        return self.items()
+
+
+def iter_json_array(data, chunk_size=65536):
+    """
+    Elements of JSON array decoded one by one
+    :param data: JSON text, UTF-8 encoded if bytes
+    :type data: bytes or str
+    :param chunk_size: see JsonArrayStream
+    :type chunk_size: int
+    :returns: generator
+    """
+    return JsonArrayStream(data, chunk_size=chunk_size).items()
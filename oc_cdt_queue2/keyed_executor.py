@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+import collections
+import concurrent.futures
+import threading
+
+"""
+Concurrent tasks execution keeping order of tasks with the same key
+"""
+
+
+class KeyedExecutor(object):
+    """
+    Runs tasks on an executor (threads, processes) keeping order of tasks with the same key:
+    a task is passed to the executor when the previous one with its key has finished,
+    tasks with different keys run in parallel. Tasks without key (None) are not ordered.
+    Futures returned are resolved before the next task with the same key starts, so results
+    of the same key are seen in order.
+    """
+
+    def __init__(self, executor, max_keys=0):
+        """
+        Main initialization
+        :param executor: executor to run tasks on
+        :type executor: concurrent.futures.Executor
+        :param max_keys: max number of keys with tasks running or waiting (tasks without key count each), 0 for no limit
+        :type max_keys: int
+        """
+        if max_keys < 0:
+            raise ValueError("Keys limit should not be negative")
+
+        self.executor = executor
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        # key: tasks waiting for the running one, (future, function, args, kwargs)
+        self._waiting = dict()
+        self._unordered = 0
+        self._pending = 0
+
+    @property
+    def pending(self):
+        """
+        Tasks submitted and not finished yet
+        """
+        return self._pending
+
+    @property
+    def active_keys(self):
+        """
+        Keys with tasks running or waiting, tasks without key count each
+        """
+        return len(self._waiting) + self._unordered
+
+    def active(self, key):
+        """
+        There are tasks with the key running or waiting
+        :param key: key to check, None is never active
+        :returns: boolean
+        """
+        return key is not None and key in self._waiting
+
+    def full(self, key=None):
+        """
+        Keys limit is reached: a task with a new key would exceed it
+        :param key: key of the task to be submitted, None to check if any new key is accepted
+        :returns: boolean
+        """
+        if not self.max_keys:
+            return False
+
+        with self._lock:
+            if key is not None and key in self._waiting:
+                return False
+
+            return len(self._waiting) + self._unordered >= self.max_keys
+
+    def submit(self, key, fn, *args, **kwargs):
+        """
+        Schedule a task. Keys limit is not enforced here: check full() before
+        :param key: ordering key, None for task not ordered with others
+        :param fn: callable to run
+        :returns: concurrent.futures.Future
+        """
+        _future = concurrent.futures.Future()
+
+        with self._lock:
+            self._pending += 1
+
+            if key is None:
+                self._unordered += 1
+            elif key in self._waiting:
+                self._waiting[key].append((_future, fn, args, kwargs))
+                return _future
+            else:
+                self._waiting[key] = collections.deque()
+
+        self._start(key, _future, fn, args, kwargs)
+        return _future
+
+    def _start(self, key, future, fn, args, kwargs):
+        """
+        Pass task to the executor
+        """
+        future.set_running_or_notify_cancel()
+
+        try:
+            _inner = self.executor.submit(fn, *args, **kwargs)
+        except Exception as e:
+            _inner = concurrent.futures.Future()
+            _inner.set_exception(e)
+
+        _inner.add_done_callback(lambda _inner: self._done(key, future, _inner))
+
+    def _done(self, key, future, inner):
+        """
+        Task finished: resolve its future and start the next task with the same key
+        """
+        _exception = inner.exception()
+
+        if _exception is None:
+            future.set_result(inner.result())
+        else:
+            future.set_exception(_exception)
+
+        _next = None
+
+        with self._lock:
+            self._pending -= 1
+
+            if key is None:
+                self._unordered -= 1
+            elif self._waiting[key]:
+                _next = self._waiting[key].popleft()
+            else:
+                del self._waiting[key]
+
+        if _next is not None:
+            self._start(key, *_next)
+
+    def shutdown(self, wait=True):
+        """
+        Shut the executor down
+        :param wait: wait for the tasks running to finish
+        """
+        self.executor.shutdown(wait=wait)
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+
+import bisect
+import threading
+
+"""
+Latency histograms of message processing stages
+"""
+
+
+class Histogram(object):
+    """
+    Histogram of durations with logarithmic buckets: four per power of two from 10 microseconds to about 5 minutes,
+    so percentiles are estimated within 19% of the value with fixed memory.
+    """
+
+    bounds = [0.00001 * 2 ** (_index / 4.0) for _index in range(0, 100)]   # bucket upper bounds, seconds
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+        # the last one is for values above all bounds
+        self._buckets = [0] * (len(self.bounds) + 1)
+
+    def record(self, value):
+        """
+        Add a duration
+        :param value: seconds
+        :type value: float
+        """
+        value = max(0.0, value)
+        self._buckets[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+        if self.min is None or value < self.min:
+            self.min = value
+
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """
+        Add durations of another histogram
+        :param other: histogram to add
+        :type other: Histogram
+        """
+        if not other.count:
+            return
+
+        self._buckets = [_own + _other for (_own, _other) in zip(self._buckets, other._buckets)]
+        self.count += other.count
+        self.sum += other.sum
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+
+    def percentile(self, percent):
+        """
+        Estimate a percentile: upper bound of the bucket it falls to, not more than the maximum seen
+        :param percent: 0 to 100
+        :type percent: float
+        :returns: seconds, None if there are no values
+        """
+        if not self.count:
+            return None
+
+        _rank = max(1, percent * self.count / 100.0)
+        _seen = 0
+
+        for (_index, _count) in enumerate(self._buckets):
+            _seen += _count
+
+            if _seen >= _rank:
+                break
+
+        return min(self.bounds[_index], self.max) if _index < len(self.bounds) else self.max
+
+    def as_dict(self):
+        """
+        Summary and non-empty buckets, for reporting
+        :returns: dict
+        """
+        return {'count': self.count,
+                'sum': self.sum,
+                'min': self.min,
+                'max': self.max,
+                'p50': self.percentile(50),
+                'p90': self.percentile(90),
+                'p99': self.percentile(99),
+                'buckets': dict((self.bounds[_index] if _index < len(self.bounds) else float('inf'), _count)
+                                for (_index, _count) in enumerate(self._buckets) if _count)}
+
+
+class LatencyStats(object):
+    """
+    Histograms of message processing stages durations by label: queue or published function name.
+    Thread-safe, so it may be reported from another thread.
+    """
+
+    stages = ('queue_wait', 'ipc', 'handler', 'ack')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (stage, label): Histogram
+        self._histograms = dict()
+
+    def record(self, stage, label, value):
+        """
+        Add a duration
+        :param stage: processing stage, see stages
+        :type stage: str
+        :param label: queue or published function name
+        :type label: str
+        :param value: seconds
+        :type value: float
+        """
+        with self._lock:
+            _histogram = self._histograms.get((stage, label))
+
+            if _histogram is None:
+                _histogram = self._histograms[(stage, label)] = Histogram()
+
+            _histogram.record(value)
+
+    def snapshot(self):
+        """
+        Current histograms
+        :returns: {stage: {label: Histogram.as_dict()}}
+        """
+        _result = dict()
+
+        with self._lock:
+            for ((_stage, _label), _histogram) in self._histograms.items():
+                _result.setdefault(_stage, dict())[_label] = _histogram.as_dict()
+
+        return _result
+
+    def report(self):
+        """
+        Human-readable report: a line per stage and label
+        :returns: list of str
+        """
+        _lines = list()
+
+        with self._lock:
+            for ((_stage, _label), _histogram) in sorted(self._histograms.items(),
+                                                          key=lambda _x: (self.stages.index(_x[0][0]), str(_x[0][1]))):
+                _lines.append("%s %s: count %d avg %.6f p50 %.6f p90 %.6f p99 %.6f max %.6f" % (
+                    _stage, _label, _histogram.count, _histogram.sum / _histogram.count,
+                    _histogram.percentile(50), _histogram.percentile(90), _histogram.percentile(99), _histogram.max))
+
+        return _lines
+
+    def reset(self):
+        """
+        Forget all durations
+        """
+        with self._lock:
+            self._histograms = dict()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+
+import importlib
+import importlib.util
+import sys
+
+"""
+Helpers for deferring heavy imports until the first use
+"""
+
+
+def lazy_import(name):
+    """
+    Get module object which is actually loaded on the first attribute access.
+    Already imported module is returned as is.
+
+    :param name: absolute module name
+    :returns: module
+    :raises ImportError: if there is no such module
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+
+    _spec = importlib.util.find_spec(name)
+
+    if _spec is None:
+        raise ImportError("No module named %s" % name)
+
+    _loader = importlib.util.LazyLoader(_spec.loader)
+    _spec.loader = _loader
+    _module = importlib.util.module_from_spec(_spec)
+    sys.modules[name] = _module
+    _loader.exec_module(_module)
+    return _module
+
+
+class LazyAttribute(object):
+    """
+    Class attribute taken from a module on the first access.
+    May be re-defined in subclasses or instances as a usual class attribute.
+    """
+
+    def __init__(self, module, name):
+        """
+        :param module: absolute module name
+        :param name: attribute name in the module
+        """
+        self.module = module
+        self.name = name
+
+    def __get__(self, instance, owner):
+        return getattr(importlib.import_module(self.module), self.name)
@@ -0,0 +1,1378 @@
+#!/usr/bin/env python
+
+import argparse
+import asyncio
+import collections
+import copy
+import datetime
+import logging
+import struct
+import threading
+import uuid
+from pika import frame as amqp_frame
+from pika import spec
+
+"""
+Local AMQP 0-9-1 broker for load testing without RabbitMQ server.
+Implements the subset of the protocol this library uses: exchanges (direct, fanout, topic, headers) and queues
+declaration, bindings, qos, consuming and getting, publishing with confirms and transactions, acknowledgements,
+requeueing with redelivery, queue priorities, message TTL and dead-lettering with 'x-death' headers.
+Everything is kept in memory of a single process; credentials and virtual hosts are not checked.
+Run as: python -m oc_cdt_queue2.local_broker [--host 127.0.0.1] [--port 5672]
+"""
+
+
+class _AmqpError(Exception):
+    """
+    Protocol exception to be reported with Channel.Close or Connection.Close
+    """
+    channel_level = True
+
+    def __init__(self, reply_code, reply_text):
+        super(_AmqpError, self).__init__(reply_code, reply_text)
+        self.reply_code = reply_code
+        self.reply_text = reply_text
+
+
+class _ConnectionError(_AmqpError):
+    channel_level = False
+
+
+class _Message(object):
+    """
+    Message kept in a queue or waiting for acknowledgement
+    """
+    __slots__ = ('exchange', 'routing_key', 'properties', 'body', 'redelivered', 'expires', 'priority', '_header')
+
+    def __init__(self, exchange, routing_key, properties, body, expires=None, priority=0):
+        self.exchange = exchange
+        self.routing_key = routing_key
+        self.properties = properties
+        self.body = body
+        self.redelivered = False
+        self.expires = expires
+        self.priority = priority
+        self._header = None
+
+    def header_payload(self):
+        """
+        Content header frame payload, encoded once for all deliveries
+        """
+        if self._header is None:
+            self._header = struct.pack('>HxxQ', spec.BasicProperties.INDEX, len(self.body)) + \
+                b''.join(self.properties.encode())
+
+        return self._header
+
+
+class _Queue(object):
+    """
+    Queue with priority levels, consumers are served in turn
+    """
+
+    def __init__(self, name, durable=False, exclusive=None, auto_delete=False, arguments=None):
+        """
+        Main initialization
+        :param exclusive: connection owning the queue, None for shared one
+        :raises: _AmqpError on invalid arguments
+        """
+        self.name = name
+        self.durable = durable
+        self.exclusive = exclusive
+        self.auto_delete = auto_delete
+        self.arguments = dict(arguments or dict())
+        self.max_priority = self._argument('x-max-priority', int, 0, 255) or 0
+        self.ttl = self._argument('x-message-ttl', int, 0)
+        self.dead_letter_exchange = self._argument('x-dead-letter-exchange', str)
+        self.dead_letter_routing_key = self._argument('x-dead-letter-routing-key', str)
+        self._levels = [collections.deque() for _level in range(0, self.max_priority + 1)]
+        self._length = 0
+        self.consumers = collections.deque()
+        self.had_consumers = False
+        self.unacked = 0
+        self.deleted = False
+        # expiration timer of the head message and its time
+        self.timer = None
+        self.timer_at = None
+
+    def _argument(self, name, kind, minimum=None, maximum=None):
+        _value = self.arguments.get(name)
+
+        if _value is None:
+            return None
+
+        if isinstance(_value, bytes):
+            _value = _value.decode('utf-8')
+
+        if not isinstance(_value, kind) or isinstance(_value, bool) or \
+                (minimum is not None and _value < minimum) or (maximum is not None and _value > maximum):
+            raise _AmqpError(406, "PRECONDITION_FAILED - invalid arg '%s' for queue '%s': %r" % (name, self.name, _value))
+
+        return _value
+
+    def __len__(self):
+        return self._length
+
+    def put(self, message, front=False):
+        _level = self._levels[min(message.priority, self.max_priority)]
+
+        if front:
+            _level.appendleft(message)
+        else:
+            _level.append(message)
+
+        self._length += 1
+
+    def head(self):
+        for _level in reversed(self._levels):
+            if _level:
+                return _level[0]
+
+        return None
+
+    def get(self):
+        for _level in reversed(self._levels):
+            if _level:
+                self._length -= 1
+                return _level.popleft()
+
+        return None
+
+    def purge(self):
+        _count = self._length
+        self._levels = [collections.deque() for _level in self._levels]
+        self._length = 0
+        return _count
+
+    def equivalent(self, durable, auto_delete, arguments):
+        """
+        Check declaration of existing queue
+        :raises: _AmqpError if it differs
+        """
+        if durable != self.durable or auto_delete != self.auto_delete:
+            raise _AmqpError(406, "PRECONDITION_FAILED - inequivalent arg 'durable' or 'auto_delete' for queue '%s'"
+                             % self.name)
+
+        _arguments = dict(arguments or dict())
+
+        for _name in sorted(set(_arguments) | set(self.arguments)):
+            if _arguments.get(_name) != self.arguments.get(_name):
+                raise _AmqpError(406, "PRECONDITION_FAILED - inequivalent arg '%s' for queue '%s': "
+                                      "received %r but current is %r" %
+                                 (_name, self.name, _arguments.get(_name), self.arguments.get(_name)))
+
+
+class _Exchange(object):
+    """
+    Exchange with its bindings
+    """
+
+    types = ('direct', 'fanout', 'topic', 'headers')
+
+    def __init__(self, name, exchange_type='direct', durable=False, auto_delete=False, internal=False, arguments=None):
+        self.name = name
+        self.type = exchange_type
+        self.durable = durable
+        self.auto_delete = auto_delete
+        self.internal = internal
+        self.arguments = dict(arguments or dict())
+        # (queue, routing key, sorted arguments items): arguments
+        self.bindings = dict()
+        # routing key: queues, for direct exchanges
+        self._direct = collections.defaultdict(set)
+
+    def equivalent(self, exchange_type, durable, auto_delete, internal, arguments):
+        if (exchange_type, durable, auto_delete, internal, dict(arguments or dict())) != \
+                (self.type, self.durable, self.auto_delete, self.internal, self.arguments):
+            raise _AmqpError(406, "PRECONDITION_FAILED - inequivalent declaration of exchange '%s'" % self.name)
+
+    @staticmethod
+    def _key(queue, routing_key, arguments):
+        return (queue, routing_key, tuple(sorted((arguments or dict()).items(), key=lambda _x: _x[0])))
+
+    def bind(self, queue, routing_key, arguments=None):
+        self.bindings[self._key(queue, routing_key, arguments)] = dict(arguments or dict())
+        self._direct[routing_key].add(queue)
+
+    def unbind(self, queue, routing_key, arguments=None):
+        self.bindings.pop(self._key(queue, routing_key, arguments), None)
+
+        if not any(_key[0] == queue and _key[1] == routing_key for _key in self.bindings):
+            self._direct[routing_key].discard(queue)
+
+    def unbind_queue(self, queue):
+        for _key in [_key for _key in self.bindings if _key[0] == queue]:
+            self.unbind(*_key[:2], arguments=self.bindings[_key])
+
+    @staticmethod
+    def _topic_match(pattern, words):
+        if not pattern:
+            return not words
+
+        if pattern[0] == '#':
+            return any(_Exchange._topic_match(pattern[1:], words[_index:]) for _index in range(0, len(words) + 1))
+
+        return bool(words) and pattern[0] in ('*', words[0]) and _Exchange._topic_match(pattern[1:], words[1:])
+
+    @staticmethod
+    def _headers_match(arguments, headers):
+        _expected = dict((_name, _value) for (_name, _value) in arguments.items() if not _name.startswith('x-'))
+        _matches = [_name in headers and headers[_name] == _value for (_name, _value) in _expected.items()]
+
+        if arguments.get('x-match') == 'any':
+            return any(_matches)
+
+        return all(_matches)
+
+    def route(self, routing_key, headers):
+        """
+        Queues the message is to be put to
+        :returns: set of queue names
+        """
+        if self.type == 'direct':
+            return set(self._direct.get(routing_key, ()))
+
+        if self.type == 'fanout':
+            return set(_key[0] for _key in self.bindings)
+
+        if self.type == 'topic':
+            _words = tuple(routing_key.split('.')) if routing_key else tuple()
+            return set(_key[0] for _key in self.bindings if self._topic_match(tuple(_key[1].split('.')), _words))
+
+        return set(_key[0] for (_key, _arguments) in self.bindings.items()
+                   if self._headers_match(_arguments, headers or dict()))
+
+
+class _Consumer(object):
+    __slots__ = ('tag', 'channel', 'queue', 'no_ack', 'exclusive', 'prefetch_count', 'unacked')
+
+    def __init__(self, tag, channel, queue, no_ack, exclusive, prefetch_count):
+        self.tag = tag
+        self.channel = channel
+        self.queue = queue
+        self.no_ack = no_ack
+        self.exclusive = exclusive
+        self.prefetch_count = prefetch_count
+        self.unacked = 0
+
+    def ready(self):
+        """
+        Consumer may take a message: its connection is writable and prefetch limits are not reached
+        """
+        _channel = self.channel
+
+        if _channel.closing or _channel.connection.paused:
+            return False
+
+        if self.no_ack:
+            return True
+
+        return ((not self.prefetch_count or self.unacked < self.prefetch_count) and
+                (not _channel.global_prefetch_count or len(_channel.unacked) < _channel.global_prefetch_count))
+
+
+class _Channel(object):
+    """
+    Channel state: consumers, messages not acknowledged, publishing modes and the message being received
+    """
+
+    def __init__(self, connection, number):
+        self.connection = connection
+        self.number = number
+        self.prefetch_count = 0
+        self.global_prefetch_count = 0
+        # consumer tag: _Consumer
+        self.consumers = dict()
+        # delivery tag: (message, queue name, consumer or None for basic_get)
+        self.unacked = collections.OrderedDict()
+        self.delivery_tag = 0
+        self.confirm = False
+        self.publish_tag = 0
+        # actions postponed until commit in transactional mode, None if it is not set
+        self.transaction = None
+        # Basic.Publish method, properties, body size and fragments of the message being received
+        self.content = None
+        self.closing = False
+
+
+class _AmqpConnection(asyncio.Protocol):
+    """
+    Client connection: frames parsing and protocol methods handling
+    """
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.transport = None
+        self.channels = dict()
+        self.frame_max = broker.frame_max
+        self.heartbeat = 0
+        self.paused = False
+        self.closing = False
+        self._buffer = bytearray()
+        self._heartbeat_timer = None
+        self._received = 0
+        self._handlers = {
+            spec.Connection.StartOk: self._on_start_ok,
+            spec.Connection.TuneOk: self._on_tune_ok,
+            spec.Connection.Open: self._on_connection_open,
+            spec.Connection.Close: self._on_connection_close,
+            spec.Connection.CloseOk: self._on_connection_close_ok,
+            spec.Channel.Close: self._on_channel_close,
+            spec.Channel.CloseOk: self._on_channel_close_ok,
+            spec.Channel.Flow: self._on_channel_flow,
+            spec.Exchange.Declare: self._on_exchange_declare,
+            spec.Exchange.Delete: self._on_exchange_delete,
+            spec.Queue.Declare: self._on_queue_declare,
+            spec.Queue.Bind: self._on_queue_bind,
+            spec.Queue.Unbind: self._on_queue_unbind,
+            spec.Queue.Purge: self._on_queue_purge,
+            spec.Queue.Delete: self._on_queue_delete,
+            spec.Basic.Qos: self._on_basic_qos,
+            spec.Basic.Consume: self._on_basic_consume,
+            spec.Basic.Cancel: self._on_basic_cancel,
+            spec.Basic.Publish: self._on_basic_publish,
+            spec.Basic.Get: self._on_basic_get,
+            spec.Basic.Ack: self._on_basic_ack,
+            spec.Basic.Nack: self._on_basic_nack,
+            spec.Basic.Reject: self._on_basic_reject,
+            spec.Basic.Recover: self._on_basic_recover,
+            spec.Confirm.Select: self._on_confirm_select,
+            spec.Tx.Select: self._on_tx_select,
+            spec.Tx.Commit: self._on_tx_commit,
+            spec.Tx.Rollback: self._on_tx_rollback}
+
+    #### BEG: transport callbacks
+    def connection_made(self, transport):
+        self.transport = transport
+        self.broker.connections.add(self)
+
+    def connection_lost(self, exc):
+        logging.debug("Connection lost: %s", exc)
+        self.broker.connections.discard(self)
+
+        if self._heartbeat_timer is not None:
+            self._heartbeat_timer.cancel()
+            self._heartbeat_timer = None
+
+        for _channel in list(self.channels.values()):
+            self._release_channel(_channel)
+
+        self.channels = dict()
+        self.broker.delete_exclusive_queues(self)
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+
+        for _channel in list(self.channels.values()):
+            for _consumer in list(_channel.consumers.values()):
+                self.broker.dispatch(_consumer.queue)
+
+    def data_received(self, data):
+        self._received += 1
+        self._buffer.extend(data)
+        _position = 0
+        _length = len(self._buffer)
+
+        try:
+            while _length - _position >= 8:
+                if self._buffer[_position:_position + 4] == b'AMQP':
+                    self._on_protocol_header(bytes(self._buffer[_position:_position + 8]))
+                    _position += 8
+                    continue
+
+                (_type, _number, _size) = struct.unpack_from('>BHI', self._buffer, _position)
+                _end = _position + 7 + _size + 1
+
+                if _end > _length:
+                    break
+
+                if _type == spec.FRAME_BODY:
+                    self._on_body(_number, bytes(self._buffer[_position + 7:_end - 1]))
+                else:
+                    self._on_frame(amqp_frame.decode_frame(bytes(self._buffer[_position:_end]))[1])
+
+                _position = _end
+        except _ConnectionError as e:
+            self.close(e.reply_code, e.reply_text)
+        except Exception as e:
+            logging.exception(e)
+            self.close(541, "INTERNAL_ERROR - %s" % e)
+
+        del self._buffer[:_position]
+    #### END: transport callbacks
+
+    #### BEG: frames writing
+    def send_method(self, number, method):
+        self.transport.write(amqp_frame.Method(number, method).marshal())
+
+    def send_content(self, number, method, message):
+        _body = message.body
+        _header = message.header_payload()
+        _pieces = [amqp_frame.Method(number, method).marshal(),
+                   struct.pack('>BHI', spec.FRAME_HEADER, number, len(_header)), _header, b'\xce']
+        _fragment = self.frame_max - 8
+
+        for _offset in range(0, len(_body), _fragment):
+            _chunk = _body[_offset:_offset + _fragment]
+            _pieces.extend((struct.pack('>BHI', spec.FRAME_BODY, number, len(_chunk)), _chunk, b'\xce'))
+
+        self.transport.write(b''.join(_pieces))
+
+    def close(self, reply_code, reply_text, class_id=0, method_id=0):
+        """
+        Close the connection because of an error
+        """
+        if self.closing or self.transport is None:
+            return
+
+        logging.info("Closing connection: %d %s", reply_code, reply_text)
+        self.closing = True
+        self.send_method(0, spec.Connection.Close(reply_code, reply_text, class_id, method_id))
+        # client is to answer with Close-Ok, do not wait for it too long
+        self.broker._loop.call_later(1, self.transport.close)
+
+    def _heartbeat_send(self):
+        if self.transport is None or self.transport.is_closing():
+            return
+
+        if self._received == self._heartbeat_received:
+            self._heartbeat_missed += 1
+
+            if self._heartbeat_missed >= 4:
+                logging.warning("Heartbeats missed, closing connection")
+                self.transport.close()
+                return
+        else:
+            self._heartbeat_missed = 0
+
+        self._heartbeat_received = self._received
+        self.transport.write(amqp_frame.Heartbeat().marshal())
+        self._heartbeat_timer = self.broker._loop.call_later(self.heartbeat / 2.0, self._heartbeat_send)
+    #### END: frames writing
+
+    #### BEG: frames handling
+    def _on_protocol_header(self, data):
+        if data != b'AMQP\x00\x00\x09\x01':
+            self.transport.write(b'AMQP\x00\x00\x09\x01')
+            self.transport.close()
+            return
+
+        _capabilities = {'publisher_confirms': True,
+                         'basic.nack': True,
+                         'consumer_cancel_notify': True,
+                         'per_consumer_qos': True,
+                         'authentication_failure_close': True,
+                         'exchange_exchange_bindings': False,
+                         'connection.blocked': False}
+        self.send_method(0, spec.Connection.Start(
+            server_properties={'product': 'oc-cdt-queue2 local broker', 'capabilities': _capabilities},
+            mechanisms='PLAIN AMQPLAIN', locales='en_US'))
+
+    def _on_frame(self, frame):
+        if isinstance(frame, amqp_frame.Heartbeat):
+            return
+
+        _channel = None
+
+        if frame.channel_number:
+            _channel = self.channels.get(frame.channel_number)
+
+            if _channel is None and not isinstance(frame, amqp_frame.Method):
+                raise _ConnectionError(504, "CHANNEL_ERROR - unexpected frame on channel %d" % frame.channel_number)
+
+        if isinstance(frame, amqp_frame.Header):
+            self._on_header(_channel, frame)
+            return
+
+        _method = frame.method
+
+        if self.closing and not isinstance(_method, (spec.Connection.Close, spec.Connection.CloseOk)):
+            return
+
+        if bool(frame.channel_number) != (_method.INDEX >> 16 != spec.Connection.INDEX):
+            raise _ConnectionError(503, "COMMAND_INVALID - %s on channel %d" % (_method.NAME, frame.channel_number))
+
+        if isinstance(_method, spec.Channel.Open):
+            if _channel is not None:
+                raise _ConnectionError(504, "CHANNEL_ERROR - channel %d is open already" % frame.channel_number)
+
+            self.channels[frame.channel_number] = _Channel(self, frame.channel_number)
+            self.send_method(frame.channel_number, spec.Channel.OpenOk())
+            return
+
+        if _channel is None and frame.channel_number:
+            raise _ConnectionError(504, "CHANNEL_ERROR - channel %d is not open" % frame.channel_number)
+
+        if _channel is not None and _channel.closing and \
+                not isinstance(_method, (spec.Channel.Close, spec.Channel.CloseOk)):
+            return
+
+        if _channel is not None and _channel.content is not None:
+            raise _ConnectionError(505, "UNEXPECTED_FRAME - %s while expecting content" % _method.NAME)
+
+        _handler = self._handlers.get(type(_method))
+
+        if _handler is None:
+            raise _ConnectionError(540, "NOT_IMPLEMENTED - %s" % _method.NAME)
+
+        try:
+            if _channel is not None:
+                _handler(_channel, _method)
+            else:
+                _handler(_method)
+        except _AmqpError as e:
+            if not e.channel_level:
+                raise
+
+            self._close_channel(_channel, e.reply_code, e.reply_text, _method)
+
+    def _on_header(self, channel, frame):
+        if channel.closing:
+            # the rest of a message published before the channel was closed
+            return
+
+        if channel.content is None or channel.content[1] is not None:
+            raise _ConnectionError(505, "UNEXPECTED_FRAME - content header")
+
+        channel.content = (channel.content[0], frame.properties, frame.body_size, list(), 0)
+
+        if not frame.body_size:
+            self._on_content(channel)
+
+    def _on_body(self, number, fragment):
+        _channel = self.channels.get(number)
+
+        if _channel is not None and _channel.closing:
+            return
+
+        if _channel is None or _channel.content is None or _channel.content[1] is None:
+            raise _ConnectionError(505, "UNEXPECTED_FRAME - content body")
+
+        (_method, _properties, _size, _fragments, _received) = _channel.content
+        _fragments.append(fragment)
+        _received += len(fragment)
+        _channel.content = (_method, _properties, _size, _fragments, _received)
+
+        if _received > _size:
+            raise _ConnectionError(505, "UNEXPECTED_FRAME - content body exceeds its size")
+
+        if _received == _size:
+            self._on_content(_channel)
+
+    def _on_content(self, channel):
+        (_method, _properties, _size, _fragments, _received) = channel.content
+        channel.content = None
+        _body = _fragments[0] if len(_fragments) == 1 else b''.join(_fragments)
+
+        try:
+            if channel.transaction is not None:
+                self.broker.check_publish(_method.exchange)
+                channel.transaction.append(lambda: self._publish(channel, _method, _properties, _body))
+                return
+
+            self._publish(channel, _method, _properties, _body)
+        except _AmqpError as e:
+            if not e.channel_level:
+                raise
+
+            self._close_channel(channel, e.reply_code, e.reply_text, _method)
+
+    def _publish(self, channel, method, properties, body):
+        _routed = self.broker.publish(method.exchange, method.routing_key, properties, body)
+
+        if not _routed and method.mandatory:
+            self.send_content(channel.number, spec.Basic.Return(312, 'NO_ROUTE', method.exchange, method.routing_key),
+                              _Message(method.exchange, method.routing_key, properties, body))
+
+        if channel.confirm:
+            channel.publish_tag += 1
+            self.send_method(channel.number, spec.Basic.Ack(channel.publish_tag, False))
+    #### END: frames handling
+
+    #### BEG: connection and channel methods
+    def _on_start_ok(self, method):
+        # credentials are not checked
+        self.send_method(0, spec.Connection.Tune(self.broker.channel_max, self.broker.frame_max, self.broker.heartbeat))
+
+    def _on_tune_ok(self, method):
+        self.frame_max = method.frame_max or self.broker.frame_max
+        self.heartbeat = method.heartbeat
+
+        if self.heartbeat:
+            self._heartbeat_received = self._received
+            self._heartbeat_missed = 0
+            self._heartbeat_timer = self.broker._loop.call_later(self.heartbeat / 2.0, self._heartbeat_send)
+
+    def _on_connection_open(self, method):
+        self.send_method(0, spec.Connection.OpenOk())
+
+    def _on_connection_close(self, method):
+        self.send_method(0, spec.Connection.CloseOk())
+        self.transport.close()
+
+    def _on_connection_close_ok(self, method):
+        self.transport.close()
+
+    def _on_channel_close(self, channel, method):
+        self._release_channel(channel)
+        self.channels.pop(channel.number, None)
+        self.send_method(channel.number, spec.Channel.CloseOk())
+
+    def _on_channel_close_ok(self, channel, method):
+        self.channels.pop(channel.number, None)
+
+    def _on_channel_flow(self, channel, method):
+        self.send_method(channel.number, spec.Channel.FlowOk(method.active))
+
+    def _close_channel(self, channel, reply_code, reply_text, method=None):
+        """
+        Close the channel because of an error
+        """
+        logging.info("Closing channel %d: %d %s", channel.number, reply_code, reply_text)
+        self._release_channel(channel)
+        channel.closing = True
+        channel.content = None
+        self.send_method(channel.number, spec.Channel.Close(reply_code, reply_text,
+                                                            method.INDEX >> 16 if method else 0,
+                                                            method.INDEX & 0xffff if method else 0))
+
+    def _release_channel(self, channel):
+        """
+        Cancel consumers and requeue messages not acknowledged
+        """
+        for _consumer in list(channel.consumers.values()):
+            self.broker.cancel(_consumer)
+
+        channel.consumers = dict()
+        self.broker.settle(channel, 0, multiple=True, requeue=True)
+    #### END: connection and channel methods
+
+    #### BEG: exchange and queue methods
+    def _reply(self, channel, method, reply):
+        if not getattr(method, 'nowait', False):
+            self.send_method(channel.number, reply)
+
+    def _on_exchange_declare(self, channel, method):
+        self.broker.declare_exchange(method.exchange, method.type, passive=method.passive, durable=method.durable,
+                                     auto_delete=method.auto_delete, internal=method.internal,
+                                     arguments=method.arguments)
+        self._reply(channel, method, spec.Exchange.DeclareOk())
+
+    def _on_exchange_delete(self, channel, method):
+        self.broker.delete_exchange(method.exchange, if_unused=method.if_unused)
+        self._reply(channel, method, spec.Exchange.DeleteOk())
+
+    def _on_queue_declare(self, channel, method):
+        _queue = self.broker.declare_queue(method.queue, self, passive=method.passive, durable=method.durable,
+                                           exclusive=method.exclusive, auto_delete=method.auto_delete,
+                                           arguments=method.arguments)
+        self._reply(channel, method, spec.Queue.DeclareOk(_queue.name, len(_queue), len(_queue.consumers)))
+
+    def _on_queue_bind(self, channel, method):
+        self.broker.bind(self.broker.get_queue(method.queue, self).name, method.exchange, method.routing_key,
+                         method.arguments)
+        self._reply(channel, method, spec.Queue.BindOk())
+
+    def _on_queue_unbind(self, channel, method):
+        self.broker.unbind(self.broker.get_queue(method.queue, self).name, method.exchange, method.routing_key,
+                           method.arguments)
+        self.send_method(channel.number, spec.Queue.UnbindOk())
+
+    def _on_queue_purge(self, channel, method):
+        _count = self.broker.get_queue(method.queue, self).purge()
+        self._reply(channel, method, spec.Queue.PurgeOk(_count))
+
+    def _on_queue_delete(self, channel, method):
+        _count = self.broker.delete_queue(method.queue, self, if_unused=method.if_unused, if_empty=method.if_empty)
+        self._reply(channel, method, spec.Queue.DeleteOk(_count))
+    #### END: exchange and queue methods
+
+    #### BEG: basic methods
+    def _on_basic_qos(self, channel, method):
+        if method.global_qos:
+            channel.global_prefetch_count = method.prefetch_count
+        else:
+            # applies to consumers started after it
+            channel.prefetch_count = method.prefetch_count
+
+        self.send_method(channel.number, spec.Basic.QosOk())
+
+    def _on_basic_consume(self, channel, method):
+        _queue = self.broker.get_queue(method.queue, self)
+        _tag = method.consumer_tag or 'amq.ctag-%s' % uuid.uuid4().hex
+
+        if _tag in channel.consumers:
+            raise _ConnectionError(530, "NOT_ALLOWED - attempt to reuse consumer tag '%s'" % _tag)
+
+        if any(_consumer.exclusive for _consumer in _queue.consumers) or (method.exclusive and _queue.consumers):
+            raise _AmqpError(403, "ACCESS_REFUSED - queue '%s' in exclusive use" % _queue.name)
+
+        _consumer = _Consumer(_tag, channel, _queue, method.no_ack, method.exclusive, channel.prefetch_count)
+        channel.consumers[_tag] = _consumer
+        _queue.consumers.append(_consumer)
+        _queue.had_consumers = True
+        self._reply(channel, method, spec.Basic.ConsumeOk(_tag))
+        self.broker.dispatch(_queue)
+
+    def _on_basic_cancel(self, channel, method):
+        _consumer = channel.consumers.pop(method.consumer_tag, None)
+
+        if _consumer is not None:
+            self.broker.cancel(_consumer)
+
+        self._reply(channel, method, spec.Basic.CancelOk(method.consumer_tag))
+
+    def _on_basic_publish(self, channel, method):
+        self.broker.check_publish(method.exchange)
+        channel.content = (method, None, 0, None, 0)
+
+    def _on_basic_get(self, channel, method):
+        _queue = self.broker.get_queue(method.queue, self)
+        _message = self.broker.take(_queue)
+
+        if _message is None:
+            self.send_method(channel.number, spec.Basic.GetEmpty())
+            return
+
+        channel.delivery_tag += 1
+
+        if not method.no_ack:
+            channel.unacked[channel.delivery_tag] = (_message, _queue.name, None)
+            _queue.unacked += 1
+
+        self.broker.counter_delivered += 1
+        self.send_content(channel.number, spec.Basic.GetOk(channel.delivery_tag, _message.redelivered, _message.exchange,
+                                                           _message.routing_key, len(_queue)), _message)
+
+    def _settle(self, channel, delivery_tag, multiple, requeue=False, reject=False):
+        if channel.transaction is not None:
+            channel.transaction.append(lambda: self.broker.settle(channel, delivery_tag, multiple, requeue, reject))
+            return
+
+        self.broker.settle(channel, delivery_tag, multiple, requeue, reject)
+
+    def _on_basic_ack(self, channel, method):
+        self._settle(channel, method.delivery_tag, method.multiple)
+
+    def _on_basic_nack(self, channel, method):
+        self._settle(channel, method.delivery_tag, method.multiple, requeue=method.requeue, reject=not method.requeue)
+
+    def _on_basic_reject(self, channel, method):
+        self._settle(channel, method.delivery_tag, False, requeue=method.requeue, reject=not method.requeue)
+
+    def _on_basic_recover(self, channel, method):
+        self.broker.settle(channel, 0, multiple=True, requeue=True)
+        self.send_method(channel.number, spec.Basic.RecoverOk())
+
+    def _on_confirm_select(self, channel, method):
+        if channel.transaction is not None:
+            raise _AmqpError(406, "PRECONDITION_FAILED - cannot switch from tx to confirm mode")
+
+        channel.confirm = True
+        self._reply(channel, method, spec.Confirm.SelectOk())
+
+    def _on_tx_select(self, channel, method):
+        if channel.confirm:
+            raise _AmqpError(406, "PRECONDITION_FAILED - cannot switch from confirm to tx mode")
+
+        if channel.transaction is None:
+            channel.transaction = list()
+
+        self.send_method(channel.number, spec.Tx.SelectOk())
+
+    def _on_tx_commit(self, channel, method):
+        if channel.transaction is None:
+            raise _AmqpError(406, "PRECONDITION_FAILED - channel is not transactional")
+
+        (_actions, channel.transaction) = (channel.transaction, list())
+
+        for _action in _actions:
+            _action()
+
+        self.send_method(channel.number, spec.Tx.CommitOk())
+
+    def _on_tx_rollback(self, channel, method):
+        if channel.transaction is None:
+            raise _AmqpError(406, "PRECONDITION_FAILED - channel is not transactional")
+
+        channel.transaction = list()
+        self.send_method(channel.number, spec.Tx.RollbackOk())
+    #### END: basic methods
+
+
+class LocalBroker(object):
+    """
+    In-memory AMQP 0-9-1 broker serving clients on a TCP port with asyncio.
+    Run it with serve_forever() as a standalone process, or with start_thread() in background of a test or benchmark;
+    real pika connections of QueueClient, QueueServer and AsyncQueueClient work with it as with RabbitMQ.
+    """
+
+    default_port = 5672
+    frame_max = 131072
+    channel_max = 2047
+
+    def __init__(self, host='127.0.0.1', port=None, heartbeat=60):
+        """
+        Main initialization
+        :param host: address to listen to
+        :type host: str
+        :param port: port to listen to, 0 for any free one, default_port by default
+        :type port: int
+        :param heartbeat: heartbeat interval proposed to clients, seconds, 0 to disable
+        :type heartbeat: int
+        """
+        self.host = host
+        self.port = self.default_port if port is None else port
+        self.heartbeat = heartbeat
+        self.connections = set()
+        self.exchanges = dict()
+        self.queues = dict()
+        self.counter_published = 0
+        self.counter_delivered = 0
+        self.counter_acked = 0
+        self.counter_dead_lettered = 0
+        self._loop = None
+        self._server = None
+        self._thread = None
+
+        for _type in _Exchange.types:
+            self.exchanges['amq.%s' % _type] = _Exchange('amq.%s' % _type, _type, durable=True)
+
+    #### BEG: running
+    async def start(self):
+        """
+        Start listening in the current event loop. Port is set to the actual one
+        """
+        self._loop = asyncio.get_event_loop()
+        self._server = await self._loop.create_server(lambda: _AmqpConnection(self), self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logging.info("Local broker is listening on %s:%d", self.host, self.port)
+
+    async def stop(self):
+        """
+        Stop listening and drop connections
+        """
+        if self._server is None:
+            return
+
+        self._server.close()
+
+        for _connection in list(self.connections):
+            _connection.transport.close()
+
+        await self._server.wait_closed()
+        self._server = None
+
+    def serve_forever(self):
+        """
+        Run the broker in a new event loop of the current thread until interrupted
+        """
+        _loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(_loop)
+        _loop.run_until_complete(self.start())
+
+        try:
+            _loop.run_forever()
+        finally:
+            _loop.run_until_complete(self.stop())
+            _loop.close()
+
+    def start_thread(self):
+        """
+        Run the broker in a background daemon thread
+        :returns: self, port is set
+        """
+        _started = threading.Event()
+        _errors = list()
+
+        def _run():
+            _loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(_loop)
+
+            try:
+                _loop.run_until_complete(self.start())
+            except Exception as e:
+                _errors.append(e)
+                _started.set()
+                _loop.close()
+                return
+
+            _started.set()
+            _loop.run_forever()
+            _loop.run_until_complete(self.stop())
+            _loop.close()
+
+        self._thread = threading.Thread(target=_run, name='local-broker')
+        self._thread.daemon = True
+        self._thread.start()
+        _started.wait()
+
+        if _errors:
+            self._thread = None
+            raise _errors[0]
+
+        return self
+
+    def stop_thread(self):
+        """
+        Stop the broker started with start_thread()
+        """
+        if self._thread is None:
+            return
+
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._thread = None
+
+    @property
+    def url(self):
+        """
+        AMQP URL to connect to the broker
+        """
+        return 'amqp://guest:guest@%s:%d/' % (self.host, self.port)
+
+    def get_stats(self):
+        """
+        Queues state and message counters. Thread-safe when the broker runs in a thread of its own
+        :returns: {'queues': {name: {'messages', 'consumers', 'unacked'}}, 'published', 'delivered', 'acked', 'dead_lettered'}
+        """
+        if self._thread is not None and threading.current_thread() is not self._thread:
+            async def _stats():
+                return self.get_stats()
+
+            return asyncio.run_coroutine_threadsafe(_stats(), self._loop).result()
+
+        return {'queues': dict((_name, {'messages': len(_queue), 'consumers': len(_queue.consumers),
+                                        'unacked': _queue.unacked})
+                               for (_name, _queue) in self.queues.items()),
+                'published': self.counter_published,
+                'delivered': self.counter_delivered,
+                'acked': self.counter_acked,
+                'dead_lettered': self.counter_dead_lettered}
+    #### END: running
+
+    #### BEG: topology
+    def declare_exchange(self, name, exchange_type='direct', passive=False, durable=False, auto_delete=False,
+                         internal=False, arguments=None):
+        if not name:
+            raise _AmqpError(403, "ACCESS_REFUSED - operation not permitted on the default exchange")
+
+        _exchange = self.exchanges.get(name)
+
+        if passive:
+            if _exchange is None:
+                raise _AmqpError(404, "NOT_FOUND - no exchange '%s'" % name)
+            return _exchange
+
+        if exchange_type not in _Exchange.types:
+            raise _ConnectionError(503, "COMMAND_INVALID - unknown exchange type '%s'" % exchange_type)
+
+        if _exchange is not None:
+            _exchange.equivalent(exchange_type, durable, auto_delete, internal, arguments)
+            return _exchange
+
+        if name.startswith('amq.'):
+            raise _AmqpError(403, "ACCESS_REFUSED - exchange name '%s' contains reserved prefix 'amq.'" % name)
+
+        _exchange = self.exchanges[name] = _Exchange(name, exchange_type, durable, auto_delete, internal, arguments)
+        return _exchange
+
+    def delete_exchange(self, name, if_unused=False):
+        if not name or name.startswith('amq.'):
+            raise _AmqpError(403, "ACCESS_REFUSED - operation not permitted on exchange '%s'" % name)
+
+        _exchange = self.exchanges.get(name)
+
+        if _exchange is None:
+            return
+
+        if if_unused and _exchange.bindings:
+            raise _AmqpError(406, "PRECONDITION_FAILED - exchange '%s' in use" % name)
+
+        del self.exchanges[name]
+
+    def get_queue(self, name, connection):
+        """
+        Queue to be used by the connection
+        :raises: _AmqpError if it is missing or exclusive to another connection
+        """
+        _queue = self.queues.get(name)
+
+        if _queue is None:
+            raise _AmqpError(404, "NOT_FOUND - no queue '%s'" % name)
+
+        if _queue.exclusive is not None and _queue.exclusive is not connection:
+            raise _AmqpError(405, "RESOURCE_LOCKED - cannot obtain exclusive access to locked queue '%s'" % name)
+
+        return _queue
+
+    def declare_queue(self, name, connection, passive=False, durable=False, exclusive=False, auto_delete=False,
+                      arguments=None):
+        if passive:
+            return self.get_queue(name, connection)
+
+        if not name:
+            name = 'amq.gen-%s' % uuid.uuid4().hex
+        elif name.startswith('amq.'):
+            raise _AmqpError(403, "ACCESS_REFUSED - queue name '%s' contains reserved prefix 'amq.'" % name)
+
+        if name in self.queues:
+            _queue = self.get_queue(name, connection)
+            _queue.equivalent(durable, auto_delete, arguments)
+            return _queue
+
+        _queue = self.queues[name] = _Queue(name, durable, connection if exclusive else None, auto_delete, arguments)
+        return _queue
+
+    def delete_queue(self, name, connection, if_unused=False, if_empty=False):
+        """
+        Delete the queue, cancelling its consumers
+        :returns: number of messages deleted
+        """
+        if name not in self.queues:
+            return 0
+
+        _queue = self.get_queue(name, connection)
+
+        if if_unused and _queue.consumers:
+            raise _AmqpError(406, "PRECONDITION_FAILED - queue '%s' in use" % name)
+
+        if if_empty and len(_queue):
+            raise _AmqpError(406, "PRECONDITION_FAILED - queue '%s' not empty" % name)
+
+        return self._delete_queue(_queue)
+
+    def _delete_queue(self, queue):
+        queue.deleted = True
+        self.queues.pop(queue.name, None)
+
+        if queue.timer is not None:
+            queue.timer.cancel()
+            queue.timer = None
+
+        for _exchange in self.exchanges.values():
+            _exchange.unbind_queue(queue.name)
+
+        for _consumer in list(queue.consumers):
+            # clients are notified, see consumer_cancel_notify capability
+            _consumer.channel.consumers.pop(_consumer.tag, None)
+
+            if not _consumer.channel.closing and _consumer.channel.connection.transport is not None:
+                _consumer.channel.connection.send_method(_consumer.channel.number,
+                                                         spec.Basic.Cancel(_consumer.tag, nowait=True))
+
+        queue.consumers.clear()
+        return queue.purge()
+
+    def delete_exclusive_queues(self, connection):
+        for _queue in [_queue for _queue in self.queues.values() if _queue.exclusive is connection]:
+            self._delete_queue(_queue)
+
+    def bind(self, queue, exchange, routing_key, arguments=None):
+        if not exchange:
+            raise _AmqpError(403, "ACCESS_REFUSED - operation not permitted on the default exchange")
+
+        if exchange not in self.exchanges:
+            raise _AmqpError(404, "NOT_FOUND - no exchange '%s'" % exchange)
+
+        self.exchanges[exchange].bind(queue, routing_key, arguments)
+
+    def unbind(self, queue, exchange, routing_key, arguments=None):
+        if not exchange:
+            raise _AmqpError(403, "ACCESS_REFUSED - operation not permitted on the default exchange")
+
+        if exchange not in self.exchanges:
+            raise _AmqpError(404, "NOT_FOUND - no exchange '%s'" % exchange)
+
+        self.exchanges[exchange].unbind(queue, routing_key, arguments)
+    #### END: topology
+
+    #### BEG: messages flow
+    def check_publish(self, exchange):
+        """
+        Check the exchange may be published to
+        :raises: _AmqpError otherwise
+        """
+        if not exchange:
+            return
+
+        _exchange = self.exchanges.get(exchange)
+
+        if _exchange is None:
+            raise _AmqpError(404, "NOT_FOUND - no exchange '%s'" % exchange)
+
+        if _exchange.internal:
+            raise _AmqpError(403, "ACCESS_REFUSED - cannot publish to internal exchange '%s'" % exchange)
+
+    def publish(self, exchange, routing_key, properties, body):
+        """
+        Route the message to queues and deliver it to consumers if they are ready
+        :returns: True if the message was routed to a queue
+        :raises: _AmqpError if the exchange is missing or the message is malformed
+        """
+        if exchange:
+            _exchange = self.exchanges.get(exchange)
+
+            if _exchange is None:
+                raise _AmqpError(404, "NOT_FOUND - no exchange '%s'" % exchange)
+
+            _names = _exchange.route(routing_key, properties.headers)
+        else:
+            _names = (routing_key, ) if routing_key in self.queues else ()
+
+        _expiration = None
+
+        if properties.expiration is not None:
+            try:
+                _expiration = int(properties.expiration)
+
+                if _expiration < 0:
+                    raise ValueError(properties.expiration)
+            except ValueError:
+                raise _AmqpError(406, "PRECONDITION_FAILED - invalid expiration '%s'" % properties.expiration)
+
+        self.counter_published += 1
+        _now = self._loop.time()
+
+        for _name in _names:
+            _queue = self.queues.get(_name)
+
+            if _queue is None:
+                continue
+
+            _ttl = min(_value for _value in (_queue.ttl, _expiration, float('inf')) if _value is not None)
+            _message = _Message(exchange, routing_key, properties, body,
+                                expires=None if _ttl == float('inf') else _now + _ttl / 1000.0,
+                                priority=properties.priority or 0)
+            _queue.put(_message)
+
+            if _message.expires is not None:
+                self._schedule_expiry(_queue)
+
+            self.dispatch(_queue)
+
+        return bool(_names)
+
+    def take(self, queue):
+        """
+        Get the next message of the queue, dead-lettering expired ones
+        :returns: _Message or None
+        """
+        while len(queue):
+            _message = queue.get()
+
+            if _message.expires is not None and _message.expires <= self._loop.time():
+                self.dead_letter(queue, _message, 'expired')
+                continue
+
+            return _message
+
+        return None
+
+    def dispatch(self, queue):
+        """
+        Deliver messages of the queue to its consumers in turn while they are ready to take them
+        """
+        _consumers = queue.consumers
+
+        while len(queue) and _consumers:
+            for _index in range(0, len(_consumers)):
+                _consumer = _consumers[0]
+                _consumers.rotate(-1)
+
+                if _consumer.ready():
+                    break
+            else:
+                return
+
+            _message = self.take(queue)
+
+            if _message is None:
+                return
+
+            _channel = _consumer.channel
+            _channel.delivery_tag += 1
+
+            if not _consumer.no_ack:
+                _channel.unacked[_channel.delivery_tag] = (_message, queue.name, _consumer)
+                _consumer.unacked += 1
+                queue.unacked += 1
+
+            self.counter_delivered += 1
+            _channel.connection.send_content(_channel.number, spec.Basic.Deliver(
+                _consumer.tag, _channel.delivery_tag, _message.redelivered, _message.exchange, _message.routing_key),
+                _message)
+
+    def cancel(self, consumer):
+        """
+        Stop delivering to the consumer, delete auto-delete queue left without consumers
+        """
+        _queue = consumer.queue
+
+        try:
+            _queue.consumers.remove(consumer)
+        except ValueError:
+            return
+
+        if _queue.auto_delete and not _queue.consumers and not _queue.deleted:
+            self._delete_queue(_queue)
+
+    def settle(self, channel, delivery_tag, multiple=False, requeue=False, reject=False):
+        """
+        Acknowledge, requeue or reject messages delivered on the channel
+        :param delivery_tag: the message delivery tag, 0 with multiple for all of them
+        :raises: _AmqpError if the tag is unknown
+        """
+        if multiple:
+            _tags = list()
+
+            for _tag in channel.unacked:
+                if delivery_tag and _tag > delivery_tag:
+                    break
+                _tags.append(_tag)
+        elif delivery_tag in channel.unacked:
+            _tags = [delivery_tag]
+        else:
+            raise _AmqpError(406, "PRECONDITION_FAILED - unknown delivery tag %d" % delivery_tag)
+
+        _queues = set(_consumer.queue for _consumer in channel.consumers.values())
+
+        # requeued in reverse order, so they keep it at the head of the queue
+        for _tag in reversed(_tags):
+            (_message, _name, _consumer) = channel.unacked.pop(_tag)
+
+            if _consumer is not None:
+                _consumer.unacked -= 1
+
+            _queue = self.queues.get(_name)
+
+            if _queue is None:
+                continue
+
+            _queue.unacked -= 1
+
+            if requeue:
+                _message.redelivered = True
+                _queue.put(_message, front=True)
+
+                if _message.expires is not None and (_queue.timer_at is None or _message.expires < _queue.timer_at):
+                    self._schedule_expiry(_queue, force=True)
+
+                _queues.add(_queue)
+            elif reject:
+                self.dead_letter(_queue, _message, 'rejected')
+            else:
+                self.counter_acked += 1
+
+        for _queue in _queues:
+            if not _queue.deleted:
+                self.dispatch(_queue)
+
+    def dead_letter(self, queue, message, reason):
+        """
+        Re-publish the message to dead letter exchange of the queue if it is set, with 'x-death' header updated
+        """
+        if queue.dead_letter_exchange is None:
+            return
+
+        if queue.dead_letter_exchange and queue.dead_letter_exchange not in self.exchanges:
+            logging.debug("Dead letter exchange '%s' is missing, message dropped", queue.dead_letter_exchange)
+            return
+
+        _properties = copy.copy(message.properties)
+        _headers = dict(_properties.headers or dict())
+        _deaths = list(_headers.get('x-death') or list())
+        _death = None
+
+        for (_index, _item) in enumerate(_deaths):
+            if _item.get('queue') == queue.name and _item.get('reason') == reason:
+                _death = dict(_item, count=int(_item.get('count', 1)) + 1)
+                del _deaths[_index]
+                break
+
+        if _death is None:
+            _death = {'count': 1, 'reason': reason, 'queue': queue.name,
+                      'time': datetime.datetime.utcnow().replace(microsecond=0),
+                      'exchange': message.exchange, 'routing-keys': [message.routing_key]}
+
+        if _properties.expiration is not None:
+            _death['original-expiration'] = _properties.expiration
+            _properties.expiration = None
+
+        _deaths.insert(0, _death)
+        _headers['x-death'] = _deaths
+
+        if 'x-first-death-reason' not in _headers:
+            _headers.update({'x-first-death-reason': reason, 'x-first-death-queue': queue.name,
+                             'x-first-death-exchange': message.exchange})
+
+        _properties.headers = _headers
+        _routing_key = queue.dead_letter_routing_key
+
+        if _routing_key is None:
+            _routing_key = message.routing_key
+
+        self.counter_dead_lettered += 1
+        self.publish(queue.dead_letter_exchange, _routing_key, _properties, message.body)
+
+    def _schedule_expiry(self, queue, force=False):
+        """
+        Set timer for the head message expiration. Only messages at the head are expired, as RabbitMQ does
+        """
+        if queue.timer is not None:
+            if not force:
+                return
+
+            queue.timer.cancel()
+            queue.timer = None
+
+        _head = queue.head()
+
+        if _head is None or _head.expires is None:
+            return
+
+        queue.timer_at = _head.expires
+        queue.timer = self._loop.call_at(_head.expires, self._expire, queue)
+
+    def _expire(self, queue):
+        queue.timer = None
+        queue.timer_at = None
+        _now = self._loop.time()
+
+        while len(queue):
+            _head = queue.head()
+
+            if _head.expires is None or _head.expires > _now:
+                break
+
+            self.dead_letter(queue, queue.get(), 'expired')
+
+        if not queue.deleted:
+            self._schedule_expiry(queue)
+    #### END: messages flow
+
+
+def main(cmdline=None):
+    parser = argparse.ArgumentParser(description='Local AMQP 0-9-1 broker for load testing')
+    parser.add_argument('--host', help='Address to listen to', default='127.0.0.1')
+    parser.add_argument('--port', help='Port to listen to', default=LocalBroker.default_port, type=int)
+    parser.add_argument('--heartbeat', help='Heartbeat interval proposed to clients, seconds, 0 to disable',
+                        default=60, type=int)
+    parser.add_argument('--verbose', '-v', help='Verbose output', default=False, action='store_true')
+    args = parser.parse_args(cmdline)
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format='%(asctime)s:%(name)s:%(levelname)s:%(message)s')
+
+    try:
+        LocalBroker(args.host, args.port, args.heartbeat).serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+    return 0
+
+
+if __name__ == '__main__':
+    exit(main())
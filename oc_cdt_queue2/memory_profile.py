@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+
+import logging
+import os
+import signal
+import tracemalloc
+
+"""
+Sampling memory profiler for message processing
+"""
+
+
+class MemoryProfiler(object):
+    """
+    Measures memory retained by processing of every N-th message and aggregates it by a key (published function).
+    'tracemalloc' method traces allocations during sampled messages only and reports their sites,
+    'rss' method takes resident set size difference, it is cheaper but noisy and has no sites.
+    Not sampled messages cost a counter increment only.
+    """
+
+    methods = ['tracemalloc', 'rss']
+
+    def __init__(self, sample=100, method='tracemalloc', report_every=0, top=10, report_signal=None):
+        """
+        Main initialization
+        :param sample: profile every N-th message
+        :type sample: int
+        :param method: 'tracemalloc' or 'rss'
+        :type method: str
+        :param report_every: log report every K messages, 0 to do it on signal only
+        :type report_every: int
+        :param top: allocation sites number to keep and report per key
+        :type top: int
+        :param report_signal: signal to log report on, e.g. signal.SIGUSR1. None to not install handler
+        :type report_signal: int
+        """
+        if sample < 1:
+            raise ValueError("Memory profile sample should be positive")
+
+        if method not in self.methods:
+            raise ValueError("Unsupported memory profile method: %s" % method)
+
+        self.sample = sample
+        self.method = method
+        self.report_every = report_every
+        self.top = top
+        self._messages = 0
+        self._report_requested = False
+        self._reported_at = 0
+        # key: [samples, bytes retained, {site: bytes}]
+        self._stats = dict()
+
+        if report_signal is not None:
+            self.install_signal(report_signal)
+
+    def install_signal(self, signum):
+        """
+        Log report on the signal given. Report is written on the next message or main loop iteration,
+        not from the signal handler itself
+        :param signum: signal number
+        :type signum: int
+        """
+        try:
+            signal.signal(signum, self._on_signal)
+        except ValueError as e:
+            # not the main thread
+            logging.warning("Unable to install memory report signal handler: %s", e)
+
+    def _on_signal(self, signum, frame):
+        self._report_requested = True
+
+    @staticmethod
+    def _rss():
+        """
+        Current resident set size, bytes
+        """
+        try:
+            with open('/proc/self/statm', 'rb') as _statm:
+                return int(_statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError, IndexError):
+            import resource
+            # peak value, but better than nothing
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def begin(self):
+        """
+        Call before message processing
+        :returns: sample state to pass to end(), None if message is not sampled
+        """
+        self._messages += 1
+
+        if self._messages % self.sample:
+            return None
+
+        if self.method == 'rss':
+            return self._rss()
+
+        if tracemalloc.is_tracing():
+            # traced by someone else: compare snapshots
+            return tracemalloc.take_snapshot()
+
+        tracemalloc.start()
+        return True
+
+    def end(self, state, key):
+        """
+        Call after message processing
+        :param state: begin() result
+        :param key: key to aggregate stats by, e.g. published function name
+        :type key: str
+        """
+        if state is None:
+            return
+
+        _stats = self._stats.setdefault(key, [0, 0, dict()])
+        _stats[0] += 1
+
+        if self.method == 'rss':
+            _stats[1] += self._rss() - state
+            return
+
+        _snapshot = tracemalloc.take_snapshot()
+
+        if state is True:
+            tracemalloc.stop()
+            # all traces are allocations done during the message and still alive
+            _top = _snapshot.statistics('lineno')
+            _stats[1] += sum(_stat.size for _stat in _top)
+            _sites = [(str(_stat.traceback[0]), _stat.size) for _stat in _top[:self.top]]
+        else:
+            _top = _snapshot.compare_to(state, 'lineno')
+            _stats[1] += sum(_stat.size_diff for _stat in _top)
+            _sites = [(str(_stat.traceback[0]), _stat.size_diff) for _stat in _top[:self.top] if _stat.size_diff > 0]
+
+        for (_site, _size) in _sites:
+            _stats[2][_site] = _stats[2].get(_site, 0) + _size
+
+        if len(_stats[2]) > self.top * 10:
+            # keep the largest sites only, so stats do not grow themselves
+            _stats[2] = dict(sorted(_stats[2].items(), key=lambda _x: -_x[1])[:self.top * 10])
+
+    def report_due(self):
+        """
+        Check if report is to be logged now: requested by signal or K messages passed
+        :returns: boolean
+        """
+        if self._report_requested:
+            return True
+
+        return bool(self.report_every and self._messages - self._reported_at >= self.report_every)
+
+    def report(self):
+        """
+        Build report text
+        :returns: str
+        """
+        self._report_requested = False
+        self._reported_at = self._messages
+        _lines = ["Memory profile (%s, every %d of %d messages):" % (self.method, self.sample, self._messages)]
+
+        for _key, (_samples, _retained, _sites) in sorted(self._stats.items(), key=lambda _x: -_x[1][1]):
+            _lines.append("  %s: %d samples, %d bytes retained, %.1f bytes per message" %
+                          (_key, _samples, _retained, _retained / float(_samples)))
+
+            for _site, _size in sorted(_sites.items(), key=lambda _x: -_x[1])[:self.top]:
+                _lines.append("    %10d  %s" % (_size, _site))
+
+        return '\n'.join(_lines)
+
+    def log_report(self):
+        """
+        Log report if it is due
+        """
+        if self.report_due():
+            logging.info(self.report())
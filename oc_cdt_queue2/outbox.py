@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+
+import fcntl
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+"""
+Disk-backed outbox of messages to be published
+"""
+
+
+class OutboxFull(Exception):
+    """
+    Outbox disk size limit is reached
+    """
+    pass
+
+
+class _Segment(object):
+    """
+    Memory-mapped segment file
+    """
+
+    def __init__(self, path, size):
+        self.path = path
+        _exists = os.path.exists(path)
+        self._file = open(path, 'r+b' if _exists else 'w+b')
+
+        if not _exists:
+            self._file.truncate(size)
+
+        self.size = os.path.getsize(path)
+        self.mmap = mmap.mmap(self._file.fileno(), self.size)
+        # end of records written
+        self.end = 0
+
+    def close(self):
+        self.mmap.close()
+        self._file.close()
+
+    def remove(self):
+        self.close()
+        os.remove(self.path)
+
+
+class Outbox(object):
+    """
+    Append-only log of records kept in memory-mapped segment files of a directory.
+    Records are read in order they were appended and removed when committed: segment files
+    are deleted as soon as all their records are committed. The position of the first record
+    not committed is kept in a cursor file, so records survive process restart;
+    they survive power loss also if 'sync' is set.
+    One process may use an outbox directory at a time. Thread-safe.
+    """
+
+    default_segment_size = 16 * 1024 * 1024
+    _magic = b'OCOUTBX1'
+    _cursor = struct.Struct('<8sQQ')    # magic, segment number and offset of the first record not committed
+    _record = struct.Struct('<II')      # payload length, payload crc32
+
+    def __init__(self, path, max_size=1024 * 1024 * 1024, segment_size=None, sync=False):
+        """
+        Main initialization
+        :param path: directory to keep files in, created if missing
+        :type path: str
+        :param max_size: max total size of segment files, bytes
+        :type max_size: int
+        :param segment_size: segment file size, bytes. Larger segments are created for records not fitting it.
+        :type segment_size: int
+        :param sync: flush every record appended to disk
+        :type sync: boolean
+        """
+        self.path = path
+        self.segment_size = segment_size or self.default_segment_size
+        self.max_size = max_size
+        self.sync = sync
+
+        if self.max_size < self.segment_size:
+            raise ValueError("Outbox size should not be less than segment size")
+
+        self._lock = threading.Lock()
+        self._appended = threading.Condition(self._lock)
+        # segment number: _Segment, all segments with records not committed
+        self._segments = dict()
+        self._size = 0
+        self._pending = 0
+        self._committed = (0, 0)
+        self._read = (0, 0)
+        self._write = 0
+        self._open()
+
+    def _segment_path(self, number):
+        return os.path.join(self.path, '%016d.seg' % number)
+
+    def _open(self):
+        """
+        Lock the directory, load cursor and segments left by previous run
+        """
+        os.makedirs(self.path, exist_ok=True)
+        self._lock_file = open(os.path.join(self.path, 'lock'), 'w')
+
+        try:
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self._lock_file.close()
+            raise
+
+        _cursor_path = os.path.join(self.path, 'cursor')
+        _cursor_exists = os.path.exists(_cursor_path) and os.path.getsize(_cursor_path) == self._cursor.size
+        self._cursor_file = open(_cursor_path, 'r+b' if _cursor_exists else 'w+b')
+
+        if not _cursor_exists:
+            self._cursor_file.truncate(self._cursor.size)
+
+        self._cursor_mmap = mmap.mmap(self._cursor_file.fileno(), self._cursor.size)
+        (_magic, _segment, _offset) = self._cursor.unpack_from(self._cursor_mmap, 0)
+
+        if _magic != self._magic:
+            (_segment, _offset) = (0, 0)
+
+        _numbers = sorted(int(_name[:-4]) for _name in os.listdir(self.path) if _name.endswith('.seg'))
+
+        for _number in _numbers:
+            if _number < _segment:
+                # committed but not removed
+                os.remove(self._segment_path(_number))
+                continue
+
+            _loaded = _Segment(self._segment_path(_number), self.segment_size)
+            self._segments[_number] = _loaded
+            self._size += _loaded.size
+            _loaded.end = self._scan(_loaded, _offset if _number == _segment else 0)
+
+        if not self._segments or min(self._segments) > _segment:
+            _offset = 0
+            _segment = min(self._segments) if self._segments else _segment
+
+        self._committed = (_segment, _offset)
+        self._read = self._committed
+        self._write = max(self._segments) if self._segments else _segment
+        self._store_cursor()
+
+        if self._pending:
+            logging.info("Outbox %s has %d records to publish", self.path, self._pending)
+
+    def _scan(self, segment, offset):
+        """
+        Count valid records from offset and find their end. Data past the end (torn write) is cleared.
+        """
+        _end = offset
+
+        while _end + self._record.size <= segment.size:
+            (_length, _crc) = self._record.unpack_from(segment.mmap, _end)
+            _start = _end + self._record.size
+
+            if not _length or _start + _length > segment.size or zlib.crc32(segment.mmap[_start:_start + _length]) != _crc:
+                break
+
+            _end = _start + _length
+            self._pending += 1
+
+        if _end + self._record.size <= segment.size:
+            segment.mmap[_end:_end + self._record.size] = b'\x00' * self._record.size
+
+        return _end
+
+    def _store_cursor(self):
+        self._cursor.pack_into(self._cursor_mmap, 0, self._magic, *self._committed)
+
+        if self.sync:
+            self._cursor_mmap.flush()
+
+    def __len__(self):
+        """
+        Records not committed
+        """
+        return self._pending
+
+    @property
+    def size(self):
+        """
+        Total size of segment files, bytes
+        """
+        return self._size
+
+    def append(self, payload):
+        """
+        Write a record
+
+        :param payload: record data, not empty
+        :type payload: bytes
+        :raises: OutboxFull if there is no room for the record
+        """
+        if not payload:
+            raise ValueError("Outbox record should not be empty")
+
+        _length = self._record.size + len(payload)
+
+        with self._lock:
+            _segment = self._segments.get(self._write)
+
+            if _segment is None or _segment.end + _length > _segment.size:
+                _number = self._write + 1 if _segment is not None else self._write
+                _size = max(self.segment_size, _length)
+
+                if _segment is not None and self._committed == (self._write, _segment.end):
+                    # all records of the full segment are committed
+                    self._size -= _segment.size
+                    _segment.remove()
+                    del self._segments[self._write]
+                    self._committed = (_number, 0)
+                    self._read = self._committed
+                    self._store_cursor()
+
+                if self._size + _size > self.max_size:
+                    raise OutboxFull("Outbox %s size limit %d is reached" % (self.path, self.max_size))
+
+                _segment = _Segment(self._segment_path(_number), _size)
+                self._segments[_number] = _segment
+                self._size += _segment.size
+                self._write = _number
+
+            _start = _segment.end + self._record.size
+            # payload is written before its header, so a torn record is never seen as a valid one
+            _segment.mmap[_start:_start + len(payload)] = payload
+            self._record.pack_into(_segment.mmap, _segment.end, len(payload), zlib.crc32(payload))
+            _segment.end = _start + len(payload)
+
+            if self.sync:
+                _segment.mmap.flush()
+
+            self._pending += 1
+            self._appended.notify_all()
+
+    def read(self, limit=1, timeout=None):
+        """
+        Read records following ones read before, waiting for them if there are none
+
+        :param limit: max records to return
+        :type limit: int
+        :param timeout: seconds to wait for records, None to wait forever
+        :type timeout: float
+        :returns: list of (position, payload), position is to be passed to commit()
+        """
+        _records = list()
+
+        with self._lock:
+            if not self._readable():
+                self._appended.wait(timeout)
+
+            while len(_records) < limit and self._readable():
+                (_number, _offset) = self._read
+                _segment = self._segments[_number]
+
+                if _offset >= _segment.end:
+                    self._read = (_number + 1, 0)
+                    continue
+
+                (_length, _crc) = self._record.unpack_from(_segment.mmap, _offset)
+                _start = _offset + self._record.size
+                self._read = (_number, _start + _length)
+                _records.append((self._read, _segment.mmap[_start:_start + _length]))
+
+        return _records
+
+    def _readable(self):
+        (_number, _offset) = self._read
+        _segment = self._segments.get(_number)
+        return _segment is not None and (_offset < _segment.end or _number < self._write)
+
+    def wakeup(self):
+        """
+        Wake up readers waiting for records
+        """
+        with self._lock:
+            self._appended.notify_all()
+
+    def rewind(self):
+        """
+        Read again records not committed, i.e. after failure to publish them
+        """
+        with self._lock:
+            self._read = self._committed
+
+    def commit(self, position):
+        """
+        Remove records up to the position
+
+        :param position: position returned by read()
+        """
+        with self._lock:
+            (_number, _offset) = self._committed
+            _count = 0
+
+            while _number in self._segments:
+                _segment = self._segments[_number]
+
+                if _offset >= _segment.end and _number < self._write:
+                    # all records of the segment are committed
+                    self._size -= _segment.size
+                    _segment.remove()
+                    del self._segments[_number]
+                    (_number, _offset) = (_number + 1, 0)
+                    continue
+
+                if (_number, _offset) >= position or _offset >= _segment.end:
+                    break
+
+                (_length, _crc) = self._record.unpack_from(_segment.mmap, _offset)
+                _offset += self._record.size + _length
+                _count += 1
+
+            self._committed = (_number, _offset)
+            self._pending -= _count
+
+            if self._read < self._committed:
+                self._read = self._committed
+
+            self._store_cursor()
+
+    def wait_empty(self, timeout=None):
+        """
+        Wait for all records to be committed
+
+        :param timeout: seconds to wait, None to wait forever
+        :returns: True if there are no records left
+        """
+        _deadline = None if timeout is None else time.monotonic() + timeout
+
+        while self._pending:
+            if _deadline is not None and time.monotonic() >= _deadline:
+                return False
+
+            time.sleep(0.01)
+
+        return True
+
+    def close(self):
+        """
+        Flush and close files
+        """
+        with self._lock:
+            for _segment in self._segments.values():
+                _segment.mmap.flush()
+                _segment.close()
+
+            self._segments = dict()
+            self._cursor_mmap.flush()
+            self._cursor_mmap.close()
+            self._cursor_file.close()
+            self._lock_file.close()
@@ -1,10 +1,15 @@
 #!/usr/bin/env python
 
-import pika
 import argparse
+import inspect
 import logging
+import multiprocessing
+import sys
 import time
 from .queue_handler import QueueHandler
+from .queue_logging import QueueLogging
+from .queue_supervisor import QueueSupervisor
+from .queue_supervisor import AppFactory
 
 
 class QueueApplication(QueueHandler):
@@ -14,6 +19,18 @@ class QueueApplication(QueueHandler):
     that must be done by your own methods supplied by subclassing this class
     """
 
+    _log_queue = None   # QueueLogging instance if log records are written in background
+    _QueueSupervisor = QueueSupervisor
+    _shutdown = False   # stop requested, do not reconnect
+    _failed = False     # the last pass failed: no connection, connection lost or main loop error, see _worker_main()
+
+    def shutdown(self):
+        """
+        Stop processing and do not reconnect. Used by supervisor workers on SIGTERM
+        """
+        self._shutdown = True
+        self.stop()
+
     def _connect_and_run(self):
 
         try:
@@ -25,8 +42,15 @@ class QueueApplication(QueueHandler):
             raise
         except Exception as e:
             logging.exception(e)
+            self._failed = True
             return 2
 
+        self._failed = False
+
+        if self._shutdown:
+            # shutdown was requested while connecting, connect() resets stop flag
+            self.stop()
+
         # 'run' implements main loop
         # exceptions are catched in 'run' loop
         # but in case of big failure we have to shutdown ourself
@@ -35,6 +59,7 @@ class QueueApplication(QueueHandler):
         except Exception as e:
             logging.exception(e)
             self.disconnect()
+            self._failed = True
             return 1
 
         # do the normal 'disconnection' when run finished with exceptions catched normally
@@ -48,6 +73,12 @@ class QueueApplication(QueueHandler):
             logging.debug("Reconnect was specified")
             return 3
 
+        if not self._stop:
+            # supervised worker exits with error to be restarted, standalone application exits normally
+            logging.error("Connection is lost and reconnect is not set")
+            self._failed = True
+            return 0
+
         logging.info("Normal connection stopping, but reconnect is not set")
         return 0
 
@@ -82,6 +113,10 @@ class QueueApplication(QueueHandler):
         parser.add_argument('--reconnect', '-r', help='Reconnect on failure', default=False, action='store_true')
         parser.add_argument('--verbose', '-v', help='Verbose output (repeat to get more verbosity)', default=0, action='count')
         parser.add_argument('--log', help='write log file', default=None)
+        parser.add_argument('--log-async', help='Write log records in background thread, for connection process also',
+                            default=False, action='store_true')
+        parser.add_argument('--processes', help='Run this number of independent consumer processes under supervisor',
+                            default=1, type=int)
         return parser
 
     def setup_from_args(self, args=None):
@@ -109,12 +144,11 @@ class QueueApplication(QueueHandler):
         if len(args) > 0 or len(argv) > 0:
             super(QueueApplication, self).setup(*args, **argv)
 
-    def main(self, cmdline=None):
+    def parse_args(self, cmdline=None):
         """
-        Run this as your application's main() function
+        Parse command line and configure logging by it. Done by main() and by supervisor workers
 
-        :param cmdline: Command line parameters array for debug purposes
-        :returns:    return code for os.exit. Quit your application with this code
+        :param cmdline: Command line parameters array, sys.argv by default
         """
         self.parser = self.prepare_parser()
         self.basic_args()
@@ -135,6 +169,49 @@ class QueueApplication(QueueHandler):
 
         logging.captureWarnings(True)
 
+    def main(self, cmdline=None, factory=None):
+        """
+        Run this as your application's main() function
+
+        :param cmdline: Command line parameters array for debug purposes
+        :param factory: picklable callable building application for every worker with --processes, see AppFactory.
+                        By default workers build the class of this one with no constructor arguments: state set
+                        on this instance before main() is not passed to them
+        :returns:    return code for os.exit. Quit your application with this code
+        """
+        self.parse_args(cmdline)
+
+        if self.args.processes > 1 and factory is None:
+            try:
+                inspect.signature(type(self)).bind()
+            except TypeError:
+                logging.error("%s needs constructor arguments: pass factory to main() to run it with --processes",
+                              type(self).__name__)
+                return 2
+
+            factory = AppFactory(type(self), sys.argv[1:] if cmdline is None else cmdline)
+
+        if self.args.log_async:
+            self._log_queue = QueueLogging().start()
+
+        try:
+            if self.args.processes > 1:
+                # workers build application of their own: it is not to be pickled with 'spawn' or 'forkserver'
+                return self._QueueSupervisor(factory, self.args.processes,
+                                             context=multiprocessing.get_context(self.args.start_method)).run()
+
+            return self._main()
+        finally:
+            if self._log_queue:
+                self._log_queue.stop()
+                self._log_queue = None
+
+    def _main(self):
+        """
+        Set up from parsed arguments and run connect-process-reconnect loop
+
+        :returns:    return code for os.exit
+        """
         try:
             self.setup_from_args()
         except (TypeError, ValueError) as e:
@@ -146,12 +223,15 @@ class QueueApplication(QueueHandler):
         while True:
             logging.debug("Calling _connect_and_run")
             ret = self._connect_and_run()
-            logging.debug("Result of _connect_and_run: %d, reconnect is: %s" % (ret, self.reconnect))
-            if self.reconnect and ret != 0:
+            logging.debug("Result of _connect_and_run: %d, reconnect is: %s", ret, self.reconnect)
+            if self.reconnect and ret != 0 and not self._shutdown:
                 time.sleep(self._terminate_delay)
                 logging.warning('Reconnecting...')
                 continue
             break
 
+        self.stop_metrics()
+        self.stop_capture()
+        self.stop_profile()
         logging.info('exiting')
         return 0
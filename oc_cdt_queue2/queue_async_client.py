@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+
+from oc_cdt_queue2.queue_client import QueueClient
+from oc_cdt_queue2.lazy import lazy_import
+from oc_cdt_queue2.lazy import LazyAttribute
+import asyncio
+import json
+import logging
+import os
+
+pika = lazy_import('pika')
+
+"""
+AMQP client for asyncio applications
+"""
+
+
+class PublishNacked(Exception):
+    """
+    Broker has not accepted a message published
+    """
+    pass
+
+
+class AsyncQueueClient(QueueClient):
+    """
+    asyncio version of QueueClient built on pika AsyncioConnection. Options and setup are the same.
+    Publisher confirms are enabled: send() returns when the broker has accepted the message,
+    so no thread is held by a message in flight and any number of sends may be awaited concurrently.
+    Reconnection and rate limit delays are awaited, not slept.
+    """
+
+    _Connection = LazyAttribute('pika.adapters.asyncio_connection', 'AsyncioConnection')
+
+    def __init__(self, *args, **kvargs):
+        super(AsyncQueueClient, self).__init__(*args, **kvargs)
+        # created on the first connect(): lock is bound to the event loop running
+        self._connect_lock = None
+        # connections made, to tell if one was made while waiting for the lock
+        self._connections = 0
+        self._closed = None
+        # delivery tag: future resolved by publisher confirm
+        self._confirms = dict()
+        self._delivery_tag = 0
+
+    def setup(self, *args, **argv):
+        """
+        Sets things up, see QueueClient.setup(). Outbox is not supported: sends are awaited instead.
+        """
+        if argv.get('outbox'):
+            raise ValueError("Outbox is not supported by asyncio client")
+
+        super(AsyncQueueClient, self).setup(*args, **argv)
+
+    def _open(self, params):
+        """
+        Open connection and channel with publisher confirms, declare queues if asked
+
+        :returns: future resolved when done
+        """
+        _loop = asyncio.get_event_loop()
+        _opened = _loop.create_future()
+        _verify = self.queue_declare == 'verify'
+        _topology = list()
+        _keys = None
+
+        if self.queue_declare != 'no':
+            _topology = self.queues_topology(self.partition_queue_names(self.queue, self.partitions),
+                                             deads_disabled=self.deads_disabled, verify=_verify,
+                                             deads_queue=self.deads_queue_name(self.queue))
+            _keys = self._declarations.topology_keys(_topology)
+
+            if not _verify and self._declarations.is_confirmed(params, _keys):
+                logging.debug("Topology for %s is declared already", self.queue)
+                _topology = list()
+                _keys = None
+
+        def _fail(connection, error):
+            if not _opened.done():
+                _opened.set_exception(error)
+
+        def _declare(frame=None):
+            # declarations are done one by one, any failure closes the channel
+            if _topology:
+                (_method, _kwargs) = _topology.pop(0)
+                getattr(self.channel, _method)(callback=_declare, **_kwargs)
+                return
+
+            if _keys is not None and not _verify:
+                self._declarations.add(params, _keys)
+
+            if not _opened.done():
+                _opened.set_result(True)
+
+        def _on_channel_closed(channel, reason):
+            _fail(channel, reason)
+            self._on_channel_closed(channel, reason)
+
+        def _on_channel_open(channel):
+            self.channel = channel
+            self.channel.add_on_close_callback(_on_channel_closed)
+            self.channel.confirm_delivery(ack_nack_callback=self._on_confirm, callback=_declare)
+
+        def _on_connection_open(connection):
+            connection.channel(on_open_callback=_on_channel_open)
+
+        def _on_connection_closed(connection, reason):
+            _fail(connection, reason)
+            self._on_connection_closed(connection, reason)
+
+        self._delivery_tag = 0
+        self.connection = self._Connection(parameters=params, on_open_callback=_on_connection_open,
+                                           on_open_error_callback=_fail, on_close_callback=_on_connection_closed,
+                                           custom_ioloop=_loop)
+        return _opened
+
+    def _on_confirm(self, frame):
+        """
+        Publisher confirm: resolve futures of the messages acked or nacked
+        """
+        _method = frame.method
+        _tags = [_method.delivery_tag]
+
+        if _method.multiple:
+            _tags = [_tag for _tag in self._confirms if _tag <= _method.delivery_tag]
+
+        for _tag in _tags:
+            _future = self._confirms.pop(_tag, None)
+
+            if _future is None or _future.done():
+                continue
+
+            if isinstance(_method, pika.spec.Basic.Ack):
+                _future.set_result(True)
+            else:
+                _future.set_exception(PublishNacked("Message %d was not accepted by the broker" % _tag))
+
+    def _fail_confirms(self, reason):
+        """
+        Messages not confirmed are lost with the channel
+        """
+        _confirms = self._confirms
+        self._confirms = dict()
+
+        for _future in _confirms.values():
+            if not _future.done():
+                _future.set_exception(reason)
+
+    def _on_channel_closed(self, channel, reason):
+        logging.debug("Channel closed: %s", repr(reason))
+        self.channel = None
+        self._fail_confirms(reason)
+
+    def _on_connection_closed(self, connection, reason):
+        logging.debug("Connection closed: %s", repr(reason))
+
+        if connection is self.connection:
+            self.connection = None
+            self.channel = None
+
+        self._fail_confirms(reason)
+
+        if self._closed is not None and not self._closed.done():
+            self._closed.set_result(True)
+
+    async def connect(self):
+        """
+        Connect and open channel. Concurrent calls are serialized: ones waiting for another to connect
+        use its connection if the channel is open, not to close it with messages in flight.
+        Retries are done as QueueClient does, with delays awaited.
+
+        :raises:    Anything AsyncioConnection can raise
+        """
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+
+        _connections = self._connections
+
+        async with self._connect_lock:
+            if self._connections != _connections and self.channel is not None and self.channel.is_open:
+                logging.debug("Connected by a concurrent call already")
+                return
+
+            await self.__connect()
+            self._connections += 1
+
+    async def __connect(self):
+        params = self.connection_parameters
+        tries = self.reconnect_tries
+        delay = 0
+
+        while True:
+            await self.disconnect()
+
+            try:
+                await self._open(params)
+                return
+            except (pika.exceptions.AMQPConnectionError,
+                    pika.exceptions.AMQPChannelError) as e:
+                if isinstance(e, pika.exceptions.ChannelClosedByBroker) or tries == 0:
+                    await self.disconnect()
+                    raise
+                if delay >= self.reconnect_delay:
+                    delay = self.reconnect_delay
+                logging.debug("Connection to %s:%d failed: %s - trying again in %d seconds...",
+                              params.host, params.port, repr(e), delay)
+                if tries > 0:
+                    tries -= 1
+
+                await asyncio.sleep(delay)
+                delay = delay * 2 if delay else 1
+
+    async def disconnect(self):
+        """
+        Close connection ignoring any error
+        """
+        _connection = self.connection
+
+        if _connection is None or _connection.is_closed:
+            return
+
+        self._closed = asyncio.get_event_loop().create_future()
+
+        try:
+            if not _connection.is_closing:
+                _connection.close()
+
+            await self._closed
+        except Exception as e:
+            logging.debug("Disconnection failed: %s", repr(e))
+        finally:
+            self._closed = None
+
+    async def _publish(self, body, properties, routing_key):
+        """
+        Publish and wait for confirm
+        """
+        if self.channel is None or not self.channel.is_open:
+            await self.connect()
+
+        # delivery tag is taken by the message only if it is published: publishing may raise
+        self.channel.basic_publish(exchange=self.exchange, routing_key=routing_key, body=body, properties=properties)
+        self._delivery_tag += 1
+        _confirmed = asyncio.get_event_loop().create_future()
+        self._confirms[self._delivery_tag] = _confirmed
+        await _confirmed
+
+    async def send(self, body, content_type=None, headers={}, content_encoding=None, message_id=None, partition_key=None):
+        """
+        Send a message and wait for the broker to confirm it. Parameters are the same as for QueueClient.send()
+
+        :raises: PublishNacked if the broker has rejected the message, RateLimited as QueueClient.send() does,
+                 anything pika can raise + anything json.dumps() in case of list/dict body
+        """
+        if isinstance(body, dict) or isinstance(body, list):
+            content_type = 'application/json'
+            body = json.dumps(body)
+
+        _wait = self._rate_limit(body)
+
+        if _wait:
+            await asyncio.sleep(_wait)
+
+        if message_id is None:
+            message_id = os.urandom(16).hex()
+
+        _routing_key = self.partition_routing_key(partition_key, headers)
+        _properties = self._properties(content_type, headers, content_encoding, message_id)
+
+        try:
+            await self._publish(body, _properties, _routing_key)
+        except (pika.exceptions.AMQPConnectionError, pika.exceptions.AMQPChannelError) as e:
+            if not self.resend_on_fail:
+                raise
+
+            # the channel may be reopened by a concurrent send already: it is not to be closed with its messages
+            logging.debug('Got an error while trying to send message, will reconnect if needed and re-send', exc_info=True)
+            await self._publish(body, _properties, _routing_key)
+
+    async def send_stream(self, fileobj, content_type=None, headers={}, content_encoding=None, chunk_size=None,
+                          transfer_id=None, partition_key=None):
+        """
+        Send large payload as a sequence of chunk messages, see QueueClient.send_stream()
+
+        :returns: transfer id
+        """
+        if transfer_id is None:
+            transfer_id = os.urandom(16).hex()
+
+        for (_chunk, _headers, _message_id, _partition_key) in self._stream_chunks(
+                fileobj, headers, chunk_size, transfer_id, partition_key):
+            await self.send(_chunk, content_type=content_type, headers=_headers, content_encoding=content_encoding,
+                            message_id=_message_id, partition_key=_partition_key)
+
+        return transfer_id
+
+    def __del__(self):
+        # asynchronous disconnect can not be done here
+        pass
@@ -0,0 +1,13 @@
+#!/usr/bin/env python
+
+from oc_cdt_queue2.queue_async_client import AsyncQueueClient
+from oc_cdt_queue2.queue_rpc import QueueRPC
+
+
+class AsyncQueueRPC(AsyncQueueClient, QueueRPC):
+    """
+    asyncio version of QueueRPC: the same published contract, calls are to be awaited:
+        await rpc.connect()
+        await rpc.method(arg, param=value)
+    """
+    pass
@@ -1,10 +1,18 @@
 #!/usr/bin/env python
 
 from oc_cdt_queue2.queue_base import QueueBase
-import pika
+from oc_cdt_queue2.lazy import lazy_import
+from oc_cdt_queue2.lazy import LazyAttribute
+from oc_cdt_queue2.rate_limit import RateLimiter
+from oc_cdt_queue2.rate_limit import RateLimited
+from oc_cdt_queue2.outbox import Outbox
 import json
 import os
-import re
+import struct
+import threading
+
+# loading pika takes most of the import time and is not needed until connection
+pika = lazy_import('pika')
 import logging
 import time
 
@@ -14,18 +22,38 @@ class QueueClient(QueueBase):
     This is AMQP client class. It can be used stand-alone, but better use QueueRPC from queue_rpc.py
     """
     resend_on_fail = True
+    default_chunk_size = 1024 * 1024    # Chunk size for send_stream(), bytes
+    timestamp_messages = True   # Set timestamp property and published_at_header with microseconds resolution
 
     # One can re-define it for debugging purposes or to implement another protocol driver
     # See queue_loopback.py as an somewhat dirty example
-    _Connection = pika.BlockingConnection
+    _Connection = LazyAttribute('pika', 'BlockingConnection')
+    _RateLimiter = RateLimiter
+    _Outbox = Outbox
+    outbox_batch_size = 100     # Messages read from outbox at once by background publisher
+    _outbox_meta = struct.Struct('<I')   # Outbox record: length of JSON with message properties, JSON, body
 
     def __init__(self, *args, **kvargs):
         super(QueueClient, self).__init__(*args, **kvargs)
         self.routing_key = None
         self.exchange = None
         self.priority = None
+        self.partition_header = None
         self.connection = None
         self.channel = None
+        # partition for messages sent without partitioning key
+        self._next_partition = 0
+        self.rate_limiter = None
+        self.rate_limit_block = True
+        self.counter_throttled = 0
+        self.counter_rate_limited = 0
+        self.throttled_time = 0.0
+        self.outbox_path = None
+        self.outbox_max_size = 0
+        self.outbox_sync = False
+        self.outbox = None
+        self._outbox_thread = None
+        self._outbox_stop = threading.Event()
 
     def basic_args(self, parser=None):
         """
@@ -40,6 +68,22 @@ class QueueClient(QueueBase):
         parser.add_argument('--routing-key', help='Set routing key. Default is to use queue name', default=None)
         parser.add_argument('--exchange', help='Set exchange. Use default if not specified', default='')
         parser.add_argument('--priority', help='Messages priority', default=1, type=int)
+        parser.add_argument('--partition-header', help='Header to take partitioning key from for partitioned queue',
+                            default=None)
+        parser.add_argument('--rate-limit', help='Max messages to send per second, 0 for no limit', default=0, type=float)
+        parser.add_argument('--rate-limit-bytes', help='Max message body bytes to send per second, 0 for no limit',
+                            default=0, type=float)
+        parser.add_argument('--rate-limit-burst', help='Seconds worth of messages to send at once before limiting',
+                            default=1.0, type=float)
+        parser.add_argument('--rate-limit-group', help='Share rate limit with other clients of the process set up with this group',
+                            default=None)
+        parser.add_argument('--rate-limit-raise', help='Raise RateLimited instead of waiting when rate limit is reached',
+                            default=False, action='store_true')
+        parser.add_argument('--outbox', help='Write messages to outbox in this directory and publish them in background, '
+                                             'so sending does not wait for the broker', default=None)
+        parser.add_argument('--outbox-max-size', help='Max outbox size on disk, MB', default=1024, type=int)
+        parser.add_argument('--outbox-sync', help='Flush every message written to outbox to disk',
+                            default=False, action='store_true')
         return parser
 
     def setup_from_args(self, args=None):
@@ -51,7 +95,11 @@ class QueueClient(QueueBase):
         :return: Used args
         """
         args = super(QueueClient, self).setup_from_args(args)
-        self.setup(routing_key=args.routing_key, exchange=args.exchange, priority=args.priority)
+        self.setup(routing_key=args.routing_key, exchange=args.exchange, priority=args.priority,
+                   partition_header=args.partition_header, rate_limit=args.rate_limit,
+                   rate_limit_bytes=args.rate_limit_bytes, rate_limit_burst=args.rate_limit_burst,
+                   rate_limit_group=args.rate_limit_group, rate_limit_block=not args.rate_limit_raise,
+                   outbox=args.outbox, outbox_max_size=args.outbox_max_size * 1024 * 1024, outbox_sync=args.outbox_sync)
 
         return args
 
@@ -62,6 +110,16 @@ class QueueClient(QueueBase):
         :param routing_key:    Routing key. Uses queue name as routing key if not specified
         :param exchange:    RabbitMQ exchange name. Uses default exchange if not specified
         :param priority:    Messages priority for sending
+        :param partition_header:    Header to take partitioning key from if the queue is partitioned
+        :param rate_limit:  Max messages to send per second, 0 for no limit
+        :param rate_limit_bytes:    Max message body bytes to send per second, 0 for no limit
+        :param rate_limit_burst:    Seconds worth of messages sent at once before the limits apply
+        :param rate_limit_group:    Name of the limit shared by clients of this process, set up with the same limits
+        :param rate_limit_block:    Wait for the limit if it is reached, raise RateLimited otherwise
+        :param outbox:  Directory to keep messages in until they are published by background thread, None to publish
+                        them at once
+        :param outbox_max_size: Max outbox size on disk, bytes
+        :param outbox_sync: Flush every message written to outbox to disk, so it survives power loss also
 
         All the rest params are the same as QueueBase.setup(). If used without url - no
         basic parameters touched, only client-specific are set
@@ -69,6 +127,23 @@ class QueueClient(QueueBase):
         self.routing_key = argv.pop('routing_key', None)
         self.exchange = argv.pop('exchange', '')
         self.priority = argv.pop('priority', 1)
+        self.partition_header = argv.pop('partition_header', None)
+        _rate_limit = argv.pop('rate_limit', 0)
+        _rate_limit_bytes = argv.pop('rate_limit_bytes', 0)
+        _rate_limit_burst = argv.pop('rate_limit_burst', 1.0)
+        _rate_limit_group = argv.pop('rate_limit_group', None)
+        self.rate_limit_block = argv.pop('rate_limit_block', True)
+        self.rate_limiter = None
+        self.outbox_path = argv.pop('outbox', None)
+        self.outbox_max_size = argv.pop('outbox_max_size', 1024 * 1024 * 1024)
+        self.outbox_sync = argv.pop('outbox_sync', False)
+
+        if _rate_limit or _rate_limit_bytes:
+            if _rate_limit_group:
+                self.rate_limiter = self._RateLimiter.shared(_rate_limit_group, _rate_limit, _rate_limit_bytes,
+                                                             _rate_limit_burst)
+            else:
+                self.rate_limiter = self._RateLimiter(_rate_limit, _rate_limit_bytes, _rate_limit_burst)
 
         if len(args) > 0 or 'url' in argv:
             super(QueueClient, self).setup(*args, **argv)
@@ -77,24 +152,106 @@ class QueueClient(QueueBase):
         if self.routing_key is None:
             self.routing_key = self.queue
 
-    def _basic_publish(self, body, content_type, headers, content_encoding):
+    def partition_routing_key(self, partition_key=None, headers=None):
+        """
+        Routing key for a message to partitioned queue.
+        Partition is chosen by hash of the key given or taken from partition_header,
+        messages without key are sent to partitions in turn.
+
+        :param partition_key:   Partitioning key
+        :param headers:     Message headers
+        :returns: routing key, self.routing_key if the queue is not partitioned
+        """
+        if not self.partitions:
+            return self.routing_key
+
+        if partition_key is None and self.partition_header:
+            partition_key = (headers or dict()).get(self.partition_header)
+
+        if partition_key is None:
+            _index = self._next_partition
+            self._next_partition = (_index + 1) % self.partitions
+        else:
+            _index = self.partition_index(partition_key, self.partitions)
+
+        return self.partition_queue_name(self.routing_key, _index)
+
+    def _rate_limit(self, body):
+        """
+        Take rate limit tokens for a message
+
+        :returns: seconds to wait before sending
+        :raises: RateLimited if the limit is reached and rate_limit_block is not set
+        """
+        if self.rate_limiter is None:
+            return 0
+
+        _size = 0
+
+        if self.rate_limiter.bytes_rate and body:
+            _size = len(body if isinstance(body, bytes) else str(body).encode('utf-8'))
+
+        try:
+            _wait = self.rate_limiter.reserve(_size, self.rate_limit_block)
+        except RateLimited:
+            self.counter_rate_limited += 1
+            raise
+
+        if _wait:
+            logging.debug("Publish rate limit reached, waiting %.3f seconds", _wait)
+            self.counter_throttled += 1
+            self.throttled_time += _wait
+
+        return _wait
+
+    def get_stats(self):
+        """
+        Get sending statistics
+
+        :returns: dict
+        """
+        _stats = {'throttled': self.counter_throttled,
+                  'throttled_time': self.throttled_time,
+                  'rate_limited': self.counter_rate_limited}
+
+        if self.outbox is not None:
+            _stats['outbox'] = len(self.outbox)
+            _stats['outbox_size'] = self.outbox.size
+
+        return _stats
+
+    def _properties(self, content_type, headers, content_encoding, message_id=None):
+        _timestamp = None
+
+        if self.timestamp_messages:
+            # consumer measures time the message waited in the broker by these
+            _now = time.time()
+            _timestamp = int(_now)
+            headers = dict(headers or dict())
+            headers[self.published_at_header] = int(_now * 1000000)
+
+        return pika.BasicProperties(
+            delivery_mode=2,  # make message persistent
+            priority=self.priority,
+            content_type=content_type,
+            headers=headers,
+            content_encoding=content_encoding,
+            message_id=message_id,
+            timestamp=_timestamp
+        )
+
+    def _basic_publish(self, body, content_type, headers, content_encoding, message_id=None, routing_key=None):
         self.channel.basic_publish(
             exchange=self.exchange,
-            routing_key=self.routing_key,
+            routing_key=routing_key or self.routing_key,
             body=body,
-            properties=pika.BasicProperties(
-                delivery_mode=2,  # make message persistent
-                priority=self.priority,
-                content_type=content_type,
-                headers=headers,
-                content_encoding=content_encoding
-            ))
+            properties=self._properties(content_type, headers, content_encoding, message_id))
 
     def __connect(self, params):
         """
         This is a helper for handling reconnections
         """
-        self.disconnect()
+        self._close_connection()
         self.connection = self._Connection(params)
         self.channel = self.connection.channel()
 
@@ -103,32 +260,38 @@ class QueueClient(QueueBase):
 
     def __queue_declare(self, deads_disabled=False):
         """
-        Queue creation with or without dead messages queue and exchange
+        Queue creation with or without dead messages queue and exchange.
+        Skipped if the same topology was declared on this broker already: on reconnect for example.
         """
-        if deads_disabled:
-            self.channel.queue_declare(queue=self.queue, durable=True, arguments={'x-max-priority': 3})
-        else:
-            queue_regex = re.compile('.*(?=\.)')
-            try:
-                deads_queue_name = queue_regex.findall(self.queue)[0] + '.deads'
-            except IndexError:
-                deads_queue_name = self.queue + '.deads'
-
-            self.channel.exchange_declare(exchange=deads_queue_name, exchange_type='direct', durable=True)  # Creating dead-messages exchange
-            self.channel.queue_declare(queue=deads_queue_name, durable=True, arguments={'x-max-priority': 3})  # Creating dead-messages queue
-            self.channel.queue_bind(queue=deads_queue_name, exchange=deads_queue_name, routing_key=deads_queue_name)  # Binding the deads queue to the exchange
-            # Creating or updating the existing exchange with the appropriate x-dead-letter arguments
-            self.channel.queue_declare(queue=self.queue, durable=True, arguments={'x-max-priority': 3,
-                                                                                  'x-dead-letter-exchange': deads_queue_name,
-                                                                                  'x-dead-letter-routing-key': deads_queue_name})
+        _verify = self.queue_declare == 'verify'
+        _topology = self.queues_topology(self.partition_queue_names(self.queue, self.partitions),
+                                         deads_disabled=deads_disabled, verify=_verify,
+                                         deads_queue=self.deads_queue_name(self.queue))
+        _keys = self._declarations.topology_keys(_topology)
+
+        if not _verify and self._declarations.is_confirmed(self.connection_parameters, _keys):
+            logging.debug("Topology for %s is declared already", self.queue)
+            return
+
+        for (_method, _kwargs) in _topology:
+            getattr(self.channel, _method)(**_kwargs)
+
+        if not _verify:
+            self._declarations.add(self.connection_parameters, _keys)
 
     def connect(self):
         """
         Connects to server and allocates channel. If allready connected - replaces the old connection
         with new one. Sets self.connection and seld.channel properties and declares queue if asked by setup()
 
-        :raises:    Anything BlockingConnection() can raise
+        With outbox set up, opens it and starts background publisher instead: connection is made there.
+
+        :raises:    Anything BlockingConnection() can raise, anything Outbox() can raise
         """
+        if self.outbox_path:
+            self._start_outbox()
+            return
+
         params = self.connection_parameters
         tries = self.reconnect_tries
         delay = 0
@@ -159,15 +322,19 @@ class QueueClient(QueueBase):
 
     def disconnect(self):
         """
-        Disconnect ignoring any error
+        Disconnect ignoring any error. Background publisher is stopped, messages not published yet are kept in outbox.
         """
+        self._stop_outbox()
+        self._close_connection()
+
+    def _close_connection(self):
         try:
             if self.connection != None and self.connection.is_open == True:
                 self.connection.close()
         except AttributeError:
             pass
 
-    def send(self, body, content_type=None, headers={}, content_encoding=None):
+    def send(self, body, content_type=None, headers={}, content_encoding=None, message_id=None, partition_key=None):
         """
         Sends an message
 
@@ -175,22 +342,223 @@ class QueueClient(QueueBase):
         :param content_type:    Message content_type. This will be set automatically if list or dict supplied
         :param headers:        dict of message headers
         :param content_encoding:Message content encoding
+        :param message_id:  Message id, unique one is generated if not specified.
+                            It is the same for re-sent message, so consumer may detect duplicates
+        :param partition_key:   Key to choose partition of partitioned queue by, partition_header value by default
 
-        :raises: anything pika.channel.basic_publish() can raise + anything json.dumps() in case of list/dict body
+        :raises: anything pika.channel.basic_publish() can raise + anything json.dumps() in case of list/dict body,
+                 RateLimited if rate limit is reached and rate_limit_block is not set,
+                 OutboxFull if outbox is set up and its size limit is reached
         """
         if isinstance(body, dict) or isinstance(body, list):
             content_type = 'application/json'
             body = json.dumps(body)
 
+        _wait = self._rate_limit(body)
+
+        if _wait:
+            time.sleep(_wait)
+
+        if message_id is None:
+            message_id = os.urandom(16).hex()
+
+        _routing_key = self.partition_routing_key(partition_key, headers)
+
+        if self.outbox_path:
+            self._outbox_append(body, self._properties(content_type, headers, content_encoding, message_id), _routing_key)
+            return
+
         try:
-            self._basic_publish(body, content_type, headers, content_encoding)
+            self._basic_publish(body, content_type, headers, content_encoding, message_id, _routing_key)
         except (pika.exceptions.AMQPConnectionError, pika.exceptions.ChannelClosed,
                 pika.exceptions.ConnectionClosed) as e:
             if self.resend_on_fail:
                 logging.debug('Got an error while trying to send message, will try to reconnect and re-send', exc_info=True)
                 self.connect()
-                self._basic_publish(body, content_type, headers, content_encoding)
+                self._basic_publish(body, content_type, headers, content_encoding, message_id, _routing_key)
             else: 
                 raise
 
 
+
+    def _pack_outbox(self, body, properties, routing_key):
+        """
+        Convert message to outbox record. Headers should be JSON-serializable.
+        """
+        _text = isinstance(body, str)
+        _meta = json.dumps({'exchange': self.exchange, 'routing_key': routing_key, 'text': _text,
+                            'properties': dict((_name, _value) for (_name, _value) in vars(properties).items()
+                                               if _value is not None)}).encode('utf-8')
+
+        if _text:
+            body = body.encode('utf-8')
+
+        return self._outbox_meta.pack(len(_meta)) + _meta + (body or b'')
+
+    def _unpack_outbox(self, record):
+        """
+        Convert outbox record back to message
+
+        :returns: (exchange, routing key, body, properties)
+        """
+        (_length, ) = self._outbox_meta.unpack_from(record, 0)
+        _start = self._outbox_meta.size + _length
+        _meta = json.loads(record[self._outbox_meta.size:_start].decode('utf-8'))
+        _body = record[_start:]
+
+        if _meta['text']:
+            _body = _body.decode('utf-8')
+
+        return (_meta['exchange'], _meta['routing_key'], _body, pika.BasicProperties(**_meta['properties']))
+
+    def _outbox_append(self, body, properties, routing_key):
+        if self._outbox_thread is None:
+            self.connect()
+
+        self.outbox.append(self._pack_outbox(body, properties, routing_key))
+
+    def _start_outbox(self):
+        """
+        Open outbox and start background publisher
+        """
+        if self.outbox is None:
+            self.outbox = self._Outbox(self.outbox_path, max_size=self.outbox_max_size, sync=self.outbox_sync)
+
+        if self._outbox_thread is not None:
+            return
+
+        self._outbox_stop.clear()
+        self._outbox_thread = threading.Thread(target=self._drain_outbox, name='outbox')
+        self._outbox_thread.daemon = True
+        self._outbox_thread.start()
+
+    def _stop_outbox(self):
+        """
+        Stop background publisher and close outbox
+        """
+        if self._outbox_thread is not None:
+            self._outbox_stop.set()
+            self.outbox.wakeup()
+            self._outbox_thread.join()
+            self._outbox_thread = None
+
+        if self.outbox is not None:
+            self.outbox.close()
+            self.outbox = None
+
+    def _drain_outbox(self):
+        """
+        Background publisher: sends messages from outbox with publisher confirms and removes confirmed ones.
+        Reconnects while the broker is not available, messages not confirmed are sent again then.
+        """
+        delay = 0
+
+        while not self._outbox_stop.is_set():
+            try:
+                if self.channel is None or not self.channel.is_open:
+                    self.__connect(self.connection_parameters)
+                    self.channel.confirm_delivery()
+                    delay = 0
+
+                for (_position, _record) in self.outbox.read(self.outbox_batch_size, timeout=1):
+                    (_exchange, _routing_key, _body, _properties) = self._unpack_outbox(_record)
+                    # returns when the broker confirms the message, raises NackError if it rejects it
+                    self.channel.basic_publish(exchange=_exchange, routing_key=_routing_key, body=_body,
+                                               properties=_properties)
+                    self.outbox.commit(_position)
+            except Exception as e:
+                if isinstance(e, pika.exceptions.AMQPError):
+                    logging.warning("Publishing from outbox failed: %s - trying again in %d seconds", repr(e), delay)
+                else:
+                    logging.exception(e)
+
+                self.outbox.rewind()
+                self.channel = None
+
+                try:
+                    self._close_connection()
+                except Exception as e:
+                    logging.debug("Disconnection failed: %s", repr(e))
+
+                self._outbox_stop.wait(delay)
+                delay = min(delay * 2 or 1, max(1, self.reconnect_delay))
+
+    def flush(self, timeout=None):
+        """
+        Wait for messages written to outbox to be published
+
+        :param timeout: seconds to wait, None to wait forever
+        :returns: True if all messages are published
+        """
+        if self.outbox is None:
+            return True
+
+        return self.outbox.wait_empty(timeout)
+
+    def send_stream(self, fileobj, content_type=None, headers={}, content_encoding=None, chunk_size=None,
+                    transfer_id=None, partition_key=None):
+        """
+        Send large payload as a sequence of chunk messages, reading it from a file-like object chunk by chunk.
+        Chunks have transfer id and chunk number headers, the last one has total chunks number also.
+        QueueServer spools chunks to disk and passes them to on_stream() when the last one arrives.
+
+        :param fileobj:     File-like object opened in binary mode to read payload from
+        :param content_type:    Payload content_type, set for every chunk
+        :param headers:     dict of headers to set for every chunk
+        :param content_encoding:    Payload content encoding
+        :param chunk_size:  Chunk size, bytes. default_chunk_size if not specified
+        :param transfer_id: Transfer id, unique one is generated if not specified
+        :param partition_key:   Key to choose partition of partitioned queue by, partition_header value
+                                or transfer id by default: all chunks are sent to the same partition
+        :returns: transfer id
+        :raises: anything send() can raise
+        """
+        if transfer_id is None:
+            transfer_id = os.urandom(16).hex()
+
+        for (_chunk, _headers, _message_id, _partition_key) in self._stream_chunks(
+                fileobj, headers, chunk_size, transfer_id, partition_key):
+            self.send(_chunk, content_type=content_type, headers=_headers, content_encoding=content_encoding,
+                      message_id=_message_id, partition_key=_partition_key)
+
+        return transfer_id
+
+    def _stream_chunks(self, fileobj, headers, chunk_size, transfer_id, partition_key):
+        """
+        Read payload chunk by chunk for send_stream()
+
+        :returns: generator of (chunk, headers, message id, partition key) for each chunk message
+        """
+        chunk_size = chunk_size or self.default_chunk_size
+
+        if chunk_size < 1:
+            raise ValueError("Chunk size should be positive")
+
+        if partition_key is None and self.partition_header:
+            partition_key = (headers or dict()).get(self.partition_header)
+
+        if partition_key is None:
+            partition_key = transfer_id
+
+        _index = 0
+        _chunk = fileobj.read(chunk_size)
+
+        while True:
+            # read ahead to know if the current chunk is the last one
+            _next = fileobj.read(chunk_size) if _chunk else b''
+            _headers = dict(headers or dict())
+            _headers[self.stream_id_header] = transfer_id
+            _headers[self.stream_index_header] = _index
+
+            if not _next:
+                _headers[self.stream_count_header] = _index + 1
+
+            yield (_chunk, _headers, '%s.%d' % (transfer_id, _index), partition_key)
+
+            if not _next:
+                break
+
+            _chunk = _next
+            _index += 1
+
+        logging.debug("Transfer %s sent in %d chunks", transfer_id, _index + 1)
@@ -1,11 +1,21 @@
 #!/usr/bin/env python2.7
 
 import pika
+import copy
 import multiprocessing
 import logging
+import functools
+import signal
+import time
+from .queue_base import QueueBase
 from .ipc_messages import IpcMessage
 from .ipc_messages import IpcMessageResult
 from .ipc_messages import IpcExcMsg
+from .ipc_messages import IpcDeclared
+from .ipc_messages import IpcLatency
+from .ipc_messages import IpcQueueStats
+from .declarations import DeclarationCache
+from .cpu_profile import CpuProfiler
 
 """
 This is helper proxy-type class which is to be run in separate process
@@ -33,6 +43,8 @@ class QueueConnectionProcess(multiprocessing.Process):
     _declare = None
     _prefetch_count = None
     _consumer_tag = None
+    # header with publish sequence number of a message re-published to retry queue, to match it when returned
+    retry_publish_header = 'x-retry-publish'
 
     def __init__(self,
                  connection,
@@ -42,7 +54,20 @@ class QueueConnectionProcess(multiprocessing.Process):
                  deads_disabled,
                  declare,
                  ipc_q_out,
-                 ipc_q_in):
+                 ipc_q_in,
+                 retry_delays=None,
+                 declared=None,
+                 max_inflight=0,
+                 max_inflight_bytes=0,
+                 start_method=None,
+                 declare_queues=None,
+                 consume_queues=None,
+                 latency=False,
+                 probe_interval=0,
+                 profile=None,
+                 profile_output=None,
+                 profile_interval=0.005,
+                 deads_queue=None):
         """
         The process initialization.
         :param connection: connection class reference
@@ -53,12 +78,40 @@ class QueueConnectionProcess(multiprocessing.Process):
         :type prefetch_count: int
         :param deads_disabled: disable deads queues routing
         :type deads_disabled: boolean
-        :param declare: tristate queue declare parameter ('yes', 'no', 'only')
+        :param declare: queue declare parameter ('yes', 'no', 'only', 'verify')
         :type declare: str
         :param ipc_q_out: python queue for messages and exceptions
         :type ipc_q_out: multiprocessing.JoinableQueue
         :param ipc_q_in: python queue for results
         :type ipc_q_in: multiprocessing.JoinableQueue
+        :param retry_delays: delays of retry queues to declare, seconds
+        :type retry_delays: list
+        :param declared: keys of declarations confirmed by the broker before, see DeclarationCache
+        :type declared: frozenset
+        :param max_inflight: pause consuming when this number of messages is passed to worker
+                             and not reported back, 0 for no limit
+        :type max_inflight: int
+        :param max_inflight_bytes: pause consuming when total body size of such messages reaches this, 0 for no limit
+        :type max_inflight_bytes: int
+        :param start_method: multiprocessing start method: 'fork', 'spawn', 'forkserver', None for default one
+        :type start_method: str
+        :param declare_queues: other queues to declare in the same way as the main one: partitions of the queue
+        :type declare_queues: list
+        :param consume_queues: other queues to consume from along with the main one
+        :type consume_queues: list
+        :param latency: report acknowledgement latency back for results with reporting time set
+        :type latency: boolean
+        :param probe_interval: report depth of consumed queues every N seconds, 0 to disable
+        :type probe_interval: float
+        :param profile: CPU profiling method, see CpuProfiler. Report is logged on SIGUSR2 and on stopping
+        :type profile: str
+        :param profile_output: file to write CPU profile stats to along with report
+        :type profile_output: str
+        :param profile_interval: seconds between stack samples for 'sample' profiling method
+        :type profile_interval: float
+        :param deads_queue: dead messages queue name, deads_queue_name() of the queue by default.
+                            Partitions consumed should get the one of the partitioned queue
+        :type deads_queue: str
         """
         if not connection:
             raise TypeError("Please specify the connection class")
@@ -86,24 +139,78 @@ class QueueConnectionProcess(multiprocessing.Process):
         self._rmq_deads = None
 
         if not deads_disabled:
-            self._rmq_deads = queue
-
-            if '.' in self._rmq_deads:
-                # pick last suffix off to replace it with '.deads'
-                self._rmq_deads = queue.rsplit('.', 1)[0]
-
-            self._rmq_deads = '.'.join([self._rmq_deads, 'deads'])
-            logging.debug("Deads queue name is: %s" % self._rmq_deads)
+            self._rmq_deads = deads_queue or QueueBase.deads_queue_name(queue)
+            logging.debug("Deads queue name is: %s", self._rmq_deads)
 
         if not isinstance(declare, str):
             raise TypeError("'declare' parameter has wrong type")
 
-        if declare not in ['yes', 'no', 'only']:
+        if declare not in ['yes', 'no', 'only', 'verify']:
             raise ValueError("Unsupported 'declare' value: %s" % declare)
 
         self._declare = declare
         self._prefetch_count = prefetch_count
         self._consumer_tag = None
+        # consumers of other queues, cancelled along with the main one
+        self._consume_queues = list(consume_queues or list())
+        self._extra_consumer_tags = list()
+        # consumer tag: queue, to let worker know where a message came from
+        self._consumer_queues = dict()
+
+        # additional declarations independent of the main chain: list of (channel method name, arguments)
+        # main chain comes first since declarations shared by the queues are kept in the first place
+        self._declare_queues = [queue] + list(declare_queues or list())
+        _topology = QueueBase.queues_topology(self._declare_queues, deads_disabled=deads_disabled,
+                                              retry_delays=retry_delays, deads_queue=self._rmq_deads)
+        self._extra_declarations = _topology[len(QueueBase.queue_topology(
+            queue, deads_disabled=deads_disabled, deads_queue=self._rmq_deads)):]
+        self._declarations_left = list()
+        # channel the additional declarations are done on, and declaration chains to wait for
+        self._declare_channel = None
+        self._declarations_pending = 1
+
+        # skip declarations at all if the same topology was confirmed on previous connection
+        self._retry_delays = retry_delays
+        self._declared = frozenset(declared or frozenset())
+        self._topology_keys = DeclarationCache.topology_keys(_topology)
+        self._report_declared = False
+
+        # messages kept until processing result is known, for re-publishing to retry queues
+        self._keep_messages = bool(retry_delays)
+        self._messages = dict()
+        # retry publishes not confirmed yet: publish sequence number: original delivery tag, and returned ones
+        self._publish_seq = 0
+        self._retries = dict()
+        self._retries_returned = set()
+
+        # messages passed to worker and not reported back: delivery tag: body size
+        # consuming is paused when a limit is reached and resumed when usage drops to a half of it
+        self._max_inflight = max_inflight or 0
+        self._max_inflight_bytes = max_inflight_bytes or 0
+        self._inflight = dict()
+        self._inflight_bytes = 0
+        self._paused = False
+
+        # acknowledgement latency: delivery tag: queue, and (queue, seconds) samples not reported yet
+        self._latency = latency
+        self._delivery_queues = dict()
+        self._ack_samples = list()
+
+        # queues depth is probed with passive declarations on a channel of its own,
+        # so a probe failure does not affect consuming
+        self._probe_interval = probe_interval or 0
+        self._probe_channel = None
+
+        # CPU profiler is created in the process itself, it has a thread and a signal handler
+        self._profile = profile
+        self._profile_output = profile_output
+        self._profile_interval = profile_interval
+        self._profiler = None
+        self._profile_state = None
+
+        # with 'spawn' and 'forkserver' child does not inherit logging configuration
+        self._start_method = start_method
+        self._log_level = logging.getLogger().level
 
         super(QueueConnectionProcess, self).__init__()
         logging.debug("Initialization done")
@@ -164,7 +271,7 @@ class QueueConnectionProcess(multiprocessing.Process):
         :param err: error description
         :type err: Exception
         """
-        logging.debug("Connection was failed to open: %s" % type(err))
+        logging.debug("Connection was failed to open: %s", type(err))
         self._put_out_exception(err)
 
         # This is the main error. Nothing was done yet, so simply stop main loop
@@ -187,12 +294,46 @@ class QueueConnectionProcess(multiprocessing.Process):
         self._channel.add_on_close_callback(self.on_channel_closed)
         self._channel.add_on_cancel_callback(self.disconnect)
 
+        if self._keep_messages:
+            # original message is acked once its copy is confirmed to be routed to retry queue,
+            # unconfirmed ones are redelivered by broker when the channel is lost
+            self._publish_seq = 0
+            self._retries = dict()
+            self._retries_returned = set()
+            self._channel.confirm_delivery(ack_nack_callback=self.on_retry_confirmed)
+            self._channel.add_on_return_callback(self.on_retry_returned)
+
         # declaring queues if we are forced to do so
         if self._declare == 'no':
-            logging.debug("Declaration of queues is disabled, try to bind to an existing queue %s" % self._rmq_main)
+            logging.debug("Declaration of queues is disabled, try to bind to an existing queue %s", self._rmq_main)
             self.on_main_queue_declared()
             return
 
+        if self._declare == 'verify':
+            logging.debug("Verifying queues for %s", self._rmq_main)
+            self._declarations_pending = 1
+            self._declarations_left = QueueBase.queues_topology(
+                self._declare_queues, deads_disabled=not self._rmq_deads, retry_delays=self._retry_delays, verify=True,
+                deads_queue=self._rmq_deads)
+            self._declare_channel = self._channel
+            self.on_extra_declared()
+            return
+
+        if self._declared.issuperset(self._topology_keys):
+            logging.debug("Topology for %s is declared already, skipping declarations", self._rmq_main)
+            self.on_topology_declared()
+            return
+
+        self._report_declared = True
+        self._declarations_pending = 1
+
+        if self._extra_declarations:
+            # independent declarations are done on a separate channel concurrently with the main chain:
+            # pika waits for a reply to each synchronous method before sending the next one on the same channel
+            self._declarations_pending += 1
+            self._declarations_left = list(self._extra_declarations)
+            self._connection.channel(on_open_callback=self.on_declare_channel_open)
+
         if not self._rmq_deads:
             # assming deads queue creation OK and bind to main queue or disconnect
             self.on_deads_queue_bind()
@@ -211,7 +352,7 @@ class QueueConnectionProcess(multiprocessing.Process):
         :param frame: result frame from pika, unused
         :type frame: pika.Frame
         """
-        logging.debug("Declared deads exchange, %s queue declaring." % self._rmq_deads)
+        logging.debug("Declared deads exchange, %s queue declaring.", self._rmq_deads)
 
         self._channel.queue_declare(queue=self._rmq_deads,
                                     durable=True,
@@ -239,7 +380,7 @@ class QueueConnectionProcess(multiprocessing.Process):
         :param frame: result frame from pika, unused
         :type frame: pika.Frame
         """
-        logging.debug("Declaring main queue %s" % self._rmq_main)
+        logging.debug("Declaring main queue %s", self._rmq_main)
 
         __rmq_args = {'x-max-priority': 3}
 
@@ -260,12 +401,88 @@ class QueueConnectionProcess(multiprocessing.Process):
         :type frame: pika.Frame
         """
 
+        if self._declare == 'no':
+            self.on_topology_declared()
+            return
+
+        self.on_declarations_done()
+
+    def on_declare_channel_open(self, channel):
+        """
+        Callback for opening of the channel additional declarations are done on
+        :param channel: channel opened
+        :type channel: pika.Channel
+        """
+        logging.debug("Declarations channel opened")
+        self._declare_channel = channel
+        self._declare_channel.add_on_close_callback(self.on_declare_channel_closed)
+        self.on_extra_declared()
+
+    def on_declare_channel_closed(self, channel, reason):
+        """
+        Callback for declarations channel closed event.
+        Closing before all declarations are done means an error, e.g. arguments mismatch.
+        :param channel: channel just closed
+        :type channel: pika.Channel
+        :param reason: close reason
+        :type reason: Exception
+        """
+        if self._declare_channel is None:
+            # closed by ourselves
+            return
+
+        logging.debug("Declarations channel closed unexpectedly, disconnecting")
+        self._declare_channel = None
+        self._put_out_exception(reason)
+        self.disconnect()
+
+    def on_extra_declared(self, frame=None):
+        """
+        Callback for additional declarations chain: retry queues and so on, or passive checks for 'verify'
+        :param frame: result frame from pika, unused
+        :type frame: pika.Frame
+        """
+        if self._declarations_left:
+            (_method, _kwargs) = self._declarations_left.pop(0)
+            logging.debug("Extra declaration: %s %s", _method, _kwargs.get('queue') or _kwargs.get('exchange'))
+            getattr(self._declare_channel, _method)(callback=self.on_extra_declared, **_kwargs)
+            return
+
+        _channel = self._declare_channel
+        self._declare_channel = None
+
+        if _channel is not None and _channel is not self._channel:
+            _channel.close()
+
+        self.on_declarations_done()
+
+    def on_declarations_done(self):
+        """
+        One of declaration chains is finished, go on when all of them are
+        """
+        self._declarations_pending -= 1
+
+        if self._declarations_pending > 0:
+            logging.debug("Waiting for %d declaration chains more", self._declarations_pending)
+            return
+
+        self.on_topology_declared()
+
+    def on_topology_declared(self):
+        """
+        All declarations are done or skipped, stop or set prefetch count
+        """
+        if self._report_declared:
+            # let the parent remember topology for reconnections
+            self._report_declared = False
+            self._ipc_q_out.put(IpcDeclared(self._topology_keys))
+
         if self._declare == 'only':
             logging.debug("Declare is set to 'only' value, stopping")
             self.disconnect()
             return
 
-        logging.debug("Main queue %s has been declared, setting prefetch_count to %d" % (self._rmq_main, self._prefetch_count))
+        logging.debug("Main queue %s has been declared, setting prefetch_count to %d", self._rmq_main, self._prefetch_count)
         self._channel.basic_qos(prefetch_count=self._prefetch_count, callback=self.on_prefetch_set_ok)
 
     def on_prefetch_set_ok(self, frame=None):
@@ -281,11 +498,168 @@ class QueueConnectionProcess(multiprocessing.Process):
         # This function can raise an exception, so 'on_channel_closed' will be run asynchroniously
         # with that exception as 'reason' argument
         # This case consumer tag may be empty or None
-        self._consumer_tag = self._channel.basic_consume(queue=self._rmq_main, on_message_callback=self.on_message)
+        self._start_consuming()
 
         # if we are not failed with 'basic_consume' - scheduler _ipc_q_in checks
         if self._consumer_tag:
             self.ipc_queue_process()
+
+            if self._probe_interval:
+                self._open_probe_channel()
+
+    def _start_consuming(self):
+        """
+        Start consuming from the main queue and the other ones if any
+        """
+        self._consumer_tag = self._channel.basic_consume(queue=self._rmq_main, on_message_callback=self.on_message)
+        self._consumer_queues = {self._consumer_tag: self._rmq_main}
+
+        for _queue in self._consume_queues:
+            _consumer_tag = self._channel.basic_consume(queue=_queue, on_message_callback=self.on_message)
+            self._extra_consumer_tags.append(_consumer_tag)
+            self._consumer_queues[_consumer_tag] = _queue
+
+    def _cancel_extra_consumers(self):
+        """
+        Cancel consuming from queues other than the main one without waiting for confirmation:
+        the main consumer is cancelled after them on the same channel, so its confirmation covers them too
+        """
+        for _consumer_tag in self._extra_consumer_tags:
+            self._channel.basic_cancel(consumer_tag=_consumer_tag)
+
+        self._extra_consumer_tags = list()
+
+    def _inflight_exceeded(self):
+        """
+        In-flight messages number or size has reached a limit
+        """
+        return bool((self._max_inflight and len(self._inflight) >= self._max_inflight) or
+                    (self._max_inflight_bytes and self._inflight_bytes >= self._max_inflight_bytes))
+
+    def _inflight_drained(self):
+        """
+        In-flight messages number and size dropped to a half of limits
+        """
+        return bool((not self._max_inflight or len(self._inflight) <= self._max_inflight // 2) and
+                    (not self._max_inflight_bytes or self._inflight_bytes <= self._max_inflight_bytes // 2))
+
+    def pause_consuming(self):
+        """
+        Stop deliveries until worker catches up.
+        Messages delivered already are processed as usual, ones coming before cancel is confirmed are requeued by pika.
+        """
+        if not self._consumer_tag or not self._channel:
+            return
+
+        logging.info("In-flight limit reached: %d messages, %d bytes, pausing consuming",
+                     len(self._inflight), self._inflight_bytes)
+        self._paused = True
+        _consumer_tag = self._consumer_tag
+        self._consumer_tag = None
+        self._cancel_extra_consumers()
+        self._channel.basic_cancel(consumer_tag=_consumer_tag, callback=self.on_consuming_paused)
+
+    def on_consuming_paused(self, frame=None):
+        """
+        Callback for consuming cancel because of in-flight limits
+        :param frame: result frame from pika, unused
+        :type frame: pika.Frame
+        """
+        logging.debug("Consuming has been paused")
+
+    def resume_consuming(self):
+        """
+        Start consuming again after pause
+        """
+        if not self._paused or not self._channel:
+            return
+
+        logging.info("In-flight usage dropped to %d messages, %d bytes, resuming consuming",
+                     len(self._inflight), self._inflight_bytes)
+        self._paused = False
+        self._start_consuming()
+
+    def _settle(self, delivery_tag, multiple=False):
+        """
+        Forget in-flight message(s) reported back by worker
+        """
+        _tags = [delivery_tag]
+
+        if multiple:
+            _tags = [_tag for _tag in self._inflight if _tag <= delivery_tag]
+
+        for _tag in _tags:
+            self._inflight_bytes -= self._inflight.pop(_tag, 0)
+
+        if self._paused and self._inflight_drained():
+            self.resume_consuming()
+
+    def _open_probe_channel(self):
+        """
+        Open the channel queues depth is probed on
+        """
+        if not self._connection or not self._connection.is_open:
+            return
+
+        self._connection.channel(on_open_callback=self.on_probe_channel_open)
+
+    def on_probe_channel_open(self, channel):
+        """
+        Callback for opening of the probe channel
+        :param channel: channel opened
+        :type channel: pika.Channel
+        """
+        logging.debug("Probe channel opened")
+        self._probe_channel = channel
+        self._probe_channel.add_on_close_callback(self.on_probe_channel_closed)
+        self.probe_queues(channel)
+
+    def on_probe_channel_closed(self, channel, reason):
+        """
+        Callback for probe channel closed event: a queue is missing or the connection is closing.
+        The channel is re-opened on the next probe time, consuming goes on anyway.
+        :param channel: channel just closed
+        :type channel: pika.Channel
+        :param reason: close reason
+        :type reason: Exception
+        """
+        if self._probe_channel is not channel:
+            # closed by ourselves
+            return
+
+        logging.warning("Probe channel closed: %s", reason)
+        self._probe_channel = None
+
+        if self._connection and self._connection.is_open:
+            self._connection.ioloop.call_later(self._probe_interval, self._open_probe_channel)
+
+    def probe_queues(self, channel):
+        """
+        Passively declare consumed queues to get their depth, and schedule the next probe.
+        Replies are handled by the ioloop as they come, so messages are not held by probes.
+        :param channel: probe channel the probe was scheduled for
+        :type channel: pika.Channel
+        """
+        if channel is not self._probe_channel or not channel.is_open:
+            # the channel was closed since then, the new one has its own schedule
+            return
+
+        for _queue in [self._rmq_main] + self._consume_queues:
+            channel.queue_declare(queue=_queue, passive=True, callback=self.on_queue_probed)
+
+        self._connection.ioloop.call_later(self._probe_interval, functools.partial(self.probe_queues, channel))
+
+    def on_queue_probed(self, frame):
+        """
+        Callback for passive declaration of a queue probed
+        :param frame: result frame from pika
+        :type frame: pika.frame.Method
+        """
+        if not self._ipc_q_out:
+            return
+
+        self._ipc_q_out.put(IpcQueueStats(frame.method.queue, frame.method.message_count,
+                                          frame.method.consumer_count, time.time()))
     #### END: CONNECT-RELATED CALLS AND CALLBACKS
 
     #### BEG: DISCONNECT-RELATED CALLS AND CALLBACKS
@@ -300,11 +674,19 @@ class QueueConnectionProcess(multiprocessing.Process):
             logging.debug("Already disconnected, nothing to do")
             return
 
+        if self._probe_channel:
+            _probe_channel = self._probe_channel
+            self._probe_channel = None
+
+            if _probe_channel.is_open:
+                _probe_channel.close()
+
         # if consuming was set to 'on' then first need to cancel it
         if self._consumer_tag:
             logging.debug("Consuming is to be stopped")
 
             if self._channel:
+                self._cancel_extra_consumers()
                 self._channel.basic_cancel(consumer_tag=self._consumer_tag, callback=self.on_consuming_cancel)
                 # when stopping will be done we have to call this method agian
                 # but with _consumer_tag droped
@@ -313,6 +695,7 @@ class QueueConnectionProcess(multiprocessing.Process):
 
             # otherwise consumer tag is to be simply dropped since consuming start was failed
             self._consumer_tag = None
+            self._extra_consumer_tags = list()
 
         # if self._channel is not closed yet: close it
         # in the callback this method will be called again
@@ -382,13 +765,47 @@ class QueueConnectionProcess(multiprocessing.Process):
     #### END: DISCONNECT-RELATED CALLS AND CALLBACKS
 
     #### BEG: main-loop-related methods
+    def _Popen(self, process_obj):
+        """
+        Start the process using context of the start method given
+        """
+        return multiprocessing.get_context(self._start_method).Process._Popen(process_obj)
+
     def run(self):
         """
         Main run loop
         """
-        logging.debug("Started a subprocess, pid is: %d" % self.pid)
+        if not logging.getLogger().handlers:
+            # started from scratch, not forked
+            logging.basicConfig(level=self._log_level)
+
+        # handler may be inherited from supervisor worker, parent terminates us with SIGTERM
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        logging.debug("Started a subprocess, pid is: %d", self.pid)
+
+        if self._profile:
+            self._profiler = CpuProfiler(self._profile, output=self._profile_output, interval=self._profile_interval,
+                                         report_signal=signal.SIGUSR2)
+            self._profile_state = self._profiler.begin()
+
         self.connect()
 
+        if self._profiler is not None:
+            self._profiler.end(self._profile_state, 'connection')
+            self._profiler.log_report(force=True)
+            self._profiler.close()
+
+    def _log_profile(self):
+        """
+        Log CPU profile report if it is requested: profiling is restarted, so the report covers the time until now
+        """
+        if self._profiler is None or not self._profiler.report_due():
+            return
+
+        self._profiler.end(self._profile_state, 'connection')
+        self._profiler.log_report()
+        self._profile_state = self._profiler.begin()
+
     def _set_ipc_delay(self, msg):
         """
         Check if we may reduce _ipc_q check interval
@@ -403,7 +820,7 @@ class QueueConnectionProcess(multiprocessing.Process):
         # set _ipc_q check pause to the minimum of message processing time
         if msg.time_delta > 0.0 and msg.time_delta < self._ipc_delay:
             self._ipc_delay = msg.time_delta
-            logging.debug("Ipc delay is set to %f sec" % self._ipc_delay)
+            logging.debug("Ipc delay is set to %f sec", self._ipc_delay)
 
     def _increase_ipc_delay(self):
         """
@@ -416,7 +833,7 @@ class QueueConnectionProcess(multiprocessing.Process):
             return
 
         self._ipc_delay = _new_delay
-        logging.debug("Ipc delay is increased to %f sec" % self._ipc_delay)
+        logging.debug("Ipc delay is increased to %f sec", self._ipc_delay)
 
     def ipc_queue_process(self):
         """
@@ -438,6 +855,7 @@ class QueueConnectionProcess(multiprocessing.Process):
                 # report it to server
                 self.report_msg_result(_item)
                 self._set_ipc_delay(_item)
+                self._ack_latency(_item)
             else:
                 # otherwise it is something wrong.
                 # consider as shutdown signal
@@ -445,6 +863,12 @@ class QueueConnectionProcess(multiprocessing.Process):
 
             self._ipc_q_in.task_done()
 
+        if self._ack_samples:
+            self._ipc_q_out.put(IpcLatency(self._ack_samples))
+            self._ack_samples = list()
+
+        self._log_profile()
+
         # if we recieve shutdown signal - disconnect immediately without self re-scheduling
         if _shutdown:
             # it is safe to call disconnect here since nothing will be done if we are disconnected already
@@ -458,6 +882,24 @@ class QueueConnectionProcess(multiprocessing.Process):
         # to reduce the CPU
         self._increase_ipc_delay()
 
+    def _ack_latency(self, rslt):
+        """
+        Take acknowledgement latency sample for the result
+        :param rslt: message process result
+        :type rslt: IpcMessageResult
+        """
+        if not self._latency:
+            return
+
+        _queue = self._delivery_queues.pop(rslt.delivery_tag, None)
+
+        if rslt.multiple:
+            for _tag in [_tag for _tag in self._delivery_queues if _tag < rslt.delivery_tag]:
+                del self._delivery_queues[_tag]
+
+        if rslt.reported:
+            self._ack_samples.append((_queue, time.time() - rslt.reported))
+
     def on_message(self, channel, method, properties, body):
         """
         Callback for recieved message. Re-deliver message to the main worker via _ipc_q
@@ -470,7 +912,29 @@ class QueueConnectionProcess(multiprocessing.Process):
         :param body: message body
         :type body: bytes
         """
-        _qmsg = IpcMessage(method.delivery_tag, properties, body)
+        if self.retry_publish_header in (getattr(properties, 'headers', None) or dict()):
+            # publish sequence number is bookkeeping of the process re-published the message, not for handlers
+            del properties.headers[self.retry_publish_header]
+
+        _size = len(body or b'')
+        self._inflight[method.delivery_tag] = _size
+        self._inflight_bytes += _size
+
+        if not self._paused and self._inflight_exceeded():
+            self.pause_consuming()
+
+        _qmsg = IpcMessage(method.delivery_tag, properties, body, redelivered=method.redelivered,
+                           exchange=method.exchange, routing_key=method.routing_key,
+                           inflight=len(self._inflight), inflight_bytes=self._inflight_bytes, paused=self._paused,
+                           queue=self._consumer_queues.get(getattr(method, 'consumer_tag', None)),
+                           received=time.time())
+
+        if self._latency:
+            self._delivery_queues[method.delivery_tag] = _qmsg.queue
+
+        if self._keep_messages:
+            self._messages[method.delivery_tag] = (properties, body)
+
         self._ipc_q_out.put(_qmsg)
 
     def report_msg_result(self, rslt):
@@ -482,15 +946,114 @@ class QueueConnectionProcess(multiprocessing.Process):
         if not rslt:
             raise ValueError("BUG: report_msg_result is called without result itself")
 
+        _message = self._messages.pop(rslt.delivery_tag, None)
+        self._settle(rslt.delivery_tag, multiple=rslt.multiple)
+        _covered = list()
+
+        if rslt.multiple:
+            _covered = sorted(_tag for _tag in self._messages if _tag < rslt.delivery_tag)
+
+            for _tag in _covered:
+                del self._messages[_tag]
+
+        if rslt.ack and rslt.multiple and any(_tag < rslt.delivery_tag for _tag in self._retries.values()):
+            # multiple acknowledgement would cover messages acked when their retry copies are confirmed
+            logging.debug("Acking messages up to delivery tag %d one by one: retries are pending", rslt.delivery_tag)
+
+            for _tag in _covered + [rslt.delivery_tag]:
+                self._channel.basic_ack(delivery_tag=_tag)
+
+            return
+
+        if rslt.retry_queue and _message:
+            self.retry_message(rslt, *_message)
+            return
+
         # acknowledge if all OK
+        if rslt.ack and rslt.multiple:
+            logging.debug("Acking messages up to delivery tag %d", rslt.delivery_tag)
+            self._channel.basic_ack(delivery_tag=rslt.delivery_tag, multiple=True)
+            return
+
         if rslt.ack:
-            logging.info("Acking message with delivery tag %d" % rslt.delivery_tag)
+            logging.debug("Acking message with delivery tag %d", rslt.delivery_tag)
             self._channel.basic_ack(delivery_tag=rslt.delivery_tag)
             return
 
-        logging.info("Nacking message with delivery tag %d, requeue is %s" % (rslt.delivery_tag, rslt.requeue))
+        logging.debug("Nacking message with delivery tag %d, requeue is %s", rslt.delivery_tag, rslt.requeue)
         self._channel.basic_nack(delivery_tag=rslt.delivery_tag, requeue=rslt.requeue)
 
+    def retry_message(self, rslt, properties, body):
+        """
+        Re-publish message to delayed retry queue. The original one is acked when the publish is confirmed,
+        see on_retry_confirmed().
+        :param rslt: message process result with retry queue name
+        :type rslt: IpcMessageResult
+        :param properties: original message properties
+        :type properties: pika.Spec.BasicProperties
+        :param body: original message body
+        :type body: bytes
+        """
+        logging.debug("Retrying message with delivery tag %d via %s, retry %d",
+                     rslt.delivery_tag, rslt.retry_queue, rslt.retry_count)
+        _properties = copy.copy(properties)
+        _properties.headers = dict(properties.headers or dict())
+        _properties.headers[QueueBase.retry_header] = rslt.retry_count
+        # publish is returned if retry queue does not exist, default exchange would drop it silently otherwise
+        self._publish_seq += 1
+        _properties.headers[self.retry_publish_header] = self._publish_seq
+        self._retries[self._publish_seq] = rslt.delivery_tag
+        self._channel.basic_publish(exchange='', routing_key=rslt.retry_queue, body=body, properties=_properties,
+                                    mandatory=True)
+
+    def on_retry_returned(self, channel, method, properties, body):
+        """
+        Callback for retry publish returned by broker as unroutable. It is confirmed after that anyway
+        :param channel: channel the message was published on, unused
+        :type channel: pika.Channel
+        :param method: return method with reply text and routing key
+        :type method: pika.spec.Basic.Return
+        :param properties: message properties
+        :type properties: pika.Spec.BasicProperties
+        :param body: message body, unused
+        :type body: bytes
+        """
+        _seq = (properties.headers or dict()).get(self.retry_publish_header)
+        logging.warning("Retry publish to %s is returned: %s", method.routing_key, method.reply_text)
+
+        if _seq in self._retries:
+            self._retries_returned.add(_seq)
+
+    def on_retry_confirmed(self, frame):
+        """
+        Callback for retry publish confirmation: ack original message if its copy is routed,
+        reject it to deads queue (or requeue if deads are disabled) otherwise
+        :param frame: Basic.Ack or Basic.Nack frame
+        :type frame: pika.frame.Method
+        """
+        _ack = isinstance(frame.method, pika.spec.Basic.Ack)
+        _seqs = [frame.method.delivery_tag]
+
+        if frame.method.multiple:
+            _seqs = sorted(_seq for _seq in self._retries if _seq <= frame.method.delivery_tag)
+
+        for _seq in _seqs:
+            _delivery_tag = self._retries.pop(_seq, None)
+            _returned = _seq in self._retries_returned
+            self._retries_returned.discard(_seq)
+
+            if _delivery_tag is None or not self._channel:
+                continue
+
+            if _ack and not _returned:
+                logging.debug("Retry publish %d is confirmed, acking message with delivery tag %d", _seq, _delivery_tag)
+                self._channel.basic_ack(delivery_tag=_delivery_tag)
+                continue
+
+            logging.error("Message with delivery tag %d is not re-published to retry queue, %s", _delivery_tag,
+                          "rejecting it" if self._rmq_deads else "requeueing it")
+            self._channel.basic_nack(delivery_tag=_delivery_tag, requeue=not self._rmq_deads)
+
     def _stop(self):
         """
         Calling if the process is to be killed with all its resources
@@ -1,12 +1,232 @@
 #!/usr/bin/env python
 
 from .queue_server import QueueServer
+from .rpc_schema import compile_published
+from .json_stream import JsonArrayStream
+import concurrent.futures
+import json
+import re
 import warnings
 
+# call with no keyword arguments: the end of its JSON is enough to tell it
+_no_parameters = re.compile(br',[ \t\n\r]*\{[ \t\n\r]*\}[ \t\n\r]*\]$')
+_no_parameters_text = re.compile(r',[ \t\n\r]*\{[ \t\n\r]*\}[ \t\n\r]*\]$')
+
+
+def _has_no_parameters(data):
+    """
+    Check if JSON call has empty keyword arguments by the end of its text, trailing whitespace skipped without copying
+    :param data: JSON text
+    :type data: bytes or str
+    :returns: boolean, False if it is not known
+    """
+    _blank = ' \t\n\r' if isinstance(data, str) else b' \t\n\r'
+    _end = len(data)
+
+    while _end > 0 and data[_end - 1:_end] in _blank:
+        _end -= 1
+
+    _pattern = _no_parameters_text if isinstance(data, str) else _no_parameters
+    return _pattern.search(data[max(_end - 64, 0):_end]) is not None
+
+
+def threaded(method):
+    """
+    Decorator for published methods to be called on thread pool instead of the main loop: for I/O-bound ones
+    """
+    method.threaded = True
+    return method
+
+
+def streamed(method):
+    """
+    Decorator for published methods taking a long list of arguments: method gets iterator of positional arguments
+    instead of them. Arguments of messages decoded element by element (see QueueServer json_stream_size) are decoded
+    while it iterates, schema of published methods is not checked for such calls
+    """
+    method.streamed = True
+    return method
+
 
 class QueueHandler(QueueServer):
 
-    published = []  # add functions you wish to call via queue here
+    published = []  # add functions you wish to call via queue here, or RpcSchema (dict of schemas) shared with QueueRPC
+    ordering_argument = None    # call argument (name or position) to take ordering key from, see ordering_key()
+    threaded_by_default = False     # call all published methods on thread pool, not marked with @threaded only
+    _published_schema = None    # ('published' value, its schema) compiled for the instance
+
+    def __init__(self, *args, **kvargs):
+        super(QueueHandler, self).__init__(*args, **kvargs)
+        self.threads = 0
+
+    def basic_args(self, parser=None):
+        parser = super(QueueHandler, self).basic_args(parser)
+        parser.add_argument('--threads', help='Thread pool size for @threaded methods. Default is prefetch count',
+                            default=0, type=int)
+        return parser
+
+    def setup_from_args(self, args=None):
+        args = super(QueueHandler, self).setup_from_args(args)
+        self.setup(threads=args.threads)
+        return args
+
+    def setup(self, *args, **argv):
+        """
+        Sets things up.
+        :param threads: thread pool size for methods called on it, prefetch count by default.
+                        The pool is created on connection if there are such methods
+
+        All other params are the same as in parent classes
+        """
+        if 'threads' in argv:
+            self.threads = argv.pop('threads')
+
+            if self.threads < 0:
+                raise ValueError("Threads number should not be negative")
+
+        if len(args) > 0 or len(argv) > 0:
+            super(QueueHandler, self).setup(*args, **argv)
+
+    def is_threaded(self, function):
+        """
+        Published method is to be called on thread pool
+        :param function: method name
+        :type function: str
+        :returns: boolean
+        """
+        return bool(getattr(getattr(self, function, None), 'threaded', self.threaded_by_default))
+
+    def is_streamed(self, function):
+        """
+        Published method takes iterator of positional arguments
+        :param function: method name
+        :type function: str
+        :returns: boolean
+        """
+        return bool(getattr(getattr(self, function, None), 'streamed', False))
+
+    def _setup_thread_pool(self):
+        """
+        Create thread pool if some published methods are to be called on it.
+        Pool size is prefetch count by default, so every message received may be in progress.
+        """
+        if self.executor is not None or not any(self.is_threaded(_function) for _function in self.published):
+            return
+
+        self.setup(executor=concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.threads or max(self.prefetch_count, 1), thread_name_prefix='handler'))
+
+    def prepare(self):
+        self._setup_thread_pool()
+        super(QueueHandler, self).prepare()
+
+    def _decode(self, body):
+        """
+        Decode call remembering the last one of the thread: in the main loop it is needed for ordering key
+        and for choosing thread, then it is passed to the thread to be called on, see _executor_task()
+        """
+        _decoded = getattr(self._local, 'decoded', None)
+
+        if _decoded is None or _decoded[0] is not body:
+            _decoded = self._local.decoded = (body, json.loads(body))
+
+        return _decoded[1]
+
+    def _executor_task(self, body, properties):
+        """
+        Call decoded in the main loop already goes to the thread along with the message,
+        the main loop does not keep it
+        """
+        _decoded = getattr(self._local, 'decoded', None)
+        self._local.decoded = None
+
+        if _decoded is None or _decoded[0] is not body:
+            return super(QueueHandler, self)._executor_task(body, properties)
+
+        return (self._on_decoded_message, _decoded, properties)
+
+    def _on_decoded_message(self, decoded, properties):
+        """
+        Process message on executor thread with its call decoded already
+        """
+        self._local.decoded = decoded
+
+        try:
+            return self.on_message_raw(decoded[0], properties)
+        finally:
+            self._local.decoded = None
+
+    def on_message_raw(self, body, properties):
+        """
+        Call decoded already is not decoded again, unless the method called is to get it element by element.
+        It is not kept after the message is processed.
+        """
+        _decoded = getattr(self._local, 'decoded', None)
+        self._local.decoded = None
+
+        if _decoded is None or _decoded[0] is not body or properties.content_type != 'application/json' or \
+                self._decodes_as_stream(body):
+            return super(QueueHandler, self).on_message_raw(body, properties)
+
+        return self.on_message(_decoded[1], properties)
+
+    def _function(self, body):
+        """
+        Name of function called, decoded alone from message decoded element by element
+        """
+        if self._decodes_as_stream(body):
+            return JsonArrayStream(body).next_value()
+
+        return self._decode(body)[0]
+
+    def run_concurrently(self, body, properties):
+        """
+        Methods marked with @threaded (or all of them if threaded_by_default is set) are called on thread pool
+        """
+        try:
+            return self.is_threaded(self._function(body))
+        except (ValueError, TypeError, IndexError, KeyError):
+            # malformed message is rejected by on_message()
+            return False
+
+    def latency_label(self, body, properties):
+        """
+        Handler latency is aggregated by published function name
+        """
+        try:
+            _function = self._function(body)
+        except (ValueError, TypeError, IndexError, KeyError):
+            _function = None
+
+        if _function not in self.published:
+            return super(QueueHandler, self).latency_label(body, properties)
+
+        return _function
+
+    def ordering_key(self, body, properties):
+        """
+        Key of messages to be processed in order when processing concurrently:
+        ordering_argument value of the call if set, ordering_header value otherwise
+        """
+        if self.ordering_argument is None:
+            return super(QueueHandler, self).ordering_key(body, properties)
+
+        try:
+            if self._decodes_as_stream(body):
+                _key = self._stream_argument(JsonArrayStream(body), self.ordering_argument)
+            else:
+                (function, arguments, parameters) = self._decode(body)
+                _key = arguments[self.ordering_argument] if isinstance(self.ordering_argument, int) \
+                    else parameters.get(self.ordering_argument)
+        except (ValueError, TypeError, IndexError, AttributeError):
+            # malformed message is rejected by on_message(), order does not matter
+            return None
+
+        if isinstance(_key, (list, dict)):
+            # should be hashable
+            _key = json.dumps(_key, sort_keys=True)
+
+        return _key
 
     def on_message(self, data, properties):
         """
@@ -22,6 +242,80 @@ class QueueHandler(QueueServer):
         else:
             raise ValueError("invalid message: unknown function %s (known functions are: %s)" % (function, self.published))
 
-        r = call(*arguments, **parameters)
+        # memory profile is aggregated by function
+        self._local.function = function
+        self._schema().validate(function, arguments, parameters)
+
+        if self.is_streamed(function):
+            r = call(iter(arguments), **parameters)
+        else:
+            r = call(*arguments, **parameters)
+
+        if r is not None:
+            warnings.warn("Call to method returned unexpected value %s" % str(r))
+
+    def _schema(self):
+        """
+        Schema of published methods, compiled on the first call and again if 'published' is set to another value
+        """
+        _compiled = self._published_schema
+
+        if _compiled is None or _compiled[0] is not self.published:
+            _compiled = self._published_schema = (self.published, compile_published(self.published))
+
+        return _compiled[1]
+
+    def _stream_parameters(self, items):
+        """
+        Keyword arguments of call decoded element by element: they follow positional ones,
+        so those are decoded and dropped one by one by a stream of its own unless the call has none
+        """
+        if _has_no_parameters(items.data):
+            return dict()
+
+        _items = items.reopen()
+        _items.next_value()
+
+        for _argument in _items.next_array():
+            pass
+
+        _parameters = _items.next_value()
+
+        if not isinstance(_parameters, dict) or list(_items):
+            raise ValueError("invalid message format: expected: [ \"function\", [ arguments ], { parameters } ]")
+
+        return _parameters
+
+    def _stream_argument(self, items, argument):
+        """
+        Argument of call decoded element by element, elements before it are decoded and dropped one by one
+        :param argument: position or keyword
+        :type argument: int or str
+        """
+        if not isinstance(argument, int):
+            return self._stream_parameters(items).get(argument)
+
+        items.next_value()
+
+        for (_index, _value) in enumerate(items.next_array()):
+            if _index == argument:
+                return _value
+
+        raise IndexError("Call has no argument %d" % argument)
+
+    def on_message_items(self, items, properties):
+        """
+        Positional arguments of @streamed methods are decoded while the method iterates them,
+        calls of other methods are decoded entirely and passed to on_message()
+        """
+        function = items.next_value()
+
+        if not isinstance(function, str) or function not in self.published or not self.is_streamed(function):
+            return self.on_message([function] + list(items), properties)
+
+        parameters = self._stream_parameters(items)
+        self._local.function = function
+
+        r = getattr(self, function)(items.next_array(), **parameters)
         if r is not None:
             warnings.warn("Call to method returned unexpected value %s" % str(r))
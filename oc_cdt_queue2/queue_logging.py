@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+
+import logging
+import logging.handlers
+import multiprocessing
+import time
+
+"""
+Logging helpers for message processing hot path
+"""
+
+
+def truncate_body(body, limit):
+    """
+    Shorten message body for logging
+    :param body: message body
+    :type body: bytes or str
+    :param limit: max length to keep, 0 for no limit
+    :type limit: int
+    :returns: body or its beginning with the total length noted
+    """
+    if not limit or body is None or len(body) <= limit:
+        return body
+
+    return "%r... (%d total)" % (body[:limit], len(body))
+
+
+class ExceptionLogLimiter(object):
+    """
+    Rate limiter for exceptions logging.
+    The first exception of a kind (type and text) within an interval is logged with traceback,
+    repeated ones are counted only and reported by a single summary line later.
+    """
+
+    def __init__(self, interval=0):
+        """
+        Main initialization
+        :param interval: seconds to aggregate repeated exceptions for, 0 to log every exception
+        :type interval: float
+        """
+        self.interval = interval
+        # exception kind: [time first logged, repeats suppressed]
+        self._seen = dict()
+
+    @staticmethod
+    def _kind(exc):
+        return (type(exc).__name__, str(exc)[:256])
+
+    def exception(self, exc):
+        """
+        Log an exception. Call it from 'except' block to get traceback logged.
+        :param exc: exception to log
+        :type exc: Exception
+        """
+        if not self.interval:
+            logging.exception(exc)
+            return
+
+        _now = time.time()
+        _kind = self._kind(exc)
+        _seen = self._seen.get(_kind)
+
+        if _seen is not None and _now - _seen[0] < self.interval:
+            _seen[1] += 1
+            return
+
+        if _seen is not None and _seen[1]:
+            logging.error("%s: %s repeated %d times in last %d seconds",
+                          _kind[0], _kind[1], _seen[1], _now - _seen[0])
+
+        self._seen[_kind] = [_now, 0]
+        logging.exception(exc)
+        self._flush(_now)
+
+    def _flush(self, now):
+        """
+        Report and forget exceptions not seen for an interval
+        """
+        for _kind, _seen in list(self._seen.items()):
+            if now - _seen[0] < self.interval:
+                continue
+
+            if _seen[1]:
+                logging.error("%s: %s repeated %d times in last %d seconds",
+                              _kind[0], _kind[1], _seen[1], now - _seen[0])
+
+            del self._seen[_kind]
+
+
+class QueueLogging(object):
+    """
+    Moves log records writing to a background thread.
+    Root logger handlers are replaced with QueueHandler putting records to interprocess queue,
+    and QueueListener thread passes them to the original handlers.
+    Since the queue is interprocess one, connection process forked after start() sends its records here too.
+    """
+
+    def __init__(self):
+        self._queue = None
+        self._listener = None
+        self._handlers = list()
+
+    def start(self):
+        """
+        Replace root logger handlers and start the listener
+        :returns: self
+        """
+        if self._listener:
+            return self
+
+        _root = logging.getLogger()
+        self._handlers = list(_root.handlers)
+        self._queue = multiprocessing.Queue(-1)
+        self._listener = logging.handlers.QueueListener(self._queue, *self._handlers, respect_handler_level=True)
+
+        for _handler in self._handlers:
+            _root.removeHandler(_handler)
+
+        _root.addHandler(logging.handlers.QueueHandler(self._queue))
+        self._listener.start()
+        return self
+
+    def stop(self):
+        """
+        Write all records queued and restore original root logger handlers
+        """
+        if not self._listener:
+            return
+
+        _root = logging.getLogger()
+
+        for _handler in list(_root.handlers):
+            if isinstance(_handler, logging.handlers.QueueHandler) and _handler.queue is self._queue:
+                _root.removeHandler(_handler)
+
+        self._listener.stop()
+        self._listener = None
+
+        for _handler in self._handlers:
+            _root.addHandler(_handler)
+
+        self._handlers = list()
+        self._queue.close()
+        self._queue = None
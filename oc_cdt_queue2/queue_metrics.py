@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+
+import json
+import logging
+import math
+import socketserver
+import threading
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+
+"""
+Queue backlog tracking and metrics HTTP endpoint for autoscaling
+"""
+
+
+class QueueBacklog(object):
+    """
+    Depth and consumers of queues probed regularly, with drain rate and time-to-empty estimated from them.
+    Drain rate is the rate queue depth decreases with, i.e. consuming rate less publishing one,
+    smoothed exponentially since depth probes are noisy. Thread-safe.
+    """
+
+    def __init__(self, smoothing=0.3):
+        """
+        Main initialization
+        :param smoothing: weight of the latest rate in the smoothed drain rate, 0 to 1
+        :type smoothing: float
+        """
+        if not 0 < smoothing <= 1:
+            raise ValueError("Smoothing should be in range (0, 1]")
+
+        self.smoothing = smoothing
+        self._lock = threading.Lock()
+        # queue: dict of the latest values
+        self._queues = dict()
+
+    def update(self, queue, messages, consumers, probed):
+        """
+        Add a probe result
+        :param queue: queue name
+        :type queue: str
+        :param messages: messages ready for delivery
+        :type messages: int
+        :param consumers: consumers of the queue
+        :type consumers: int
+        :param probed: time of the probe, seconds since epoch
+        :type probed: float
+        """
+        with self._lock:
+            _last = self._queues.get(queue)
+            _rate = None
+
+            if _last is not None:
+                _rate = _last['drain_rate']
+                _elapsed = probed - _last['probed']
+
+                if _elapsed <= 0:
+                    # out of order or duplicate
+                    return
+
+                _current = (_last['messages'] - messages) / _elapsed
+                _rate = _current if _rate is None else self.smoothing * _current + (1 - self.smoothing) * _rate
+
+            self._queues[queue] = {'messages': messages,
+                                   'consumers': consumers,
+                                   'probed': probed,
+                                   'drain_rate': _rate,
+                                   'time_to_empty': self._time_to_empty(messages, _rate)}
+
+    @staticmethod
+    def _time_to_empty(messages, rate):
+        """
+        Seconds for the queue to be drained at the rate, None if it is not known, infinity if the queue is not drained
+        """
+        if not messages:
+            return 0.0
+
+        if rate is None:
+            return None
+
+        return messages / rate if rate > 0 else float('inf')
+
+    def snapshot(self):
+        """
+        The latest values
+        :returns: {queue: {'messages', 'consumers', 'probed', 'drain_rate', 'time_to_empty'}}.
+                  Drain rate and time-to-empty are None until the second probe
+        """
+        with self._lock:
+            return dict((_queue, dict(_values)) for (_queue, _values) in self._queues.items())
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    """
+    HTTP server handling requests in threads, http.server.ThreadingHTTPServer is missing in Python 3.6
+    """
+    daemon_threads = True
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    """
+    GET /metrics for Prometheus text format, GET /metrics.json for JSON
+    """
+
+    def do_GET(self):
+        _path = self.path.split('?', 1)[0]
+
+        if _path not in ('/metrics', '/metrics.json'):
+            self.send_error(404)
+            return
+
+        try:
+            _metrics = self.server.collect()
+        except Exception as e:
+            logging.exception(e)
+            self.send_error(500)
+            return
+
+        if _path == '/metrics.json':
+            _body = json.dumps(MetricsServer.json_safe(_metrics), default=str).encode('utf-8')
+            _type = 'application/json'
+        else:
+            _body = MetricsServer.prometheus_text(_metrics, self.server.prefix).encode('utf-8')
+            _type = 'text/plain; version=0.0.4; charset=utf-8'
+
+        self.send_response(200)
+        self.send_header('Content-Type', _type)
+        self.send_header('Content-Length', str(len(_body)))
+        self.end_headers()
+        self.wfile.write(_body)
+
+    def log_message(self, format, *args):
+        logging.debug("metrics: " + format, *args)
+
+
+class MetricsServer(object):
+    """
+    HTTP server for metrics scraping running in a daemon thread.
+    Metrics are taken with the callback given on every request, so it should only copy values kept already:
+    requests are served while messages are being processed.
+    """
+
+    def __init__(self, collect, port, host='', prefix='cdtqueue'):
+        """
+        Main initialization
+        :param collect: callable returning metrics: {'backlog': QueueBacklog.snapshot(), 'stats': {name: number}}
+        :type collect: callable
+        :param port: port to listen to, 0 for any free one
+        :type port: int
+        :param host: address to listen to, all of them by default
+        :type host: str
+        :param prefix: Prometheus metrics names prefix
+        :type prefix: str
+        """
+        self._server = _ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+        self._server.collect = collect
+        self._server.prefix = prefix
+        self._thread = None
+
+    @property
+    def port(self):
+        """
+        Port listened to
+        """
+        return self._server.server_address[1]
+
+    def start(self):
+        """
+        Start serving in background
+        :returns: self
+        """
+        self._thread = threading.Thread(target=self._server.serve_forever, name='metrics-server')
+        self._thread.daemon = True
+        self._thread.start()
+        logging.info("Serving metrics on port %d", self.port)
+        return self
+
+    def stop(self):
+        """
+        Stop serving and close the socket
+        """
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread.join()
+            self._thread = None
+
+        self._server.server_close()
+
+    @staticmethod
+    def _number(value):
+        if isinstance(value, float) and math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+
+        return repr(float(value))
+
+    @classmethod
+    def json_safe(cls, value):
+        """
+        Replace infinite numbers with strings, since they are not allowed in JSON
+        """
+        if isinstance(value, dict):
+            return dict((_key, cls.json_safe(_value)) for (_key, _value) in value.items())
+
+        if isinstance(value, float) and math.isinf(value):
+            return cls._number(value)
+
+        return value
+
+    @staticmethod
+    def _escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    @classmethod
+    def prometheus_text(cls, metrics, prefix='cdtqueue'):
+        """
+        Format metrics in Prometheus text exposition format.
+        Backlog values are gauges labelled by queue, unknown ones are skipped. Stats are gauges named after their keys.
+        :param metrics: see __init__ collect parameter
+        :type metrics: dict
+        :param prefix: metrics names prefix
+        :type prefix: str
+        :returns: str
+        """
+        _lines = list()
+        _backlog = metrics.get('backlog') or dict()
+
+        for (_name, _key, _help) in [('queue_messages', 'messages', 'Messages ready in the queue'),
+                                     ('queue_consumers', 'consumers', 'Consumers of the queue'),
+                                     ('queue_drain_rate', 'drain_rate', 'Messages per second the queue depth decreases with'),
+                                     ('queue_time_to_empty_seconds', 'time_to_empty',
+                                      'Estimated time for the queue to be drained'),
+                                     ('queue_probed_timestamp_seconds', 'probed', 'Time of the latest probe')]:
+            _values = [(_queue, _values[_key]) for (_queue, _values) in sorted(_backlog.items())
+                       if _values.get(_key) is not None]
+
+            if not _values:
+                continue
+
+            _lines.append('# HELP %s_%s %s' % (prefix, _name, _help))
+            _lines.append('# TYPE %s_%s gauge' % (prefix, _name))
+            _lines.extend('%s_%s{queue="%s"} %s' % (prefix, _name, cls._escape(_queue), cls._number(_value))
+                          for (_queue, _value) in _values)
+
+        for (_key, _value) in sorted((metrics.get('stats') or dict()).items()):
+            if not isinstance(_value, (int, float)):
+                continue
+
+            _lines.append('# TYPE %s_%s gauge' % (prefix, _key))
+            _lines.append('%s_%s %s' % (prefix, _key, cls._number(_value)))
+
+        return '\n'.join(_lines) + '\n'
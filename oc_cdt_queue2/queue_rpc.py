@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 from oc_cdt_queue2.queue_client import QueueClient
+from oc_cdt_queue2.rpc_schema import compile_published
 
 
 class _CallbackHelper(object):
@@ -9,17 +10,17 @@ class _CallbackHelper(object):
     Do not use it directly
     """
 
-    def __init__(self, parent, name, fmt=None):
+    def __init__(self, parent, name, schema=None):
         self.name = name
-        self.fmt = fmt
+        self.schema = schema
         self.parent = parent
 
     def action(self, *argv, **argp):
-        if isinstance(self.fmt, list):
-            for k in argp.keys():
-                if k not in fmt:
-                    raise TypeError('No such key ' + k)
-        self.parent.send([self.name, argv, argp])
+        if self.schema is not None:
+            # invalid call is rejected here instead of failing in consumer
+            self.schema.validate(self.name, argv, argp)
+        # coroutine is returned for asynchronous client to be awaited
+        return self.parent.send([self.name, argv, argp], partition_key=argp.get(self.parent.partition_argument))
 
 
 class QueueRPC(QueueClient):
@@ -27,14 +28,25 @@ class QueueRPC(QueueClient):
     This class can be supclassed for defining interface for your queue-driven application
     """
 
-    published = ['ping']  # add names of your methods here
+    published = ['ping']  # add names of your methods here, or RpcSchema (dict of schemas) shared with QueueHandler
+    partition_argument = None   # keyword argument to take partitioning key from for partitioned queue
+    _published_schema = None    # ('published' value, its schema) compiled for the instance
 
     def __getattr__(self, attr):
-        if self.connection is None or not self.connection.is_open or self.channel == None:
+        # with outbox messages are sent by background thread, connection may be not established yet
+        if not self.outbox_path and (self.connection is None or not self.connection.is_open or self.channel == None):
             raise AttributeError("not initialized")
         if self.published is not None and attr not in self.published:
             raise AttributeError("no attribute " + str(attr))
-        fmt = None
-        if isinstance(self.published, dict):
-            fmt = self.published[attr]
-        return _CallbackHelper(self, attr, fmt).action
+        return _CallbackHelper(self, attr, self._schema()).action
+
+    def _schema(self):
+        """
+        Schema of published methods, compiled on the first call and again if 'published' is set to another value
+        """
+        _compiled = self._published_schema
+
+        if _compiled is None or _compiled[0] is not self.published:
+            _compiled = self._published_schema = (self.published, compile_published(self.published))
+
+        return _compiled[1]
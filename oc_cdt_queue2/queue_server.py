@@ -8,28 +8,87 @@ from .queue_connection_prcs import QueueConnectionProcess
 from .ipc_messages import IpcMessage
 from .ipc_messages import IpcMessageResult
 from .ipc_messages import IpcExcMsg
+from .ipc_messages import IpcDeclared
+from .ipc_messages import IpcLatency
+from .ipc_messages import IpcQueueStats
+from .idempotency import IdempotencyCache
+from .queue_logging import ExceptionLogLimiter
+from .queue_logging import truncate_body
+from .stream_spool import StreamSpool
+from .memory_profile import MemoryProfiler
+from .cpu_profile import CpuProfiler
+from .keyed_executor import KeyedExecutor
+from .latency import LatencyStats
+from .queue_metrics import QueueBacklog
+from .queue_metrics import MetricsServer
+from .capture import CaptureWriter
+from .json_stream import JsonArrayStream
+from .json_stream import is_json_array
 import logging
+import os
+import queue
+import signal
+import tempfile
+import threading
 import time
 import multiprocessing
 
-# this is a version-specific import of JoinableQueue due to Python3 features
-# see https://bugs.python.org/issue21367 for details
-try:
-    from multiprocessing import JoinableQueue
-except ImportError:
-    from multiprocessing.queues import JoinableQueue
-
 from sys import version_info
 
 
+class BatchItem(object):
+    """
+    Message of a batch passed to QueueServer.on_batch()
+    """
+
+    def __init__(self, delivery_tag, properties, body, delivery=None):
+        """
+        Main initialization
+        :param delivery_tag: delivery tag
+        :type delivery_tag: int
+        :param properties: message properties
+        :type properties: pika.BasicProperties
+        :param body: message body
+        :type body: bytes
+        :param delivery: delivery information: redelivered flag, exchange and routing key
+        :type delivery: IpcMessage
+        """
+        self.delivery_tag = delivery_tag
+        self.properties = properties
+        self.body = body
+        self.delivery = delivery
+        self.error = None
+        self.failed = False
+        # processed message key for skipping duplicates
+        self.key = None
+
+    def fail(self, error=None):
+        """
+        Mark message as failed: it is nacked (or retried) separately while the rest of the batch is acked
+        :param error: failure reason passed to on_nack()
+        :type error: Exception
+        """
+        self.failed = True
+        self.error = error or ValueError("Batch item is marked as failed")
+
+
 class QueueServer(QueueBase):
     default_prefetch_count = 1      # Default prefetch count
 
     # One can re-define it for debugging purposes or to implement another protocol driver
     # See queue_loopback.py as an somewhat dirty example
     _Connection = pika.SelectConnection
-    _JoinableQueue = staticmethod(JoinableQueue)
+    # None to use JoinableQueue of the multiprocessing context for start method set
+    _JoinableQueue = None
     _QueueConnectionProcess = staticmethod(QueueConnectionProcess)
+    _MetricsServer = MetricsServer
+    _CaptureWriter = CaptureWriter
+
+    # modules forkserver imports once, so connection processes forked from it start with them loaded
+    forkserver_preload = ['pika', 'oc_cdt_queue2.queue_connection_prcs']
+
+    # channel close codes meaning declared topology is not valid any more: NOT_FOUND, PRECONDITION_FAILED
+    _topology_reply_codes = (404, 406)
 
     def __init__(self, *argv, **argp):
         super(QueueServer, self).__init__(*argv, **argp)
@@ -39,6 +98,73 @@ class QueueServer(QueueBase):
         self.counter_bad = 0
         self.prefetch_count = self.default_prefetch_count
         self.max_sleep = 16
+        self.retry_delays = list()
+        self.retry_max = 0
+        self.counter_duplicates = 0
+        # processed messages cache for skipping duplicates, disabled by default
+        self.idempotency_size = 0
+        self.idempotency_ttl = 0
+        self.idempotency_header = None
+        self.idempotency_file = None
+        self._idempotency = None
+        # hot path logging: body length limit, log every N-th message details, repeated exceptions aggregation
+        self.log_body_limit = 0
+        self.log_sample = 1
+        self._exc_log = ExceptionLogLimiter()
+        # messages are collected to batches for on_batch() if batch size is set
+        self.batch_size = 0
+        self.batch_timeout = 0
+        self._batch = list()
+        self._batch_started = 0
+        # in-flight messages limits and usage reported by connection process
+        self.max_inflight = 0
+        self.max_inflight_bytes = 0
+        self.inflight_messages = 0
+        self.inflight_bytes = 0
+        self.consuming_paused = False
+        self.counter_pauses = 0
+        # multiprocessing start method for connection process, None for platform default
+        self.start_method = None
+        # memory profiling of sampled messages, disabled by default
+        self._memory_profiler = None
+        # state of the message being processed, per thread since messages are processed on executor also:
+        # 'function' is published function name set by handler to aggregate memory and CPU profiles by
+        self._local = threading.local()
+        # CPU profiling of processing, disabled by default
+        self._cpu_profiler = None
+        self.profile_connection = False
+        self.profile_output = None
+        # chunked payloads reassembly directory, temporary one by default
+        self.stream_spool = None
+        self.stream_ttl = 86400
+        self._stream_spool = None
+        # JSON array bodies of this size or larger are decoded element by element, disabled by default
+        self.json_stream_size = 0
+        # partitions of partitioned queue to consume from, all of them if None
+        self.consume_partitions = None
+        # concurrent processing: messages with the same ordering key are processed one after another
+        self.executor = None
+        self.ordering_header = None
+        self.max_active_keys = 0
+        self._keyed_executor = None
+        # finished concurrent tasks, in order of finishing
+        self._completed = queue.Queue()
+        # processing stages latency histograms, disabled by default
+        self.latency = None
+        self.latency_report = 0
+        self._latency_reported = time.time()
+        # consumed queues depth probing and metrics endpoint, disabled by default
+        self.probe_interval = 0
+        self.backlog = QueueBacklog()
+        self.metrics_port = None
+        self.metrics_host = ''
+        self._metrics_server = None
+        # deliveries capture for replay, disabled by default
+        self.capture = None
+        self.capture_limit = 0
+        self._capture = None
+        # delivery tag: (message, arrival time) of messages captured and not processed yet
+        self._captured = dict()
         # additional process for asynchronious connection
         self._connection_prcs = None
         self._ipc_q_in = None
@@ -59,6 +185,75 @@ class QueueServer(QueueBase):
         parser = super(QueueServer, self).basic_args(parser)
         parser.add_argument('--prefetch-count', help='Pre-fetch count',
                             default=self.default_prefetch_count, type=int)
+        parser.add_argument('--retry-delays', help='Comma-separated delays of retry queues for failed messages, seconds. '
+                                                   'Retry queues are declared with --declare',
+                            default=None)
+        parser.add_argument('--retry-max', help='Retries before message is rejected, 0 for unlimited', default=0, type=int)
+        parser.add_argument('--idempotency-size', help='Processed messages keys to remember for skipping duplicates, 0 to disable',
+                            default=0, type=int)
+        parser.add_argument('--idempotency-ttl', help='Seconds to remember processed message key, 0 for no expiration',
+                            default=0, type=float)
+        parser.add_argument('--idempotency-header', help='Header with message key. Default is to use message_id property',
+                            default=None)
+        parser.add_argument('--idempotency-file', help='File to keep processed messages keys across restarts', default=None)
+        parser.add_argument('--log-body-limit', help='Max message body length to log, 0 for no limit', default=0, type=int)
+        parser.add_argument('--log-sample', help='Log details of every N-th message only', default=1, type=int)
+        parser.add_argument('--batch-size', help='Process messages in batches of up to this number with on_batch(), 0 to disable',
+                            default=0, type=int)
+        parser.add_argument('--batch-timeout', help='Seconds to wait for a batch to fill up, 0 to process messages available at once',
+                            default=0, type=float)
+        parser.add_argument('--max-inflight', help='Pause consuming when this number of messages is received and not processed yet, '
+                                                   '0 for no limit', default=0, type=int)
+        parser.add_argument('--max-inflight-bytes', help='Pause consuming when total size of messages received and not processed yet '
+                                                         'reaches this, 0 for no limit', default=0, type=int)
+        parser.add_argument('--start-method', help='How to start connection process. "spawn" and "forkserver" do not copy '
+                                                   'application memory to it. Default is platform one',
+                            choices=multiprocessing.get_all_start_methods(), default=None)
+        parser.add_argument('--memory-profile', help='Profile memory retained by every N-th message, 0 to disable. '
+                                                     'Report is logged on SIGUSR1', default=0, type=int)
+        parser.add_argument('--memory-profile-method', help='Memory profiling method',
+                            choices=MemoryProfiler.methods, default='tracemalloc')
+        parser.add_argument('--memory-profile-report', help='Log memory profile report every K messages, 0 to do it on signal only',
+                            default=0, type=int)
+        parser.add_argument('--profile', help='Profile CPU usage of message processing. "sample" takes stacks regularly '
+                                              'with low overhead. Report is logged on SIGUSR2',
+                            choices=CpuProfiler.methods, default=None)
+        parser.add_argument('--profile-report', help='Log CPU profile report every K messages, 0 to do it on signal only',
+                            default=0, type=int)
+        parser.add_argument('--profile-output', help='Write CPU profile stats to this file along with report: pstats for '
+                                                     '"cprofile", collapsed stacks for "sample". {pid} is replaced '
+                                                     'with process id', default=None)
+        parser.add_argument('--profile-interval', help='Seconds between stack samples', default=0.005, type=float)
+        parser.add_argument('--profile-connection', help='Profile connection process also',
+                            default=False, action='store_true')
+        parser.add_argument('--stream-spool', help='Directory to keep chunks of large payloads until all of them arrive. '
+                                                   'Default is a temporary one', default=None)
+        parser.add_argument('--stream-ttl', help='Remove transfers not completed from spool when no chunks arrive for '
+                                                 'this number of seconds, 0 to keep them', default=86400, type=float)
+        parser.add_argument('--json-stream-size', help='Decode JSON array messages of this size or larger element by '
+                                                       'element, bytes. 0 to disable', default=0, type=int)
+        parser.add_argument('--log-exceptions-interval', help='Aggregate repeated processing exceptions for this number of seconds, '
+                                                              '0 to log every one', default=0, type=float)
+        parser.add_argument('--ordering-header', help='Header with key of messages to be processed in order '
+                                                      'when processing concurrently', default=None)
+        parser.add_argument('--max-active-keys', help='Max ordering keys processed concurrently, 0 for no limit',
+                            default=0, type=int)
+        parser.add_argument('--consume-partitions', help='Comma-separated numbers of partitions to consume from '
+                                                         'for partitioned queue. Default is all of them', default=None)
+        parser.add_argument('--latency-stats', help='Collect histograms of queue wait, IPC, handler and acknowledgement time',
+                            default=False, action='store_true')
+        parser.add_argument('--latency-report', help='Log latency histograms summary every N seconds, 0 to disable',
+                            default=0, type=float)
+        parser.add_argument('--probe-interval', help='Probe depth of consumed queues every N seconds, 0 to disable',
+                            default=0, type=float)
+        parser.add_argument('--metrics-port', help='Serve queue depth, drain rate and processing counters over HTTP '
+                                                   'on this port, plus worker number for supervisor workers',
+                            default=None, type=int)
+        parser.add_argument('--metrics-host', help='Address to serve metrics on, all of them by default', default='')
+        parser.add_argument('--capture', help='Append messages delivered with their processing results to this file '
+                                              'for replay with oc_cdt_queue2.capture', default=None)
+        parser.add_argument('--capture-limit', help='Stop capturing after this number of messages, 0 for no limit',
+                            default=0, type=int)
         return parser
 
     def setup_from_args(self, args=None):
@@ -73,7 +268,34 @@ class QueueServer(QueueBase):
         :raises:    See setup() method
         """
         args = super(QueueServer, self).setup_from_args(args)
-        self.setup(prefetch_count=args.prefetch_count)
+        _retry_delays = list()
+
+        if args.retry_delays:
+            _retry_delays = [float(_delay) for _delay in args.retry_delays.split(',')]
+
+        _consume_partitions = None
+
+        if args.consume_partitions:
+            _consume_partitions = [int(_index) for _index in args.consume_partitions.split(',')]
+
+        self.setup(prefetch_count=args.prefetch_count, retry_delays=_retry_delays, retry_max=args.retry_max,
+                   idempotency_size=args.idempotency_size, idempotency_ttl=args.idempotency_ttl,
+                   idempotency_header=args.idempotency_header, idempotency_file=args.idempotency_file,
+                   log_body_limit=args.log_body_limit, log_sample=args.log_sample,
+                   log_exceptions_interval=args.log_exceptions_interval,
+                   batch_size=args.batch_size, batch_timeout=args.batch_timeout, stream_spool=args.stream_spool,
+                   stream_ttl=args.stream_ttl,
+                   json_stream_size=args.json_stream_size,
+                   max_inflight=args.max_inflight, max_inflight_bytes=args.max_inflight_bytes,
+                   memory_profile=args.memory_profile, memory_profile_method=args.memory_profile_method,
+                   memory_profile_report=args.memory_profile_report, start_method=args.start_method,
+                   profile=args.profile, profile_report=args.profile_report, profile_output=args.profile_output,
+                   profile_interval=args.profile_interval, profile_connection=args.profile_connection,
+                   consume_partitions=_consume_partitions, ordering_header=args.ordering_header,
+                   max_active_keys=args.max_active_keys, latency_stats=args.latency_stats,
+                   latency_report=args.latency_report, probe_interval=args.probe_interval,
+                   metrics_port=args.metrics_port, metrics_host=args.metrics_host, capture=args.capture,
+                   capture_limit=args.capture_limit)
         return args
 
     def setup(self, *args, **argv):
@@ -83,6 +305,59 @@ class QueueServer(QueueBase):
         :param routing_key:    Routing key. Uses queue name as routing key if not specified
         :param exchange:    RabbitMQ exchange name. Uses default exchange if not specified
         :param priority:    Messages priority for sending
+        :param retry_delays:    List of delays for failed messages retries, seconds.
+                                Failed message is re-published to the retry queue with
+                                the delay corresponding to its retries count (the last one is used
+                                when retries count exceeds the list) instead of nack
+        :param retry_max:   Retries before message is rejected without requeue, 0 for unlimited
+        :param idempotency_size:    Number of processed messages keys to remember. Messages with keys
+                                    remembered are acked without processing. 0 to disable
+        :param idempotency_ttl:     Seconds to remember a key, 0 for no expiration
+        :param idempotency_header:  Header to take message key from, message_id property is used by default
+        :param idempotency_file:    File to persist keys to
+        :param log_body_limit:  Max message body length to log with debug level, 0 for no limit
+        :param log_sample:  Log debug details of every N-th message only
+        :param log_exceptions_interval: Seconds to aggregate repeated processing exceptions for, 0 to log every one
+        :param batch_size:  Collect up to this number of messages and pass them to on_batch(), 0 to disable.
+                            Prefetch count is raised to batch size if it is less
+        :param batch_timeout:   Seconds to wait for a batch to fill up since its first message,
+                                0 to process the messages available immediately
+        :param stream_spool:    Directory for chunks of payloads sent with QueueClient.send_stream().
+                                Chunks of a transfer are assembled only if they all come to the same consumer:
+                                the queue (or partition) should have a single one
+        :param stream_ttl:  Seconds to keep transfers not completed in spool since their last chunk, 0 for no limit
+        :param json_stream_size:    Decode JSON array bodies of this size or larger element by element and pass them
+                                    to on_message_items(), bytes. 0 to disable
+        :param max_inflight:    Pause consuming when this number of messages is received and not processed yet,
+                                resume when it drops to a half. 0 for no limit
+        :param max_inflight_bytes:  The same for total body size of such messages, bytes
+        :param start_method:    Multiprocessing start method for connection process: 'fork', 'spawn', 'forkserver'.
+                                'forkserver' preloads forkserver_preload modules
+        :param memory_profile:  Profile memory retained by every N-th message, 0 to disable
+        :param memory_profile_method:   'tracemalloc' (with allocation sites) or 'rss'
+        :param memory_profile_report:   Log memory profile report every K messages, 0 to do it on SIGUSR1 only
+        :param profile: Profile CPU usage of message processing by published function: 'cprofile' or 'sample',
+                        None to disable
+        :param profile_report:  Log CPU profile report and write output every K messages, 0 to do it on SIGUSR2 only
+        :param profile_output:  File to write CPU profile stats to along with report, see CpuProfiler
+        :param profile_interval:    Seconds between stack samples of 'sample' method
+        :param profile_connection:  Profile connection process also: its report is written along with the main one
+        :param consume_partitions:  Numbers of partitions to consume from if the queue is partitioned, None for all.
+                                    All partitions are declared anyway
+        :param executor:    concurrent.futures.Executor to process messages on concurrently, None to process them
+                            in the main loop one by one. Up to prefetch_count messages are processed at once
+        :param ordering_header: Header with key of messages to be processed in order, see ordering_key()
+        :param max_active_keys: Max number of ordering keys processed at once, 0 for no limit
+        :param latency_stats:   Collect latency histograms of processing stages, see get_latency()
+        :param latency_report:  Log latency histograms summary every N seconds, 0 to disable
+        :param probe_interval:  Probe depth and consumers of consumed queues every N seconds, 0 to disable.
+                                Passive declarations are done by connection process on a channel of its own
+        :param metrics_port:    Serve metrics over HTTP on this port since connection, None to disable, 0 for any free one.
+                                Supervisor workers add their number to it
+        :param metrics_host:    Address to serve metrics on, all of them by default
+        :param capture: File to append messages delivered to, with arrival time and processing result,
+                        see capture.CaptureReplay. None to disable
+        :param capture_limit:   Stop capturing after this number of messages, 0 for no limit
 
         All the rest params are the same as QueueBase.setup(). If used without url - no
         basic parameters touched, only client-specific are set
@@ -92,6 +367,146 @@ class QueueServer(QueueBase):
         if prefetch_count is not None:
             self.prefetch_count = prefetch_count
 
+        retry_delays = argv.pop('retry_delays', None)
+        if retry_delays is not None:
+            if any(_delay <= 0 for _delay in retry_delays):
+                raise ValueError("Retry delays should be positive")
+            self.retry_delays = list(retry_delays)
+
+        retry_max = argv.pop('retry_max', None)
+        if retry_max is not None:
+            self.retry_max = retry_max
+
+        if 'idempotency_size' in argv:
+            self.idempotency_size = argv.pop('idempotency_size')
+
+        if 'idempotency_ttl' in argv:
+            self.idempotency_ttl = argv.pop('idempotency_ttl')
+
+        if 'idempotency_header' in argv:
+            self.idempotency_header = argv.pop('idempotency_header')
+
+        if 'idempotency_file' in argv:
+            self.idempotency_file = argv.pop('idempotency_file')
+
+        if 'log_body_limit' in argv:
+            self.log_body_limit = argv.pop('log_body_limit')
+
+        if 'log_sample' in argv:
+            self.log_sample = argv.pop('log_sample')
+
+        if 'batch_size' in argv:
+            self.batch_size = argv.pop('batch_size')
+
+        if 'batch_timeout' in argv:
+            self.batch_timeout = argv.pop('batch_timeout')
+
+        if 'stream_spool' in argv:
+            self.stream_spool = argv.pop('stream_spool')
+
+        if 'stream_ttl' in argv:
+            self.stream_ttl = argv.pop('stream_ttl')
+
+        if 'json_stream_size' in argv:
+            self.json_stream_size = argv.pop('json_stream_size')
+
+        if 'max_inflight' in argv:
+            self.max_inflight = argv.pop('max_inflight')
+
+        if 'max_inflight_bytes' in argv:
+            self.max_inflight_bytes = argv.pop('max_inflight_bytes')
+
+        if 'start_method' in argv:
+            self.start_method = argv.pop('start_method')
+
+        if 'profile_connection' in argv:
+            self.profile_connection = argv.pop('profile_connection')
+
+        if 'profile_output' in argv:
+            self.profile_output = argv.pop('profile_output')
+
+        if 'consume_partitions' in argv:
+            self.consume_partitions = argv.pop('consume_partitions')
+
+        if 'ordering_header' in argv:
+            self.ordering_header = argv.pop('ordering_header')
+
+        if 'max_active_keys' in argv:
+            self.max_active_keys = argv.pop('max_active_keys')
+
+        if 'latency_report' in argv:
+            self.latency_report = argv.pop('latency_report')
+
+        if 'probe_interval' in argv:
+            self.probe_interval = argv.pop('probe_interval')
+
+        if 'metrics_port' in argv:
+            self.metrics_port = argv.pop('metrics_port')
+
+        if 'metrics_host' in argv:
+            self.metrics_host = argv.pop('metrics_host')
+
+        if 'capture' in argv:
+            self.capture = argv.pop('capture')
+
+        if 'capture_limit' in argv:
+            self.capture_limit = argv.pop('capture_limit')
+
+        if self.log_sample < 1:
+            raise ValueError("Log sample should be positive")
+
+        if self.batch_size < 0 or self.batch_timeout < 0:
+            raise ValueError("Batch size and timeout should not be negative")
+
+        if self.probe_interval < 0:
+            raise ValueError("Probe interval should not be negative")
+
+        if self.capture_limit < 0:
+            raise ValueError("Capture limit should not be negative")
+
+        if self.stream_ttl < 0:
+            raise ValueError("Stream TTL should not be negative")
+
+        if self.json_stream_size < 0:
+            raise ValueError("JSON stream size should not be negative")
+
+        if 'executor' in argv:
+            self.executor = argv.pop('executor')
+            self._keyed_executor = None
+
+        if self.executor is not None and self.batch_size:
+            raise ValueError("Batch processing can not be combined with concurrent one")
+
+        memory_profile = argv.pop('memory_profile', None)
+        memory_profile_method = argv.pop('memory_profile_method', 'tracemalloc')
+        memory_profile_report = argv.pop('memory_profile_report', 0)
+        if memory_profile is not None:
+            self._memory_profiler = None
+            if memory_profile:
+                self._memory_profiler = MemoryProfiler(memory_profile, method=memory_profile_method,
+                                                       report_every=memory_profile_report,
+                                                       report_signal=getattr(signal, 'SIGUSR1', None))
+
+        profile = argv.pop('profile', False)
+        profile_report = argv.pop('profile_report', 0)
+        profile_interval = argv.pop('profile_interval', 0.005)
+        if profile is not False:
+            if self._cpu_profiler is not None:
+                self._cpu_profiler.close()
+                self._cpu_profiler = None
+            if profile:
+                self._cpu_profiler = CpuProfiler(profile, report_every=profile_report, output=self.profile_output,
+                                                 interval=profile_interval,
+                                                 report_signal=getattr(signal, 'SIGUSR2', None))
+
+        latency_stats = argv.pop('latency_stats', None)
+        if latency_stats is not None:
+            self.latency = LatencyStats() if latency_stats else None
+
+        log_exceptions_interval = argv.pop('log_exceptions_interval', None)
+        if log_exceptions_interval is not None:
+            self._exc_log = ExceptionLogLimiter(log_exceptions_interval)
+
         if len(args) > 0 or 'url' in argv:
             super(QueueServer, self).setup(*args, **argv)
         elif len(argv) > 0:
@@ -117,9 +532,96 @@ class QueueServer(QueueBase):
         if properties.content_type != 'application/json':
             raise ValueError("invalid message: content-type should be application/json")
 
+        if self._decodes_as_stream(body):
+            return self.on_message_items(JsonArrayStream(body), properties)
+
         data = json.loads(body)
         return self.on_message(data, properties)
 
+    def _decodes_as_stream(self, body):
+        """
+        Check if message body is to be decoded element by element: it is a large JSON array
+        """
+        return bool(self.json_stream_size) and len(body) >= self.json_stream_size and is_json_array(body)
+
+    def on_message_items(self, items, properties):
+        """
+        Redefine this to process JSON array messages of json_stream_size or larger without decoding them entirely:
+        elements are decoded one by one while iterating.
+        Default is to decode all of them and call on_message().
+        :param items: top-level array elements. JsonArrayStream.next_array() reads a nested array the same way
+        :type items: JsonArrayStream
+        :param properties: message properties
+        :type properties: pika.BasicProperties
+        """
+        return self.on_message(list(items), properties)
+
+    def ordering_key(self, body, properties):
+        """
+        Redefine this to set key of messages to be processed in order when processing concurrently:
+        messages with the same key are processed one after another, ones with different keys in parallel.
+        Default is ordering_header value.
+        :param body: message body
+        :type body: bytes
+        :param properties: message properties
+        :type properties: pika.BasicProperties
+        :returns: hashable key, None if message may be processed in any order
+        """
+        if not self.ordering_header:
+            return None
+
+        return (getattr(properties, 'headers', None) or dict()).get(self.ordering_header)
+
+    def run_concurrently(self, body, properties):
+        """
+        Redefine this to choose messages processed on executor if it is set up, others are processed in the main loop.
+        Default is to process all of them on executor.
+        :param body: message body
+        :type body: bytes
+        :param properties: message properties
+        :type properties: pika.BasicProperties
+        :returns: boolean
+        """
+        return True
+
+    def latency_label(self, body, properties):
+        """
+        Redefine this to set label of the message handler latency is aggregated by. Default is message type.
+        :param body: message body
+        :type body: bytes
+        :param properties: message properties
+        :type properties: pika.BasicProperties
+        :returns: str
+        """
+        return getattr(properties, 'type', None) or 'message'
+
+    def on_stream(self, chunks, properties):
+        """
+        Redefine this to process payloads sent with QueueClient.send_stream() without loading them to memory.
+        Called when all the chunks have arrived, chunks are read from spool one by one while iterating.
+        Default is to join chunks and call on_message_raw().
+        :param chunks: payload chunks in order
+        :type chunks: iterator of bytes
+        :param properties: properties of the chunk completed the transfer, with transfer id header
+        :type properties: pika.BasicProperties
+        """
+        return self.on_message_raw(b''.join(chunks), properties)
+
+    def on_batch(self, items):
+        """
+        Redefine this to process messages in bulk, used if batch size is set.
+        Call fail() for items failed, the rest are acked with single acknowledgement.
+        Exception raised fails the whole batch.
+        Default is to call on_message_raw() for each message.
+        :param items: messages in delivery order
+        :type items: list of BatchItem
+        """
+        for _item in items:
+            try:
+                self.on_message_raw(_item.body, _item.properties)
+            except Exception as e:
+                _item.fail(e)
+
     def _sleep_on_nack(self):
         """
         Sleep between messages if nack occured
@@ -137,11 +639,11 @@ class QueueServer(QueueBase):
         :param delay: new delay
         :type delay: float
         """
-        logging.debug("IPC delay set call with argument %f" % delay)
+        logging.debug("IPC delay set call with argument %f", delay)
 
         if delay > 0.0 and delay < self._ipc_delay:
             self._ipc_delay = delay
-            logging.debug("Ipc delay is set to %f sec" % self._ipc_delay)
+            logging.debug("Ipc delay is set to %f sec", self._ipc_delay)
 
     def _increase_ipc_delay(self):
         """
@@ -154,9 +656,10 @@ class QueueServer(QueueBase):
             return
 
         self._ipc_delay = _new_delay
-        logging.debug("Ipc delay is increased to %f sec" % self._ipc_delay)
+        logging.debug("Ipc delay is increased to %f sec", self._ipc_delay)
 
-    def _report_message_result(self, delivery_tag, ack=False, requeue=True, time_delta=0):
+    def _report_message_result(self, delivery_tag, ack=False, requeue=True, time_delta=0, retry_queue=None, retry_count=0,
+                               multiple=False):
         """
         Report message processing result
         :param delivery_tag: message delivery tag
@@ -167,9 +670,104 @@ class QueueServer(QueueBase):
         :type requeue: boolean
         :param time_delta: time took to process message
         :type time_delta: float
+        :param retry_queue: re-publish message to this retry queue instead of nack
+        :type retry_queue: str
+        :param retry_count: retries count for re-published message
+        :type retry_count: int
+        :param multiple: ack all the messages up to delivery tag given
+        :type multiple: boolean
         """
+        if self._captured:
+            self._capture_result(delivery_tag, multiple, CaptureWriter.result(ack, requeue, retry_queue))
+
         self._ipc_q_out.put(IpcMessageResult(
-            delivery_tag=delivery_tag, ack=ack, requeue=requeue, time_delta=time_delta))
+            delivery_tag=delivery_tag, ack=ack, requeue=requeue, time_delta=time_delta,
+            retry_queue=retry_queue, retry_count=retry_count, multiple=multiple,
+            reported=time.time() if self.latency is not None else None))
+
+    def _capture_result(self, delivery_tag, multiple, result):
+        """
+        Write messages captured to the file with their processing result
+        :param delivery_tag: message delivery tag
+        :type delivery_tag: int
+        :param multiple: result is for all the messages up to delivery tag
+        :type multiple: boolean
+        :param result: result name, see CaptureWriter.results
+        :type result: str
+        """
+        _tags = [delivery_tag]
+
+        if multiple:
+            _tags = sorted(_tag for _tag in self._captured if _tag <= delivery_tag)
+
+        _now = time.time()
+
+        for _tag in _tags:
+            _captured = self._captured.pop(_tag, None)
+
+            if _captured is None or self._capture is None:
+                continue
+
+            (_msg, _received) = _captured
+
+            try:
+                self._capture.write(_received, _now - _received, result, _msg.properties, _msg.body,
+                                    queue=_msg.queue, redelivered=_msg.redelivered)
+            except Exception as e:
+                # capture is an aid, processing goes on without it
+                logging.exception(e)
+                logging.error("Capturing to %s failed, stopping it", self.capture)
+                self.stop_capture()
+                continue
+
+            if self.capture_limit and self._capture.count >= self.capture_limit:
+                logging.info("%d messages are captured to %s, stopping", self._capture.count, self.capture)
+                self.stop_capture()
+
+    def stop_capture(self):
+        """
+        Stop capturing messages: the file is closed and is not re-opened on reconnection
+        """
+        self._captured = dict()
+
+        if self._capture is None:
+            return
+
+        self._capture.close()
+        self._capture = None
+        self.capture = None
+
+    def _report_message_failure(self, delivery_tag, properties, delivery=None):
+        """
+        Report message processing failure: schedule delayed retry if configured, nack otherwise
+        :param delivery_tag: message delivery tag
+        :type delivery_tag: int
+        :param properties: message properties
+        :type properties: pika.Spec.BasicProperties
+        :param delivery: delivery information, queue the message came from is retried to
+        :type delivery: IpcMessage
+        """
+        if not self.retry_delays:
+            self._report_message_result(delivery_tag=delivery_tag, ack=False, requeue=self.deads_disabled)
+            return
+
+        _headers = getattr(properties, 'headers', None) or dict()
+        _retries = int(_headers.get(self.retry_header, 0))
+
+        if self.retry_max and _retries >= self.retry_max:
+            if self.deads_disabled:
+                logging.warning("Message with delivery tag %d failed after %d retries, dropping it: deads queue is disabled",
+                                delivery_tag, _retries)
+            else:
+                logging.warning("Message with delivery tag %d failed after %d retries, rejecting", delivery_tag, _retries)
+
+            self._report_message_result(delivery_tag=delivery_tag, ack=False, requeue=False)
+            return
+
+        _delay = self.retry_delays[min(_retries, len(self.retry_delays) - 1)]
+        self._report_message_result(delivery_tag=delivery_tag, ack=False, requeue=False,
+                                    retry_queue=self.retry_queue_name(getattr(delivery, 'queue', None) or self.queue, _delay),
+                                    retry_count=_retries + 1)
 
     def _on_nack(self, body, properties, result):
         """
@@ -181,11 +779,12 @@ class QueueServer(QueueBase):
         :param result: message processing result
         :type result: Exception
         """
-        logging.exception(result)
+        self._exc_log.exception(result)
         self.counter_bad += 1
         self._nacks += 1
         self.on_nack(body, properties, result)
-        if self.max_sleep > 0 and self.deads_disabled:
+        # delayed retries are done by broker, no need to block
+        if self.max_sleep > 0 and self.deads_disabled and not self.retry_delays:
             self._sleep_on_nack()
 
     def _on_ack(self, body, properties):
@@ -201,14 +800,29 @@ class QueueServer(QueueBase):
         self.on_ack(body, properties)
 
     def __debug_message(self, properties, body):
+        if self.counter_messages % self.log_sample or not logging.root.isEnabledFor(logging.DEBUG):
+            return
+
         logging.debug("stats: total %d good %d bad %d", self.counter_messages, self.counter_good, self.counter_bad)
-        logging.debug("Received message: %s", body)
+        logging.debug("Received message: %s", truncate_body(body, self.log_body_limit))
         logging.debug("Message properties - content-type: %s (encoding: %s) type: %s priority: %s",
                       properties.content_type, properties.content_encoding, properties.type, properties.priority)
         if hasattr(properties, 'headers') and properties.headers and len(properties.headers) > 0:
             logging.debug("Message headers: %s", repr(properties.headers))
 
-    def _process_message(self, delivery_tag, properties, body):
+    def _idempotency_key(self, properties):
+        """
+        Key to detect duplicate message by
+        :param properties: message properties
+        :type properties: pika.BasicProperties
+        :returns: key or None if message has no one
+        """
+        if self.idempotency_header:
+            return (getattr(properties, 'headers', None) or dict()).get(self.idempotency_header)
+
+        return getattr(properties, 'message_id', None)
+
+    def _process_message(self, delivery_tag, properties, body, delivery=None):
         """
         Process message
         :param delivery_tag: delivery tag
@@ -217,24 +831,364 @@ class QueueServer(QueueBase):
         :type properties: pika.BasicProperties
         :param body: message body
         :type body: bytes
+        :param delivery: delivery information: redelivered flag, exchange and routing key
+        :type delivery: IpcMessage
         """
         self.counter_messages += 1
         self.__debug_message(properties, body)
+        _key = None
+
+        if self._idempotency is not None:
+            _key = self._idempotency_key(properties)
+
+            if _key is not None and _key in self._idempotency:
+                logging.info("Message with key %s (redelivered: %s) has been processed already, skipping",
+                             _key, getattr(delivery, 'redelivered', None))
+                self.counter_duplicates += 1
+                self._report_message_result(delivery_tag=delivery_tag, ack=True, requeue=False)
+                return
+
+        if self.stream_id_header in (getattr(properties, 'headers', None) or dict()):
+            self._process_chunk(delivery_tag, properties, body, delivery=delivery)
+            return
+
+        if self.batch_size:
+            self._batch_append(delivery_tag, properties, body, delivery, _key)
+            return
+
+        if self.executor is not None:
+            _order = self.ordering_key(body, properties)
+
+            # message with a key being processed is queued after others with the same key in any case
+            if self.run_concurrently(body, properties) or \
+                    (self._keyed_executor is not None and self._keyed_executor.active(_order)):
+                self._submit_message(delivery_tag, properties, body, delivery, _key, _order)
+                return
 
         try:
             _start_t = time.time()
-            self.on_message_raw(body, properties)
+            self._local.function = None
+            _sample = self._memory_profiler.begin() if self._memory_profiler else None
+            _profile = self._cpu_profiler.begin() if self._cpu_profiler else None
+
+            try:
+                self.on_message_raw(body, properties)
+            finally:
+                _function = self._local.function or getattr(properties, 'type', None) or 'message'
+
+                if _profile is not None:
+                    self._cpu_profiler.end(_profile, _function)
+
+                if _sample is not None:
+                    self._memory_profiler.end(_sample, _function)
+
             _delta_t = time.time() - _start_t
-            logging.debug("Message processing took %f" % _delta_t)
+            logging.debug("Message processing took %f", _delta_t)
             self._set_ipc_delay(_delta_t)
+            self._record_handler_latency(_delta_t, body, properties, label=self._local.function)
+
+            if _key is not None:
+                self._idempotency.add(_key)
+
             self._report_message_result(delivery_tag=delivery_tag, ack=True, requeue=False, time_delta=_delta_t)
             self._on_ack(body, properties)
         except Exception as e:
             # this block should be actived only if message processing result throws an exception
-            # so we have to nack it unconditionally
+            # so we have to nack (or retry) it unconditionally
+            self._record_handler_latency(time.time() - _start_t, body, properties, label=self._local.function)
+            self._report_message_failure(delivery_tag, properties, delivery=delivery)
+            self._on_nack(body, properties, result=e)
+
+    def _record_handler_latency(self, seconds, body, properties, label=None):
+        """
+        Add handler time to latency histograms if they are collected
+        :param label: handler label known already, latency_label() of the message by default
+        :type label: str
+        """
+        if self.latency is None:
+            return
+
+        self.latency.record('handler', label or self.latency_label(body, properties), seconds)
+
+    def _record_delivery_latency(self, msg):
+        """
+        Add time spent in the broker and in interprocess queue by the message received to latency histograms
+        :param msg: message received
+        :type msg: IpcMessage
+        """
+        if self.latency is None or not msg.received:
+            return
+
+        _queue = msg.queue or self.queue
+        self.latency.record('ipc', _queue, time.time() - msg.received)
+        _published = self.published_time(msg.properties)
+
+        if _published is not None:
+            # clocks of producer and consumer hosts may differ, negative values are counted as zero
+            self.latency.record('queue_wait', _queue, msg.received - _published)
+
+    def get_latency(self):
+        """
+        Latency histograms of processing stages by queue (queue_wait, ipc, ack) or by handler label (handler),
+        see LatencyStats.snapshot()
+        :returns: dict, empty if latency is not collected
+        """
+        return self.latency.snapshot() if self.latency is not None else dict()
+
+    def _log_latency_report(self):
+        """
+        Log latency histograms summary if it is due
+        """
+        if self.latency is None or not self.latency_report or time.time() - self._latency_reported < self.latency_report:
+            return
+
+        self._latency_reported = time.time()
+
+        for _line in self.latency.report():
+            logging.info("latency: %s", _line)
+
+    def _log_cpu_profile(self, force=False):
+        """
+        Log CPU profile report if it is due, let connection process report also if it is profiled
+        :param force: report anyway
+        :type force: boolean
+        """
+        if not self._cpu_profiler.log_report(force=force) or not self.profile_connection:
+            return
+
+        _connection_prcs = self._connection_prcs
+
+        if _connection_prcs is not None and _connection_prcs.is_alive() and hasattr(signal, 'SIGUSR2'):
+            os.kill(_connection_prcs.pid, signal.SIGUSR2)
+
+    def stop_profile(self):
+        """
+        Write the final CPU profile report and stop profiling
+        """
+        if self._cpu_profiler is None:
+            return
+
+        self._cpu_profiler.log_report(force=True)
+        self._cpu_profiler.close()
+        self._cpu_profiler = None
+
+    def _submit_message(self, delivery_tag, properties, body, delivery, key, order):
+        """
+        Pass message to executor, result is reported by the main loop when it finishes
+        """
+        if self._keyed_executor is None:
+            self._keyed_executor = KeyedExecutor(self.executor, self.max_active_keys)
+
+        _connection_prcs = self._connection_prcs
+        # handler label is taken here: the message is decoded in the main loop already
+        _label = self.latency_label(body, properties) if self.latency is not None else None
+        _start_t = time.time()
+        _future = self._keyed_executor.submit(order, *self._executor_task(body, properties))
+        _future.add_done_callback(lambda _future: self._completed.put(
+            (_future, _connection_prcs, time.time() - _start_t, delivery_tag, properties, body, delivery, key, _label)))
+
+    def _executor_task(self, body, properties):
+        """
+        Function to process message on executor with, followed by its arguments: on_message_raw() by default
+        """
+        return (self.on_message_raw, body, properties)
+
+    def _process_completed(self, timeout=0):
+        """
+        Report results of messages processed concurrently, in order of finishing
+        :param timeout: seconds to wait for the first result if there is no one yet
+        :type timeout: float
+        """
+        while True:
+            try:
+                _completed = self._completed.get(timeout=timeout) if timeout else self._completed.get_nowait()
+            except queue.Empty:
+                return
+
+            timeout = 0
+            (_future, _connection_prcs, _delta_t, _delivery_tag, _properties, _body, _delivery, _key, _label) = _completed
+
+            if _connection_prcs is not self._connection_prcs:
+                # delivery tags are valid within the connection only, message is to be redelivered
+                logging.warning("Dropping result of message with delivery tag %d got on previous connection", _delivery_tag)
+                continue
+
+            _exception = _future.exception()
+            self._record_handler_latency(_delta_t, _body, _properties, label=_label)
+
+            if _exception is not None:
+                self._report_message_failure(_delivery_tag, _properties, delivery=_delivery)
+                self._on_nack(_body, _properties, result=_exception)
+                continue
+
+            logging.debug("Message processing took %f", _delta_t)
+
+            if _key is not None:
+                self._idempotency.add(_key)
+
+            self._report_message_result(delivery_tag=_delivery_tag, ack=True, requeue=False, time_delta=_delta_t)
+            self._on_ack(_body, _properties)
+
+    def _executor_pending(self):
+        """
+        Messages passed to executor and not processed yet
+        """
+        return self._keyed_executor.pending if self._keyed_executor is not None else 0
+
+    def _get_stream_spool(self):
+        """
+        Create spool on the first chunk received
+        """
+        if self._stream_spool is None:
+            _path = self.stream_spool or os.path.join(tempfile.gettempdir(), 'oc_cdt_queue2-spool', self.queue or '')
+            logging.debug("Spooling chunks to %s", _path)
+            self._stream_spool = StreamSpool(_path, ttl=self.stream_ttl)
+
+        return self._stream_spool
+
+    def _process_chunk(self, delivery_tag, properties, body, delivery=None):
+        """
+        Process a chunk of payload sent with QueueClient.send_stream().
+        Chunks are acked once spooled to disk, the one completing transfer is acked after on_stream() succeeds.
+        Chunks are rejected by supervised workers: other workers consume the same queue, so a transfer would be
+        split between their spools and never completed.
+        :param delivery_tag: delivery tag
+        :type delivery_tag: int
+        :param properties: properties
+        :type properties: pika.BasicProperties
+        :param body: chunk
+        :type body: bytes
+        :param delivery: delivery information
+        :type delivery: IpcMessage
+        """
+        if getattr(self, 'worker_index', None) is not None:
             self._report_message_result(delivery_tag=delivery_tag, ack=False, requeue=self.deads_disabled)
+            self._on_nack(body, properties, result=ValueError(
+                "Streamed transfers need a single consumer of the queue, chunk is rejected by supervised worker"))
+            return
+
+        _headers = properties.headers
+        _transfer_id = _headers.get(self.stream_id_header)
+
+        if isinstance(_transfer_id, bytes):
+            _transfer_id = _transfer_id.decode('utf-8')
+
+        try:
+            _complete = self._get_stream_spool().add(_transfer_id, _headers.get(self.stream_index_header, 0), body,
+                                                     count=_headers.get(self.stream_count_header))
+
+            if not _complete:
+                self._report_message_result(delivery_tag=delivery_tag, ack=True, requeue=False)
+                return
+
+            logging.debug("Transfer %s is complete", _transfer_id)
+            _start_t = time.time()
+            _profile = self._cpu_profiler.begin() if self._cpu_profiler else None
+
+            try:
+                self.on_stream(self._stream_spool.chunks(_transfer_id), properties)
+            finally:
+                if _profile is not None:
+                    self._cpu_profiler.end(_profile, 'stream')
+
+            _delta_t = time.time() - _start_t
+            logging.debug("Transfer processing took %f", _delta_t)
+            self._record_handler_latency(_delta_t, None, properties, label='stream')
+            self._stream_spool.remove(_transfer_id)
+            self._report_message_result(delivery_tag=delivery_tag, ack=True, requeue=False, time_delta=_delta_t)
+            self._on_ack(None, properties)
+        except Exception as e:
+            # spooled chunks are kept: transfer is processed again when failed chunk is redelivered or retried
+            self._report_message_failure(delivery_tag, properties, delivery=delivery)
             self._on_nack(body, properties, result=e)
 
+    def _batch_append(self, delivery_tag, properties, body, delivery, key):
+        """
+        Add message to the current batch, process the batch if it is full
+        """
+        if not self._batch:
+            self._batch_started = time.time()
+
+        _item = BatchItem(delivery_tag, properties, body, delivery=delivery)
+        _item.key = key
+        self._batch.append(_item)
+
+        if len(self._batch) >= self.batch_size:
+            self._process_batch()
+
+    def _batch_wait(self):
+        """
+        Seconds left to wait for the current batch to fill up, 0 if it is to be processed now
+        """
+        if not self._batch:
+            return None
+
+        return max(0, self._batch_started + self.batch_timeout - time.time())
+
+    def _process_batch(self):
+        """
+        Process collected messages with on_batch().
+        Failed messages are reported first, then the rest are acked: messages are processed in delivery order,
+        so all the previous ones are reported already and multiple acknowledgement of the last successful one
+        covers the successful ones of the batch only. Failed ones re-published to retry queue are acked later,
+        when the copy is confirmed, and multiple acknowledgement would cover them: with retries set up
+        successful ones are acked one by one if there are failed ones.
+        """
+        _items = self._batch
+        self._batch = list()
+
+        if not _items:
+            return
+
+        logging.debug("Processing batch of %d messages", len(_items))
+        _start_t = time.time()
+        _profile = self._cpu_profiler.begin() if self._cpu_profiler else None
+
+        try:
+            self.on_batch(_items)
+        except Exception as e:
+            for _item in _items:
+                if not _item.failed:
+                    _item.fail(e)
+
+        if _profile is not None:
+            self._cpu_profiler.end(_profile, 'batch')
+
+        _delta_t = time.time() - _start_t
+        logging.debug("Batch processing took %f", _delta_t)
+
+        for _item in _items:
+            self._record_handler_latency(_delta_t, _item.body, _item.properties, label='batch')
+
+        _succeeded = list()
+
+        for _item in _items:
+            if _item.failed:
+                self._report_message_failure(_item.delivery_tag, _item.properties, delivery=_item.delivery)
+                self._on_nack(_item.body, _item.properties, result=_item.error)
+                continue
+
+            _succeeded.append(_item)
+
+        if not _succeeded:
+            return
+
+        self._set_ipc_delay(_delta_t / len(_items))
+
+        if self.retry_delays and len(_succeeded) < len(_items):
+            for _item in _succeeded:
+                self._report_message_result(delivery_tag=_item.delivery_tag, ack=True, requeue=False,
+                                            time_delta=_delta_t)
+        else:
+            self._report_message_result(delivery_tag=max(_item.delivery_tag for _item in _succeeded),
+                                        ack=True, requeue=False, time_delta=_delta_t, multiple=True)
+
+        for _item in _succeeded:
+            if _item.key is not None:
+                self._idempotency.add(_item.key)
+
+            self._on_ack(_item.body, _item.properties)
+
     def run(self):
         """
         Run the main loop
@@ -254,9 +1208,41 @@ class QueueServer(QueueBase):
                 logging.debug("Connection prcs is not active, breaking main loop")
                 break
 
+            if self._memory_profiler:
+                self._memory_profiler.log_report()
+
+            if self._cpu_profiler:
+                self._log_cpu_profile()
+
+            self._log_latency_report()
+
+            if self._keyed_executor is not None:
+                self._process_completed()
+
+                if self._keyed_executor.full():
+                    # do not take more messages until one of active keys is finished
+                    self._process_completed(self._ipc_delay)
+                    continue
+
+            _batch_wait = self._batch_wait()
+
+            if _batch_wait == 0:
+                self._process_batch()
+                continue
+
             # sleeping if inbound queue is empty
             if self._ipc_q_in.empty():
-                time.sleep(self._ipc_delay)
+                if _batch_wait is not None and self.batch_timeout == 0:
+                    # nothing more is available immediately
+                    self._process_batch()
+                    continue
+
+                if self._executor_pending():
+                    # results are reported as soon as they are ready
+                    self._process_completed(self._ipc_delay)
+                    continue
+
+                time.sleep(self._ipc_delay if _batch_wait is None else min(self._ipc_delay, _batch_wait))
                 # if queue is emty for a long time
                 # we may sleep much more next time
                 # to decrease CPU usage
@@ -265,6 +1251,15 @@ class QueueServer(QueueBase):
 
             self._prcs_ipc_q_pop()
 
+        if self._batch and self._connection_prcs.is_alive():
+            # stopping: acknowledgements may be sent still
+            self._process_batch()
+
+        while self._executor_pending() and self._connection_prcs.is_alive():
+            # stopping: wait for messages being processed to report results
+            self._process_completed(self._ipc_delay)
+
+        self._process_completed()
         self.disconnect()
 
     def _prcs_ipc_q_pop(self, do_process=True):
@@ -275,16 +1270,35 @@ class QueueServer(QueueBase):
         """
         __msg = self._ipc_q_in.get()
         self._ipc_q_in.task_done()
-        logging.debug("recieved from ipc_q_in: item_type : %s" % type(__msg))
+        logging.debug("recieved from ipc_q_in: item_type : %s", type(__msg))
 
         if isinstance(__msg, IpcExcMsg):
-            logging.debug("Exception received, type: %s" % str(__msg.type))
+            logging.debug("Exception received, type: %s", __msg.type)
 
             if __msg.reply_code is not None and __msg.reply_code in [0, 200]:
                 # normal shutdown
                 logging.info(repr(__msg))
             else:
                 logging.exception(__msg)
+
+            if __msg.reply_code in self._topology_reply_codes:
+                # queue was deleted or re-declared with other arguments: declare everything again on reconnect
+                logging.debug("Forgetting declared topology")
+                self._declarations.forget(self.connection_parameters)
+            return
+
+        if isinstance(__msg, IpcDeclared):
+            self._declarations.add(self.connection_parameters, __msg.keys)
+            return
+
+        if isinstance(__msg, IpcQueueStats):
+            self.backlog.update(__msg.queue, __msg.messages, __msg.consumers, __msg.probed)
+            return
+
+        if isinstance(__msg, IpcLatency):
+            if self.latency is not None:
+                for (_queue, _seconds) in __msg.samples:
+                    self.latency.record('ack', _queue or self.queue, _seconds)
             return
 
         if not do_process:
@@ -292,7 +1306,81 @@ class QueueServer(QueueBase):
             return
 
         if isinstance(__msg, IpcMessage):
-            self._process_message(__msg.delivery_tag, __msg.properties, __msg.body)
+            self._update_inflight(__msg)
+            self._record_delivery_latency(__msg)
+
+            if self._capture is not None:
+                self._captured[__msg.delivery_tag] = (__msg, __msg.received or time.time())
+
+            self._process_message(__msg.delivery_tag, __msg.properties, __msg.body, delivery=__msg)
+
+    def _update_inflight(self, msg):
+        """
+        Take in-flight usage reported by connection process with a message
+        :param msg: message received
+        :type msg: IpcMessage
+        """
+        if msg.paused and not self.consuming_paused:
+            self.counter_pauses += 1
+
+        self.inflight_messages = msg.inflight
+        self.inflight_bytes = msg.inflight_bytes
+        self.consuming_paused = msg.paused
+
+    def get_stats(self):
+        """
+        Processing counters and in-flight usage. In-flight values are as of the last message received
+        :returns: dict
+        """
+        return {'messages': self.counter_messages,
+                'good': self.counter_good,
+                'bad': self.counter_bad,
+                'duplicates': self.counter_duplicates,
+                'inflight_messages': self.inflight_messages,
+                'inflight_bytes': self.inflight_bytes,
+                'consuming_paused': self.consuming_paused,
+                'pauses': self.counter_pauses}
+
+    def get_backlog(self):
+        """
+        Depth of consumed queues as of the latest probe, with drain rate and time-to-empty estimated
+        :returns: {queue: dict}, see QueueBacklog.snapshot(). Empty if queues are not probed
+        """
+        return self.backlog.snapshot()
+
+    def get_metrics(self):
+        """
+        All the metrics served over HTTP. Redefine this to add your own processing counters to 'stats'
+        :returns: {'backlog': get_backlog(), 'stats': get_stats(), 'latency': get_latency()}
+        """
+        return {'backlog': self.get_backlog(),
+                'stats': self.get_stats(),
+                'latency': self.get_latency()}
+
+    def start_metrics(self):
+        """
+        Start serving metrics if a port is set up and they are not served yet. Done on connection
+        """
+        if self.metrics_port is None or self._metrics_server is not None:
+            return
+
+        _port = self.metrics_port
+
+        if _port:
+            # workers of the same pod listen to ports of their own
+            _port += getattr(self, 'worker_index', 0)
+
+        self._metrics_server = self._MetricsServer(self.get_metrics, _port, host=self.metrics_host).start()
+
+    def stop_metrics(self):
+        """
+        Stop serving metrics
+        """
+        if self._metrics_server is None:
+            return
+
+        self._metrics_server.stop()
+        self._metrics_server = None
 
     def _prcs_ipc_q(self, do_process=True):
         """
@@ -303,6 +1391,25 @@ class QueueServer(QueueBase):
         while not self._ipc_q_in.empty():
             self._prcs_ipc_q_pop(do_process=do_process)
 
+    def prepare(self):
+        """
+        Create processing resources not created yet. Done on connection, call it to process messages without one
+        """
+        # in-memory cache is kept across reconnections: unacked messages are redelivered after them.
+        # File-backed one is closed on disconnection and reopened here with the keys written
+        if self.idempotency_size and self._idempotency is None:
+            self._idempotency = IdempotencyCache(self.idempotency_size, self.idempotency_ttl, self.idempotency_file)
+
+    def _close_idempotency(self):
+        """
+        Flush and close file-backed cache of processed keys, it is reopened by prepare()
+        """
+        if self._idempotency is None or not self.idempotency_file:
+            return
+
+        self._idempotency.close()
+        self._idempotency = None
+
     def connect(self):
         """
         Connect to RabbitMQ
@@ -313,27 +1420,86 @@ class QueueServer(QueueBase):
             logging.error("Connection process is not destroyed while trying to connect!")
             self.disconnect()
 
+        self.prepare()
+
+        self.inflight_messages = 0
+        self.inflight_bytes = 0
+        self.consuming_paused = False
+        self.start_metrics()
+
+        if self.capture and self._capture is None:
+            self._capture = self._CaptureWriter(self.capture)
+            logging.info("Capturing messages to %s", self.capture)
+
+        # delivery tags are valid within the connection only
+        self._captured = dict()
+
+        if self._batch:
+            # delivery tags are valid within the connection only, messages are to be redelivered
+            logging.warning("Dropping %d messages of unfinished batch", len(self._batch))
+            self._batch = list()
+
         # creating queues for interprocess communication
         # may be safely re-created without additional checks
         # old ipc_queues will be garbage-collected
         self._stop = False
-        self._ipc_q_in = self._JoinableQueue()
-        self._ipc_q_out = self._JoinableQueue()
+        _context = multiprocessing.get_context(self.start_method)
+
+        if self.start_method == 'forkserver':
+            # takes effect when forkserver is started, i.e. on the first connection
+            _context.set_forkserver_preload(self.forkserver_preload)
+
+        self._ipc_q_in = (self._JoinableQueue or _context.JoinableQueue)()
+        self._ipc_q_out = (self._JoinableQueue or _context.JoinableQueue)()
+        _queues = self.partition_queue_names(self.queue, self.partitions)
+        _consume_queues = self.consume_queues()
         self._connection_prcs = self._QueueConnectionProcess(
             connection=self._Connection,
             params=self.connection_parameters,
-            prefetch_count=self.prefetch_count,
-            queue=self.queue,
+            prefetch_count=max(self.prefetch_count, self.batch_size),
+            queue=_consume_queues[0],
             deads_disabled=self.deads_disabled,
             declare=self.queue_declare,
             ipc_q_out=self._ipc_q_in,  # note on queue direction across each other
-            ipc_q_in=self._ipc_q_out
+            ipc_q_in=self._ipc_q_out,
+            retry_delays=self.retry_delays,
+            declared=self._declarations.confirmed(self.connection_parameters),
+            max_inflight=self.max_inflight,
+            max_inflight_bytes=self.max_inflight_bytes,
+            start_method=self.start_method,
+            declare_queues=[_queue for _queue in _queues if _queue != _consume_queues[0]],
+            consume_queues=_consume_queues[1:],
+            latency=self.latency is not None,
+            probe_interval=self.probe_interval,
+            profile=self._cpu_profiler.method if self._cpu_profiler is not None and self.profile_connection else None,
+            profile_output='%s.connection' % self.profile_output if self.profile_output else None,
+            profile_interval=self._cpu_profiler.interval if self._cpu_profiler is not None else 0.005,
+            deads_queue=self.deads_queue_name(self.queue)
         )
 
         logging.debug("Connection subprocess is ready to start")
         self._connection_prcs.start()
         logging.info("Connection subprocess started")
 
+    def consume_queues(self):
+        """
+        Queues to consume from: the queue itself or its partitions chosen by consume_partitions
+
+        :returns: list of queue names
+        """
+        if not self.partitions:
+            return [self.queue]
+
+        _partitions = self.consume_partitions
+
+        if _partitions is None:
+            _partitions = range(0, self.partitions)
+
+        if not _partitions or any(_index < 0 or _index >= self.partitions for _index in _partitions):
+            raise ValueError("Partitions to consume should be in range 0..%d" % (self.partitions - 1))
+
+        return [self.partition_queue_name(self.queue, _index) for _index in _partitions]
+
     def stop(self):
         """
         Scheduler normal stopping
@@ -350,6 +1516,9 @@ class QueueServer(QueueBase):
         # before log anything
         if logging is not None: logging.debug("Closing the connection process")
 
+        # processed keys are synced to the file on every disconnection, the main loop is not running
+        self._close_idempotency()
+
         # catch chid process finish
         if not self._connection_prcs:
             if logging is not None: logging.debug("Disconnection has been done already")
@@ -364,8 +1533,10 @@ class QueueServer(QueueBase):
 
         # if connection subprocess is failed to disconnect then terminate it hardcorely
         if self._connection_prcs.is_alive():
-            if logging is not None: logging.error("Normal disconnection has been failed within %d seconds, terminating hardly" % self._terminate_delay)
+            if logging is not None: logging.error("Normal disconnection has been failed within %d seconds, terminating hardly", self._terminate_delay)
             self._connection_prcs.terminate()
+            # process is to be reaped before it may be closed
+            self._connection_prcs.join(self._terminate_delay or None)
 
         # close/join the process and free all resources got by it
         try:
@@ -379,9 +1550,12 @@ class QueueServer(QueueBase):
             self._connection_prcs = None
 
         # catch and process all messages from interprocess queue
-        if logging is not None: logging.debug("ipc queue size is: %s" % self._ipc_q_in.qsize())
+        if logging is not None: logging.debug("ipc queue size is: %s", self._ipc_q_in.qsize())
         self._prcs_ipc_q(do_process=False)
 
+        if self._capture is not None:
+            self._capture.flush()
+
         # closing all interprocess queues
         if self._ipc_q_in:
             self._ipc_q_in.close()
@@ -389,7 +1563,8 @@ class QueueServer(QueueBase):
             self._ipc_q_in = None
 
         if self._ipc_q_out:
-            # queue should be closed by receiver only
-            # self._ipc_q_out.close()
+            # receiver has gone already, closing the queue just flushes and stops its feeder thread;
+            # join_thread() fails for not closed queue
+            self._ipc_q_out.close()
             self._ipc_q_out.join_thread()
             self._ipc_q_out = None
@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+
+"""
+Supervisor running several independent consumers of a QueueApplication
+"""
+
+
+def _report_stats(app, index, stats_queue, interval):
+    """
+    Worker thread sending application stats to supervisor periodically
+    """
+    while True:
+        time.sleep(interval)
+        stats_queue.put((index, os.getpid(), app.get_stats()))
+
+
+class AppFactory(object):
+    """
+    Picklable recipe of the application for workers: its class (pickled by reference) and command line.
+    Application is built in worker, so nothing of the supervisor process is to be pickled for 'spawn'
+    and 'forkserver' start methods
+    """
+
+    def __init__(self, app_class, cmdline, args=(), kwargs=None):
+        """
+        Main initialization
+        :param app_class: QueueApplication descendant defined at module level
+        :type app_class: type
+        :param cmdline: command line parameters array
+        :type cmdline: list
+        :param args: positional arguments of the class constructor
+        :type args: tuple
+        :param kwargs: keyword arguments of the class constructor
+        :type kwargs: dict
+        """
+        self.app_class = app_class
+        self.cmdline = list(cmdline)
+        self.args = tuple(args)
+        self.kwargs = dict(kwargs or dict())
+
+    def __call__(self):
+        """
+        Build application with command line parsed, not set up yet
+        :returns: QueueApplication
+        """
+        _app = self.app_class(*self.args, **self.kwargs)
+        _app.parse_args(self.cmdline)
+        return _app
+
+
+def _worker_main(factory, index, stats_queue, stats_interval):
+    """
+    Worker process entry point: complete consumer with its own connection.
+    Application is built, set up and initialized here, so every worker has its own resources.
+    """
+    app = factory()
+
+    def _on_signal(signum, frame):
+        logging.info("Worker %d got signal %d, shutting down", index, signum)
+        app.shutdown()
+
+    signal.signal(signal.SIGTERM, _on_signal)
+    signal.signal(signal.SIGINT, _on_signal)
+    app.worker_index = index
+    _reporter = threading.Thread(target=_report_stats, args=(app, index, stats_queue, stats_interval))
+    _reporter.daemon = True
+    _reporter.start()
+    _code = app._main()
+
+    if not _code and app._failed and not app._shutdown:
+        # application exits normally if it has failed without reconnect, worker is restarted then
+        _code = 1
+
+    stats_queue.put((index, os.getpid(), app.get_stats()))
+    # let queue feeder thread flush the last stats
+    stats_queue.close()
+    stats_queue.join_thread()
+    sys.exit(_code)
+
+
+class QueueSupervisor(object):
+    """
+    Runs N worker processes, each one is a complete QueueApplication consumer with its own connection.
+    Restarts workers died with non-zero exit code, lost connection included (with increasing delay if they die quickly),
+    stops all of them on SIGTERM/SIGINT and aggregates their stats.
+    """
+
+    check_interval = 1          # seconds between workers checks
+    restart_delay_max = 60      # max delay before restarting a worker died quickly, seconds
+    shutdown_timeout = 10       # seconds to wait for workers to stop before killing them
+    stats_interval = 10         # seconds between stats reports from workers
+
+    def __init__(self, factory, processes, context=None):
+        """
+        Main initialization
+        :param factory: picklable callable building application to run in worker, not set up yet:
+                        setup_from_args() and init() are called by workers. See AppFactory
+        :type factory: AppFactory
+        :param processes: workers number
+        :type processes: int
+        :param context: multiprocessing context for workers, default one if not specified
+        """
+        if processes < 1:
+            raise ValueError("Processes number should be positive")
+
+        self.factory = factory
+        self.processes = processes
+        self._context = context or multiprocessing.get_context()
+        self._stats_queue = None
+        self._workers = [None] * processes
+        self._started_at = [0] * processes
+        self._failures = [0] * processes
+        self._restart_at = [0] * processes
+        self._stopping = False
+        # index: (pid, stats)
+        self._stats = dict()
+        self.counter_restarts = 0
+
+    def _start_worker(self, index):
+        """
+        Start worker process
+        :param index: worker number
+        :type index: int
+        """
+        # not daemonic: worker starts its own connection process
+        _worker = self._context.Process(target=_worker_main, name='worker-%d' % index,
+                                        args=(self.factory, index, self._stats_queue, self.stats_interval))
+        _worker.start()
+        logging.info("Worker %d started, pid %d", index, _worker.pid)
+        self._workers[index] = _worker
+        self._started_at[index] = time.time()
+
+    def _check_worker(self, index):
+        """
+        Check worker is alive, schedule restart if it died with an error
+        :param index: worker number
+        :type index: int
+        """
+        _worker = self._workers[index]
+
+        if _worker is None or _worker.is_alive():
+            return
+
+        _worker.join()
+        self._workers[index] = None
+        _now = time.time()
+
+        if _worker.exitcode == 0:
+            logging.info("Worker %d finished normally", index)
+            self._restart_at[index] = None
+            return
+
+        if _now - self._started_at[index] > self.restart_delay_max:
+            self._failures[index] = 0
+
+        _delay = 0 if not self._failures[index] else min(self.restart_delay_max, 2 ** (self._failures[index] - 1))
+        self._failures[index] += 1
+        self._restart_at[index] = _now + _delay
+        logging.warning("Worker %d died with exit code %s, restarting in %d seconds", index, _worker.exitcode, _delay)
+
+    def _collect_stats(self):
+        """
+        Take all stats reports sent by workers
+        """
+        while True:
+            try:
+                (_index, _pid, _stats) = self._stats_queue.get_nowait()
+            except queue.Empty:
+                return
+
+            self._stats[_index] = (_pid, _stats)
+
+    def get_stats(self):
+        """
+        Aggregated stats of all workers: numeric values are summed up, booleans are counted.
+        Values are as of the last report of each worker
+        :returns: dict with 'workers' - stats of each worker and 'restarts' - number of workers restarted
+        """
+        _total = dict()
+
+        for (_pid, _stats) in self._stats.values():
+            for _key, _value in _stats.items():
+                if isinstance(_value, (bool, int, float)):
+                    _total[_key] = _total.get(_key, 0) + _value
+
+        _total['workers'] = dict((_index, _stats) for (_index, (_pid, _stats)) in self._stats.items())
+        _total['restarts'] = self.counter_restarts
+        return _total
+
+    def shutdown(self, signum=None, frame=None):
+        """
+        Request coordinated stop of all workers. May be used as a signal handler
+        """
+        logging.info("Supervisor is shutting down")
+        self._stopping = True
+
+    def _stop_workers(self):
+        """
+        Ask workers to stop, kill ones not stopped in time
+        """
+        for _worker in self._workers:
+            if _worker is not None and _worker.is_alive():
+                _worker.terminate()
+
+        _deadline = time.time() + self.shutdown_timeout
+
+        for _index, _worker in enumerate(self._workers):
+            if _worker is None:
+                continue
+
+            _worker.join(max(0, _deadline - time.time()))
+
+            if _worker.is_alive():
+                logging.error("Worker %d did not stop within %d seconds, killing it", _index, self.shutdown_timeout)
+                _worker.kill()
+                _worker.join()
+
+            self._workers[_index] = None
+
+    def run(self):
+        """
+        Start workers and supervise them until all of them finish or shutdown is requested
+
+        :returns: return code for exit(): 0 if all workers finished normally or were stopped
+        """
+        signal.signal(signal.SIGTERM, self.shutdown)
+        signal.signal(signal.SIGINT, self.shutdown)
+        self._stats_queue = self._context.Queue()
+        _code = 0
+
+        for _index in range(0, self.processes):
+            self._start_worker(_index)
+
+        while not self._stopping:
+            for _index in range(0, self.processes):
+                self._check_worker(_index)
+
+                if self._workers[_index] is None and self._restart_at[_index] is not None and \
+                        self._restart_at[_index] <= time.time() and not self._stopping:
+                    self.counter_restarts += 1
+                    self._start_worker(_index)
+
+            self._collect_stats()
+
+            if all(_restart_at is None for _restart_at in self._restart_at):
+                logging.info("All workers finished")
+                break
+
+            time.sleep(self.check_interval)
+
+        self._stop_workers()
+        self._collect_stats()
+        logging.info("Workers stats: %s", dict((_k, _v) for (_k, _v) in self.get_stats().items() if _k != 'workers'))
+        return _code
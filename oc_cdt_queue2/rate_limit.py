@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+import threading
+import time
+
+"""
+Token bucket rate limiting of messages publishing
+"""
+
+
+class RateLimited(Exception):
+    """
+    Rate limit is reached and the caller asked not to wait
+    """
+    pass
+
+
+class RateLimiter(object):
+    """
+    Token bucket limiter of messages and bytes rates.
+    Buckets are filled at the rates given and hold up to 'burst' seconds worth of tokens,
+    so short bursts are passed at once and longer ones are smoothed down to the rates.
+    Waiting time is reserved under the lock and slept outside it, so concurrent senders
+    are served in turn without holding each other. Thread-safe.
+    """
+
+    # group name: limiter shared by clients of this process
+    _shared = dict()
+    _shared_lock = threading.Lock()
+
+    def __init__(self, messages_rate=0, bytes_rate=0, burst=1.0):
+        """
+        Main initialization
+        :param messages_rate: messages per second, 0 for no limit
+        :type messages_rate: float
+        :param bytes_rate: body bytes per second, 0 for no limit
+        :type bytes_rate: float
+        :param burst: seconds worth of tokens a bucket holds
+        :type burst: float
+        """
+        if messages_rate < 0 or bytes_rate < 0:
+            raise ValueError("Rate limits should not be negative")
+
+        if burst <= 0:
+            raise ValueError("Burst should be positive")
+
+        self.messages_rate = messages_rate
+        self.bytes_rate = bytes_rate
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._updated = self._clock()
+        # buckets are full initially, tokens go negative when waiting time is reserved
+        self._messages = messages_rate * burst
+        self._bytes = bytes_rate * burst
+
+        self.counter_throttled = 0
+        self.counter_rejected = 0
+        self.throttled_time = 0.0
+
+    _clock = staticmethod(time.monotonic)
+    _sleep = staticmethod(time.sleep)
+
+    @classmethod
+    def shared(cls, group, messages_rate=0, bytes_rate=0, burst=1.0):
+        """
+        Limiter shared by all clients of the group in this process, created on the first call.
+
+        :param group: group name
+        :type group: str
+        :raises: ValueError if the group limiter exists with other limits
+        :returns: RateLimiter
+        """
+        with cls._shared_lock:
+            _limiter = cls._shared.get(group)
+
+            if _limiter is None:
+                _limiter = cls(messages_rate, bytes_rate, burst)
+                cls._shared[group] = _limiter
+            elif (_limiter.messages_rate, _limiter.bytes_rate, _limiter.burst) != (messages_rate, bytes_rate, burst):
+                raise ValueError("Rate limit group '%s' is set up with other limits" % group)
+
+            return _limiter
+
+    def _refill(self, now):
+        _elapsed = max(0.0, now - self._updated)
+        self._updated = now
+        self._messages = min(self.messages_rate * self.burst, self._messages + _elapsed * self.messages_rate)
+        self._bytes = min(self.bytes_rate * self.burst, self._bytes + _elapsed * self.bytes_rate)
+
+    def reserve(self, size=0, block=True):
+        """
+        Take tokens for a message, reserving waiting time if there are not enough of them.
+        Use it if waiting is to be done by the caller (asyncio), acquire() otherwise.
+
+        :param size: message body size, bytes
+        :type size: int
+        :param block: reserve waiting time if tokens are missing, raise RateLimited otherwise
+        :type block: boolean
+        :returns: seconds to wait before sending
+        """
+        with self._lock:
+            self._refill(self._clock())
+            _wait = 0.0
+
+            if self.messages_rate and self._messages < 1:
+                _wait = (1 - self._messages) / self.messages_rate
+
+            if self.bytes_rate and size and self._bytes < size:
+                # a message larger than the bucket waits for the bucket to be full
+                _wait = max(_wait, (min(size, self.bytes_rate * self.burst) - self._bytes) / self.bytes_rate)
+
+            if _wait and not block:
+                self.counter_rejected += 1
+                raise RateLimited("Publish rate limit reached, %.3f seconds to wait" % _wait)
+
+            if self.messages_rate:
+                self._messages -= 1
+
+            if self.bytes_rate:
+                self._bytes -= size
+
+            if _wait:
+                self.counter_throttled += 1
+                self.throttled_time += _wait
+
+            return _wait
+
+    def acquire(self, size=0, block=True):
+        """
+        Take tokens for a message waiting for them if needed
+
+        :param size: message body size, bytes
+        :type size: int
+        :param block: wait if tokens are missing, raise RateLimited otherwise
+        :type block: boolean
+        :returns: seconds waited
+        """
+        _wait = self.reserve(size, block)
+
+        if _wait:
+            self._sleep(_wait)
+
+        return _wait
+
+    def get_stats(self):
+        """
+        Get throttling statistics
+
+        :returns: dict
+        """
+        return {'throttled': self.counter_throttled,
+                'rejected': self.counter_rejected,
+                'throttled_time': self.throttled_time}
@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+
+from oc_cdt_queue2.queue_client import QueueClient
+import argparse
+import logging
+import sys
+import time
+
+"""
+Dead messages replay tool.
+Moves messages from '<name>.deads' queue back to the main queue (or any other target)
+Run as: python -m oc_cdt_queue2.replay --queue <main queue> [options]
+"""
+
+
+class QueueReplay(QueueClient):
+    """
+    Moves messages from dead messages queue to the target one.
+    Target is set in the same way as for QueueClient: exchange and routing key, queue name by default.
+    Messages are consumed and published in batches within AMQP transaction,
+    so each batch costs one round-trip to the server only and is moved atomically:
+    publishes to the target and multiple acknowledgement on the source are committed together.
+    """
+
+    default_batch_size = 500        # Messages per transaction
+    default_consume_timeout = 1     # Seconds to wait for the next message before stopping
+
+    resend_on_fail = False
+
+    def __init__(self, *args, **kvargs):
+        super(QueueReplay, self).__init__(*args, **kvargs)
+        self.source = None
+        self.batch_size = self.default_batch_size
+        self.rate = 0
+        self.limit = 0
+        self.min_deaths = None
+        self.max_deaths = None
+        self.headers_filter = dict()
+        self.consume_timeout = self.default_consume_timeout
+        self.counter_replayed = 0
+        self.counter_skipped = 0
+
+    def basic_args(self, parser=None):
+        """
+        Call this to add replay arguments to your argparse parser.
+        See QueueClient for details.
+
+        :param parser: argparse object
+        :returns: Modified parser
+        """
+        parser = super(QueueReplay, self).basic_args(parser)
+        parser.add_argument('--source', help='Queue to take messages from. Default is dead messages queue for --queue', default=None)
+        parser.add_argument('--batch-size', help='Messages moved in one transaction',
+                            default=self.default_batch_size, type=int)
+        parser.add_argument('--rate', help='Max messages per second, 0 for unlimited', default=0, type=float)
+        parser.add_argument('--limit', help='Max messages to process. Default is source queue depth at start',
+                            default=0, type=int)
+        parser.add_argument('--min-deaths', help='Replay messages died at least this number of times only',
+                            default=None, type=int)
+        parser.add_argument('--max-deaths', help='Replay messages died at most this number of times only',
+                            default=None, type=int)
+        parser.add_argument('--header', help='Replay messages with header NAME set to VALUE only, may be repeated',
+                            default=[], action='append', metavar='NAME=VALUE')
+        parser.add_argument('--consume-timeout', help='Seconds to wait for the next message before stopping',
+                            default=self.default_consume_timeout, type=float)
+        return parser
+
+    def setup_from_args(self, args=None):
+        """
+        Converts argparse resulting namespace to replay parameters.
+        See QueueClient for details
+
+        :param args: args from your argparse parser extended by basic_args()
+        :return: Used args
+        """
+        args = super(QueueReplay, self).setup_from_args(args)
+
+        _headers = dict()
+        for _header in args.header:
+            if '=' not in _header:
+                raise ValueError("Header filter should be in form NAME=VALUE: %s" % _header)
+            _name, _value = _header.split('=', 1)
+            _headers[_name] = _value
+
+        self.setup(source=args.source, batch_size=args.batch_size, rate=args.rate, limit=args.limit,
+                   min_deaths=args.min_deaths, max_deaths=args.max_deaths, headers_filter=_headers,
+                   consume_timeout=args.consume_timeout)
+        return args
+
+    def setup(self, *args, **argv):
+        """
+        Sets things up. Takes all arguments QueueClient.setup() accepts and few additional
+
+        :param source:  queue to take messages from, dead messages queue for the main one by default
+        :param batch_size:  messages moved in one transaction
+        :param rate:    max messages per second, 0 for unlimited
+        :param limit:   max messages to process, source queue depth at start by default
+        :param min_deaths:  replay messages with 'x-death' count not less than this only
+        :param max_deaths:  replay messages with 'x-death' count not greater than this only
+        :param headers_filter:  dict of headers values messages should have to be replayed
+        :param consume_timeout: seconds to wait for the next message before stopping
+        """
+        self.source = argv.pop('source', None)
+        self.batch_size = argv.pop('batch_size', self.default_batch_size)
+        self.rate = argv.pop('rate', 0)
+        self.limit = argv.pop('limit', 0)
+        self.min_deaths = argv.pop('min_deaths', None)
+        self.max_deaths = argv.pop('max_deaths', None)
+        self.headers_filter = argv.pop('headers_filter', None) or dict()
+        self.consume_timeout = argv.pop('consume_timeout', self.default_consume_timeout)
+
+        if self.batch_size < 1:
+            raise ValueError("Batch size should be positive")
+
+        if len(args) > 0 or len(argv) > 0:
+            super(QueueReplay, self).setup(*args, **argv)
+
+    @staticmethod
+    def deaths_count(properties):
+        """
+        Total number of times message was dead-lettered, taken from 'x-death' header
+
+        :param properties: message properties
+        :type properties: pika.Spec.BasicProperties
+        :returns: int
+        """
+        _headers = properties.headers or dict()
+        return sum(int(_death.get('count', 1)) for _death in _headers.get('x-death') or list())
+
+    def accept(self, properties):
+        """
+        Check if message is to be replayed. Re-define it for custom filtering
+
+        :param properties: message properties
+        :type properties: pika.Spec.BasicProperties
+        :returns: boolean
+        """
+        _headers = properties.headers or dict()
+
+        for _name, _value in self.headers_filter.items():
+            _actual = _headers.get(_name)
+
+            if isinstance(_actual, bytes):
+                _actual = _actual.decode('utf-8', 'replace')
+
+            if str(_actual) != _value:
+                return False
+
+        if self.min_deaths is None and self.max_deaths is None:
+            return True
+
+        _deaths = self.deaths_count(properties)
+
+        if self.min_deaths is not None and _deaths < self.min_deaths:
+            return False
+
+        if self.max_deaths is not None and _deaths > self.max_deaths:
+            return False
+
+        return True
+
+    def _replay_batch(self, source, batch):
+        """
+        Move batch of messages within one transaction.
+        Messages rejected by filters are put back to the tail of the source queue.
+
+        :param source: source queue name
+        :param batch: list of (method, properties, body) tuples
+        """
+        for (_method, _properties, _body) in batch:
+            if self.accept(_properties):
+                self.channel.basic_publish(exchange=self.exchange, routing_key=self.routing_key,
+                                           body=_body, properties=_properties)
+                self.counter_replayed += 1
+            else:
+                self.channel.basic_publish(exchange='', routing_key=source, body=_body, properties=_properties)
+                self.counter_skipped += 1
+
+        self.channel.basic_ack(delivery_tag=batch[-1][0].delivery_tag, multiple=True)
+        self.channel.tx_commit()
+        logging.debug("Batch of %d committed: replayed %d, skipped %d",
+                      len(batch), self.counter_replayed, self.counter_skipped)
+
+    def _throttle(self, started, processed):
+        """
+        Sleep to keep the rate limit
+
+        :param started: time replay started at
+        :type started: float
+        :param processed: messages processed so far
+        :type processed: int
+        """
+        if not self.rate:
+            return
+
+        _ahead = processed / self.rate - (time.time() - started)
+
+        if _ahead > 0:
+            time.sleep(_ahead)
+
+    def replay(self):
+        """
+        Connect and move messages from source queue to the target one
+
+        :returns: dict with 'replayed' and 'skipped' messages count
+        :raises: Anything pika.BlockingConnection can raise
+        """
+        self.counter_replayed = 0
+        self.counter_skipped = 0
+        self.connect()
+        _source = self.source or self.deads_queue_name(self.queue)
+
+        try:
+            _limit = self.limit
+
+            if not _limit:
+                _limit = self.channel.queue_declare(queue=_source, passive=True).method.message_count
+
+            logging.info("Replaying up to %d messages from %s to exchange '%s' with routing key %s",
+                         _limit, _source, self.exchange, self.routing_key)
+
+            if _limit > 0:
+                self.__replay(_source, _limit)
+        finally:
+            self.disconnect()
+
+        logging.info("Replay finished: replayed %d, skipped %d", self.counter_replayed, self.counter_skipped)
+        return {'replayed': self.counter_replayed, 'skipped': self.counter_skipped}
+
+    def __replay(self, source, limit):
+        """
+        Consuming loop
+        """
+        self.channel.basic_qos(prefetch_count=min(self.batch_size, limit))
+        self.channel.tx_select()
+        _started = time.time()
+        _processed = 0
+        _batch = list()
+
+        for _delivery in self.channel.consume(source, inactivity_timeout=self.consume_timeout):
+            if _delivery[0] is None:
+                # nothing came within timeout: source queue is drained
+                break
+
+            _batch.append(_delivery)
+
+            if len(_batch) < self.batch_size and _processed + len(_batch) < limit:
+                continue
+
+            self._replay_batch(source, _batch)
+            _processed += len(_batch)
+            _batch = list()
+
+            if _processed >= limit:
+                break
+
+            self._throttle(_started, _processed)
+
+        if _batch:
+            self._replay_batch(source, _batch)
+
+        # messages prefetched over the limit are returned to the source queue
+        self.channel.cancel()
+        self.channel.tx_commit()
+
+
+def main(cmdline=None):
+    """
+    Command-line entry point
+
+    :param cmdline: Command line parameters array for debug purposes
+    :returns: return code for sys.exit()
+    """
+    _replay = QueueReplay()
+    _replay.parser = argparse.ArgumentParser(description='Replay dead messages')
+    _replay.basic_args()
+    _replay.parser.add_argument('--verbose', '-v', help='Verbose output (repeat to get more verbosity)',
+                                default=0, action='count')
+    _replay.args = _replay.parser.parse_args(cmdline)
+
+    _level = logging.WARNING
+    if _replay.args.verbose == 1:
+        _level = logging.INFO
+    elif _replay.args.verbose > 1:
+        _level = logging.DEBUG
+
+    logging.basicConfig(level=_level, format='%(asctime)s:%(name)s:%(levelname)s:%(message)s')
+
+    try:
+        _replay.setup_from_args()
+    except (TypeError, ValueError) as e:
+        logging.error("Wrong arguments: %s", str(e))
+        return 2
+
+    _result = _replay.replay()
+    print("Replayed: %d, skipped: %d" % (_result['replayed'], _result['skipped']))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+
+"""
+Argument schemas of published RPC methods, compiled to validators shared by QueueRPC and QueueHandler
+"""
+
+
+class InvalidCall(TypeError):
+    """
+    Call arguments do not match the schema of published method
+    """
+    pass
+
+
+class Arg(object):
+    """
+    Argument of published method: name, type and limits of its value
+    """
+
+    # types accepted for the declared ones: JSON has no tuples, numbers without fraction are decoded as int
+    _equivalents = {list: (list, tuple), float: (float, int)}
+
+    def __init__(self, name=None, type=None, required=False, nullable=False, max_length=None, min=None, max=None,
+                 choices=None, items=None):
+        """
+        Main initialization
+        :param name: argument name, may be omitted for list items
+        :type name: str
+        :param type: type or tuple of types of the value: str, int, float, bool, list, dict.
+                     bool is not accepted for int, int is for float, tuple is for list. None for any type
+        :type type: type
+        :param required: argument is to be given, positionally or by keyword
+        :type required: boolean
+        :param nullable: None is accepted as a value regardless of type
+        :type nullable: boolean
+        :param max_length: max length of str, bytes, list or dict value
+        :type max_length: int
+        :param min: min numeric value
+        :type min: float
+        :param max: max numeric value
+        :type max: float
+        :param choices: allowed values
+        :type choices: collection
+        :param items: schema of list items
+        :type items: Arg
+        """
+        self.name = name
+        self.type = type
+        self.required = required
+        self.nullable = nullable
+        self.max_length = max_length
+        self.min = min
+        self.max = max
+        self.choices = choices
+        self.items = items
+
+    def _types(self):
+        """
+        Types accepted for the value, None for any
+        """
+        if self.type is None:
+            return None
+
+        _declared = self.type if isinstance(self.type, tuple) else (self.type,)
+        _types = list()
+
+        for _type in _declared:
+            for _accepted in self._equivalents.get(_type, (_type,)):
+                if _accepted not in _types:
+                    _types.append(_accepted)
+
+        return tuple(_types)
+
+    def compile(self, label):
+        """
+        Build validator of a value: a function raising InvalidCall, with checks set up only
+        :param label: argument description for error messages, e.g. "build() argument 'version'"
+        :type label: str
+        :returns: function(value)
+        """
+        _checks = list()
+        _types = self._types()
+
+        if _types is not None:
+            _names = '/'.join(_type.__name__ for _type in _types)
+            # bool is a subclass of int, but true is not a number in JSON
+            _no_bool = bool not in _types
+
+            def _check_type(value):
+                if not isinstance(value, _types) or (_no_bool and isinstance(value, bool)):
+                    raise InvalidCall("%s should be %s, not %s" % (label, _names, type(value).__name__))
+
+            _checks.append(_check_type)
+
+        if self.max_length is not None:
+            _max_length = self.max_length
+
+            def _check_length(value):
+                if hasattr(value, '__len__') and len(value) > _max_length:
+                    raise InvalidCall("%s is longer than %d: %d" % (label, _max_length, len(value)))
+
+            _checks.append(_check_length)
+
+        if self.min is not None or self.max is not None:
+            _min = self.min
+            _max = self.max
+
+            def _check_range(value):
+                try:
+                    _out = (_min is not None and value < _min) or (_max is not None and value > _max)
+                except TypeError:
+                    raise InvalidCall("%s should be a number, not %s" % (label, type(value).__name__))
+
+                if _out:
+                    raise InvalidCall("%s is out of range [%s, %s]: %r" % (label, _min, _max, value))
+
+            _checks.append(_check_range)
+
+        if self.choices is not None:
+            _choices = frozenset(self.choices)
+
+            def _check_choices(value):
+                try:
+                    _allowed = value in _choices
+                except TypeError:
+                    # not hashable
+                    _allowed = False
+
+                if not _allowed:
+                    raise InvalidCall("%s is not one of allowed values: %r" % (label, value))
+
+            _checks.append(_check_choices)
+
+        if self.items is not None:
+            _item = self.items.compile("%s item" % label)
+
+            def _check_items(value):
+                if not isinstance(value, (list, tuple)):
+                    raise InvalidCall("%s should be list, not %s" % (label, type(value).__name__))
+
+                for _value in value:
+                    _item(_value)
+
+            _checks.append(_check_items)
+
+        _nullable = self.nullable
+        _checks = tuple(_checks)
+
+        if not _checks:
+            return lambda value: None
+
+        if len(_checks) == 1 and not _nullable:
+            return _checks[0]
+
+        def _validate(value):
+            if value is None and _nullable:
+                return
+
+            for _check in _checks:
+                _check(value)
+
+        return _validate
+
+
+class RpcSchema(object):
+    """
+    Published methods with their argument schemas, compiled once to validators.
+    Define it in a module shared by client and server and set it as 'published' of both QueueRPC and QueueHandler
+    descendants, so invalid calls are rejected by client before publishing and by server before the method is called.
+    Behaves as a collection of method names where a list of them is expected.
+    """
+
+    def __init__(self, methods):
+        """
+        Main initialization
+        :param methods: {method name: schema}, schema is one of:
+                        None for any arguments;
+                        list of keyword names allowed, positional arguments are not checked;
+                        list of Arg in positional order: arguments are bound to them as Python does,
+                        unknown keywords and extra positional arguments are rejected
+        :type methods: dict, or list of method names to accept any arguments for
+        """
+        if not isinstance(methods, dict):
+            methods = dict((_name, None) for _name in methods)
+
+        self.methods = dict(methods)
+        self._validators = dict((_name, self._compile(_name, _schema)) for (_name, _schema) in self.methods.items())
+
+    def __contains__(self, name):
+        return name in self.methods
+
+    def __iter__(self):
+        return iter(self.methods)
+
+    def __len__(self):
+        return len(self.methods)
+
+    def __repr__(self):
+        return repr(sorted(self.methods))
+
+    @staticmethod
+    def _compile(name, schema):
+        """
+        Build validator of a call: function(arguments, parameters) raising InvalidCall. None if there is nothing to check
+        """
+        if schema is None:
+            return None
+
+        schema = list(schema)
+
+        if all(isinstance(_arg, str) for _arg in schema):
+            _allowed = frozenset(schema)
+
+            def _validate_keywords(arguments, parameters):
+                for _key in parameters:
+                    if _key not in _allowed:
+                        raise InvalidCall("%s() got an unexpected keyword argument '%s'" % (name, _key))
+
+            return _validate_keywords
+
+        if not all(isinstance(_arg, Arg) and _arg.name for _arg in schema):
+            raise TypeError("Schema of %s() should be a list of keyword names or of named Arg" % name)
+
+        _checks = tuple(_arg.compile("%s() argument '%s'" % (name, _arg.name)) for _arg in schema)
+        _positions = dict((_arg.name, _index) for (_index, _arg) in enumerate(schema))
+        _required = tuple((_index, _arg.name) for (_index, _arg) in enumerate(schema) if _arg.required)
+        _count = len(schema)
+
+        def _validate(arguments, parameters):
+            if len(arguments) > _count:
+                raise InvalidCall("%s() takes at most %d positional arguments, %d given" % (name, _count, len(arguments)))
+
+            for (_index, _value) in enumerate(arguments):
+                _checks[_index](_value)
+
+            for (_key, _value) in parameters.items():
+                _index = _positions.get(_key)
+
+                if _index is None:
+                    raise InvalidCall("%s() got an unexpected keyword argument '%s'" % (name, _key))
+
+                if _index < len(arguments):
+                    raise InvalidCall("%s() got multiple values for argument '%s'" % (name, _key))
+
+                _checks[_index](_value)
+
+            for (_index, _name) in _required:
+                if _index >= len(arguments) and _name not in parameters:
+                    raise InvalidCall("%s() missing required argument '%s'" % (name, _name))
+
+        return _validate
+
+    def validate(self, name, arguments, parameters):
+        """
+        Check call of a published method
+        :param name: method name
+        :type name: str
+        :param arguments: positional arguments
+        :type arguments: list or tuple
+        :param parameters: keyword arguments
+        :type parameters: dict
+        :raises InvalidCall: if arguments do not match the schema
+        """
+        _validator = self._validators.get(name)
+
+        if _validator is not None:
+            _validator(arguments, parameters)
+
+
+def compile_published(published):
+    """
+    Schema of 'published' value. Dicts and lists are compiled on every call: the result is to be kept by the caller
+    :param published: RpcSchema, dict of schemas or list of method names, see RpcSchema. None for any method
+    :returns: RpcSchema, None for None
+    """
+    if published is None or isinstance(published, RpcSchema):
+        return published
+
+    return RpcSchema(published)
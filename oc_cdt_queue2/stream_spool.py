@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+import hashlib
+import logging
+import os
+import shutil
+import time
+
+"""
+Disk spool for chunked payloads reassembly
+"""
+
+
+class StreamSpool(object):
+    """
+    Keeps chunks of transfers on disk until all of them arrive.
+    Each transfer is a directory with a file per chunk, so a chunk written is safe to acknowledge
+    and transfers survive restarts. Chunks are never kept in memory all together.
+    A transfer is assembled only if all of its chunks are delivered to the same spool: its queue (or partition)
+    should have a single consumer. Transfers not completed are removed when they are not updated for ttl seconds.
+    """
+
+    _count_file = 'count'
+    sweep_interval = 60     # max seconds between sweeps of expired transfers
+
+    def __init__(self, path, ttl=0):
+        """
+        Main initialization
+        :param path: spool directory, created if does not exist
+        :type path: str
+        :param ttl: seconds since the last chunk to keep transfer not completed for, 0 to keep it forever
+        :type ttl: float
+        """
+        if ttl < 0:
+            raise ValueError("Spool TTL should not be negative")
+
+        self.path = path
+        self.ttl = ttl
+        self._swept_at = 0
+        os.makedirs(self.path, exist_ok=True)
+        self.sweep()
+
+    def sweep(self, now=None):
+        """
+        Remove transfers not updated for ttl seconds: chunk written updates modification time of its directory
+        :param now: current time, seconds since epoch
+        :type now: float
+        :returns: number of transfers removed
+        """
+        if not self.ttl:
+            return 0
+
+        now = now or time.time()
+        self._swept_at = now
+        _removed = 0
+
+        for _entry in os.scandir(self.path):
+            try:
+                if not _entry.is_dir() or now - _entry.stat().st_mtime < self.ttl:
+                    continue
+            except FileNotFoundError:
+                continue
+
+            logging.warning("Removing spooled transfer %s not completed for %d seconds", _entry.name, self.ttl)
+            shutil.rmtree(_entry.path, ignore_errors=True)
+            _removed += 1
+
+        return _removed
+
+    def _transfer_path(self, transfer_id):
+        # transfer id comes from message headers, do not use it as path as is
+        if isinstance(transfer_id, str):
+            transfer_id = transfer_id.encode('utf-8')
+
+        return os.path.join(self.path, hashlib.blake2b(bytes(transfer_id), digest_size=16).hexdigest())
+
+    @staticmethod
+    def _write(path, data):
+        """
+        Write file atomically: partially written chunk should never be taken as complete one
+        """
+        with open(path + '.tmp', 'wb') as _file:
+            _file.write(data)
+
+        os.replace(path + '.tmp', path)
+
+    def _count(self, transfer_path):
+        """
+        Total chunks number if the last chunk has arrived, None otherwise
+        """
+        try:
+            with open(os.path.join(transfer_path, self._count_file), 'rb') as _file:
+                return int(_file.read())
+        except FileNotFoundError:
+            return None
+
+    def add(self, transfer_id, index, data, count=None):
+        """
+        Store a chunk. Chunk stored again (redelivered one) replaces the previous copy.
+        :param transfer_id: transfer id
+        :type transfer_id: str
+        :param index: chunk number, starting from 0
+        :type index: int
+        :param data: chunk data
+        :type data: bytes
+        :param count: total chunks number, known for the last chunk only
+        :type count: int
+        :returns: boolean, all chunks of the transfer are stored
+        """
+        if self.ttl and time.time() - self._swept_at >= min(self.ttl, self.sweep_interval):
+            self.sweep()
+
+        _path = self._transfer_path(transfer_id)
+        os.makedirs(_path, exist_ok=True)
+
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+
+        self._write(os.path.join(_path, '%d.chunk' % int(index)), data or b'')
+
+        if count is not None:
+            self._write(os.path.join(_path, self._count_file), str(int(count)).encode('ascii'))
+        else:
+            count = self._count(_path)
+
+        if count is None:
+            return False
+
+        # checked once the last chunk has arrived only, so it is cheap enough
+        return all(os.path.exists(os.path.join(_path, '%d.chunk' % _index)) for _index in range(0, count))
+
+    def chunks(self, transfer_id):
+        """
+        Iterate over transfer chunks in order, reading them one by one
+        :param transfer_id: transfer id
+        :type transfer_id: str
+        :returns: generator of bytes
+        """
+        _path = self._transfer_path(transfer_id)
+
+        for _index in range(0, self._count(_path) or 0):
+            with open(os.path.join(_path, '%d.chunk' % _index), 'rb') as _file:
+                yield _file.read()
+
+    def remove(self, transfer_id):
+        """
+        Remove transfer chunks
+        :param transfer_id: transfer id
+        :type transfer_id: str
+        """
+        logging.debug("Removing spooled transfer %s", transfer_id)
+        shutil.rmtree(self._transfer_path(transfer_id), ignore_errors=True)
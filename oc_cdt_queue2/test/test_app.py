@@ -301,3 +301,46 @@ class QueueApplicationTest(unittest.TestCase):
         # _connect_and_run is to be called once here
         self.assertEqual(1, _app.connect_and_run_call)
         self.assertEqual(2, _app._counter)
+
+    def test_connect_and_run_lost(self):
+        # main loop finished without stop requested: exit code is not changed, the failure is remembered for supervisor
+        class _MockAppConnectAndRun(QueueApplication):
+            def connect(self):
+                self._stop = False
+
+            def run(self):
+                pass
+
+            def disconnect(self):
+                pass
+
+        _app = _MockAppConnectAndRun()
+        _app = self.__setup_app(_app)
+        _app.reconnect = False
+        self.assertFalse(_app._failed)
+        self.assertEqual(0, _app._connect_and_run())
+        self.assertTrue(_app._failed)
+
+        # stopped normally
+        _app.run = _app.stop
+        self.assertEqual(0, _app._connect_and_run())
+        self.assertFalse(_app._failed)
+
+    def test_main_shutdown(self):
+        class _MockAppMain(QueueApplication):
+            connect_and_run_calls = 0
+
+            def setup_from_args(self, args=None):
+                pass
+
+            def _connect_and_run(self):
+                self.connect_and_run_calls += 1
+                self.shutdown()
+                return 3
+
+        _app = _MockAppMain()
+        _app.reconnect = True
+        self.assertEqual(0, _app.main(cmdline=['--amqp-url', 'amqp://blablabla', '--reconnect']))
+        # no reconnect after shutdown requested
+        self.assertEqual(1, _app.connect_and_run_calls)
+        self.assertTrue(_app._stop)
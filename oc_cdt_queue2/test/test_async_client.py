@@ -0,0 +1,242 @@
+import unittest
+from oc_cdt_queue2.queue_async_client import AsyncQueueClient
+from oc_cdt_queue2.queue_async_client import PublishNacked
+from oc_cdt_queue2.queue_async_rpc import AsyncQueueRPC
+import asyncio
+import logging
+import pika
+
+# to get rid of logging output from imported classes
+logging.getLogger().propagate = False
+logging.getLogger().disabled = True
+
+
+class _Frame(object):
+    def __init__(self, method):
+        self.method = method
+
+
+class _ChannelMock(object):
+    # delivery tags to nack instead of ack
+    nack = set()
+    # publish attempts to fail with channel error, channel stays open
+    fail = set()
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.is_open = True
+        self.published = list()
+        self.declared = list()
+        self.on_close = None
+        self.on_confirm = None
+        self._tag = 0
+        self._attempts = 0
+
+    def add_on_close_callback(self, callback):
+        self.on_close = callback
+
+    def confirm_delivery(self, ack_nack_callback, callback):
+        self.on_confirm = ack_nack_callback
+        self.loop.call_soon(callback, None)
+
+    def exchange_declare(self, callback, **kwargs):
+        self.declared.append(('exchange_declare', kwargs))
+        self.loop.call_soon(callback, None)
+
+    def queue_declare(self, callback, **kwargs):
+        self.declared.append(('queue_declare', kwargs))
+        self.loop.call_soon(callback, None)
+
+    def queue_bind(self, callback, **kwargs):
+        self.declared.append(('queue_bind', kwargs))
+        self.loop.call_soon(callback, None)
+
+    def basic_publish(self, exchange, routing_key, body, properties):
+        self._attempts += 1
+
+        if self._attempts in self.fail:
+            raise pika.exceptions.ChannelWrongStateError("Test failure")
+
+        self._tag += 1
+        self.published.append({'routing_key': routing_key, 'body': body, 'properties': properties})
+
+        if self._tag in self.nack:
+            _method = pika.spec.Basic.Nack(delivery_tag=self._tag)
+        elif self._tag % 2:
+            # odd messages are confirmed with the next one
+            return
+        else:
+            _method = pika.spec.Basic.Ack(delivery_tag=self._tag, multiple=True)
+
+        self.loop.call_later(0.001, self.on_confirm, _Frame(_method))
+
+
+class _ConnectionMock(object):
+    # number of connection attempts to fail
+    failures = 0
+    created = list()
+
+    def __init__(self, parameters, on_open_callback, on_open_error_callback, on_close_callback, custom_ioloop):
+        self.loop = custom_ioloop
+        self.on_close = on_close_callback
+        self.is_closed = False
+        self.is_closing = False
+        self.channels = list()
+        _ConnectionMock.created.append(self)
+
+        if _ConnectionMock.failures:
+            _ConnectionMock.failures -= 1
+            self.is_closed = True
+            self.loop.call_soon(on_open_error_callback, self, pika.exceptions.AMQPConnectionError("Test failure"))
+            return
+
+        self.loop.call_soon(on_open_callback, self)
+
+    @property
+    def is_open(self):
+        return not self.is_closed
+
+    def channel(self, on_open_callback):
+        _channel = _ChannelMock(self.loop)
+        self.channels.append(_channel)
+        self.loop.call_soon(on_open_callback, _channel)
+
+    def close(self):
+        self.is_closing = True
+
+        def _closed():
+            self.is_closed = True
+            self.on_close(self, pika.exceptions.ConnectionClosedByClient(200, 'Normal shutdown'))
+
+        self.loop.call_soon(_closed)
+
+    def drop(self):
+        # broker has gone away
+        self.is_closed = True
+        for _channel in self.channels:
+            _channel.is_open = False
+            _channel.on_close(_channel, pika.exceptions.ChannelWrongStateError("Test drop"))
+        self.on_close(self, pika.exceptions.StreamLostError("Test drop"))
+
+
+class _RPC(AsyncQueueRPC):
+    published = ['ping', 'method']
+
+
+class AsyncQueueClientTest(unittest.TestCase):
+    def setUp(self):
+        _ConnectionMock.failures = 0
+        _ConnectionMock.created = list()
+        _ChannelMock.nack = set()
+        _ChannelMock.fail = set()
+        self.client = AsyncQueueClient()
+        self.client._Connection = _ConnectionMock
+
+    def run_async(self, coroutine):
+        return asyncio.new_event_loop().run_until_complete(coroutine)
+
+    def test_send_confirmed(self):
+        self.client.setup('amqp://127.0.0.1/', queue='test.input', queue_declare='yes')
+
+        async def _send():
+            await self.client.connect()
+            # sends are concurrent: odd ones are confirmed along with the next ones
+            await asyncio.gather(*[self.client.send({'n': _n}) for _n in range(0, 4)])
+            _channel = self.client.channel
+            await self.client.disconnect()
+            return _channel
+
+        _channel = self.run_async(_send())
+        self.assertEqual(len(_channel.published), 4)
+        self.assertEqual(_channel.published[0]['routing_key'], 'test.input')
+        self.assertEqual(_channel.published[0]['properties'].content_type, 'application/json')
+        self.assertEqual(_channel.published[0]['properties'].delivery_mode, 2)
+        self.assertEqual([_method for (_method, _kwargs) in _channel.declared],
+                         ['exchange_declare', 'queue_declare', 'queue_bind', 'queue_declare'])
+        self.assertEqual(self.client._confirms, dict())
+        self.assertIsNone(self.client.connection)
+
+    def test_send_nacked(self):
+        self.client.setup('amqp://127.0.0.1/', queue='test.input')
+        _ChannelMock.nack = set([1])
+
+        with self.assertRaises(PublishNacked):
+            self.run_async(self.client.send('body'))
+
+    def test_reconnect(self):
+        self.client.setup('amqp://127.0.0.1/', queue='test.input', reconnect_tries=3, reconnect_delay=0)
+        _ConnectionMock.failures = 2
+
+        async def _send():
+            # connection is made on the first send
+            await asyncio.gather(self.client.send('first'), self.client.send('second'))
+            # broker has gone away, message is re-sent on a new connection
+            self.client.connection.drop()
+            await asyncio.gather(self.client.send('third'), self.client.send('fourth'))
+
+        self.run_async(_send())
+        # concurrent sends wait for the same connection attempts
+        self.assertEqual(len(_ConnectionMock.created), 4)
+        self.assertEqual([_message['body'] for _message in _ConnectionMock.created[-1].channels[0].published],
+                         ['third', 'fourth'])
+
+    def test_send_failed_concurrently(self):
+        self.client.setup('amqp://127.0.0.1/', queue='test.input', reconnect_tries=3, reconnect_delay=0)
+        _ChannelMock.fail = set([2])
+
+        async def _send():
+            await self.client.connect()
+            # failed send does not close the channel other messages are waiting confirms on
+            await asyncio.gather(*[self.client.send(str(_n)) for _n in range(0, 4)])
+
+        self.run_async(_send())
+        self.assertEqual(len(_ConnectionMock.created), 1)
+        self.assertEqual(sorted(_message['body'] for _message in _ConnectionMock.created[0].channels[0].published),
+                         ['0', '1', '2', '3'])
+        self.assertEqual(self.client._confirms, dict())
+
+        # channel lost with messages in flight: all of them are re-sent over one new connection
+        _ConnectionMock.created = list()
+        _ChannelMock.fail = set()
+        self.client = AsyncQueueClient()
+        self.client._Connection = _ConnectionMock
+        self.client.setup('amqp://127.0.0.1/', queue='test.input', reconnect_tries=3, reconnect_delay=0)
+
+        async def _send_dropped():
+            await self.client.connect()
+            # the last one is confirmed along with the next one, it is sent after the drop
+            _sends = asyncio.gather(*[self.client.send(str(_n)) for _n in range(0, 3)])
+            await asyncio.sleep(0)
+            self.client.connection.drop()
+            await asyncio.gather(_sends, self.client.send('3'))
+
+        self.run_async(_send_dropped())
+        self.assertEqual(len(_ConnectionMock.created), 2)
+        self.assertEqual(sorted(_message['body'] for _message in _ConnectionMock.created[1].channels[0].published),
+                         ['0', '1', '2', '3'])
+
+    def test_connect_failed(self):
+        self.client.setup('amqp://127.0.0.1/', queue='test.input', reconnect_tries=0)
+        _ConnectionMock.failures = 1
+
+        with self.assertRaises(pika.exceptions.AMQPConnectionError):
+            self.run_async(self.client.connect())
+
+    def test_rpc(self):
+        _rpc = _RPC()
+        _rpc._Connection = _ConnectionMock
+        _rpc.setup('amqp://127.0.0.1/', queue='test.input')
+
+        with self.assertRaises(AttributeError):
+            _rpc.ping
+
+        async def _call():
+            await _rpc.connect()
+            await asyncio.gather(_rpc.ping(), _rpc.method('arg', param=1))
+
+            with self.assertRaises(AttributeError):
+                _rpc.not_published
+
+        self.run_async(_call())
+        self.assertEqual([_message['body'] for _message in _ConnectionMock.created[-1].channels[0].published],
+                         ['["ping", [], {}]', '["method", ["arg"], {"param": 1}]'])
@@ -46,3 +46,20 @@ class QueueBaseTest(unittest.TestCase):
         self.assertEqual(self.queue.reconnect_tries, 10)
         self.assertEqual(self.queue.reconnect_delay, 0)
         self.assertEqual(self.queue.connection_parameters.host, '203.0.113.1')
+
+    def test_partitions_topology(self):
+        # partitions of a dotted queue name share the same deads queue as the queue itself
+        self.assertEqual(QueueBase.deads_queue_name('a.b'), 'a.deads')
+        _queues = QueueBase.partition_queue_names('a.b', 2)
+        self.assertEqual(_queues, ['a.b.p0', 'a.b.p1'])
+        _topology = QueueBase.queues_topology(_queues, deads_queue=QueueBase.deads_queue_name('a.b'))
+        self.assertEqual([_kwargs.get('queue') for (_method, _kwargs) in _topology if _method == 'queue_declare'],
+                         ['a.deads', 'a.b.p0', 'a.b.p1'])
+
+        for (_method, _kwargs) in _topology:
+            if _method == 'queue_declare' and _kwargs.get('queue') != 'a.deads':
+                self.assertEqual(_kwargs['arguments']['x-dead-letter-exchange'], 'a.deads')
+                self.assertEqual(_kwargs['arguments']['x-dead-letter-routing-key'], 'a.deads')
+
+        # without it each queue gets deads_queue_name() of its own
+        self.assertEqual(QueueBase.queue_topology('a.b')[1][1]['queue'], 'a.deads')
@@ -0,0 +1,154 @@
+import unittest
+from oc_cdt_queue2.capture import CaptureWriter
+from oc_cdt_queue2.capture import CaptureRecord
+from oc_cdt_queue2.capture import CaptureReplay
+from oc_cdt_queue2.capture import read_capture
+from oc_cdt_queue2.capture import main
+from oc_cdt_queue2.queue_server import QueueServer
+import concurrent.futures
+import contextlib
+import io
+import logging
+import os
+import pika
+import shutil
+import tempfile
+import time
+
+# to get rid of logging output from imported classes
+logging.getLogger().propagate = False
+logging.getLogger().disabled = True
+
+
+class _Server(QueueServer):
+    """
+    Fails messages with 'fail' body, sleeps for 'slow' ones
+    """
+
+    def on_message_raw(self, body, properties):
+        if body == b'slow':
+            time.sleep(0.05)
+
+        if body == b'fail':
+            raise ValueError("Processing failed")
+
+
+class _BatchServer(QueueServer):
+    batches = list()
+
+    def on_batch(self, items):
+        self.batches.append([_item.body for _item in items])
+
+        for _item in items:
+            if _item.body == b'fail':
+                _item.fail()
+
+
+def _record(received, body, result='ack'):
+    return CaptureRecord(received=received, duration=0.001, result=result, redelivered=False, queue='test.input',
+                         properties=pika.BasicProperties(), body=body)
+
+
+class CaptureTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, 'capture.bin')
+
+    def test_write_read(self):
+        _writer = CaptureWriter(self.path)
+        _writer.write(1000.5, 0.25, 'ack', pika.BasicProperties(headers={'x-retry-count': 2}, message_id='m1'),
+                      b'first', queue='test.input', redelivered=True)
+        _writer.write(1001.0, 0.5, 'retry', None, b'')
+        _writer.close()
+
+        # appending keeps records written before
+        _writer = CaptureWriter(self.path)
+        _writer.write(1002.0, 0.1, 'reject', pika.BasicProperties(), b'third')
+        _writer.close()
+
+        _records = list(read_capture(self.path))
+        self.assertEqual([(_record.received, _record.duration, _record.result, _record.redelivered, _record.queue,
+                           _record.body) for _record in _records],
+                         [(1000.5, 0.25, 'ack', True, 'test.input', b'first'), (1001.0, 0.5, 'retry', False, None, b''),
+                          (1002.0, 0.1, 'reject', False, None, b'third')])
+        self.assertEqual(_records[0].properties.headers, {'x-retry-count': 2})
+        self.assertEqual(_records[0].properties.message_id, 'm1')
+
+        # record torn by crash is skipped
+        with open(self.path, 'r+b') as _file:
+            _file.truncate(os.path.getsize(self.path) - 2)
+
+        self.assertEqual([_record.body for _record in read_capture(self.path)], [b'first', b''])
+
+        with open(self.path, 'wb') as _file:
+            _file.write(b'something else')
+
+        with self.assertRaises(ValueError):
+            list(read_capture(self.path))
+
+    def test_replay_fast(self):
+        _server = _Server()
+        _server.setup('amqp://127.0.0.1', queue='test.input')
+        _server.setup(retry_delays=[1])
+        _replay = CaptureReplay(_server, pace=False)
+        _report = _replay.run([_record(1000.0, b'first'), _record(1000.0, b'fail', result='retry'),
+                               _record(1000.0, b'slow', result='reject'), _record(3000.0, b'fail')])
+
+        self.assertEqual(_report['messages'], 4)
+        self.assertEqual(_report['results'], {'ack': 2, 'retry': 2, 'requeue': 0, 'reject': 0})
+        # results other than captured ones
+        self.assertEqual(_report['changed'], 2)
+        self.assertEqual(_report['latency']['count'], 4)
+        self.assertGreaterEqual(_report['latency']['max'], 0.05)
+        self.assertLess(_report['elapsed'], 1)
+        self.assertEqual(_report['captured']['count'], 4)
+        self.assertEqual(_server.counter_bad, 2)
+
+    def test_replay_pace(self):
+        _server = _Server()
+        _started = time.time()
+        _report = CaptureReplay(_server, speed=2).run([_record(1000.0, b'first'), _record(1000.2, b'second'),
+                                                       _record(1000.4, b'third')])
+        # 0.4 seconds captured are replayed twice as fast
+        self.assertGreaterEqual(time.time() - _started, 0.2)
+        self.assertLess(_report['elapsed'], 0.4)
+        self.assertEqual(_report['results']['ack'], 3)
+
+        with self.assertRaises(ValueError):
+            CaptureReplay(_server, speed=0)
+
+    def test_replay_batch_and_executor(self):
+        _server = _BatchServer()
+        _server.setup(batch_size=2, batch_timeout=1)
+        _report = CaptureReplay(_server, pace=False).run([_record(1000.0, _body)
+                                                          for _body in [b'1', b'fail', b'3', b'4', b'5']])
+        self.assertEqual(_server.batches, [[b'1', b'fail'], [b'3', b'4'], [b'5']])
+        self.assertEqual(_report['results'], {'ack': 4, 'retry': 0, 'requeue': 0, 'reject': 1})
+
+        _executor = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+        self.addCleanup(_executor.shutdown)
+        _server = _Server()
+        _server.setup(executor=_executor, prefetch_count=4)
+        _started = time.time()
+        _report = CaptureReplay(_server, pace=False).run([_record(1000.0, b'slow') for _index in range(0, 4)])
+        # processed concurrently
+        self.assertLess(time.time() - _started, 0.15)
+        self.assertEqual(_report['results']['ack'], 4)
+
+    def test_main(self):
+        _writer = CaptureWriter(self.path)
+
+        for _body in [b'first', b'fail', b'second']:
+            _writer.write(time.time(), 0.001, 'ack', pika.BasicProperties(), _body)
+
+        _writer.close()
+        _output = io.StringIO()
+
+        with contextlib.redirect_stdout(_output):
+            self.assertEqual(main([self.path, '--handler', '%s:_Server' % __name__, '--fast', '--limit', '2',
+                                   '--amqp-url', 'amqp://127.0.0.1']), 0)
+
+        _lines = _output.getvalue().splitlines()
+        self.assertTrue(_lines[0].startswith('messages   2 in'))
+        self.assertEqual(_lines[-1], 'results    ack 1, requeue 0, reject 1, retry 0, 1 changed')
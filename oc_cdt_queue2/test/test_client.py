@@ -11,6 +11,13 @@ try:
 except ImportError:
     import Queue as queue
 
+def _unstamped(headers):
+    # publishing time is set by client for every message
+    _headers = dict(headers)
+    _headers.pop(QueueClient.published_at_header)
+    return _headers
+
+
 class _ChannelMock(object):
     def __init__(self, *args, **kvargs):
         self.msg_buffer = queue.Queue()
@@ -134,7 +141,7 @@ class QueueClientTest(unittest.TestCase):
         self.assertEqual(_props.delivery_mode, 2) #persistant
         self.assertEqual(_props.priority, 3)
         self.assertEqual(_props.content_type, _msg_content_type)
-        self.assertEqual(_props.headers, _msg_headers)
+        self.assertEqual(_unstamped(_props.headers), _msg_headers)
         self.assertEqual(_props.content_encoding, _msg_content_encoding)
 
     def test_send_all_ok(self):
@@ -158,8 +165,14 @@ class QueueClientTest(unittest.TestCase):
         self.assertEqual(_props.delivery_mode, 2) #persistant
         self.assertEqual(_props.priority, 1)
         self.assertEqual(_props.content_type, 'application/json')
-        self.assertEqual(_props.headers, {})
+        self.assertEqual(_unstamped(_props.headers), {})
         self.assertIsNone(_props.content_encoding)
+        # unique message id is generated
+        self.assertTrue(_props.message_id)
+        self.client.send(_msg_body)
+        self.assertNotEqual(_props.message_id, self.client.channel.msg_buffer.get().get('properties').message_id)
+        self.client.send(_msg_body, message_id='test_id')
+        self.assertEqual('test_id', self.client.channel.msg_buffer.get().get('properties').message_id)
 
     def test_send_content_type_differ(self):
         # the same as above but we specify content-type exactly
@@ -186,7 +199,7 @@ class QueueClientTest(unittest.TestCase):
         self.assertEqual(_props.delivery_mode, 2) #persistant
         self.assertEqual(_props.priority, 1)
         self.assertEqual(_props.content_type, _msg_content_type)
-        self.assertEqual(_props.headers, _msg_headers)
+        self.assertEqual(_unstamped(_props.headers), _msg_headers)
         self.assertEqual(_props.content_encoding, _msg_content_encoding)
 
     def test_send_publish_fail_no_resend(self):
@@ -242,7 +255,7 @@ class QueueClientTest(unittest.TestCase):
         self.assertEqual(_props.delivery_mode, 2)
         self.assertEqual(_props.priority, 3)
         self.assertEqual(_props.content_type, _msg_content_type)
-        self.assertEqual(_props.headers, {})
+        self.assertEqual(_unstamped(_props.headers), {})
         self.assertIsNone(_props.content_encoding)
 
     def test_disconnect_connection_ok(self):
@@ -437,3 +450,252 @@ class QueueClientTest(unittest.TestCase):
         _all_exchanges = self.client.channel.exchanges
         self.assertIn(_deads, _all_exchanges)
         self.assertEqual(_all_exchanges.get(_deads).get('queue'), _deads)
+
+    def test_reconnect_declared(self):
+        # topology declared once is not declared again on reconnect to the same broker
+        _queue = 'my_queue.input'
+        self.client.setup('amqp://127.0.0.1/', queue=_queue, queue_declare='yes')
+        self.client.connect()
+        self.assertIn(_queue, self.client.channel.queues)
+        self.client.connect()
+        self.assertEqual(self.client.channel.queues, dict())
+        self.assertEqual(self.client.channel.exchanges, dict())
+
+        # other broker
+        self.client.setup('amqp://127.0.0.2/', queue=_queue, queue_declare='yes')
+        self.client.connect()
+        self.assertIn(_queue, self.client.channel.queues)
+
+    def test_connect_verify(self):
+        # passive declaration fails if queue does not exist, nothing is created
+        class _ChanVerifyMock(_ChannelMock):
+            def exchange_declare(self, exchange, exchange_type, durable, passive=False):
+                if passive and exchange not in self.exchanges:
+                    raise pika.exceptions.ChannelClosedByBroker(404, "NOT_FOUND - no exchange %s" % exchange)
+
+                super(_ChanVerifyMock, self).exchange_declare(exchange, exchange_type, durable)
+
+            def queue_declare(self, queue, durable, arguments, passive=False):
+                if passive and queue not in self.queues:
+                    raise pika.exceptions.ChannelClosedByBroker(404, "NOT_FOUND - no queue %s" % queue)
+
+                super(_ChanVerifyMock, self).queue_declare(queue, durable, arguments)
+
+        class _ConnVerifyMock(_ConnectionMock):
+            existing = False
+
+            def channel(self):
+                _chan = _ChanVerifyMock()
+
+                if self.existing:
+                    _chan.exchange_declare('my_queue.deads', 'direct', True)
+                    _chan.queue_declare('my_queue.deads', True, {'x-max-priority': 3})
+                    _chan.queue_declare('my_queue.input', True, {'x-max-priority': 3,
+                                                                 'x-dead-letter-exchange': 'my_queue.deads',
+                                                                 'x-dead-letter-routing-key': 'my_queue.deads'})
+                self.channels.append(_chan)
+                return _chan
+
+        self.client._Connection = _ConnVerifyMock
+        self.client.setup('amqp://127.0.0.1/', queue='my_queue.input', queue_declare='verify')
+
+        with self.assertRaises(pika.exceptions.ChannelClosedByBroker):
+            self.client.connect()
+
+        self.assertEqual(self.client.channel.exchanges, dict())
+
+        _ConnVerifyMock.existing = True
+        self.client.connect()
+        self.assertEqual(len(self.client.channel.queues), 2)
+        self.assertNotIn('queue', self.client.channel.exchanges.get('my_queue.deads'))
+
+    def test_send_stream(self):
+        import io
+        self.client.setup('amqp://127.0.0.1/', queue='my_queue')
+        self.client.connect()
+        _id = self.client.send_stream(io.BytesIO(b'0123456789'), content_type='text/plain', headers={'a': 'b'},
+                                      chunk_size=4)
+        _chunks = list()
+        while not self.client.channel.msg_buffer.empty():
+            _chunks.append(self.client.channel.msg_buffer.get())
+
+        self.assertEqual([_msg['body'] for _msg in _chunks], [b'0123', b'4567', b'89'])
+        self.assertEqual([_msg['properties'].headers.get('x-stream-index') for _msg in _chunks], [0, 1, 2])
+        self.assertEqual([_msg['properties'].headers.get('x-stream-count') for _msg in _chunks], [None, None, 3])
+        self.assertTrue(all(_msg['properties'].headers.get('x-stream-id') == _id for _msg in _chunks))
+        self.assertTrue(all(_msg['properties'].headers.get('a') == 'b' for _msg in _chunks))
+        self.assertEqual(_chunks[1]['properties'].message_id, '%s.1' % _id)
+        self.assertEqual(_chunks[0]['properties'].content_type, 'text/plain')
+
+        # empty payload is sent as a single empty chunk
+        self.client.send_stream(io.BytesIO(b''))
+        _msg = self.client.channel.msg_buffer.get()
+        self.assertEqual(_msg['body'], b'')
+        self.assertEqual(_msg['properties'].headers.get('x-stream-count'), 1)
+
+    def test_send_partitioned(self):
+        self.client.setup('amqp://127.0.0.1/', queue='my.queue', partitions=4, partition_header='x-key',
+                          queue_declare='yes')
+        self.client.connect()
+
+        # every partition is declared, dead messages queue is the one of 'my.queue'
+        self.assertEqual(sorted(self.client.channel.queues.keys()),
+                         ['my.deads', 'my.queue.p0', 'my.queue.p1', 'my.queue.p2', 'my.queue.p3'])
+        self.assertEqual(self.client.channel.queues['my.queue.p2']['args']['x-dead-letter-exchange'], 'my.deads')
+
+        for _i in range(0, 3):
+            self.client.send('by argument', partition_key='key_%d' % _i)
+            self.client.send('by header', headers={'x-key': 'key_%d' % _i})
+
+        self.client.send('no key')
+        self.client.send('no key')
+        _routing_keys = list()
+        while not self.client.channel.msg_buffer.empty():
+            _routing_keys.append(self.client.channel.msg_buffer.get()['routing_key'])
+
+        # the same key goes to the same partition
+        _expected = ['my.queue.p%d' % QueueClient.partition_index('key_%d' % _i, 4) for _i in range(0, 3)]
+        self.assertEqual(_routing_keys[0:6:2], _expected)
+        self.assertEqual(_routing_keys[1:6:2], _expected)
+        # messages without key are sent in turn
+        self.assertEqual(_routing_keys[6:], ['my.queue.p0', 'my.queue.p1'])
+
+    def test_send_stream_partitioned(self):
+        import io
+        self.client.setup('amqp://127.0.0.1/', queue='my_queue', partitions=8)
+        self.client.connect()
+        _id = self.client.send_stream(io.BytesIO(b'0123456789'), chunk_size=2)
+        _routing_keys = set()
+        while not self.client.channel.msg_buffer.empty():
+            _routing_keys.add(self.client.channel.msg_buffer.get()['routing_key'])
+
+        # chunks of a transfer are sent to the same partition
+        self.assertEqual(_routing_keys, set(['my_queue.p%d' % QueueClient.partition_index(_id, 8)]))
+
+    def test_rate_limit(self):
+        from oc_cdt_queue2.rate_limit import RateLimited
+        parser = argparse.ArgumentParser(description='test parser')
+        self.client.basic_args(parser)
+        args = parser.parse_args(['--amqp-url', 'amqp://127.0.0.1', '--rate-limit', '2', '--rate-limit-bytes', '1000',
+                                  '--rate-limit-group', 'test_client', '--rate-limit-raise'])
+        self.client.setup_from_args(args)
+        self.assertEqual(self.client.rate_limiter.messages_rate, 2)
+        self.assertEqual(self.client.rate_limiter.bytes_rate, 1000)
+        self.assertFalse(self.client.rate_limit_block)
+
+        # clients of the same group share the limit
+        _other = QueueClient()
+        _other._Connection = _ConnectionMock
+        _other.setup_from_args(args)
+        self.assertIs(_other.rate_limiter, self.client.rate_limiter)
+
+        self.client.connect()
+        _other.connect()
+        self.client.send('first')
+        _other.send('second')
+
+        with self.assertRaises(RateLimited):
+            self.client.send('third')
+
+        self.assertEqual(self.client.channel.msg_buffer.qsize(), 1)
+        self.assertEqual(self.client.get_stats(), {'throttled': 0, 'throttled_time': 0.0, 'rate_limited': 1})
+
+        # blocking client waits for the limit
+        _other.setup('amqp://127.0.0.1', rate_limit=100, rate_limit_burst=0.01)
+        _started = time.time()
+        for _i in range(0, 3):
+            _other.send(b'body')
+
+        self.assertGreaterEqual(time.time() - _started, 0.015)
+        self.assertEqual(_other.get_stats()['throttled'], 2)
+        self.assertIsNone(QueueClient().rate_limiter)
+
+    def test_outbox(self):
+        import shutil
+        import tempfile
+
+        class _ChanConfirmMock(_ChannelMock):
+            is_open = True
+
+            def confirm_delivery(self):
+                self.confirms = True
+
+        class _ConnOutboxMock(_ConnectionMock):
+            # broker is not available for the first connection
+            failures = [pika.exceptions.AMQPConnectionError("Test failure")]
+            created = list()
+
+            def __init__(self, params):
+                if self.failures:
+                    raise self.failures.pop()
+
+                super(_ConnOutboxMock, self).__init__(params)
+                self.created.append(self)
+
+            def channel(self):
+                _chan = _ChanConfirmMock()
+                self.channels.append(_chan)
+                return _chan
+
+        _path = tempfile.mkdtemp()
+        self.client._Connection = _ConnOutboxMock
+
+        try:
+            parser = argparse.ArgumentParser(description='test parser')
+            self.client.basic_args(parser)
+            args = parser.parse_args(['--amqp-url', 'amqp://127.0.0.1', '--queue', 'my_queue',
+                                      '--outbox', _path, '--outbox-max-size', '16'])
+            self.client.setup_from_args(args)
+            self.assertEqual(self.client.outbox_max_size, 16 * 1024 * 1024)
+
+            # sending does not wait for connection
+            self.client.send({'first': 1}, headers={'x-test': 'value'})
+            self.client.send(b'second')
+            self.assertTrue(self.client.flush(5))
+            self.assertEqual(self.client.get_stats()['outbox'], 0)
+
+            _chan = _ConnOutboxMock.created[0].channels[0]
+            self.assertTrue(_chan.confirms)
+            _first = _chan.msg_buffer.get()
+            self.assertEqual(_first['routing_key'], 'my_queue')
+            self.assertEqual(_first['body'], '{"first": 1}')
+            self.assertEqual(_first['properties'].content_type, 'application/json')
+            self.assertEqual(_unstamped(_first['properties'].headers), {'x-test': 'value'})
+            self.assertEqual(_first['properties'].delivery_mode, 2)
+            self.assertEqual(_chan.msg_buffer.get()['body'], b'second')
+
+            # messages not published are kept on disconnect and sent on the next connection
+            _ConnOutboxMock.failures = [pika.exceptions.AMQPConnectionError("Test failure")] * 100
+            self.client._close_connection()
+            self.client.channel = None
+            self.client.send('third')
+            self.client.disconnect()
+            self.assertIsNone(self.client.outbox)
+
+            _ConnOutboxMock.failures = list()
+            self.client.connect()
+            self.assertTrue(self.client.flush(5))
+            self.assertEqual(_ConnOutboxMock.created[-1].channels[0].msg_buffer.get()['body'], 'third')
+            self.client.disconnect()
+        finally:
+            shutil.rmtree(_path)
+
+    def test_published_time(self):
+        _chan = _ChannelMock()
+        self.client.channel = _chan
+        _headers = {'x-test': 'value'}
+        _before = time.time()
+        self.client.send('body', headers=_headers)
+        _props = _chan.msg_buffer.get()['properties']
+        # caller's headers are not changed
+        self.assertEqual(_headers, {'x-test': 'value'})
+        self.assertEqual(_props.timestamp, int(QueueClient.published_time(_props)))
+        self.assertTrue(_before <= QueueClient.published_time(_props) <= time.time())
+        self.assertEqual(QueueClient.published_time(pika.BasicProperties(timestamp=1000)), 1000.0)
+        self.assertIsNone(QueueClient.published_time(pika.BasicProperties()))
+
+        self.client.timestamp_messages = False
+        self.client.send('body')
+        _props = _chan.msg_buffer.get()['properties']
+        self.assertIsNone(_props.timestamp)
+        self.assertEqual(_props.headers, {})
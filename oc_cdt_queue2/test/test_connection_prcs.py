@@ -3,9 +3,13 @@ from oc_cdt_queue2.queue_connection_prcs import QueueConnectionProcess
 from oc_cdt_queue2.ipc_messages import IpcMessage
 from oc_cdt_queue2.ipc_messages import IpcMessageResult
 from oc_cdt_queue2.ipc_messages import IpcExcMsg
+from oc_cdt_queue2.ipc_messages import IpcDeclared
+from oc_cdt_queue2.ipc_messages import IpcLatency
+from oc_cdt_queue2.ipc_messages import IpcQueueStats
 from .mocks.queue_t import JoinableQueue
 import pika
 import logging
+import time
 
 # this will remove exaustive logging output from our testing console
 logging.getLogger().propagate = False
@@ -13,8 +17,11 @@ logging.getLogger().disabled = True
 
 
 class _MockMethod(object):
-    def __init__(self, delivery_tag):
+    def __init__(self, delivery_tag, redelivered=False, exchange='', routing_key='test_q.input'):
         self.delivery_tag = delivery_tag
+        self.redelivered = redelivered
+        self.exchange = exchange
+        self.routing_key = routing_key
 
 
 class _IOLoopMock(object):
@@ -586,6 +593,176 @@ class QueueConnectionTest(unittest.TestCase):
         _elmnt = _chan.calls.pop()
         self.assertIn('close', _elmnt)
 
+    def test_on_main_queue_declared_retries(self):
+        # retry queues are to be declared on a separate channel concurrently with the main chain
+        _cn = QueueConnectionProcess(
+            connection=_ConnectionMock,
+            params=self._params,
+            prefetch_count=1,
+            queue=self._queue_prd,
+            deads_disabled=False,
+            declare='yes',
+            ipc_q_in=self._ipc_q_out,
+            ipc_q_out=self._ipc_q_in,
+            retry_delays=[1, 2.5])
+
+        _cn._connection = _ConnectionMock()
+        _chan = _ChannelMock()
+        _cn.on_channel_open(_chan)
+        self.assertIn('exchange_declare', _chan.calls[-1])
+        self.assertEqual(len(_cn._connection.channels), 1)
+        self.assertEqual(_cn._connection.callbacks.on_channel, _cn.on_declare_channel_open)
+
+        _decl_chan = _ChannelMock()
+        _cn.on_declare_channel_open(_decl_chan)
+        self.assertIn('add_on_close_callback', _decl_chan.calls.pop(0))
+
+        for _queue, _ttl in [('test_q.input.retry.1000', 1000), ('test_q.input.retry.2500', 2500)]:
+            self.assertEqual(len(_decl_chan.calls), 1)
+            _elmnt = _decl_chan.calls.pop()
+            self.assertIn('queue_declare', _elmnt)
+            _kwargs = _elmnt.get('queue_declare')[1]
+            self.assertEqual(_kwargs.get('queue'), _queue)
+            self.assertTrue(_kwargs.get('durable'))
+            self.assertEqual(_kwargs.get('arguments').get('x-message-ttl'), _ttl)
+            self.assertEqual(_kwargs.get('arguments').get('x-dead-letter-exchange'), '')
+            self.assertEqual(_kwargs.get('arguments').get('x-dead-letter-routing-key'), self._queue_prd)
+            self.assertEqual(_kwargs.get('callback'), _cn.on_extra_declared)
+            _cn.on_extra_declared()
+
+        # declarations channel is closed, main chain is still waited for
+        self.assertEqual(len(_decl_chan.calls), 1)
+        self.assertIn('close', _decl_chan.calls.pop())
+        _cn.on_declare_channel_closed(_decl_chan, None)
+        self.assertTrue(self._ipc_q_in.empty())
+        _chan.calls = list()
+        _cn.on_main_queue_declared()
+        self.assertEqual(len(_chan.calls), 1)
+        self.assertIn('basic_qos', _chan.calls.pop())
+
+        # confirmed topology is reported to parent
+        _item = self._ipc_q_in.get()
+        self._ipc_q_in.task_done()
+        self.assertIsInstance(_item, IpcDeclared)
+        self.assertEqual(len(_item.keys), 6)
+
+        # nothing is declared with declare == 'no'
+        _cn._declare = 'no'
+        _cn.on_main_queue_declared()
+        self.assertEqual(len(_chan.calls), 1)
+        self.assertIn('basic_qos', _chan.calls.pop())
+        self.assertTrue(self._ipc_q_in.empty())
+
+    def test_on_declare_channel_closed_error(self):
+        _cn = QueueConnectionProcess(
+            connection=_ConnectionMock,
+            params=self._params,
+            prefetch_count=1,
+            queue=self._queue_prd,
+            deads_disabled=False,
+            declare='yes',
+            ipc_q_in=self._ipc_q_out,
+            ipc_q_out=self._ipc_q_in,
+            retry_delays=[1])
+
+        _cn._connection = _ConnectionMock()
+        _cn._channel = _ChannelMock()
+        _cn._declare_channel = _ChannelMock()
+        _cn.on_declare_channel_closed(_cn._declare_channel, pika.exceptions.ChannelClosed(406, 'PRECONDITION_FAILED'))
+        _item = self._ipc_q_in.get()
+        self._ipc_q_in.task_done()
+        self.assertIsInstance(_item, IpcExcMsg)
+        self.assertEqual(_item.reply_code, 406)
+        self.assertIn('close', _cn._channel.calls.pop())
+
+    def test_on_channel_open_declared(self):
+        # topology confirmed before is not declared again
+        _declared = QueueConnectionProcess(
+            connection=_ConnectionMock,
+            params=self._params,
+            prefetch_count=1,
+            queue=self._queue_prd,
+            deads_disabled=False,
+            declare='yes',
+            ipc_q_in=self._ipc_q_out,
+            ipc_q_out=self._ipc_q_in,
+            retry_delays=[1])._topology_keys
+
+        _cn = QueueConnectionProcess(
+            connection=_ConnectionMock,
+            params=self._params,
+            prefetch_count=1,
+            queue=self._queue_prd,
+            deads_disabled=False,
+            declare='yes',
+            ipc_q_in=self._ipc_q_out,
+            ipc_q_out=self._ipc_q_in,
+            retry_delays=[1],
+            declared=_declared)
+
+        _cn._connection = _ConnectionMock()
+        _chan = _ChannelMock()
+        _cn.on_channel_open(_chan)
+        # close and cancel callbacks, confirm mode and return callback for retries, prefetch
+        self.assertEqual(len(_chan.calls), 5)
+        self.assertIn('confirm_delivery', _chan.calls[2])
+        self.assertIn('basic_qos', _chan.calls[-1])
+        self.assertEqual(_cn._connection.channels, list())
+        self.assertTrue(self._ipc_q_in.empty())
+
+        # other retry delays make other topology
+        _cn = QueueConnectionProcess(
+            connection=_ConnectionMock,
+            params=self._params,
+            prefetch_count=1,
+            queue=self._queue_prd,
+            deads_disabled=False,
+            declare='yes',
+            ipc_q_in=self._ipc_q_out,
+            ipc_q_out=self._ipc_q_in,
+            retry_delays=[2],
+            declared=_declared)
+
+        _cn._connection = _ConnectionMock()
+        _chan = _ChannelMock()
+        _cn.on_channel_open(_chan)
+        self.assertIn('exchange_declare', _chan.calls[-1])
+
+    def test_on_channel_open_verify(self):
+        # passive declaration is followed by regular one, bindings are skipped
+        _cn = QueueConnectionProcess(
+            connection=_ConnectionMock,
+            params=self._params,
+            prefetch_count=1,
+            queue=self._queue_prd,
+            deads_disabled=False,
+            declare='verify',
+            ipc_q_in=self._ipc_q_out,
+            ipc_q_out=self._ipc_q_in)
+
+        _cn._connection = _ConnectionMock()
+        _chan = _ChannelMock()
+        _cn.on_channel_open(_chan)
+        _chan.calls = _chan.calls[2:]
+        _expected = [('exchange_declare', self._queue_dds, True), ('exchange_declare', self._queue_dds, None),
+                     ('queue_declare', self._queue_dds, True), ('queue_declare', self._queue_dds, None),
+                     ('queue_declare', self._queue_prd, True), ('queue_declare', self._queue_prd, None)]
+
+        for (_method, _name, _passive) in _expected:
+            self.assertEqual(len(_chan.calls), 1)
+            _elmnt = _chan.calls.pop()
+            self.assertIn(_method, _elmnt)
+            _kwargs = _elmnt.get(_method)[1]
+            self.assertEqual(_kwargs.get('queue') or _kwargs.get('exchange'), _name)
+            self.assertEqual(_kwargs.get('passive'), _passive)
+            self.assertEqual(_kwargs.get('callback'), _cn.on_extra_declared)
+            _cn.on_extra_declared()
+
+        self.assertEqual(len(_chan.calls), 1)
+        self.assertIn('basic_qos', _chan.calls.pop())
+        # verification is not cached
+        self.assertTrue(self._ipc_q_in.empty())
+
     def test_on_prefetch_set_ok(self):
         # just call basic_consume
         # no ipc_queue_process should be called because we are not returning consumer tag here
@@ -871,7 +1048,7 @@ class QueueConnectionTest(unittest.TestCase):
         _body = b"{'msg_body': 'Test body'}"
         _properties = {'property': 'Test property'}
         _delivery_tag = 0
-        _method = _MockMethod(_delivery_tag)
+        _method = _MockMethod(_delivery_tag, redelivered=True)
         _chan = _ChannelMock()
         _cn.on_message(channel=_chan, method=_method, properties=_properties, body=_body)
 
@@ -882,6 +1059,45 @@ class QueueConnectionTest(unittest.TestCase):
         self.assertEqual(_cmsg.delivery_tag, _delivery_tag)
         self.assertEqual(_cmsg.properties, _properties)
         self.assertEqual(_cmsg.body, _body)
+        self.assertTrue(_cmsg.redelivered)
+        self.assertEqual(_cmsg.exchange, '')
+        self.assertEqual(_cmsg.routing_key, 'test_q.input')
+
+    def test_ack_latency(self):
+        _cn = QueueConnectionProcess(
+            connection=_ConnectionMock,
+            params=self._params,
+            prefetch_count=4,
+            queue=self._queue_prd,
+            deads_disabled=False,
+            declare='yes',
+            ipc_q_in=self._ipc_q_out,
+            ipc_q_out=self._ipc_q_in,
+            latency=True)
+
+        _cn._channel = _ChannelMock()
+        _cn._connection = _ConnectionMock()
+        _before = time.time()
+
+        for _tag in range(1, 5):
+            _cn.on_message(_cn._channel, _MockMethod(_tag), pika.BasicProperties(), 'body')
+            _msg = self._ipc_q_in.get()
+            self._ipc_q_in.task_done()
+            # time received is passed to worker
+            self.assertTrue(_before <= _msg.received <= time.time())
+
+        _cn._delivery_queues[4] = 'test_q.input.p1'
+        self._ipc_q_out.put(IpcMessageResult(3, True, False, multiple=True, reported=time.time() - 1))
+        self._ipc_q_out.put(IpcMessageResult(4, True, False, reported=time.time() - 2))
+        _cn.ipc_queue_process()
+
+        # samples of all the results processed at once are sent back together
+        _latency = self._ipc_q_in.get()
+        self.assertIsInstance(_latency, IpcLatency)
+        self.assertEqual([_queue for (_queue, _seconds) in _latency.samples], [None, 'test_q.input.p1'])
+        self.assertGreaterEqual(_latency.samples[0][1], 1)
+        self.assertGreaterEqual(_latency.samples[1][1], 2)
+        self.assertEqual(_cn._delivery_queues, dict())
 
     def test_report_msg_result_ack(self):
         # basic_ack should be called for channel
@@ -909,6 +1125,80 @@ class QueueConnectionTest(unittest.TestCase):
         self.assertIn('basic_ack', _elmnt)
         self.assertEqual(_elmnt.get('basic_ack')[1].get('delivery_tag'), _delivery_tag)
 
+    def test_report_msg_result_ack_multiple(self):
+        # single basic_ack for all messages up to delivery tag, kept messages are dropped
+        _cn = QueueConnectionProcess(
+            connection=_ConnectionMock,
+            params=self._params,
+            prefetch_count=4,
+            queue=self._queue_prd,
+            deads_disabled=False,
+            declare='yes',
+            ipc_q_in=self._ipc_q_out,
+            ipc_q_out=self._ipc_q_in,
+            retry_delays=[1])
+
+        _chan = _ChannelMock()
+        _cn._channel = _chan
+
+        for _tag in range(1, 5):
+            _cn.on_message(_chan, _MockMethod(_tag), pika.BasicProperties(), 'body')
+
+        _cn.report_msg_result(rslt=IpcMessageResult(3, True, False, multiple=True))
+        self.assertEqual(len(_chan.calls), 1)
+        _elmnt = _chan.calls.pop()
+        self.assertIn('basic_ack', _elmnt)
+        self.assertEqual(_elmnt.get('basic_ack')[1], {'delivery_tag': 3, 'multiple': True})
+        self.assertEqual(list(_cn._messages.keys()), [4])
+
+    def test_inflight_pause_resume(self):
+        # consuming is cancelled on a limit reached and started again at a half of it
+        _cn = QueueConnectionProcess(
+            connection=_ConnectionMock,
+            params=self._params,
+            prefetch_count=0,
+            queue=self._queue_prd,
+            deads_disabled=False,
+            declare='yes',
+            ipc_q_in=self._ipc_q_out,
+            ipc_q_out=self._ipc_q_in,
+            max_inflight=10,
+            max_inflight_bytes=100)
+
+        _chan = _ChannelMock()
+        _cn._channel = _chan
+        _cn._consumer_tag = 'ctag1'
+
+        for _tag in range(1, 4):
+            _cn.on_message(_chan, _MockMethod(_tag), pika.BasicProperties(), b'x' * 40)
+
+        self.assertTrue(_cn._paused)
+        self.assertIsNone(_cn._consumer_tag)
+        _elmnt = _chan.calls.pop()
+        self.assertIn('basic_cancel', _elmnt)
+        self.assertEqual(_elmnt.get('basic_cancel')[1].get('consumer_tag'), 'ctag1')
+        self.assertEqual(_elmnt.get('basic_cancel')[1].get('callback'), _cn.on_consuming_paused)
+
+        _msgs = list()
+        while not self._ipc_q_in.empty():
+            _msgs.append(self._ipc_q_in.get())
+            self._ipc_q_in.task_done()
+
+        self.assertEqual([(_m.inflight, _m.inflight_bytes, _m.paused) for _m in _msgs],
+                         [(1, 40, False), (2, 80, False), (3, 120, True)])
+
+        # 80 bytes left, still over a half
+        _cn.report_msg_result(IpcMessageResult(1, True, False))
+        self.assertTrue(_cn._paused)
+        self.assertIn('basic_ack', _chan.calls.pop())
+        _cn.report_msg_result(IpcMessageResult(3, True, False, multiple=True))
+        self.assertFalse(_cn._paused)
+        self.assertEqual((len(_cn._inflight), _cn._inflight_bytes), (0, 0))
+        self.assertIn('basic_ack', _chan.calls.pop())
+        _elmnt = _chan.calls.pop()
+        self.assertIn('basic_consume', _elmnt)
+        self.assertEqual(_elmnt.get('basic_consume')[1].get('on_message_callback'), _cn.on_message)
+
     def test_report_msg_result_nack_requeue(self):
         # basic_nack should be called for channel
         _cn = QueueConnectionProcess(
@@ -963,6 +1253,89 @@ class QueueConnectionTest(unittest.TestCase):
         self.assertEqual(_elmnt.get('basic_nack')[1].get('delivery_tag'), _delivery_tag)
         self.assertFalse(_elmnt.get('basic_nack')[1].get('requeue'))
 
+    def test_report_msg_result_retry(self):
+        # message is to be re-published to retry queue with retry count header, then acked when confirmed
+        _cn = QueueConnectionProcess(
+            connection=_ConnectionMock,
+            params=self._params,
+            prefetch_count=1,
+            queue=self._queue_prd,
+            deads_disabled=False,
+            declare='yes',
+            ipc_q_in=self._ipc_q_out,
+            ipc_q_out=self._ipc_q_in,
+            retry_delays=[1])
+
+        _delivery_tag = 3
+        _body = b'["ping", [], {}]'
+        _properties = pika.BasicProperties(content_type='application/json', headers={'x-test': 'test'})
+        _chan = _ChannelMock()
+        _cn._channel = _chan
+        _cn.on_message(channel=_chan, method=_MockMethod(_delivery_tag), properties=_properties, body=_body)
+        self._ipc_q_in.get()
+        self._ipc_q_in.task_done()
+        _cn.report_msg_result(rslt=IpcMessageResult(_delivery_tag, False, False,
+                                                    retry_queue='test_q.input.retry.1000', retry_count=2))
+
+        self.assertEqual(len(_chan.calls), 1)
+        _elmnt = _chan.calls.pop()
+        self.assertIn('basic_publish', _elmnt)
+        _kwargs = _elmnt.get('basic_publish')[1]
+        self.assertEqual(_kwargs.get('exchange'), '')
+        self.assertEqual(_kwargs.get('routing_key'), 'test_q.input.retry.1000')
+        self.assertEqual(_kwargs.get('body'), _body)
+        self.assertTrue(_kwargs.get('mandatory'))
+        self.assertEqual(_kwargs.get('properties').headers, {'x-test': 'test', 'x-retry-count': 2, 'x-retry-publish': 1})
+        self.assertEqual(_kwargs.get('properties').content_type, 'application/json')
+        # original properties are untouched
+        self.assertEqual(_properties.headers, {'x-test': 'test'})
+        self.assertEqual(_cn._messages, dict())
+
+        _cn.on_retry_confirmed(pika.frame.Method(1, pika.spec.Basic.Ack(delivery_tag=1)))
+        self.assertEqual(len(_chan.calls), 1)
+        _elmnt = _chan.calls.pop()
+        self.assertIn('basic_ack', _elmnt)
+        self.assertEqual(_elmnt.get('basic_ack')[1].get('delivery_tag'), _delivery_tag)
+
+        # retry queue does not exist: publish is returned, original is rejected to deads queue
+        for _tag in [4, 5]:
+            _cn.on_message(channel=_chan, method=_MockMethod(_tag), properties=_properties, body=_body)
+            self._ipc_q_in.get()
+            self._ipc_q_in.task_done()
+            _cn.report_msg_result(rslt=IpcMessageResult(_tag, False, False,
+                                                        retry_queue='test_q.input.retry.1000', retry_count=1))
+
+        _published = [_call.get('basic_publish')[1].get('properties') for _call in _chan.calls]
+        _chan.calls = list()
+        _cn.on_retry_returned(_chan, pika.spec.Basic.Return(reply_code=312, reply_text='NO_ROUTE',
+                                                            routing_key='test_q.input.retry.1000'), _published[0], _body)
+        _cn.on_retry_confirmed(pika.frame.Method(1, pika.spec.Basic.Ack(delivery_tag=3, multiple=True)))
+        self.assertEqual(_chan.calls, [{'basic_nack': [(), {'delivery_tag': 4, 'requeue': False}]},
+                                       {'basic_ack': [(), {'delivery_tag': 5}]}])
+        self.assertEqual(_cn._retries, dict())
+        self.assertEqual(_cn._retries_returned, set())
+
+        # retried copy is received without publish sequence header
+        _cn.on_message(channel=_chan, method=_MockMethod(10), properties=_published[1], body=_body)
+        self.assertEqual(self._ipc_q_in.get().properties.headers, {'x-test': 'test', 'x-retry-count': 1})
+        self._ipc_q_in.task_done()
+        del _cn._messages[10]
+
+        # multiple acknowledgement is not to cover message waiting for its retry copy confirmed
+        for _tag in [6, 7, 8, 9]:
+            _cn.on_message(channel=_chan, method=_MockMethod(_tag), properties=_properties, body=_body)
+            self._ipc_q_in.get()
+            self._ipc_q_in.task_done()
+
+        _cn.report_msg_result(rslt=IpcMessageResult(7, False, False, retry_queue='test_q.input.retry.1000',
+                                                    retry_count=1))
+        _chan.calls = list()
+        _cn.report_msg_result(rslt=IpcMessageResult(9, True, False, multiple=True))
+        self.assertEqual(_chan.calls, [{'basic_ack': [(), {'delivery_tag': 6}]},
+                                       {'basic_ack': [(), {'delivery_tag': 8}]},
+                                       {'basic_ack': [(), {'delivery_tag': 9}]}])
+        self.assertEqual(_cn._messages, dict())
+
     def test_stop(self):
         # should be called disconnect and close_all_ipc_q
         class _QueueConnectionStopMock(QueueConnectionProcess):
@@ -1160,3 +1533,120 @@ class QueueConnectionTest(unittest.TestCase):
         _cn.disconnect()
         self.assertIsNone(_cn._consumer_tag)
         self.assertEqual(len(_cn._connection.calls), 0)
+
+    def test_partitions(self):
+        # main partition is declared by the main chain, the others by additional one, deads queue is shared
+        _cn = QueueConnectionProcess(
+            connection=_ConnectionMock,
+            params=self._params,
+            prefetch_count=1,
+            queue='test_q.input.p1',
+            deads_disabled=False,
+            declare='yes',
+            ipc_q_in=self._ipc_q_out,
+            ipc_q_out=self._ipc_q_in,
+            declare_queues=['test_q.input.p0', 'test_q.input.p2'],
+            consume_queues=['test_q.input.p2'],
+            deads_queue='test_q.deads')
+
+        self.assertEqual(_cn._rmq_deads, 'test_q.deads')
+        self.assertEqual([(_method, _kwargs.get('queue')) for (_method, _kwargs) in _cn._extra_declarations],
+                         [('queue_declare', 'test_q.input.p0'), ('queue_declare', 'test_q.input.p2')])
+        self.assertEqual(_cn._extra_declarations[0][1]['arguments']['x-dead-letter-exchange'], 'test_q.deads')
+
+        _cn._connection = _ConnectionMock()
+        _chan = _ChannelMock()
+        _cn.on_channel_open(_chan)
+        self.assertIn('exchange_declare', _chan.calls[-1])
+        self.assertEqual(len(_cn._connection.channels), 1)
+
+        # consuming from all the queues, message is marked with the queue it came from
+        class _TaggingChannelMock(_ChannelMock):
+            def basic_consume(self, queue, on_message_callback):
+                self.calls.append({'basic_consume': [(), {'queue': queue}]})
+                return 'ctag.%s' % queue
+
+        _chan = _TaggingChannelMock()
+        _cn._channel = _chan
+        _cn._start_consuming()
+        self.assertEqual([_call['basic_consume'][1]['queue'] for _call in _chan.calls],
+                         ['test_q.input.p1', 'test_q.input.p2'])
+
+        _method = _MockMethod(1, routing_key='test_q.input.p2')
+        _method.consumer_tag = 'ctag.test_q.input.p2'
+        _cn.on_message(channel=_chan, method=_method, properties=None, body=b'')
+        self.assertEqual(self._ipc_q_in.get().queue, 'test_q.input.p2')
+
+        # other consumers are cancelled before the main one
+        _chan.calls = list()
+        _cn.disconnect()
+        self.assertEqual([(list(_call.keys())[0], _call.get('basic_cancel')[1]) for _call in _chan.calls],
+                         [('basic_cancel', {'consumer_tag': 'ctag.test_q.input.p2'}),
+                          ('basic_cancel', {'consumer_tag': 'ctag.test_q.input.p1',
+                                            'callback': _cn.on_consuming_cancel})])
+        self.assertEqual(_cn._extra_consumer_tags, list())
+
+    def test_probe_queues(self):
+        _cn = QueueConnectionProcess(
+            connection=_ConnectionMock,
+            params=self._params,
+            prefetch_count=1,
+            queue=self._queue_prd,
+            deads_disabled=False,
+            declare='yes',
+            ipc_q_in=self._ipc_q_out,
+            ipc_q_out=self._ipc_q_in,
+            consume_queues=['test_q.input.p1'],
+            probe_interval=5)
+
+        class _TaggingChannelMock(_ChannelMock):
+            def basic_consume(self, queue, on_message_callback):
+                return 'ctag.%s' % queue
+
+        class _ProbeChannelMock(_ChannelMock):
+            is_open = True
+
+        # probe channel is opened once consuming is started
+        _cn._connection = _ConnectionMock()
+        _cn._channel = _TaggingChannelMock()
+        _cn.on_prefetch_set_ok()
+        self.assertEqual(len(_cn._connection.channels), 1)
+        self.assertEqual(_cn._connection.callbacks.on_channel, _cn.on_probe_channel_open)
+
+        # consumed queues are declared passively and the next probe is scheduled
+        _chan = _ProbeChannelMock()
+        _cn._connection.ioloop.call_buffer = list()
+        _cn.on_probe_channel_open(_chan)
+        self.assertEqual([_call['queue_declare'][1] for _call in _chan.calls if 'queue_declare' in _call],
+                         [{'queue': 'test_q.input', 'passive': True, 'callback': _cn.on_queue_probed},
+                          {'queue': 'test_q.input.p1', 'passive': True, 'callback': _cn.on_queue_probed}])
+        self.assertEqual([_call['delay'] for _call in _cn._connection.ioloop.call_buffer], [5])
+
+        # replies are passed to worker
+        _frame = type('_Frame', (object, ), {'method': pika.spec.Queue.DeclareOk('test_q.input.p1', 10, 2)})()
+        _cn.on_queue_probed(_frame)
+        _stats = self._ipc_q_in.get()
+        self._ipc_q_in.task_done()
+        self.assertIsInstance(_stats, IpcQueueStats)
+        self.assertEqual((_stats.queue, _stats.messages, _stats.consumers), ('test_q.input.p1', 10, 2))
+
+        # probe channel failure does not stop consuming, the channel is re-opened later
+        # and the probe scheduled for the old one is dropped
+        _cn._connection.ioloop.call_buffer = list()
+        _cn.on_probe_channel_closed(_chan, Exception("NOT_FOUND"))
+        self.assertIsNone(_cn._probe_channel)
+        self.assertIsNotNone(_cn._channel)
+        self.assertEqual(self._ipc_q_in.qsize(), 0)
+        self.assertEqual(_cn._connection.ioloop.call_buffer[0]['call'], _cn._open_probe_channel)
+        _chan.calls = list()
+        _cn.probe_queues(_chan)
+        self.assertEqual(_chan.calls, list())
+
+        # probe channel is closed on disconnect without reporting
+        _chan = _ProbeChannelMock()
+        _cn.on_probe_channel_open(_chan)
+        _cn.disconnect()
+        self.assertIsNone(_cn._probe_channel)
+        self.assertIn('close', _chan.calls[-1])
+        _cn.on_probe_channel_closed(_chan, Exception("closed"))
+        self.assertEqual(self._ipc_q_in.qsize(), 0)
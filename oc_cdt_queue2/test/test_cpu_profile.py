@@ -0,0 +1,91 @@
+import unittest
+from oc_cdt_queue2.cpu_profile import CpuProfiler
+import os
+import pstats
+import shutil
+import signal
+import tempfile
+import time
+
+
+def _busy(seconds):
+    _deadline = time.time() + seconds
+
+    while time.time() < _deadline:
+        pass
+
+
+class CpuProfilerTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def test_cprofile(self):
+        _output = os.path.join(self.dir, 'profile-{pid}.pstats')
+        _profiler = CpuProfiler(output=_output)
+
+        for _key in ['busy', 'busy', 'idle']:
+            _state = _profiler.begin()
+
+            if _key == 'busy':
+                _busy(0.02)
+
+            _profiler.end(_state, _key)
+
+        self.assertEqual(_profiler._times['busy'][0], 2)
+        self.assertGreaterEqual(_profiler._times['busy'][1], 0.04)
+        _report = _profiler.report()
+        self.assertIn('busy: 2 messages', _report)
+        self.assertIn('_busy (test_cpu_profile.py:', _report)
+
+        _path = _profiler.dump()
+        self.assertEqual(_path, os.path.join(self.dir, 'profile-%d.pstats' % os.getpid()))
+        _functions = [_function[2] for _function in pstats.Stats(_path).stats]
+        self.assertEqual(_functions.count('_busy'), 1)
+        self.assertIn('_busy', [_function[2] for _function in pstats.Stats(_path + '.busy').stats])
+        self.assertNotIn('_busy', [_function[2] for _function in pstats.Stats(_path + '.idle').stats])
+
+    def test_sample(self):
+        _output = os.path.join(self.dir, 'stacks.txt')
+        _profiler = CpuProfiler(method='sample', interval=0.001, output=_output)
+        self.addCleanup(_profiler.close)
+        _state = _profiler.begin()
+        _busy(0.1)
+        _profiler.end(_state, 'busy')
+        # nothing is sampled between messages
+        _busy(0.05)
+        self.assertEqual(list(_profiler._stats.keys()), ['busy'])
+        _samples = sum(_profiler._stats['busy'].values())
+        self.assertGreater(_samples, 5)
+        self.assertTrue(all(_stack[-1].startswith('_busy (test_cpu_profile.py:') for _stack in _profiler._stats['busy']))
+
+        _profiler.dump()
+
+        with open(_output) as _file:
+            _lines = _file.read().splitlines()
+
+        self.assertTrue(all(_line.startswith('busy;') for _line in _lines))
+        self.assertEqual(sum(int(_line.rsplit(' ', 1)[1]) for _line in _lines), _samples)
+
+    def test_report_due(self):
+        _profiler = CpuProfiler(report_every=2)
+        self.assertFalse(_profiler.report_due())
+        _profiler.end(_profiler.begin(), 'key')
+        _profiler.end(_profiler.begin(), 'key')
+        self.assertTrue(_profiler.report_due())
+        self.assertTrue(_profiler.log_report())
+        self.assertFalse(_profiler.report_due())
+        self.assertFalse(_profiler.log_report())
+
+        _profiler = CpuProfiler(report_signal=signal.SIGUSR2)
+        self.addCleanup(signal.signal, signal.SIGUSR2, signal.SIG_DFL)
+        self.assertFalse(_profiler.report_due())
+        os.kill(os.getpid(), signal.SIGUSR2)
+        self.assertTrue(_profiler.report_due())
+
+    def test_wrong_args(self):
+        with self.assertRaises(ValueError):
+            CpuProfiler(method='perf')
+
+        with self.assertRaises(ValueError):
+            CpuProfiler(method='sample', interval=0)
@@ -0,0 +1,29 @@
+import unittest
+from oc_cdt_queue2.declarations import DeclarationCache
+from oc_cdt_queue2.queue_base import QueueBase
+import pika
+
+
+class DeclarationCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = DeclarationCache()
+        self.params = pika.URLParameters('amqp://127.0.0.1/')
+
+    def test_declaration_key(self):
+        _key = self.cache.declaration_key('queue_declare', {'queue': 'q', 'arguments': {'b': 1, 'a': 2}, 'callback': id})
+        self.assertEqual(_key, self.cache.declaration_key('queue_declare', {'arguments': {'a': 2, 'b': 1}, 'queue': 'q'}))
+        self.assertNotEqual(_key, self.cache.declaration_key('queue_declare', {'queue': 'q', 'arguments': {'a': 2}}))
+
+    def test_confirmed(self):
+        _keys = self.cache.topology_keys(QueueBase.queue_topology('test.input'))
+        self.assertEqual(len(_keys), 4)
+        self.assertFalse(self.cache.is_confirmed(self.params, _keys))
+        self.cache.add(self.params, _keys)
+        self.assertTrue(self.cache.is_confirmed(self.params, _keys))
+        self.assertEqual(self.cache.confirmed(self.params), _keys)
+        self.assertFalse(self.cache.is_confirmed(pika.URLParameters('amqp://127.0.0.1/other'), _keys))
+        self.assertFalse(self.cache.is_confirmed(
+            self.params, self.cache.topology_keys(QueueBase.queue_topology('test.input', retry_delays=[1]))))
+        self.cache.forget(self.params)
+        self.assertFalse(self.cache.is_confirmed(self.params, _keys))
+        self.assertEqual(self.cache.confirmed(self.params), frozenset())
@@ -1,7 +1,17 @@
 import unittest
 from oc_cdt_queue2.queue_handler import QueueHandler
+from oc_cdt_queue2.queue_handler import threaded
+from oc_cdt_queue2.queue_handler import streamed
+from oc_cdt_queue2.json_stream import JsonArrayStream
+from oc_cdt_queue2.rpc_schema import Arg
+from oc_cdt_queue2.rpc_schema import InvalidCall
+from oc_cdt_queue2.rpc_schema import RpcSchema
+from unittest import mock
 import json
+import threading
 import logging
+import pika
+from .mocks.queue_t import JoinableQueue
 
 # to get rid of logging output from imported classes
 logging.getLogger().propagate = False
@@ -46,10 +56,50 @@ class TestClass(QueueHandler):
         self.itworks = True
 
 
+class ThreadedTestClass(QueueHandler):
+
+    published = ['wait', 'fail', 'ping']
+
+    def __init__(self):
+        super(ThreadedTestClass, self).__init__()
+        self.event = threading.Event()
+        self.called = list()
+
+    @threaded
+    def wait(self, key):
+        self.event.wait(5)
+        self.called.append(('wait', key, threading.current_thread().name))
+
+    @threaded
+    def fail(self, key):
+        raise ValueError("Test failure")
+
+    def ping(self, key):
+        self.called.append(('ping', key, threading.current_thread().name))
+
+
+class StreamedTestClass(QueueHandler):
+
+    published = ['total', 'ping']
+
+    def __init__(self):
+        super(StreamedTestClass, self).__init__()
+        self.called = list()
+
+    @streamed
+    def total(self, items, scale=1):
+        self.called.append(('total', type(items).__name__, sum(items) * scale))
+
+    def ping(self, *args):
+        self.called.append(('ping', list(args)))
+
+
 class QueueHandlerTest(unittest.TestCase):
 
     def setUp(self):
         self.server = TestClass()
+        self.server._ipc_q_out = JoinableQueue()
+        self.props = pika.BasicProperties(content_type='application/json')
 
     # testing settings is not interesting since
     # there is no separate settings in handler
@@ -65,6 +115,22 @@ class QueueHandlerTest(unittest.TestCase):
 
         return [method, args, kwargs]
 
+    def __threaded(self, **kwargs):
+        _server = ThreadedTestClass()
+        _server.setup(**kwargs)
+        _server._setup_thread_pool()
+        _server._ipc_q_out = JoinableQueue()
+        return _server
+
+    def __results(self, server):
+        _results = list()
+
+        while not server._ipc_q_out.empty():
+            _results.append(server._ipc_q_out.get())
+            server._ipc_q_out.task_done()
+
+        return _results
+
     # everywhere we are not interested in 'properties' since they are not (yet?) used
     def test_incorrect_message(self):
         with self.assertRaises(ValueError):
@@ -97,6 +163,32 @@ class QueueHandlerTest(unittest.TestCase):
         self.server.violate()
         self.assertTrue(self.server.itworks)
 
+    def test_schema(self):
+        self.server.published = RpcSchema({'methodA': None,
+                                           'ping': [Arg('msg1', str, required=True), Arg('msg2', int)]})
+        self.server.on_message(self.__msg('ping', 'hello', msg2=2), None)
+        self.assertEqual(self.server.messages.pop(), ['ping', 'hello', 2, None])
+        self.server.on_message(self.__msg('methodA'), None)
+
+        # invalid calls are rejected before the method is called
+        for _call in [self.__msg('ping', msg2=2), self.__msg('ping', 'hello', msg2='2'),
+                      self.__msg('ping', 'hello', test=True)]:
+            with self.assertRaises(InvalidCall):
+                self.server.on_message(_call, None)
+
+        self.assertEqual(self.server.messages, list())
+
+        with self.assertRaises(ValueError):
+            self.server.on_message(self.__msg('methodB'), None)
+
+        # dict of keyword names is compiled for the instance when 'published' is replaced
+        self.server.published = {'ping': ['msg1'], 'methodA': None}
+        self.server.on_message(self.__msg('ping', msg1='hello'), None)
+        self.assertEqual(self.server.messages.pop(), ['ping', 'hello', None, None])
+
+        with self.assertRaises(InvalidCall):
+            self.server.on_message(self.__msg('ping', msg2=2), None)
+
     def test_different_methods(self):
         self.server.on_message(self.__msg('methodA'), None)
         self.server.on_message(self.__msg('methodB'), None)
@@ -104,3 +196,166 @@ class QueueHandlerTest(unittest.TestCase):
 
     # tests for receive/ack/nack are not needed here
     # since them will repeat those in 'test_server' and 'test_connection_prcs'
+
+    def test_memory_profile_by_function(self):
+        self.server.setup(memory_profile=1, memory_profile_method='rss')
+        self.server._process_message(1, self.props, json.dumps(self.__msg('ping', msg1='hello')))
+        self.server._process_message(2, self.props, json.dumps(self.__msg('methodA')))
+        self.server._process_message(3, self.props, json.dumps(['unknown', [], {}]))
+        self.assertEqual(sorted(self.server._memory_profiler._stats.keys()), ['message', 'methodA', 'ping'])
+        self.server.setup(memory_profile=0)
+        self.assertIsNone(self.server._memory_profiler)
+
+    def test_cpu_profile_by_function(self):
+        self.server.setup(profile='cprofile')
+        self.server._process_message(1, self.props, json.dumps(self.__msg('ping', msg1='hello')))
+        self.server._process_message(2, self.props, json.dumps(self.__msg('methodA')))
+        self.server._process_message(3, self.props, json.dumps(['unknown', [], {}]))
+        self.assertEqual(sorted(self.server._cpu_profiler._times.keys()), ['message', 'methodA', 'ping'])
+        self.assertIn('methodA: 1 messages', self.server._cpu_profiler.report())
+        self.server.setup(profile=None)
+        self.assertIsNone(self.server._cpu_profiler)
+
+    def test_streamed(self):
+        _server = StreamedTestClass()
+        # small messages are decoded entirely, streamed method gets iterator anyway
+        _server.on_message_raw(json.dumps(self.__msg('total', 1, 2, 3)).encode('utf-8'), self.props)
+        self.assertEqual(_server.called.pop(), ('total', 'list_iterator', 6))
+
+        _server.setup(json_stream_size=1)
+        _server.on_message_raw(json.dumps(self.__msg('total', *range(0, 1000))).encode('utf-8'), self.props)
+        self.assertEqual(_server.called.pop(), ('total', 'generator', 499500))
+        # keyword arguments follow positional ones
+        _server.on_message_raw(json.dumps(self.__msg('total', 1, 2, scale=10)).encode('utf-8'), self.props)
+        self.assertEqual(_server.called.pop(), ('total', 'generator', 30))
+        self.assertEqual(_server.latency_label(json.dumps(self.__msg('total', 1)).encode('utf-8'), self.props), 'total')
+        # other methods are called as usual
+        _server.on_message_raw(json.dumps(self.__msg('ping', 1, [2])).encode('utf-8'), self.props)
+        self.assertEqual(_server.called.pop(), ('ping', [1, [2]]))
+
+        for _body in [b'["total", [1, 2], {"scale": 1}, 3]', b'["total", [1, 2], [3]]', b'["total", 1, {}]',
+                      b'["unknown", [], {}]']:
+            with self.assertRaises(ValueError):
+                _server.on_message_raw(_body, self.props)
+
+        self.assertEqual(_server.called, list())
+
+    def test_streamed_tail(self):
+        _server = StreamedTestClass()
+        _server.setup(json_stream_size=1)
+        _body = json.dumps(self.__msg('total', 1, 2, 3)) + ' \n' * 64
+
+        # call without keyword arguments is told by its end, for text and with trailing whitespace also
+        with mock.patch.object(JsonArrayStream, 'reopen', side_effect=AssertionError("decoded twice")):
+            _server.on_message_raw(_body, self.props)
+            _server.on_message_raw(_body.encode('utf-8'), self.props)
+
+        self.assertEqual(_server.called, [('total', 'generator', 6), ('total', 'generator', 6)])
+
+        # ordering key is decoded alone
+        _body = json.dumps(self.__msg('total', 'first', ['second'], scale=10)).encode('utf-8')
+
+        with mock.patch.object(_server, '_decode', side_effect=AssertionError("decoded entirely")):
+            _server.ordering_argument = 1
+            self.assertEqual(_server.ordering_key(_body, self.props), '["second"]')
+            _server.ordering_argument = 'scale'
+            self.assertEqual(_server.ordering_key(_body, self.props), 10)
+            _server.ordering_argument = 2
+            self.assertIsNone(_server.ordering_key(_body, self.props))
+            self.assertIsNone(_server.ordering_key(b'["total", [1, 2', self.props))
+
+    def test_ordering_key(self):
+        _props = pika.BasicProperties(headers={'x-key': 'from header'})
+        _body = json.dumps(self.__msg('methodB', 'first', ['second'], delivery=17))
+        self.assertIsNone(self.server.ordering_key(_body, _props))
+        self.server.setup(ordering_header='x-key')
+        self.assertEqual(self.server.ordering_key(_body, _props), 'from header')
+
+        # call argument takes precedence over header
+        self.server.ordering_argument = 'delivery'
+        self.assertEqual(self.server.ordering_key(_body, _props), 17)
+        self.server.ordering_argument = 1
+        self.assertEqual(self.server.ordering_key(_body, _props), '["second"]')
+        self.server.ordering_argument = 2
+        self.assertIsNone(self.server.ordering_key(_body, _props))
+        self.assertIsNone(self.server.ordering_key('blablabla', _props))
+
+    def test_latency_label(self):
+        _props = pika.BasicProperties(type='call')
+        self.assertEqual(self.server.latency_label(json.dumps(self.__msg('methodB', 'first')), _props), 'methodB')
+        # unknown functions are not labels: their number is not limited
+        self.assertEqual(self.server.latency_label(json.dumps(self.__msg('unknown')), _props), 'call')
+        self.assertEqual(self.server.latency_label('blablabla', pika.BasicProperties()), 'message')
+
+    def test_threaded(self):
+        _server = self.__threaded(prefetch_count=3, latency_stats=True)
+        _server.ordering_argument = 0
+        self.assertTrue(_server.is_threaded('wait'))
+        self.assertFalse(_server.is_threaded('ping'))
+        self.assertEqual(_server.executor._max_workers, 3)
+
+        _server._process_message(1, self.props, json.dumps(self.__msg('wait', 'a')))
+        _server._process_message(2, self.props, json.dumps(self.__msg('fail', 'b')))
+        # not threaded call is made in the main loop at once
+        _server._process_message(3, self.props, json.dumps(self.__msg('ping', 'c')))
+        self.assertEqual(_server.called, [('ping', 'c', threading.current_thread().name)])
+        # but it waits for the previous call with the same key
+        _server._process_message(4, self.props, json.dumps(self.__msg('ping', 'a')))
+        self.assertEqual(len(_server.called), 1)
+
+        _server.event.set()
+        while _server._executor_pending():
+            _server._process_completed(0.1)
+        _server._process_completed()
+        _server.executor.shutdown()
+
+        self.assertEqual([_call[0:2] for _call in _server.called], [('ping', 'c'), ('wait', 'a'), ('ping', 'a')])
+        self.assertTrue(_server.called[1][2].startswith('handler'))
+        _results = self.__results(_server)
+        self.assertEqual([(_result.delivery_tag, _result.ack) for _result in _results],
+                         [(3, True), (2, False), (1, True), (4, True)])
+        # handler latency is labeled by the function of every message wherever it is called
+        self.assertEqual({_label: _stats['count'] for (_label, _stats) in _server.get_latency()['handler'].items()},
+                         {'wait': 1, 'fail': 1, 'ping': 2})
+
+    def test_threaded_decoded_once(self):
+        _server = self.__threaded(prefetch_count=2)
+        _server._process_message(1, self.props, json.dumps(self.__msg('ping', 'a')))
+        self.assertIsNone(_server._local.decoded)
+        _server.event.set()
+        _loads = json.loads
+
+        # call decoded in the main loop is passed to the thread, function name set there is not seen by the main loop
+        with mock.patch('json.loads', side_effect=_loads) as _mock:
+            _server._process_message(2, self.props, json.dumps(self.__msg('wait', 'b')))
+            _server._process_message(3, self.props, json.dumps(self.__msg('fail', 'c')))
+            while _server._executor_pending():
+                _server._process_completed(0.1)
+            _server._process_completed()
+
+        # neither the main loop nor pool threads keep the last call decoded
+        self.assertIsNone(_server._local.decoded)
+        self.assertEqual({_server.executor.submit(getattr, _server._local, 'decoded', None).result()
+                          for _ in range(0, 4)}, {None})
+        _server.executor.shutdown()
+        self.assertEqual(_mock.call_count, 2)
+        self.assertEqual([_call[0:2] for _call in _server.called], [('ping', 'a'), ('wait', 'b')])
+        self.assertEqual(_server._local.function, 'ping')
+        _results = self.__results(_server)
+        self.assertEqual(sorted((_result.delivery_tag, _result.ack) for _result in _results),
+                         [(1, True), (2, True), (3, False)])
+
+    def test_threaded_by_default(self):
+        class _AllThreaded(TestClass):
+            threaded_by_default = True
+
+        _server = _AllThreaded()
+        _server.setup(threads=2)
+        self.assertTrue(_server.is_threaded('ping'))
+        _server._setup_thread_pool()
+        self.assertEqual(_server.executor._max_workers, 2)
+        _server.executor.shutdown()
+
+        # no pool if nothing is threaded
+        self.server._setup_thread_pool()
+        self.assertIsNone(self.server.executor)
@@ -0,0 +1,68 @@
+import unittest
+from oc_cdt_queue2.idempotency import IdempotencyCache
+import os
+import shutil
+import tempfile
+import time
+
+
+class IdempotencyCacheTest(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.mkdtemp()
+        self._path = os.path.join(self._tmp, 'keys.bin')
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp)
+
+    def test_wrong_size(self):
+        with self.assertRaises(ValueError):
+            IdempotencyCache(0)
+
+    def test_lru(self):
+        _cache = IdempotencyCache(3)
+        for _key in ['a', 'b', 'c']:
+            self.assertNotIn(_key, _cache)
+            _cache.add(_key)
+
+        # 'a' is touched, so 'b' is the least recently used one
+        self.assertIn('a', _cache)
+        _cache.add('d')
+        self.assertEqual(len(_cache), 3)
+        self.assertNotIn('b', _cache)
+
+        for _key in ['a', 'c', 'd']:
+            self.assertIn(_key, _cache)
+
+    def test_ttl(self):
+        _cache = IdempotencyCache(10, ttl=0.05)
+        _cache.add(b'key')
+        self.assertIn(b'key', _cache)
+        time.sleep(0.1)
+        self.assertNotIn(b'key', _cache)
+        self.assertEqual(len(_cache), 0)
+
+    def test_persistence(self):
+        _cache = IdempotencyCache(3, path=self._path)
+        for _key in ['a', 'b', 'c', 'd']:
+            _cache.add(_key)
+        _cache.close()
+
+        _cache = IdempotencyCache(3, path=self._path)
+        self.assertEqual(len(_cache), 3)
+        self.assertNotIn('a', _cache)
+
+        for _key in ['b', 'c', 'd']:
+            self.assertIn(_key, _cache)
+
+        # ring continues from where it was stopped: 'b' is the oldest one
+        _cache.add('e')
+        _cache.close()
+        _cache = IdempotencyCache(3, path=self._path)
+        self.assertNotIn('b', _cache)
+        self.assertIn('e', _cache)
+        _cache.close()
+
+        # file of other size is re-initialized
+        _cache = IdempotencyCache(5, path=self._path)
+        self.assertEqual(len(_cache), 0)
+        _cache.close()
@@ -0,0 +1,59 @@
+import unittest
+import subprocess
+import sys
+from oc_cdt_queue2 import importtime
+from oc_cdt_queue2.lazy import lazy_import
+from oc_cdt_queue2.lazy import LazyAttribute
+
+
+class LazyImportTest(unittest.TestCase):
+    def test_lazy_import_loaded(self):
+        self.assertIs(lazy_import('unittest'), unittest)
+
+    def test_lazy_import_missing(self):
+        with self.assertRaises(ImportError):
+            lazy_import('oc_cdt_queue2_no_such_module')
+
+    def test_lazy_attribute_override(self):
+        class _Base(object):
+            dumps = LazyAttribute('json', 'dumps')
+
+        class _Derived(_Base):
+            dumps = str
+
+        self.assertEqual(_Base().dumps([1]), '[1]')
+        self.assertIs(_Derived().dumps, str)
+        _base = _Base()
+        _base.dumps = repr
+        self.assertIs(_base.dumps, repr)
+
+
+class ImportTimeTest(unittest.TestCase):
+    # Producer-side modules must not load the heavy dependencies at import.
+    # Measured baseline for oc_cdt_queue2.queue_rpc: about 40 ms total and 6 ms in own modules,
+    # it was about 120 ms with pika loaded at import.
+    own_budget_ms = 50
+
+    def test_client_does_not_load_heavy_modules(self):
+        _check = ("import sys, oc_cdt_queue2.queue_rpc; "
+                  "print(' '.join(sorted(_m for _m in ['pika.connection', 'multiprocessing', 'argparse', 'uuid'] "
+                  "if _m in sys.modules)))")
+        _proc = subprocess.run([sys.executable, '-c', _check], stdout=subprocess.PIPE, universal_newlines=True,
+                               check=True)
+        self.assertEqual(_proc.stdout.strip(), '')
+
+    def test_own_import_time_budget(self):
+        _summary = importtime.summary(importtime.measure('oc_cdt_queue2.queue_rpc'))
+        self.assertIn('oc_cdt_queue2.queue_client', _summary['modules'])
+        self.assertNotIn('pika', _summary['dependencies'])
+        self.assertLess(_summary['own'] / 1000.0, self.own_budget_ms)
+
+    def test_summary(self):
+        _records = [('json', 2, 30, 30),
+                    ('oc_cdt_queue2.queue_base', 1, 10, 40),
+                    ('oc_cdt_queue2', 0, 5, 45),
+                    ('os', 0, 7, 7)]
+        _summary = importtime.summary(_records)
+        self.assertEqual(_summary['own'], 15)
+        self.assertEqual(_summary['total'], 52)
+        self.assertEqual(_summary['dependencies'], {'json': 30})
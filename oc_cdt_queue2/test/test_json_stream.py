@@ -0,0 +1,66 @@
+import unittest
+from oc_cdt_queue2.json_stream import JsonArrayStream
+from oc_cdt_queue2.json_stream import is_json_array
+from oc_cdt_queue2.json_stream import iter_json_array
+import json
+import tracemalloc
+
+
+class JsonStreamTest(unittest.TestCase):
+    def test_decode(self):
+        _documents = ['[]', ' [ ] ', '[1, 2.5e3, -3, 12345678901234567890, -0.5E-10]',
+                      '["a\\u00e9", "xé中", true, false, null, {"a": [1, {}]}, [[]], ""]']
+
+        # windows of any size, split numbers and multibyte characters included
+        for _document in _documents:
+            for _chunk_size in [1, 2, 3, 7, 65536]:
+                self.assertEqual(list(iter_json_array(_document.encode('utf-8'), _chunk_size)), json.loads(_document))
+                self.assertEqual(list(iter_json_array(_document, _chunk_size)), json.loads(_document))
+
+        self.assertEqual(list(iter_json_array(b'\xef\xbb\xbf[1]')), [1])
+        self.assertTrue(is_json_array(b'\n [1]'))
+        self.assertTrue(is_json_array(' [1]'))
+        self.assertFalse(is_json_array(b'{"a": [1]}'))
+
+        with self.assertRaises(ValueError):
+            JsonArrayStream(b'[]', chunk_size=0)
+
+    def test_nested(self):
+        _items = JsonArrayStream(b'["f", [1, [2], {"3": 4}], {"a": 1}]', chunk_size=3)
+        self.assertEqual(_items.next_value(), 'f')
+        self.assertEqual(list(_items.next_array()), [1, [2], {"3": 4}])
+        self.assertEqual(_items.next_value(), {"a": 1})
+        self.assertEqual(list(_items), list())
+
+        with self.assertRaises(ValueError):
+            _items.next_value()
+
+        _items = _items.reopen()
+        self.assertEqual(_items.next_value(), 'f')
+
+        with self.assertRaises(ValueError):
+            JsonArrayStream(b'["f", {"a": 1}]').next_array()
+
+        for _document in [b'', b'1', b'{}', b'[1,]', b'[,1]', b'[1 2]', b'[1', b'[1] 2', b'[tru]', b'["a]', b'["\xff"]']:
+            with self.assertRaises(ValueError):
+                list(iter_json_array(_document, 2))
+
+    def test_memory(self):
+        _body = json.dumps([{'id': _index, 'name': 'item %d' % _index, 'tags': ['a', 'b']}
+                            for _index in range(20000)]).encode('utf-8')
+        tracemalloc.start()
+
+        try:
+            json.loads(_body)
+            _loads = tracemalloc.get_traced_memory()[1]
+            # restarting resets the peak
+            tracemalloc.stop()
+            tracemalloc.start()
+            _count = sum(1 for _item in iter_json_array(_body))
+            _stream = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+        self.assertEqual(_count, 20000)
+        # a window and an element at a time, not all of them
+        self.assertLess(_stream * 10, _loads)
@@ -0,0 +1,73 @@
+import unittest
+from oc_cdt_queue2.keyed_executor import KeyedExecutor
+import concurrent.futures
+import threading
+import time
+
+
+class KeyedExecutorTest(unittest.TestCase):
+    def setUp(self):
+        self.executor = KeyedExecutor(concurrent.futures.ThreadPoolExecutor(8))
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    def test_order(self):
+        _done = list()
+        _running = dict()
+        _overlaps = list()
+
+        def _task(key, index):
+            _running[key] = _running.get(key, 0) + 1
+            _overlaps.append(_running[key])
+            time.sleep(0.001 * (index % 3))
+            _done.append((key, index))
+            _running[key] -= 1
+            return index
+
+        _futures = [self.executor.submit(_key, _task, _key, _index) for _index in range(0, 10) for _key in 'abc']
+        self.assertEqual([_future.result(5) for _future in _futures], [_index for _index in range(0, 10) for _key in 'abc'])
+
+        # tasks with the same key never run at once and finish in order
+        self.assertEqual(max(_overlaps), 1)
+        for _key in 'abc':
+            self.assertEqual([_index for (_k, _index) in _done if _k == _key], list(range(0, 10)))
+
+        self.assertEqual(self.executor.pending, 0)
+        self.assertEqual(self.executor.active_keys, 0)
+
+    def test_parallel_keys(self):
+        # task of one key waits for task of another key: possible only if they run in parallel
+        _event = threading.Event()
+        _first = self.executor.submit('a', _event.wait, 5)
+        _second = self.executor.submit('b', _event.set)
+        self.assertTrue(_first.result(5))
+        self.assertIsNone(_second.result(5))
+
+    def test_max_keys(self):
+        self.executor = KeyedExecutor(concurrent.futures.ThreadPoolExecutor(4), max_keys=2)
+        _event = threading.Event()
+        self.assertFalse(self.executor.full())
+        _futures = [self.executor.submit('a', _event.wait, 5), self.executor.submit(None, _event.wait, 5)]
+        self.assertTrue(self.executor.full())
+        self.assertTrue(self.executor.full('b'))
+        self.assertFalse(self.executor.full('a'))
+        _futures.append(self.executor.submit('a', _event.wait, 5))
+        self.assertEqual(self.executor.pending, 3)
+        self.assertEqual(self.executor.active_keys, 2)
+        _event.set()
+        concurrent.futures.wait(_futures, 5)
+        self.assertEqual(self.executor.pending, 0)
+        self.assertFalse(self.executor.full())
+
+    def test_exception(self):
+        def _fail():
+            raise ValueError("Test failure")
+
+        _failed = self.executor.submit('a', _fail)
+        _next = self.executor.submit('a', int, '7')
+        self.assertEqual(_next.result(5), 7)
+        self.assertIsInstance(_failed.exception(), ValueError)
+
+        with self.assertRaises(ValueError):
+            KeyedExecutor(None, max_keys=-1)
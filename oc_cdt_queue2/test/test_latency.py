@@ -0,0 +1,65 @@
+import unittest
+from oc_cdt_queue2.latency import Histogram
+from oc_cdt_queue2.latency import LatencyStats
+
+
+class HistogramTest(unittest.TestCase):
+    def test_percentiles(self):
+        _histogram = Histogram()
+        self.assertIsNone(_histogram.percentile(50))
+
+        for _ms in range(1, 1001):
+            _histogram.record(_ms / 1000.0)
+
+        self.assertEqual(_histogram.count, 1000)
+        self.assertAlmostEqual(_histogram.sum, 500.5)
+        self.assertEqual(_histogram.min, 0.001)
+        self.assertEqual(_histogram.max, 1.0)
+
+        # estimates are upper bounds of buckets: within 19% above the exact value
+        for (_percent, _exact) in [(50, 0.5), (90, 0.9), (99, 0.99)]:
+            self.assertGreaterEqual(_histogram.percentile(_percent), _exact)
+            self.assertLessEqual(_histogram.percentile(_percent), _exact * 1.19)
+
+        self.assertEqual(_histogram.percentile(100), 1.0)
+
+    def test_out_of_range(self):
+        _histogram = Histogram()
+        _histogram.record(-1)
+        _histogram.record(1000000)
+        self.assertEqual(_histogram.min, 0.0)
+        self.assertEqual(_histogram.percentile(1), Histogram.bounds[0])
+        self.assertEqual(_histogram.percentile(100), 1000000)
+        self.assertEqual(_histogram.as_dict()['buckets'], {Histogram.bounds[0]: 1, float('inf'): 1})
+
+    def test_merge(self):
+        _first = Histogram()
+        _second = Histogram()
+        _first.record(0.1)
+        _second.record(0.2)
+        _second.record(0.3)
+        _first.merge(_second)
+        _first.merge(Histogram())
+        self.assertEqual(_first.count, 3)
+        self.assertEqual((_first.min, _first.max), (0.1, 0.3))
+        self.assertAlmostEqual(_first.sum, 0.6)
+
+
+class LatencyStatsTest(unittest.TestCase):
+    def test_stats(self):
+        _stats = LatencyStats()
+        _stats.record('handler', 'ping', 0.01)
+        _stats.record('queue_wait', 'test.input', 0.5)
+        _stats.record('handler', 'ping', 0.03)
+        _snapshot = _stats.snapshot()
+        self.assertEqual(_snapshot['handler']['ping']['count'], 2)
+        self.assertEqual(_snapshot['queue_wait']['test.input']['max'], 0.5)
+
+        # stages are reported in processing order
+        _report = _stats.report()
+        self.assertEqual(len(_report), 2)
+        self.assertTrue(_report[0].startswith('queue_wait test.input: count 1'))
+        self.assertTrue(_report[1].startswith('handler ping: count 2 avg 0.020000'))
+
+        _stats.reset()
+        self.assertEqual(_stats.snapshot(), dict())
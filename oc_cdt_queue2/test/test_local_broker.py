@@ -0,0 +1,301 @@
+import unittest
+from oc_cdt_queue2.local_broker import LocalBroker
+from oc_cdt_queue2.queue_client import QueueClient
+from oc_cdt_queue2.queue_server import QueueServer
+from oc_cdt_queue2.queue_base import QueueBase
+import logging
+import pika
+import threading
+import time
+
+# to get rid of logging output from imported classes
+logging.getLogger().propagate = False
+logging.getLogger().disabled = True
+
+
+class LocalBrokerTest(unittest.TestCase):
+    def setUp(self):
+        self.broker = LocalBroker(port=0).start_thread()
+        self.connection = pika.BlockingConnection(pika.URLParameters(self.broker.url))
+        self.channel = self.connection.channel()
+
+    def tearDown(self):
+        if self.connection.is_open:
+            self.connection.close()
+
+        self.broker.stop_thread()
+
+    def _declare(self, queue, **arguments):
+        for (_method, _kwargs) in QueueBase.queue_topology(queue, **arguments):
+            getattr(self.channel, _method)(**_kwargs)
+
+    def _consume(self, queue, count, ack=True, channel=None):
+        _channel = channel or self.channel
+        _received = list()
+
+        for (_method, _properties, _body) in _channel.consume(queue, inactivity_timeout=2):
+            if _method is None:
+                break
+
+            _received.append((_method, _properties, _body))
+
+            if ack:
+                _channel.basic_ack(_method.delivery_tag)
+
+            if len(_received) == count:
+                break
+
+        _channel.cancel()
+        return _received
+
+    def test_priorities(self):
+        self._declare('test.input')
+        self.channel.confirm_delivery()
+
+        for (_body, _priority) in [(b'low', 0), (b'high', 3), (b'medium', 2), (b'above', 7), (b'low2', None)]:
+            self.channel.basic_publish('', 'test.input', _body, pika.BasicProperties(priority=_priority))
+
+        _declared = self.channel.queue_declare('test.input', passive=True)
+        self.assertEqual(_declared.method.message_count, 5)
+        # priority above the max is the max one
+        self.assertEqual([_body for (_method, _properties, _body) in self._consume('test.input', 5)],
+                         [b'high', b'above', b'medium', b'low', b'low2'])
+        self.assertEqual(self.broker.get_stats()['queues']['test.input'], {'messages': 0, 'consumers': 0, 'unacked': 0})
+
+    def test_declaration_errors(self):
+        self._declare('test.input')
+
+        # redeclaration with other arguments closes the channel
+        with self.assertRaises(pika.exceptions.ChannelClosedByBroker) as _error:
+            self.channel.queue_declare('test.input', durable=True)
+
+        self.assertEqual(_error.exception.reply_code, 406)
+        self.channel = self.connection.channel()
+
+        with self.assertRaises(pika.exceptions.ChannelClosedByBroker) as _error:
+            self.channel.queue_declare('test.missing', passive=True)
+
+        self.assertEqual(_error.exception.reply_code, 404)
+        # the connection is kept
+        self.channel = self.connection.channel()
+        self.assertEqual(self.channel.queue_declare('test.input', passive=True).method.message_count, 0)
+
+    def test_dead_lettering(self):
+        self._declare('test.input', retry_delays=[0.5])
+        self.channel.basic_publish('', 'test.input', b'rejected', pika.BasicProperties(headers={'key': 'value'}))
+        (_method, _properties, _body) = self._consume('test.input', 1, ack=False)[0]
+        self.channel.basic_nack(_method.delivery_tag, requeue=False)
+
+        (_method, _properties, _body) = self._consume('test.deads', 1)[0]
+        self.assertEqual(_body, b'rejected')
+        self.assertEqual(_properties.headers['key'], 'value')
+        self.assertEqual([(_death['queue'], _death['reason'], _death['count']) for _death in _properties.headers['x-death']],
+                         [('test.input', 'rejected', 1)])
+
+        # expired messages of the retry queue go back to the main one
+        self.channel.basic_publish('', 'test.input.retry.500', b'retried')
+        self.assertEqual(self.channel.queue_declare('test.input.retry.500', passive=True).method.message_count, 1)
+        (_method, _properties, _body) = self._consume('test.input', 1)[0]
+        self.assertEqual(_body, b'retried')
+        self.assertEqual(_properties.headers['x-death'][0]['reason'], 'expired')
+        self.assertEqual(self.broker.get_stats()['dead_lettered'], 2)
+
+    def test_prefetch_and_redelivery(self):
+        self._declare('test.input')
+
+        self.channel.confirm_delivery()
+
+        for _index in range(0, 5):
+            self.channel.basic_publish('', 'test.input', b'%d' % _index)
+
+        _channel = self.connection.channel()
+        _channel.basic_qos(prefetch_count=2)
+        _received = list()
+        _channel.basic_consume('test.input', lambda _ch, _method, _properties, _body: _received.append(_body))
+        _deadline = time.time() + 2
+
+        while len(_received) < 2 and time.time() < _deadline:
+            self.connection.process_data_events(0.05)
+
+        # no more than prefetch count is delivered until acknowledged
+        self.connection.process_data_events(0.2)
+        self.assertEqual(_received, [b'0', b'1'])
+        self.assertEqual(self.broker.get_stats()['queues']['test.input']['unacked'], 2)
+
+        # messages not acknowledged are redelivered when the channel is closed
+        _channel.close()
+        _redelivered = self._consume('test.input', 5)
+        self.assertEqual([_body for (_method, _properties, _body) in _redelivered], [b'0', b'1', b'2', b'3', b'4'])
+        self.assertEqual([_method.redelivered for (_method, _properties, _body) in _redelivered],
+                         [True, True, False, False, False])
+
+    def test_confirms_and_transactions(self):
+        self._declare('test.input')
+        self.channel.confirm_delivery()
+
+        with self.assertRaises(pika.exceptions.UnroutableError):
+            self.channel.basic_publish('', 'test.missing', b'lost', mandatory=True)
+
+        _channel = self.connection.channel()
+        _channel.tx_select()
+        _channel.basic_publish('', 'test.input', b'rolled back')
+        _channel.tx_rollback()
+        _channel.basic_publish('', 'test.input', b'committed')
+        self.assertEqual(self.channel.queue_declare('test.input', passive=True).method.message_count, 0)
+        _channel.tx_commit()
+        self.assertEqual([_body for (_method, _properties, _body) in self._consume('test.input', 2)], [b'committed'])
+
+    def test_topic_exchange(self):
+        self.channel.exchange_declare('test.topic', 'topic')
+        self.channel.confirm_delivery()
+
+        for (_queue, _key) in [('test.all', '#'), ('test.one', 'orders.*'), ('test.deep', 'orders.#.done')]:
+            self.channel.queue_declare(_queue)
+            self.channel.queue_bind(_queue, 'test.topic', _key)
+
+        for _key in ['orders.new', 'orders.eu.done', 'orders.done', 'users']:
+            self.channel.basic_publish('test.topic', _key, _key.encode())
+
+        _queues = self.broker.get_stats()['queues']
+        self.assertEqual(dict((_queue, _queues[_queue]['messages']) for _queue in ['test.all', 'test.one', 'test.deep']),
+                         {'test.all': 4, 'test.one': 2, 'test.deep': 2})
+
+
+class LocalBrokerApplicationTest(unittest.TestCase):
+    """
+    Client and server of this library with real pika connections
+    """
+
+    def setUp(self):
+        self.broker = LocalBroker(port=0).start_thread()
+
+    def tearDown(self):
+        self.broker.stop_thread()
+
+    def test_client_server(self):
+        class _Server(QueueServer):
+            received = list()
+
+            def on_message_raw(self, body, properties):
+                self.received.append(body)
+
+                if body == b'fail':
+                    raise ValueError("Test failure")
+
+                if len(self.received) == 4:
+                    self.stop()
+
+        _client = QueueClient()
+        _client.setup(self.broker.url, queue='test.input', queue_declare='yes')
+        _client.connect()
+
+        for _body in [b'first', b'fail', b'second', b'third']:
+            _client.send(_body)
+
+        _client.disconnect()
+
+        _server = _Server()
+        _server.setup(self.broker.url, queue='test.input', queue_declare='yes', prefetch_count=2)
+        _server._terminate_delay = 0.2
+        _server.connect()
+        _server.run()
+        self.assertEqual(_server.received, [b'first', b'fail', b'second', b'third'])
+        self.assertEqual((_server.counter_good, _server.counter_bad), (3, 1))
+
+        # failed message was rejected to dead messages queue, all the rest are acknowledged
+        _deadline = time.time() + 5
+
+        while self.broker.get_stats()['queues']['test.deads']['messages'] < 1 and time.time() < _deadline:
+            time.sleep(0.05)
+
+        _queues = self.broker.get_stats()['queues']
+        self.assertEqual(_queues['test.deads']['messages'], 1)
+        self.assertEqual((_queues['test.input']['messages'], _queues['test.input']['unacked']), (0, 0))
+
+    def test_retries(self):
+        class _Server(QueueServer):
+            received = list()
+            headers = list()
+
+            def on_message_raw(self, body, properties):
+                _retry = (properties.headers or dict()).get('x-retry-count')
+                self.received.append((body, _retry))
+                # publish bookkeeping of retries is not passed to handlers
+                self.headers.append(sorted(properties.headers or dict()))
+
+                if body == b'fail' and not _retry:
+                    raise ValueError("Test failure")
+
+        def _run(server):
+            server._terminate_delay = 0.2
+            server.connect()
+            # results of retry publishes are to be confirmed before stopping
+            threading.Timer(1, server.stop).start()
+            server.run()
+
+        _client = QueueClient()
+        _client.setup(self.broker.url, queue='test.input', queue_declare='yes')
+        _client.connect()
+        _client.send(b'first')
+        _client.send(b'fail')
+        _client.disconnect()
+
+        # retry queue is not declared: original message is rejected once its copy is returned
+        _server = _Server()
+        _server.setup(self.broker.url, queue='test.input', queue_declare='no', retry_delays=[0.1])
+        _run(_server)
+        self.assertEqual(_server.received, [(b'first', None), (b'fail', None)])
+        _queues = self.broker.get_stats()['queues']
+        self.assertEqual(_queues['test.deads']['messages'], 1)
+        self.assertEqual((_queues['test.input']['messages'], _queues['test.input']['unacked']), (0, 0))
+
+        # retry queue is declared: the copy comes back with retry count
+        _client.connect()
+        _client.send(b'fail')
+        _client.disconnect()
+        _Server.received = list()
+        _server = _Server()
+        _server.setup(self.broker.url, queue='test.input', queue_declare='yes', retry_delays=[0.1])
+        _run(_server)
+        self.assertEqual(_server.received, [(b'fail', None), (b'fail', 1)])
+        self.assertIn('x-retry-count', _server.headers[-1])
+        self.assertNotIn('x-retry-publish', _server.headers[-1])
+        _queues = self.broker.get_stats()['queues']
+        self.assertEqual(_queues['test.input.retry.100']['messages'], 0)
+        self.assertEqual((_queues['test.input']['messages'], _queues['test.input']['unacked']), (0, 0))
+
+    def test_batch_retries(self):
+        # successful messages of a batch are acked without the failed one waiting for its retry copy confirmed
+        class _Server(QueueServer):
+            received = list()
+
+            def on_batch(self, items):
+                for _item in items:
+                    _retry = (_item.properties.headers or dict()).get('x-retry-count')
+                    self.received.append((_item.body, _retry))
+
+                    if _item.body == b'fail' and not _retry:
+                        _item.fail(ValueError("Test failure"))
+
+        _client = QueueClient()
+        _client.setup(self.broker.url, queue='test.input', queue_declare='yes')
+        _client.connect()
+
+        for _body in [b'first', b'fail', b'second', b'third']:
+            _client.send(_body)
+
+        _client.disconnect()
+        _server = _Server()
+        _server.setup(self.broker.url, queue='test.input', queue_declare='yes', retry_delays=[0.1], batch_size=3,
+                      batch_timeout=0.2)
+        _server._terminate_delay = 0.2
+        _server.connect()
+        threading.Timer(1.5, _server.stop).start()
+        _server.run()
+
+        self.assertEqual(_server.received[0:4], [(b'first', None), (b'fail', None), (b'second', None), (b'third', None)])
+        self.assertEqual(_server.received[4:], [(b'fail', 1)])
+        _queues = self.broker.get_stats()['queues']
+        self.assertEqual(_queues['test.deads']['messages'], 0)
+        self.assertEqual(_queues['test.input.retry.100']['messages'], 0)
+        self.assertEqual((_queues['test.input']['messages'], _queues['test.input']['unacked']), (0, 0))
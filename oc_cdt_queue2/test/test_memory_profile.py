@@ -0,0 +1,67 @@
+import unittest
+from oc_cdt_queue2.memory_profile import MemoryProfiler
+import os
+import signal
+import tracemalloc
+
+
+class MemoryProfilerTest(unittest.TestCase):
+    def setUp(self):
+        self.leak = list()
+
+    def test_sampling(self):
+        _profiler = MemoryProfiler(sample=3, top=2)
+
+        for _i in range(0, 6):
+            _state = _profiler.begin()
+            self.assertEqual(_state is not None, _i in (2, 5))
+            self.leak.append(bytearray(100000))
+            _profiler.end(_state, 'leaky')
+            self.assertFalse(tracemalloc.is_tracing())
+
+        (_samples, _retained, _sites) = _profiler._stats.get('leaky')
+        self.assertEqual(_samples, 2)
+        self.assertGreaterEqual(_retained, 200000)
+        self.assertTrue(any('test_memory_profile.py' in _site for _site in _sites))
+        self.assertLessEqual(len(_sites), 20)
+        _report = _profiler.report()
+        self.assertIn('leaky: 2 samples', _report)
+
+    def test_traced_already(self):
+        tracemalloc.start()
+        self.addCleanup(tracemalloc.stop)
+        _profiler = MemoryProfiler(sample=1)
+        _state = _profiler.begin()
+        self.leak.append(bytearray(100000))
+        _profiler.end(_state, 'leaky')
+        self.assertTrue(tracemalloc.is_tracing())
+        self.assertGreaterEqual(_profiler._stats.get('leaky')[1], 100000)
+
+    def test_rss(self):
+        _profiler = MemoryProfiler(sample=1, method='rss')
+        _state = _profiler.begin()
+        _profiler.end(_state, 'any')
+        self.assertEqual(_profiler._stats.get('any')[0], 1)
+        self.assertEqual(_profiler._stats.get('any')[2], dict())
+
+    def test_report_due(self):
+        _profiler = MemoryProfiler(sample=10, report_every=2)
+        self.assertFalse(_profiler.report_due())
+        _profiler.end(_profiler.begin(), 'key')
+        _profiler.end(_profiler.begin(), 'key')
+        self.assertTrue(_profiler.report_due())
+        _profiler.report()
+        self.assertFalse(_profiler.report_due())
+
+        _profiler = MemoryProfiler(sample=10, report_signal=signal.SIGUSR1)
+        self.addCleanup(signal.signal, signal.SIGUSR1, signal.SIG_DFL)
+        self.assertFalse(_profiler.report_due())
+        os.kill(os.getpid(), signal.SIGUSR1)
+        self.assertTrue(_profiler.report_due())
+
+    def test_wrong_args(self):
+        with self.assertRaises(ValueError):
+            MemoryProfiler(sample=0)
+
+        with self.assertRaises(ValueError):
+            MemoryProfiler(method='valgrind')
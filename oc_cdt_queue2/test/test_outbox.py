@@ -0,0 +1,117 @@
+import unittest
+from oc_cdt_queue2.outbox import Outbox
+from oc_cdt_queue2.outbox import OutboxFull
+import os
+import shutil
+import tempfile
+import threading
+
+
+class OutboxTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.outbox = None
+
+    def tearDown(self):
+        if self.outbox is not None:
+            self.outbox.close()
+
+        shutil.rmtree(self.path)
+
+    def open(self, **kwargs):
+        if self.outbox is not None:
+            self.outbox.close()
+
+        kwargs.setdefault('segment_size', 64)
+        kwargs.setdefault('max_size', 1024)
+        self.outbox = Outbox(os.path.join(self.path, 'outbox'), **kwargs)
+        return self.outbox
+
+    def segments(self):
+        return sorted(_name for _name in os.listdir(os.path.join(self.path, 'outbox')) if _name.endswith('.seg'))
+
+    def test_append_read_commit(self):
+        _outbox = self.open()
+
+        for _i in range(0, 10):
+            _outbox.append(b'record %d' % _i)
+
+        # 8 bytes header + 8 bytes record: 4 records per 64 bytes segment
+        self.assertEqual(len(self.segments()), 3)
+        self.assertEqual(len(_outbox), 10)
+        self.assertEqual(_outbox.size, 3 * 64)
+
+        _records = _outbox.read(6)
+        self.assertEqual([_payload for (_position, _payload) in _records], [b'record %d' % _i for _i in range(0, 6)])
+
+        # records are read again after rewind
+        _outbox.rewind()
+        self.assertEqual(_outbox.read(1)[0][1], b'record 0')
+        _outbox.commit(_records[4][0])
+        self.assertEqual(len(_outbox), 5)
+        # the first segment is removed as soon as all its records are committed
+        self.assertEqual(len(self.segments()), 2)
+        self.assertEqual([_payload for (_position, _payload) in _outbox.read(10)],
+                         [b'record %d' % _i for _i in range(5, 10)])
+        self.assertEqual(_outbox.read(10, timeout=0), [])
+
+    def test_restart(self):
+        _outbox = self.open()
+
+        for _i in range(0, 6):
+            _outbox.append(b'record %d' % _i)
+
+        _records = _outbox.read(3)
+        _outbox.commit(_records[-1][0])
+
+        # not committed records are kept
+        _outbox = self.open()
+        self.assertEqual(len(_outbox), 3)
+        self.assertEqual([_payload for (_position, _payload) in _outbox.read(10)],
+                         [b'record %d' % _i for _i in range(3, 6)])
+        _outbox.append(b'record 6')
+        self.assertEqual(_outbox.read(10)[0][1], b'record 6')
+
+    def test_torn_write(self):
+        _outbox = self.open()
+        _outbox.append(b'record 0')
+        _outbox.append(b'record 1')
+        _outbox.close()
+        self.outbox = None
+
+        # process was killed while writing the second record
+        with open(os.path.join(self.path, 'outbox', self.segments()[0]), 'r+b') as _file:
+            _file.seek(16 + 8)
+            _file.write(b'broken')
+
+        _outbox = self.open()
+        self.assertEqual(len(_outbox), 1)
+        _outbox.append(b'record 2')
+        self.assertEqual([_payload for (_position, _payload) in _outbox.read(10)], [b'record 0', b'record 2'])
+
+    def test_full(self):
+        _outbox = self.open(max_size=128)
+        # record larger than segment gets its own segment
+        _outbox.append(b'x' * 100)
+        self.assertEqual(_outbox.size, 108)
+
+        with self.assertRaises(OutboxFull):
+            _outbox.append(b'record')
+
+        _outbox.commit(_outbox.read(1)[0][0])
+        _outbox.append(b'record')
+        self.assertEqual(_outbox.size, 64)
+
+    def test_locked(self):
+        self.open()
+
+        with self.assertRaises(OSError):
+            Outbox(os.path.join(self.path, 'outbox'), segment_size=64)
+
+    def test_wait(self):
+        _outbox = self.open()
+        _timer = threading.Timer(0.05, _outbox.append, args=(b'record', ))
+        _timer.start()
+        self.assertEqual(_outbox.read(10, timeout=5)[0][1], b'record')
+        _timer.join()
+        self.assertFalse(_outbox.wait_empty(0.01))
@@ -1,5 +1,8 @@
 import unittest
 from oc_cdt_queue2.queue_rpc import QueueRPC
+from oc_cdt_queue2.rpc_schema import Arg
+from oc_cdt_queue2.rpc_schema import InvalidCall
+from oc_cdt_queue2.rpc_schema import RpcSchema
 
 
 class _TestClass(QueueRPC):
@@ -7,10 +10,12 @@ class _TestClass(QueueRPC):
         super(_TestClass, self).__init__(*args, **kwargs)
         self.published = ['ping', 'methodA', 'methodB']
         self.msg_buffer = list()
+        self.partition_keys = list()
 
     # replace 'send' method to collect messages
-    def send(self, body):
+    def send(self, body, partition_key=None):
         self.msg_buffer.append(body)
+        self.partition_keys.append(partition_key)
 
 
 class _ConnectionMock(object):
@@ -41,3 +46,51 @@ class QueueRpcTest(unittest.TestCase):
         self.assertEqual(_client.msg_buffer.pop(), ['methodB', (), {'arg1': 1}])
         self.assertEqual(_client.msg_buffer.pop(), ['methodA', ('arg1',), {'arg2': 2}])
         self.assertEqual(_client.msg_buffer.pop(), ['ping', (), {}])
+
+    def test_partition_argument(self):
+        _client = _TestClass()
+        _client.partition_argument = 'arg1'
+        _client.connection = _ConnectionMock()
+        _client.channel = _ChannelMock()
+        _client.methodA('arg1', arg2=2)
+        _client.methodB(arg1='key')
+        self.assertEqual(_client.partition_keys, [None, 'key'])
+
+    def test_keywords_allowed(self):
+        _client = _TestClass()
+        _client.published = {'ping': ['msg1', 'msg2'], 'methodA': None}
+        _client.connection = _ConnectionMock()
+        _client.channel = _ChannelMock()
+        _client.ping('any', msg1=1)
+        _client.methodA(anything=1)
+
+        with self.assertRaises(TypeError):
+            _client.ping(msg3=3)
+
+        self.assertEqual(_client.msg_buffer, [['ping', ('any',), {'msg1': 1}], ['methodA', (), {'anything': 1}]])
+        # compiled once for the instance, again when replaced
+        _schema = _client._schema()
+        self.assertIs(_client._schema(), _schema)
+        _client.published = {'ping': ['msg3']}
+        self.assertIsNot(_client._schema(), _schema)
+        _client.ping(msg3=3)
+        self.assertIsNone(_TestClass._published_schema)
+
+    def test_schema(self):
+        _client = _TestClass()
+        _client.published = RpcSchema({'build': [Arg('version', str, required=True, max_length=16),
+                                                 Arg('files', list, items=Arg(type=str))]})
+        _client.connection = _ConnectionMock()
+        _client.channel = _ChannelMock()
+        _client.build('1.0', files=['a', 'b'])
+
+        # invalid calls are not published
+        for (_arguments, _parameters) in [((), {'files': []}), (('1.0', ['a', 1]), {}), (('1.0',), {'other': 1}),
+                                          (('1' * 17,), {})]:
+            with self.assertRaises(InvalidCall):
+                _client.build(*_arguments, **_parameters)
+
+        with self.assertRaises(AttributeError):
+            _client.ping()
+
+        self.assertEqual(_client.msg_buffer, [['build', ('1.0',), {'files': ['a', 'b']}]])
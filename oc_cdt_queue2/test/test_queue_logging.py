@@ -0,0 +1,71 @@
+import unittest
+from unittest import mock
+from oc_cdt_queue2.queue_logging import truncate_body
+from oc_cdt_queue2.queue_logging import ExceptionLogLimiter
+from oc_cdt_queue2.queue_logging import QueueLogging
+import logging
+import logging.handlers
+import time
+
+
+class _ListHandler(logging.Handler):
+    def __init__(self):
+        super(_ListHandler, self).__init__()
+        self.records = list()
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class QueueLoggingTest(unittest.TestCase):
+    def test_truncate_body(self):
+        self.assertEqual(truncate_body(b'123456', 0), b'123456')
+        self.assertEqual(truncate_body(b'123456', 6), b'123456')
+        self.assertEqual(truncate_body(b'123456', 3), "b'123'... (6 total)")
+        self.assertIsNone(truncate_body(None, 3))
+
+    def test_exceptions_no_limit(self):
+        _limiter = ExceptionLogLimiter()
+        with mock.patch('logging.exception') as _exception:
+            for _i in range(0, 3):
+                _limiter.exception(ValueError('test'))
+        self.assertEqual(_exception.call_count, 3)
+
+    def test_exceptions_limit(self):
+        _limiter = ExceptionLogLimiter(0.1)
+        with mock.patch('logging.exception') as _exception, mock.patch('logging.error') as _error:
+            for _i in range(0, 5):
+                _limiter.exception(ValueError('test'))
+            _limiter.exception(KeyError('other'))
+            self.assertEqual(_exception.call_count, 2)
+            self.assertEqual(_error.call_count, 0)
+
+            # summary for repeated ones is logged when interval is over
+            time.sleep(0.15)
+            _limiter.exception(ValueError('test'))
+            self.assertEqual(_exception.call_count, 3)
+            self.assertEqual(_error.call_count, 1)
+            self.assertEqual(_error.call_args[0][3], 4)
+
+    def test_queue_logging(self):
+        _root = logging.getLogger()
+        _disabled = _root.disabled
+        _level = _root.level
+        _handler = _ListHandler()
+        _root.addHandler(_handler)
+        _root.disabled = False
+        _root.setLevel(logging.INFO)
+
+        try:
+            _logging = QueueLogging().start()
+            self.assertNotIn(_handler, _root.handlers)
+            self.assertTrue(any(isinstance(_h, logging.handlers.QueueHandler) for _h in _root.handlers))
+            logging.info("Test record %d", 1)
+            _logging.stop()
+        finally:
+            _root.disabled = _disabled
+            _root.setLevel(_level)
+            _root.removeHandler(_handler)
+
+        self.assertEqual([_record.getMessage() for _record in _handler.records], ["Test record 1"])
+        self.assertFalse(any(isinstance(_h, logging.handlers.QueueHandler) for _h in _root.handlers))
@@ -0,0 +1,93 @@
+import json
+import unittest
+import urllib.error
+import urllib.request
+from oc_cdt_queue2.queue_metrics import QueueBacklog
+from oc_cdt_queue2.queue_metrics import MetricsServer
+
+
+class QueueBacklogTest(unittest.TestCase):
+    def test_drain_rate(self):
+        _backlog = QueueBacklog(smoothing=0.5)
+        _backlog.update('test.input', 100, 2, 1000.0)
+        _queue = _backlog.snapshot()['test.input']
+        self.assertEqual((_queue['messages'], _queue['consumers'], _queue['probed']), (100, 2, 1000.0))
+        # rate is not known until the second probe
+        self.assertIsNone(_queue['drain_rate'])
+        self.assertIsNone(_queue['time_to_empty'])
+
+        _backlog.update('test.input', 80, 2, 1010.0)
+        _queue = _backlog.snapshot()['test.input']
+        self.assertAlmostEqual(_queue['drain_rate'], 2.0)
+        self.assertAlmostEqual(_queue['time_to_empty'], 40.0)
+
+        # the rate is smoothed
+        _backlog.update('test.input', 80, 3, 1020.0)
+        _queue = _backlog.snapshot()['test.input']
+        self.assertAlmostEqual(_queue['drain_rate'], 1.0)
+        self.assertAlmostEqual(_queue['time_to_empty'], 80.0)
+        self.assertEqual(_queue['consumers'], 3)
+
+        # out of order probe is ignored
+        _backlog.update('test.input', 0, 3, 1015.0)
+        self.assertEqual(_backlog.snapshot()['test.input']['messages'], 80)
+
+        # growing queue is never drained, empty one is drained already
+        _backlog.update('test.input', 200, 3, 1030.0)
+        self.assertLess(_backlog.snapshot()['test.input']['drain_rate'], 0)
+        self.assertEqual(_backlog.snapshot()['test.input']['time_to_empty'], float('inf'))
+        _backlog.update('test.input.p1', 0, 1, 1030.0)
+        self.assertEqual(_backlog.snapshot()['test.input.p1']['time_to_empty'], 0.0)
+
+    def test_smoothing(self):
+        with self.assertRaises(ValueError):
+            QueueBacklog(smoothing=0)
+
+
+class MetricsServerTest(unittest.TestCase):
+    def setUp(self):
+        self._backlog = QueueBacklog()
+        self._backlog.update('test.input', 10, 1, 1000.0)
+        self._backlog.update('test.input', 20, 1, 1010.0)
+        self._backlog.update('test "odd"', 5, 0, 1010.0)
+        self._metrics = {'backlog': self._backlog.snapshot(),
+                         'stats': {'messages': 7, 'consuming_paused': False, 'name': 'skipped'},
+                         'latency': {}}
+
+    def test_prometheus_text(self):
+        _lines = MetricsServer.prometheus_text(self._metrics).splitlines()
+        self.assertIn('# TYPE cdtqueue_queue_messages gauge', _lines)
+        self.assertIn('cdtqueue_queue_messages{queue="test.input"} 20.0', _lines)
+        self.assertIn('cdtqueue_queue_messages{queue="test \\"odd\\""} 5.0', _lines)
+        self.assertIn('cdtqueue_queue_drain_rate{queue="test.input"} -1.0', _lines)
+        self.assertIn('cdtqueue_queue_time_to_empty_seconds{queue="test.input"} +Inf', _lines)
+        # unknown values are skipped
+        self.assertFalse([_line for _line in _lines if _line.startswith('cdtqueue_queue_drain_rate{queue="test \\"odd')])
+        self.assertIn('cdtqueue_messages 7.0', _lines)
+        self.assertIn('cdtqueue_consuming_paused 0.0', _lines)
+        self.assertFalse([_line for _line in _lines if 'name' in _line])
+
+    def test_serve(self):
+        _server = MetricsServer(lambda: self._metrics, 0, host='127.0.0.1').start()
+
+        try:
+            _url = 'http://127.0.0.1:%d' % _server.port
+
+            with urllib.request.urlopen(_url + '/metrics', timeout=5) as _response:
+                self.assertTrue(_response.headers['Content-Type'].startswith('text/plain'))
+                self.assertIn(b'cdtqueue_queue_messages{queue="test.input"} 20.0', _response.read())
+
+            with urllib.request.urlopen(_url + '/metrics.json', timeout=5) as _response:
+                _metrics = json.loads(_response.read().decode('utf-8'))
+
+            self.assertEqual(_metrics['backlog']['test.input']['messages'], 20)
+            self.assertEqual(_metrics['backlog']['test.input']['time_to_empty'], '+Inf')
+            self.assertEqual(_metrics['stats']['messages'], 7)
+
+            with self.assertRaises(urllib.error.HTTPError) as _error:
+                urllib.request.urlopen(_url + '/other', timeout=5)
+
+            self.assertEqual(_error.exception.code, 404)
+            _error.exception.close()
+        finally:
+            _server.stop()
@@ -0,0 +1,105 @@
+import unittest
+from oc_cdt_queue2.rate_limit import RateLimiter
+from oc_cdt_queue2.rate_limit import RateLimited
+import threading
+import time
+
+
+class _Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = list()
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+class RateLimiterTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = _Clock()
+
+    def limiter(self, *args, **kwargs):
+        _limiter = RateLimiter.__new__(RateLimiter)
+        _limiter._clock = self.clock
+        _limiter._sleep = self.clock.sleep
+        _limiter.__init__(*args, **kwargs)
+        return _limiter
+
+    def test_messages_rate(self):
+        _limiter = self.limiter(messages_rate=10, burst=0.5)
+
+        # burst passes at once, then messages are spread at the rate
+        self.assertEqual([_limiter.acquire() for _i in range(0, 5)], [0] * 5)
+        self.assertAlmostEqual(_limiter.acquire(), 0.1)
+        self.assertAlmostEqual(_limiter.acquire(), 0.1)
+        self.clock.now += 1
+        self.assertEqual([_limiter.acquire() for _i in range(0, 5)], [0] * 5)
+        self.assertAlmostEqual(_limiter.acquire(), 0.1)
+        self.assertEqual(_limiter.counter_throttled, 3)
+        self.assertAlmostEqual(_limiter.throttled_time, 0.3)
+
+    def test_reserve_concurrent(self):
+        _limiter = self.limiter(messages_rate=10, burst=0.1)
+        self.assertEqual(_limiter.reserve(), 0)
+        # waiting time is reserved for each sender in turn without sleeping
+        self.assertEqual([round(_limiter.reserve(), 3) for _i in range(0, 3)], [0.1, 0.2, 0.3])
+        self.assertEqual(self.clock.slept, [])
+
+    def test_bytes_rate(self):
+        _limiter = self.limiter(bytes_rate=1000)
+        self.assertEqual(_limiter.acquire(600), 0)
+        self.assertAlmostEqual(_limiter.acquire(600), 0.2)
+        # a message larger than the bucket waits for it to be full only
+        self.assertAlmostEqual(_limiter.acquire(5000), 1.0)
+        self.assertAlmostEqual(_limiter.acquire(100), 4.1)
+
+    def test_raise(self):
+        _limiter = self.limiter(messages_rate=1, bytes_rate=100)
+        _limiter.acquire(10, block=False)
+
+        with self.assertRaises(RateLimited):
+            _limiter.acquire(10, block=False)
+
+        # tokens are not taken by rejected message
+        self.clock.now += 1
+        self.assertEqual(_limiter.acquire(100, block=False), 0)
+        self.assertEqual(_limiter.get_stats(), {'throttled': 0, 'rejected': 1, 'throttled_time': 0.0})
+
+    def test_shared(self):
+        _limiter = RateLimiter.shared('test_shared', messages_rate=5)
+        self.assertIs(RateLimiter.shared('test_shared', messages_rate=5), _limiter)
+        self.assertIsNot(RateLimiter.shared('test_shared_other', messages_rate=5), _limiter)
+
+        with self.assertRaises(ValueError):
+            RateLimiter.shared('test_shared', messages_rate=10)
+
+    def test_threads(self):
+        _limiter = RateLimiter(messages_rate=200, burst=0.05)
+        _waits = list()
+
+        def _send():
+            for _i in range(0, 10):
+                _waits.append(_limiter.acquire())
+
+        _started = time.monotonic()
+        _threads = [threading.Thread(target=_send) for _i in range(0, 4)]
+        for _thread in _threads:
+            _thread.start()
+        for _thread in _threads:
+            _thread.join()
+
+        # 40 messages at 200/s with 10 passed at once take 0.15s at least
+        self.assertEqual(len(_waits), 40)
+        self.assertGreaterEqual(time.monotonic() - _started, 0.14)
+        self.assertEqual(_limiter.counter_throttled, len([_wait for _wait in _waits if _wait]))
+
+    def test_wrong_limits(self):
+        with self.assertRaises(ValueError):
+            RateLimiter(messages_rate=-1)
+
+        with self.assertRaises(ValueError):
+            RateLimiter(messages_rate=1, burst=0)
@@ -0,0 +1,147 @@
+import unittest
+from oc_cdt_queue2.replay import QueueReplay
+import argparse
+import logging
+import pika
+
+# to get rid of logging output from imported classes
+logging.getLogger().propagate = False
+logging.getLogger().disabled = True
+
+
+class _MockMethod(object):
+    def __init__(self, delivery_tag=None, message_count=None):
+        self.delivery_tag = delivery_tag
+        self.message_count = message_count
+
+
+class _MockFrame(object):
+    def __init__(self, method):
+        self.method = method
+
+
+class _ChannelMock(object):
+    def __init__(self, messages):
+        # list of (properties, body) in the source queue
+        self.source = list(messages)
+        self.published = list()
+        self.calls = list()
+        self.acked = list()
+        self.pending = list()
+        self.committed = list()
+
+    def queue_declare(self, queue, passive=False, durable=False, arguments=None):
+        self.calls.append('queue_declare')
+        return _MockFrame(_MockMethod(message_count=len(self.source)))
+
+    def basic_qos(self, prefetch_count):
+        self.calls.append('basic_qos')
+        self.prefetch_count = prefetch_count
+
+    def tx_select(self):
+        self.calls.append('tx_select')
+
+    def tx_commit(self):
+        self.calls.append('tx_commit')
+        self.committed.append(list(self.pending))
+        self.pending = list()
+
+    def consume(self, queue, inactivity_timeout=None):
+        self.consumed_from = queue
+        _tag = 0
+        while self.source:
+            _tag += 1
+            (_properties, _body) = self.source.pop(0)
+            yield (_MockMethod(delivery_tag=_tag), _properties, _body)
+        yield (None, None, None)
+
+    def basic_publish(self, exchange, routing_key, body, properties):
+        self.pending.append({'exchange': exchange, 'routing_key': routing_key, 'body': body})
+        self.published.append(self.pending[-1])
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        self.acked.append((delivery_tag, multiple))
+
+    def cancel(self):
+        self.calls.append('cancel')
+        return 0
+
+
+class _ConnectionMock(object):
+    channel_messages = list()
+
+    def __init__(self, params):
+        self.is_open = True
+        self._channel = _ChannelMock(self.channel_messages)
+
+    def channel(self):
+        return self._channel
+
+    def close(self):
+        self.is_open = False
+
+
+def _props(deaths=None, **headers):
+    if deaths is not None:
+        headers['x-death'] = [{'count': deaths, 'queue': 'test.input', 'reason': 'rejected'}]
+    return pika.BasicProperties(headers=headers)
+
+
+class QueueReplayTest(unittest.TestCase):
+    def setUp(self):
+        self.replay = QueueReplay()
+        self.replay._Connection = _ConnectionMock
+
+    def test_setup_from_args(self):
+        parser = argparse.ArgumentParser(description='test parser')
+        self.replay.basic_args(parser)
+        args = parser.parse_args(['--amqp-url', 'amqp://127.0.0.1', '--queue', 'test.input', '--batch-size', '7',
+                                  '--max-deaths', '3', '--header', 'x-source=cdt', '--routing-key', 'test.other'])
+        self.replay.setup_from_args(args)
+        self.assertEqual(self.replay.batch_size, 7)
+        self.assertEqual(self.replay.max_deaths, 3)
+        self.assertIsNone(self.replay.min_deaths)
+        self.assertEqual(self.replay.headers_filter, {'x-source': 'cdt'})
+        self.assertEqual(self.replay.routing_key, 'test.other')
+        self.assertEqual(self.replay.queue, 'test.input')
+
+    def test_accept(self):
+        self.replay.setup(max_deaths=2, headers_filter={'x-source': 'cdt'})
+        self.assertEqual(self.replay.deaths_count(_props(3)), 3)
+        self.assertEqual(self.replay.deaths_count(_props()), 0)
+        self.assertTrue(self.replay.accept(_props(2, **{'x-source': b'cdt'})))
+        self.assertFalse(self.replay.accept(_props(3, **{'x-source': 'cdt'})))
+        self.assertFalse(self.replay.accept(_props(1, **{'x-source': 'other'})))
+        self.assertFalse(self.replay.accept(_props(1)))
+
+    def test_replay_batches(self):
+        _ConnectionMock.channel_messages = [(_props(1), 'body_%d' % _i) for _i in range(0, 5)]
+        self.replay.setup('amqp://127.0.0.1', queue='test.input', batch_size=2)
+        self.assertEqual(self.replay.replay(), {'replayed': 5, 'skipped': 0})
+        _chan = self.replay.channel
+        self.assertEqual(_chan.consumed_from, 'test.deads')
+        self.assertEqual(_chan.prefetch_count, 2)
+
+        # three transactions: 2 + 2 + 1, and the last one after consumer cancel
+        self.assertEqual([len(_tx) for _tx in _chan.committed], [2, 2, 1, 0])
+        self.assertEqual(_chan.acked, [(2, True), (4, True), (5, True)])
+        self.assertEqual([_msg['body'] for _msg in _chan.published], ['body_%d' % _i for _i in range(0, 5)])
+        self.assertTrue(all(_msg['routing_key'] == 'test.input' for _msg in _chan.published))
+        self.assertEqual(_chan.calls[-2:], ['cancel', 'tx_commit'])
+
+    def test_replay_filter_and_limit(self):
+        _ConnectionMock.channel_messages = [(_props(_i), 'body_%d' % _i) for _i in range(0, 6)]
+        self.replay.setup('amqp://127.0.0.1', queue='test.input', batch_size=10, limit=4, min_deaths=2)
+        self.assertEqual(self.replay.replay(), {'replayed': 2, 'skipped': 2})
+        _chan = self.replay.channel
+        self.assertEqual(_chan.acked, [(4, True)])
+        # messages rejected by filter are put back to the source queue
+        self.assertEqual([(_msg['routing_key'], _msg['body']) for _msg in _chan.published],
+                         [('test.deads', 'body_0'), ('test.deads', 'body_1'),
+                          ('test.input', 'body_2'), ('test.input', 'body_3')])
+
+    def test_replay_empty(self):
+        _ConnectionMock.channel_messages = list()
+        self.replay.setup('amqp://127.0.0.1', queue='test.input')
+        self.assertEqual(self.replay.replay(), {'replayed': 0, 'skipped': 0})
+        self.assertNotIn('tx_select', self.replay.channel.calls)
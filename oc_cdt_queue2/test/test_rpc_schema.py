@@ -0,0 +1,70 @@
+import unittest
+from oc_cdt_queue2.rpc_schema import Arg
+from oc_cdt_queue2.rpc_schema import InvalidCall
+from oc_cdt_queue2.rpc_schema import RpcSchema
+from oc_cdt_queue2.rpc_schema import compile_published
+
+
+class RpcSchemaTest(unittest.TestCase):
+    def setUp(self):
+        self.schema = RpcSchema({
+            'ping': None,
+            'legacy': ['msg1', 'msg2'],
+            'build': [Arg('version', str, required=True, max_length=8),
+                      Arg('count', int, min=1, max=10),
+                      Arg('ratio', float, nullable=True),
+                      Arg('mode', choices=['fast', 'full']),
+                      Arg('files', list, max_length=3, items=Arg(type=str, max_length=5)),
+                      Arg('options', dict)]})
+
+    def test_valid(self):
+        for (_arguments, _parameters) in [(['1.0'], {}),
+                                          (['1.0', 10], {'ratio': None, 'mode': 'full'}),
+                                          ([], {'version': '1.0', 'ratio': 1, 'files': ('a', 'b')}),
+                                          (['1.0', 1, 0.5, 'fast', ['a'], {'key': 'value'}], {})]:
+            self.schema.validate('build', _arguments, _parameters)
+
+        # methods without schema accept anything
+        self.schema.validate('ping', [1, 2], {'any': 'thing'})
+        self.schema.validate('unknown', [1], {})
+        self.assertIn('build', self.schema)
+        self.assertEqual(sorted(self.schema), ['build', 'legacy', 'ping'])
+
+    def test_invalid(self):
+        for (_arguments, _parameters, _error) in [
+                ([], {}, "build() missing required argument 'version'"),
+                ([1], {}, "build() argument 'version' should be str, not int"),
+                (['1.0'], {'count': True}, "build() argument 'count' should be int, not bool"),
+                (['1.0'], {'count': 11}, "build() argument 'count' is out of range [1, 10]: 11"),
+                (['1.0.0.0.0'], {}, "build() argument 'version' is longer than 8: 9"),
+                (['1.0'], {'ratio': '0.5'}, "build() argument 'ratio' should be float/int, not str"),
+                (['1.0'], {'mode': 'slow'}, "build() argument 'mode' is not one of allowed values: 'slow'"),
+                (['1.0'], {'mode': ['fast']}, "build() argument 'mode' is not one of allowed values: ['fast']"),
+                (['1.0'], {'files': ['a', 'b', 'c', 'd']}, "build() argument 'files' is longer than 3: 4"),
+                (['1.0'], {'files': ['a', 'bbbbbb']}, "build() argument 'files' item is longer than 5: 6"),
+                (['1.0'], {'files': ['a', None]}, "build() argument 'files' item should be str, not NoneType"),
+                (['1.0'], {'options': None}, "build() argument 'options' should be dict, not NoneType"),
+                (['1.0'], {'version': '2.0'}, "build() got multiple values for argument 'version'"),
+                (['1.0'], {'other': 1}, "build() got an unexpected keyword argument 'other'"),
+                (['1.0', 1, 0.5, 'fast', [], {}, 7], {}, "build() takes at most 6 positional arguments, 7 given"),
+                ([], {'msg3': 1}, "legacy() got an unexpected keyword argument 'msg3'")]:
+            with self.assertRaises(InvalidCall) as _error_raised:
+                self.schema.validate('legacy' if 'msg3' in _parameters else 'build', _arguments, _parameters)
+
+            self.assertEqual(str(_error_raised.exception), _error)
+
+        # legacy schema checks keyword names only
+        self.schema.validate('legacy', [1, 2, 3], {'msg1': None})
+        # invalid call is a TypeError as for Python calls
+        self.assertTrue(issubclass(InvalidCall, TypeError))
+
+    def test_compile_published(self):
+        _published = {'ping': ['msg']}
+        self.assertIsInstance(compile_published(_published), RpcSchema)
+        self.assertEqual(sorted(compile_published(_published)), ['ping'])
+        self.assertIs(compile_published(self.schema), self.schema)
+        self.assertIsNone(compile_published(None))
+        self.assertEqual(sorted(compile_published(['a', 'b'])), ['a', 'b'])
+
+        with self.assertRaises(TypeError):
+            RpcSchema({'build': [Arg(type=str)]})
@@ -1,13 +1,24 @@
 import unittest
 from oc_cdt_queue2.queue_server import QueueServer
+from oc_cdt_queue2.queue_connection_prcs import QueueConnectionProcess
 from oc_cdt_queue2.ipc_messages import IpcExcMsg
 from oc_cdt_queue2.ipc_messages import IpcMessage
 from oc_cdt_queue2.ipc_messages import IpcMessageResult
+from oc_cdt_queue2.ipc_messages import IpcDeclared
+from oc_cdt_queue2.ipc_messages import IpcLatency
+from oc_cdt_queue2.ipc_messages import IpcQueueStats
+from oc_cdt_queue2.idempotency import IdempotencyCache
+from oc_cdt_queue2.capture import read_capture
 import argparse
+import concurrent.futures
 import logging
 import pika
 import time
 import json
+import os
+import shutil
+import signal
+import tempfile
 from .mocks.queue_t import JoinableQueue
 
 ## BEG:MOCKS
@@ -26,7 +37,7 @@ class _ConnectionMock(object):
 
 class _ConnectionPrcsMock(object):
     def __init__(self, connection, params, prefetch_count, queue, deads_disabled,
-                 declare, ipc_q_out, ipc_q_in):
+                 declare, ipc_q_out, ipc_q_in, **kwargs):
         self._Connection = connection
         self._connection = None
         self.params = params
@@ -36,6 +47,8 @@ class _ConnectionPrcsMock(object):
         self.declare = declare
         self.ipc_q_out = ipc_q_out
         self.ipc_q_in = ipc_q_in
+        # all other (optional) parameters
+        self.kwargs = kwargs
         self.__is_alive = False
         # use time as pid - surely it will not be the same
         # does not matter it is float, for our test this is enough
@@ -47,6 +60,9 @@ class _ConnectionPrcsMock(object):
     def terminate(self):
         self.__is_alive = False
 
+    def join(self, timeout=None):
+        pass
+
     def is_alive(self):
         return self.__is_alive
 
@@ -259,7 +275,7 @@ class QueueServerTest(unittest.TestCase):
                 self.item_list = list()
                 super(_MockServerIQ, self).__init__(*argv, **argp)
 
-            def _process_message(self, delivery_tag, properties, body):
+            def _process_message(self, delivery_tag, properties, body, delivery=None):
                 self.item_list.append({delivery_tag: [properties, body]})
 
         self.__assign_server(_MockServerIQ)
@@ -298,6 +314,190 @@ class QueueServerTest(unittest.TestCase):
             self.assertEqual(_item.get(delivery_tag)[0], _msg_props)
             self.assertEqual(_item.get(delivery_tag)[1], _msg_body)
 
+    def test_latency(self):
+        class _MockServerLatency(QueueServer):
+            def on_message_raw(self, body, properties):
+                if body == 'fail':
+                    raise ValueError("Test failure")
+
+        self.__assign_server(_MockServerLatency)
+        self.__setup_server()
+        self.assertEqual(self.server.get_latency(), dict())
+        self.assertFalse(self.server._connection_prcs.kwargs['latency'])
+
+        self.server.setup(latency_stats=True, latency_report=60)
+        self.server._terminate_delay = 0
+        self.server.disconnect()
+        self.server.connect()
+        self.assertTrue(self.server._connection_prcs.kwargs['latency'])
+        _ipc_q = self.server._ipc_q_in
+        _now = time.time()
+        _props = pika.BasicProperties(headers={QueueServer.published_at_header: int((_now - 2) * 1000000)},
+                                      type='call')
+        _ipc_q.put(IpcMessage(1, _props, 'ok', queue='test.input.p1', received=_now - 0.5))
+        _ipc_q.put(IpcMessage(2, pika.BasicProperties(timestamp=int(_now) - 10), 'fail', received=_now))
+        # messages from older versions of client and connection process have no time set
+        _ipc_q.put(IpcMessage(3, pika.BasicProperties(), 'ok'))
+        _ipc_q.put(IpcLatency([('test.input.p1', 0.25), (None, 0.125)]))
+
+        for _i in range(0, 4):
+            self.server._prcs_ipc_q_pop()
+
+        # results carry reporting time to measure acknowledgement latency
+        _results = list()
+        while not self.server._ipc_q_out.empty():
+            _results.append(self.server._ipc_q_out.get())
+            self.server._ipc_q_out.task_done()
+
+        self.assertEqual(len(_results), 3)
+        self.assertTrue(all(_result.reported for _result in _results))
+        _latency = self.server.get_latency()
+        self.assertEqual(sorted(_latency.keys()), ['ack', 'handler', 'ipc', 'queue_wait'])
+        self.assertAlmostEqual(_latency['queue_wait']['test.input.p1']['max'], 1.5, places=3)
+        self.assertGreaterEqual(_latency['queue_wait']['test.input']['max'], 10)
+        self.assertGreaterEqual(_latency['ipc']['test.input.p1']['max'], 0.5)
+        self.assertEqual(_latency['ipc']['test.input']['count'], 1)
+        # failed calls are counted too
+        self.assertEqual(_latency['handler']['call']['count'], 1)
+        self.assertEqual(_latency['handler']['message']['count'], 2)
+        self.assertEqual(_latency['ack']['test.input.p1']['max'], 0.25)
+        self.assertEqual(_latency['ack']['test.input']['max'], 0.125)
+
+    def test_backlog(self):
+        class _MetricsServerMock(object):
+            def __init__(self, collect, port, host=''):
+                self.collect = collect
+                self.port = port
+                self.stopped = False
+
+            def start(self):
+                return self
+
+            def stop(self):
+                self.stopped = True
+
+        class _MockServerBacklog(QueueServer):
+            _MetricsServer = _MetricsServerMock
+
+        self.__assign_server(_MockServerBacklog)
+        self.__setup_server()
+        self.assertEqual(self.server._connection_prcs.kwargs['probe_interval'], 0)
+        self.assertIsNone(self.server._metrics_server)
+
+        with self.assertRaises(ValueError):
+            self.server.setup(probe_interval=-1)
+
+        self.server.setup(probe_interval=10, metrics_port=9100)
+        self.server._terminate_delay = 0
+        self.server.worker_index = 2
+        self.server.disconnect()
+        self.server.connect()
+        self.assertEqual(self.server._connection_prcs.kwargs['probe_interval'], 10)
+        # supervisor workers listen to ports of their own
+        _metrics_server = self.server._metrics_server
+        self.assertEqual(_metrics_server.port, 9102)
+
+        # metrics server is kept across reconnections
+        self.server.disconnect()
+        self.server.connect()
+        self.assertIs(self.server._metrics_server, _metrics_server)
+
+        # probes are taken even when messages are not processed
+        self.server._ipc_q_in.put(IpcQueueStats('test.input', 50, 1, 1000.0))
+        self.server._ipc_q_in.put(IpcQueueStats('test.input', 30, 2, 1010.0))
+        self.server._prcs_ipc_q_pop()
+        self.server._prcs_ipc_q_pop(do_process=False)
+        _backlog = self.server.get_backlog()
+        self.assertEqual(_backlog['test.input']['messages'], 30)
+        self.assertEqual(_backlog['test.input']['consumers'], 2)
+        self.assertAlmostEqual(_backlog['test.input']['drain_rate'], 2.0)
+        self.assertAlmostEqual(_backlog['test.input']['time_to_empty'], 15.0)
+
+        _metrics = _metrics_server.collect()
+        self.assertEqual(_metrics['backlog'], _backlog)
+        self.assertEqual(_metrics['stats'], self.server.get_stats())
+        self.assertEqual(_metrics['latency'], dict())
+
+        self.server.stop_metrics()
+        self.assertTrue(_metrics_server.stopped)
+        self.assertIsNone(self.server._metrics_server)
+
+    def test_capture(self):
+        class _MockServerCapture(QueueServer):
+            def on_message_raw(self, body, properties):
+                if body == b'fail':
+                    raise ValueError("Processing failed")
+
+        _dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, _dir)
+        _path = os.path.join(_dir, 'capture.bin')
+        self.__assign_server(_MockServerCapture)
+        self.server.setup('amqp://127.0.0.1', queue='test.input', deads_disabled=False)
+
+        with self.assertRaises(ValueError):
+            self.server.setup(capture_limit=-1)
+
+        self.server.setup(capture=_path, capture_limit=3, retry_delays=[1])
+        self.server.connect()
+
+        for (_tag, _body, _headers) in [(1, b'first', {'key': 'value'}), (2, b'fail', None), (3, b'second', None),
+                                        (4, b'over limit', None)]:
+            self.server._ipc_q_in.put(IpcMessage(_tag, pika.BasicProperties(headers=_headers), _body,
+                                                 redelivered=_tag == 3, queue='test.input', received=1000.0 + _tag))
+            self.server._prcs_ipc_q_pop()
+
+        # capture is stopped when limit is reached
+        self.assertIsNone(self.server._capture)
+        self.server._terminate_delay = 0
+        self.server.disconnect()
+
+        _records = list(read_capture(_path))
+        self.assertEqual([(_record.body, _record.result, _record.redelivered, _record.queue, _record.received)
+                          for _record in _records],
+                         [(b'first', 'ack', False, 'test.input', 1001.0), (b'fail', 'retry', False, 'test.input', 1002.0),
+                          (b'second', 'ack', True, 'test.input', 1003.0)])
+        self.assertEqual(_records[0].properties.headers, {'key': 'value'})
+        self.assertGreater(_records[0].duration, 0)
+
+    def test_cpu_profile(self):
+        _dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, _dir)
+        _output = os.path.join(_dir, 'profile-{pid}')
+        parser = argparse.ArgumentParser(description='test parser')
+        self.server.basic_args(parser)
+        args = parser.parse_args(('--amqp-url amqp://127.0.0.1 --queue test.input --profile sample --profile-report 2 '
+                                  '--profile-interval 0.001 --profile-output %s --profile-connection' % _output).split(' '))
+        self.server.setup_from_args(args)
+        self.addCleanup(signal.signal, signal.SIGUSR2, signal.SIG_DFL)
+        self.server.connect()
+        _kwargs = self.server._connection_prcs.kwargs
+        self.assertEqual((_kwargs['profile'], _kwargs['profile_output'], _kwargs['profile_interval']),
+                         ('sample', _output + '.connection', 0.001))
+
+        for _tag in range(1, 3):
+            self.server._process_message(_tag, pika.BasicProperties(type='ping'), b'')
+
+        self.assertTrue(self.server._cpu_profiler.report_due())
+        # connection process is asked to report along with the main one
+        _killed = list()
+        _kill = os.kill
+        os.kill = lambda _pid, _signal: _killed.append((_pid, _signal))
+
+        try:
+            self.server._log_cpu_profile()
+        finally:
+            os.kill = _kill
+
+        self.assertEqual(_killed, [(self.server._connection_prcs.pid, signal.SIGUSR2)])
+        self.assertEqual(os.listdir(_dir), ['profile-%d' % os.getpid()])
+        self.assertFalse(self.server._cpu_profiler.report_due())
+        self.assertEqual(self.server._cpu_profiler._times['ping'][0], 2)
+
+        self.server.stop_profile()
+        self.assertIsNone(self.server._cpu_profiler)
+        self.server._terminate_delay = 0
+        self.server.disconnect()
+
     def test_run(self):
         # here we are interesting in suquence of calls
         class _MockServerRun(QueueServer):
@@ -364,6 +564,71 @@ class QueueServerTest(unittest.TestCase):
         self.assertEqual(2, self.server._increase_ipc_delay_called)
         self.assertEqual(3, self.server._disconnect_called)
 
+    def test_run_concurrent(self):
+        # messages with the same key are processed in order, results are reported as they finish
+        class _MockServerConcurrent(QueueServer):
+            processed = list()
+
+            def on_message_raw(self, body, properties):
+                (_delay, _fail) = json.loads(body)
+                time.sleep(_delay)
+                self.processed.append(properties.message_id)
+
+                if _fail:
+                    raise Exception("Test exception: message processing failed")
+
+            def _increase_ipc_delay(self):
+                # everything is processed
+                self._stop = True
+
+        self.__assign_server(_MockServerConcurrent)
+        self.__setup_server()
+        self.server.setup(executor=concurrent.futures.ThreadPoolExecutor(4), ordering_header='x-key')
+        self.server._terminate_delay = 0
+        _ipc_q = self.server._ipc_q_in
+        _ipc_q_out = self.server._ipc_q_out
+
+        for (_tag, _key, _delay, _fail) in [(1, 'a', 0.2, False), (2, 'a', 0, True), (3, 'b', 0, False),
+                                           (4, None, 0.1, False)]:
+            _props = pika.BasicProperties(headers={'x-key': _key}, message_id='m%d' % _tag)
+            _ipc_q.put(IpcMessage(_tag, _props, json.dumps([_delay, _fail])))
+
+        self.server.run()
+        self.server.executor.shutdown()
+        self.assertEqual(self.server.processed, ['m3', 'm4', 'm1', 'm2'])
+        _results = list()
+        while not _ipc_q_out.empty():
+            _results.append(_ipc_q_out.get())
+            _ipc_q_out.task_done()
+
+        # the last one is disconnect command
+        _results.pop()
+
+        self.assertEqual([(_result.delivery_tag, _result.ack) for _result in _results],
+                         [(3, True), (4, True), (1, True), (2, False)])
+        self.assertEqual(self.server.counter_good, 3)
+        self.assertEqual(self.server.counter_bad, 1)
+
+        with self.assertRaises(ValueError):
+            self.server.setup(batch_size=10)
+
+    def test_concurrent_reconnect(self):
+        # results of messages got on previous connection are dropped
+        class _MockServerConcurrent(QueueServer):
+            def on_message_raw(self, body, properties):
+                pass
+
+        self.__assign_server(_MockServerConcurrent)
+        self.__setup_server()
+        self.server.setup(executor=concurrent.futures.ThreadPoolExecutor(1))
+        self.server._terminate_delay = 0
+        self.server._process_message(1, pika.BasicProperties(), "[]")
+        self.server.executor.shutdown()
+        self.server.connect()
+        self.server._process_completed(1)
+        self.assertTrue(self.server._ipc_q_out.empty())
+        self.assertEqual(self.server.counter_good, 0)
+
     def test_process_message_ok(self):
         # re-define on_message_raw to do something and return OK
         # check _ipc_delay decreased
@@ -444,6 +709,351 @@ class QueueServerTest(unittest.TestCase):
         self.assertFalse(__item.ack)
         self.assertEqual(__item.delivery_tag, 0)
 
+    def test_process_message_retry(self):
+        # failed message is to be sent to retry queue corresponding to its retries count
+        # no sleep is expected even if deads are disabled
+        class _MockServerMsgPrcs(QueueServer):
+            def on_message_raw(self, body, properties):
+                raise Exception("Test exception: message processing failed")
+
+            def _sleep_on_nack(self):
+                raise AssertionError("Should not sleep on retries")
+
+        self.__assign_server(_MockServerMsgPrcs)
+        self.__setup_server()
+        self.server.setup(retry_delays=[1, 10], retry_max=3)
+        self.server.deads_disabled = True
+        _ipc_q = self.server._ipc_q_out
+
+        for _retries, _queue in [(None, 'test.input.retry.1000'), (1, 'test.input.retry.10000'),
+                                 (2, 'test.input.retry.10000'), (3, None)]:
+            _headers = {} if _retries is None else {'x-retry-count': _retries}
+            _msgprops = pika.BasicProperties(content_type='application/json', headers=_headers)
+            self.server._process_message(5, _msgprops, "[]")
+            __item = _ipc_q.get()
+            _ipc_q.task_done()
+            self.assertFalse(__item.ack)
+            self.assertFalse(__item.requeue)
+            self.assertEqual(__item.retry_queue, _queue)
+
+            if _queue:
+                self.assertEqual(__item.retry_count, (_retries or 0) + 1)
+
+        self.assertEqual(self.server.counter_bad, 4)
+
+    def test_setup_retries_from_args(self):
+        parser = argparse.ArgumentParser(description='test parser')
+        self.server.basic_args(parser)
+        args = parser.parse_args('--amqp-url amqp://127.0.0.1 --queue test.input --retry-delays 0.5,5,60 --retry-max 7'.split(' '))
+        self.server.setup_from_args(args)
+        self.assertEqual(self.server.retry_delays, [0.5, 5, 60])
+        self.assertEqual(self.server.retry_max, 7)
+        self.server.connect()
+        self.assertEqual(self.server._connection_prcs.kwargs.get('retry_delays'), [0.5, 5, 60])
+
+        with self.assertRaises(ValueError):
+            self.server.setup(retry_delays=[0])
+
+    def test_connect_partitions(self):
+        parser = argparse.ArgumentParser(description='test parser')
+        self.server.basic_args(parser)
+        args = parser.parse_args('--amqp-url amqp://127.0.0.1 --queue test.input --partitions 4 --consume-partitions 3,1'.split(' '))
+        self.server.setup_from_args(args)
+        self.assertEqual(self.server.partitions, 4)
+        self.assertEqual(self.server.consume_partitions, [3, 1])
+        self.server.connect()
+        _prcs = self.server._connection_prcs
+        self.assertEqual(_prcs.queue, 'test.input.p3')
+        self.assertEqual(_prcs.kwargs.get('consume_queues'), ['test.input.p1'])
+        # all partitions are declared
+        self.assertEqual(_prcs.kwargs.get('declare_queues'), ['test.input.p0', 'test.input.p1', 'test.input.p2'])
+        # dead messages go where the ones of not partitioned queue do
+        self.assertEqual(_prcs.kwargs.get('deads_queue'), 'test.deads')
+
+        self.server.setup(consume_partitions=[4])
+        with self.assertRaises(ValueError):
+            self.server.connect()
+
+    def test_process_message_retry_partition(self):
+        # failed message is retried to the partition it came from
+        class _MockServerMsgPrcs(QueueServer):
+            def on_message_raw(self, body, properties):
+                raise Exception("Test exception: message processing failed")
+
+        self.__assign_server(_MockServerMsgPrcs)
+        self.__setup_server()
+        self.server.setup(retry_delays=[1])
+        _delivery = IpcMessage(5, pika.BasicProperties(), "[]", queue='test.input.p2')
+        self.server._process_message(5, _delivery.properties, _delivery.body, delivery=_delivery)
+        self.assertEqual(self.server._ipc_q_out.get().retry_queue, 'test.input.p2.retry.1000')
+
+    def test_declared_topology(self):
+        # declarations confirmed by connection process are passed to the next one
+        self.__setup_server()
+        self.assertEqual(self.server._connection_prcs.kwargs.get('declared'), frozenset())
+        self.server._ipc_q_in.put(IpcDeclared(frozenset(['a', 'b'])))
+        self.server._prcs_ipc_q_pop()
+        self.server._terminate_delay = 0
+        self.server.disconnect()
+        self.server.connect()
+        self.assertEqual(self.server._connection_prcs.kwargs.get('declared'), frozenset(['a', 'b']))
+
+        # queue deleted: everything is to be declared again
+        self.server._ipc_q_in.put(IpcExcMsg(pika.exceptions.ChannelClosedByBroker(404, 'NOT_FOUND')))
+        self.server._prcs_ipc_q_pop()
+        self.server.disconnect()
+        self.server.connect()
+        self.assertEqual(self.server._connection_prcs.kwargs.get('declared'), frozenset())
+
+    def test_process_message_duplicate(self):
+        # message with the key processed already is to be acked without processing
+        class _MockServerMsgPrcs(QueueServer):
+            def __init__(self, *argv, **argp):
+                self.processed = list()
+                super(_MockServerMsgPrcs, self).__init__(*argv, **argp)
+
+            def on_message_raw(self, body, properties):
+                self.processed.append(body)
+
+                if body == 'fail':
+                    raise Exception("Test exception: message processing failed")
+
+        self.__assign_server(_MockServerMsgPrcs)
+        self.server.setup('amqp://127.0.0.1', queue='test.input', idempotency_size=10)
+        self.server._terminate_delay = 0
+        self.server.connect()
+        _ipc_q = self.server._ipc_q_out
+
+        for (_body, _message_id) in [('first', 'id1'), ('fail', 'id2'), ('first', 'id1'), ('fail', 'id2'), ('none', None)]:
+            _msgprops = pika.BasicProperties(content_type='application/json', message_id=_message_id)
+            self.server._process_message(1, _msgprops, _body,
+                                         delivery=IpcMessage(1, _msgprops, _body, redelivered=True))
+            _ipc_q.get()
+            _ipc_q.task_done()
+
+        # failed messages are not remembered
+        self.assertEqual(self.server.processed, ['first', 'fail', 'fail', 'none'])
+        self.assertEqual(self.server.counter_duplicates, 1)
+        self.assertEqual(self.server.counter_messages, 5)
+
+        # header may be used as a key, cache is kept across reconnections
+        _cache = self.server._idempotency
+        self.server.setup(idempotency_header='x-key')
+        self.server.connect()
+        self.assertIs(_cache, self.server._idempotency)
+        _msgprops = pika.BasicProperties(content_type='application/json', message_id='id1', headers={'x-key': 'id3'})
+        self.server._process_message(2, _msgprops, 'second')
+        self.assertEqual(self.server.processed[-1], 'second')
+
+    def test_process_message_duplicate_file(self):
+        # file-backed cache is closed on disconnection with keys synced, reopened on connection
+        _dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, _dir)
+        _path = os.path.join(_dir, 'keys')
+        self.server.setup('amqp://127.0.0.1', queue='test.input', idempotency_size=10, idempotency_file=_path)
+        self.server._terminate_delay = 0
+        self.server.connect()
+        _msgprops = pika.BasicProperties(content_type='application/json', message_id='id1')
+        self.server._process_message(1, _msgprops, '"first"')
+        self.server._ipc_q_out.get()
+        self.server._ipc_q_out.task_done()
+        _cache = self.server._idempotency
+        self.server.disconnect()
+        self.assertIsNone(self.server._idempotency)
+        self.assertIsNone(_cache._mmap)
+        _reopened = IdempotencyCache(10, path=_path)
+        self.assertIn('id1', _reopened)
+        _reopened.close()
+
+        self.server.connect()
+        self.assertIsNot(self.server._idempotency, _cache)
+        self.server._process_message(2, _msgprops, '"first"')
+        self.assertEqual(self.server.counter_duplicates, 1)
+        self.server.disconnect()
+
+    def test_process_batch(self):
+        # messages are collected up to batch size, failed ones are reported first, then the rest acked at once
+        class _MockServerBatch(QueueServer):
+            batches = list()
+            acked = list()
+
+            def on_batch(self, items):
+                self.batches.append([_item.delivery_tag for _item in items])
+
+                for _item in items:
+                    if _item.body == 'bad':
+                        _item.fail(ValueError("bad message"))
+
+            def on_ack(self, body, properties):
+                self.acked.append(body)
+
+        self.__assign_server(_MockServerBatch)
+        self.server.setup('amqp://127.0.0.1', queue='test.input', deads_disabled=True)
+        self.server.setup(batch_size=3, prefetch_count=2)
+        self.server.max_sleep = 0
+        self.server.connect()
+        self.assertEqual(self.server._connection_prcs.prefetch_count, 3)
+        _ipc_q = self.server._ipc_q_out
+        _props = pika.BasicProperties(content_type='application/json')
+
+        for (_tag, _body) in [(1, 'good'), (2, 'bad'), (3, 'good'), (4, 'good')]:
+            self.server._process_message(_tag, _props, _body)
+
+        self.assertEqual(self.server.batches, [[1, 2, 3]])
+        self.assertEqual(self.server.acked, ['good', 'good'])
+        self.assertEqual(self.server.counter_bad, 1)
+        self.assertEqual(len(self.server._batch), 1)
+
+        _results = list()
+        while not _ipc_q.empty():
+            _results.append(_ipc_q.get())
+            _ipc_q.task_done()
+
+        self.assertEqual([(_r.delivery_tag, _r.ack, _r.multiple) for _r in _results], [(2, False, False), (3, True, True)])
+
+        # incomplete batch is processed by timeout
+        self.server.batch_timeout = 10
+        self.assertGreater(self.server._batch_wait(), 0)
+        self.server._batch_started -= 10
+        self.assertEqual(self.server._batch_wait(), 0)
+        self.server._process_batch()
+        self.assertEqual(self.server.batches[-1], [4])
+        _result = _ipc_q.get()
+        _ipc_q.task_done()
+        self.assertEqual((_result.delivery_tag, _result.ack, _result.multiple), (4, True, True))
+
+    def test_process_batch_retry(self):
+        # with retries set up failed message is acked when its copy is confirmed: others are not acked at once
+        class _MockServerBatch(QueueServer):
+            def on_batch(self, items):
+                items[1].fail(ValueError("bad message"))
+
+        self.__assign_server(_MockServerBatch)
+        self.server.setup('amqp://127.0.0.1', queue='test.input', batch_size=3, retry_delays=[1])
+        self.server.connect()
+        _ipc_q = self.server._ipc_q_out
+        _props = pika.BasicProperties(content_type='application/json')
+
+        for _tag in [1, 2, 3]:
+            self.server._process_message(_tag, _props, 'body')
+
+        _results = list()
+        while not _ipc_q.empty():
+            _results.append(_ipc_q.get())
+            _ipc_q.task_done()
+
+        self.assertEqual([(_r.delivery_tag, _r.ack, _r.multiple, _r.retry_queue) for _r in _results],
+                         [(2, False, False, 'test.input.retry.1000'), (1, True, False, None), (3, True, False, None)])
+
+    def test_process_batch_exception(self):
+        # exception fails the whole batch
+        class _MockServerBatch(QueueServer):
+            def on_batch(self, items):
+                raise ValueError("database is down")
+
+        self.__assign_server(_MockServerBatch)
+        self.server.setup('amqp://127.0.0.1', queue='test.input', deads_disabled=False)
+        self.server.setup(batch_size=2)
+        self.server.connect()
+        _ipc_q = self.server._ipc_q_out
+        _props = pika.BasicProperties(content_type='application/json')
+        self.server._process_message(1, _props, 'body')
+        self.server._process_message(2, _props, 'body')
+        self.assertEqual(self.server.counter_bad, 2)
+        _results = list()
+        while not _ipc_q.empty():
+            _results.append(_ipc_q.get())
+            _ipc_q.task_done()
+
+        self.assertEqual([(_r.delivery_tag, _r.ack, _r.requeue) for _r in _results], [(1, False, False), (2, False, False)])
+
+    def test_process_stream(self):
+        # chunks are acked once spooled, the last one after on_stream() is done
+
+        class _MockServerStream(QueueServer):
+            streams = list()
+
+            def on_stream(self, chunks, properties):
+                self.streams.append(list(chunks))
+
+                if len(self.streams) == 1:
+                    raise ValueError("Processing failed")
+
+        _spool = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, _spool)
+        self.__assign_server(_MockServerStream)
+        self.server.setup('amqp://127.0.0.1', queue='test.input', deads_disabled=False)
+        self.server.setup(stream_spool=_spool)
+        self.server.connect()
+        _ipc_q = self.server._ipc_q_out
+
+        for (_tag, _index, _count) in [(1, 0, None), (2, 1, None), (3, 2, 3), (4, 2, 3)]:
+            _props = pika.BasicProperties(headers={'x-stream-id': b'tr1', 'x-stream-index': _index,
+                                                   'x-stream-count': _count})
+            self.server._process_message(_tag, _props, b'chunk%d' % _index)
+
+        _results = list()
+        while not _ipc_q.empty():
+            _results.append(_ipc_q.get())
+            _ipc_q.task_done()
+
+        # the first attempt failed, the last chunk redelivered completes transfer again
+        self.assertEqual([(_r.delivery_tag, _r.ack) for _r in _results], [(1, True), (2, True), (3, False), (4, True)])
+        self.assertEqual(self.server.streams, [[b'chunk0', b'chunk1', b'chunk2']] * 2)
+        self.assertEqual(self.server.counter_good, 1)
+        self.assertEqual(self.server.counter_bad, 1)
+        # spool is cleaned up
+        self.assertEqual(os.listdir(_spool), list())
+
+        # supervised worker is one of several consumers: chunks are rejected instead of being lost in its spool
+        self.server.worker_index = 1
+        self.server._process_message(5, pika.BasicProperties(headers={'x-stream-id': b'tr2', 'x-stream-index': 0}),
+                                     b'chunk0')
+        _result = _ipc_q.get()
+        _ipc_q.task_done()
+        self.assertEqual((_result.delivery_tag, _result.ack, _result.requeue), (5, False, False))
+        self.assertEqual(os.listdir(_spool), list())
+
+    def test_inflight_stats(self):
+        parser = argparse.ArgumentParser(description='test parser')
+        self.server.basic_args(parser)
+        args = parser.parse_args('--amqp-url amqp://127.0.0.1 --queue test.input --max-inflight 50 --max-inflight-bytes 1000'.split(' '))
+        self.server.setup_from_args(args)
+        self.server.connect()
+        self.assertEqual(self.server._connection_prcs.kwargs.get('max_inflight'), 50)
+        self.assertEqual(self.server._connection_prcs.kwargs.get('max_inflight_bytes'), 1000)
+
+        for _paused in [False, True, True, False, True]:
+            self.server._update_inflight(IpcMessage(1, None, b'', inflight=3, inflight_bytes=300, paused=_paused))
+
+        _stats = self.server.get_stats()
+        self.assertEqual(_stats.get('inflight_messages'), 3)
+        self.assertEqual(_stats.get('inflight_bytes'), 300)
+        self.assertTrue(_stats.get('consuming_paused'))
+        self.assertEqual(_stats.get('pauses'), 2)
+
+    def test_start_method(self):
+        # connection process is started by the method given, with queues of the same context
+        parser = argparse.ArgumentParser(description='test parser')
+        self.server.basic_args(parser)
+        args = parser.parse_args('--amqp-url amqp://127.0.0.1:1 --queue test.input --start-method spawn'.split(' '))
+        self.server.setup_from_args(args)
+        self.assertEqual(self.server.start_method, 'spawn')
+
+        # real process and queues: the process fails to connect and reports it
+        self.server._QueueConnectionProcess = QueueConnectionProcess
+        self.server._Connection = pika.SelectConnection
+        self.server._JoinableQueue = None
+        self.server._terminate_delay = 1
+        self.server.connect()
+        self.assertEqual(self.server._connection_prcs._start_method, 'spawn')
+        _msg = self.server._ipc_q_in.get(timeout=30)
+        self.server._ipc_q_in.task_done()
+        self.assertIsInstance(_msg, IpcExcMsg)
+        self.assertEqual(_msg.type, pika.exceptions.AMQPConnectionError)
+        self.server.disconnect()
+        self.assertIsNone(self.server._connection_prcs)
+
     def test_on_ack(self):
         ## counter increased + on_ack called
         # we do not care for body and properties yet so may simply pass None
@@ -519,3 +1129,31 @@ class QueueServerTest(unittest.TestCase):
         self.assertEqual(self.server._on_message_called, 0)
         self.assertIsNone(self.server._on_message_props)
         self.assertIsNone(self.server._on_message_body)
+
+    def test_on_message_items(self):
+        # large JSON arrays are decoded element by element when enabled
+        self.__assign_server(_MockServerOnMsg)
+        self.server.setup(json_stream_size=16)
+        _props = pika.BasicProperties(content_type='application/json')
+        self.server.on_message_raw(b'[1, "two", [3]]', _props)
+        self.server.on_message_raw(b'{"test_body": "test_value"}', _props)
+        self.assertEqual(self.server._on_message_called, 2)
+        self.assertEqual(self.server._on_message_body, {"test_body": "test_value"})
+
+        _items = list()
+
+        class _ItemsServer(_MockServerOnMsg):
+            def on_message_items(self, items, properties):
+                for _item in items:
+                    _items.append(_item)
+
+        self.__assign_server(_ItemsServer)
+        self.server.setup(json_stream_size=16)
+        self.server.on_message_raw(b'[1, "two", [3]]', _props)
+        self.assertEqual(_items, list())
+        self.assertEqual(self.server._on_message_body, [1, "two", [3]])
+        self.server.on_message_raw(b' [1, "two", [3], {"4": null}]', _props)
+        self.assertEqual(_items, [1, "two", [3], {"4": None}])
+
+        with self.assertRaises(ValueError):
+            self.server.setup(json_stream_size=-1)
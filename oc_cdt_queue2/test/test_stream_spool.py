@@ -0,0 +1,57 @@
+import unittest
+from oc_cdt_queue2.stream_spool import StreamSpool
+import os
+import tempfile
+import shutil
+import time
+
+
+class StreamSpoolTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.spool = StreamSpool(os.path.join(self.path, 'spool'))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_in_order(self):
+        self.assertFalse(self.spool.add('t1', 0, b'ab'))
+        self.assertFalse(self.spool.add('t1', 1, 'cd'))
+        self.assertTrue(self.spool.add('t1', 2, b'e', count=3))
+        self.assertEqual(list(self.spool.chunks('t1')), [b'ab', b'cd', b'e'])
+        self.spool.remove('t1')
+        self.assertEqual(list(self.spool.chunks('t1')), list())
+
+    def test_out_of_order_and_duplicates(self):
+        self.assertFalse(self.spool.add('../t2', 2, b'e', count=3))
+        self.assertFalse(self.spool.add('../t2', 0, b'ab'))
+        self.assertFalse(self.spool.add('../t2', 0, b'ab'))
+        self.assertTrue(self.spool.add('../t2', 1, b'cd'))
+        self.assertEqual(b''.join(self.spool.chunks('../t2')), b'abcde')
+        # transfer id is not used as path
+        self.assertEqual(os.listdir(self.path), ['spool'])
+
+    def test_restart(self):
+        self.spool.add('t3', 0, b'ab')
+        _spool = StreamSpool(self.spool.path)
+        self.assertTrue(_spool.add('t3', 1, b'cd', count=2))
+        self.assertEqual(list(_spool.chunks('t3')), [b'ab', b'cd'])
+
+    def test_sweep(self):
+        self.spool.add('t4', 0, b'ab')
+        _spool = StreamSpool(self.spool.path, ttl=60)
+        _spool.add('t5', 0, b'ab')
+        self.assertEqual(_spool.sweep(), 0)
+        # transfers not updated for ttl are removed, the rest are kept
+        _old = _spool._transfer_path('t4')
+        os.utime(_old, (os.path.getmtime(_old) - 120, os.path.getmtime(_old) - 120))
+        self.assertEqual(_spool.sweep(), 1)
+        self.assertFalse(os.path.exists(_old))
+        self.assertEqual(list(_spool.chunks('t5')), list())
+        self.assertTrue(_spool.add('t5', 1, b'cd', count=2))
+        # no expiration by default
+        self.assertEqual(StreamSpool(self.spool.path).sweep(time.time() + 3600), 0)
+        self.assertEqual(StreamSpool(self.spool.path, ttl=60).sweep(time.time() + 3600), 1)
+
+        with self.assertRaises(ValueError):
+            StreamSpool(self.spool.path, ttl=-1)
@@ -0,0 +1,182 @@
+import unittest
+from oc_cdt_queue2.queue_application import QueueApplication
+from oc_cdt_queue2.queue_supervisor import QueueSupervisor
+from oc_cdt_queue2.queue_supervisor import AppFactory
+import multiprocessing
+import threading
+import tempfile
+import logging
+import signal
+import shutil
+import sys
+import time
+import os
+
+# to get rid of logging output from imported classes
+logging.getLogger().propagate = False
+logging.getLogger().disabled = True
+
+
+class _AppMock(QueueApplication):
+    def __init__(self, workdir, *args, **kwargs):
+        super(_AppMock, self).__init__(*args, **kwargs)
+        self.workdir = workdir
+        self.worker_index = None
+
+    def get_stats(self):
+        return {'messages': 5, 'consuming_paused': True, 'worker': 'w%d' % self.worker_index}
+
+
+class _FailingOnceAppMock(_AppMock):
+    def _main(self):
+        _marker = os.path.join(self.workdir, str(self.worker_index))
+
+        if not os.path.exists(_marker):
+            open(_marker, 'w').close()
+            sys.exit(1)
+
+        return 0
+
+
+class _WaitingAppMock(_AppMock):
+    def _main(self):
+        open(os.path.join(self.workdir, str(self.worker_index)), 'w').close()
+
+        while not self._shutdown:
+            time.sleep(0.01)
+
+        return 0
+
+
+class _LostConnectionAppMock(_AppMock):
+    def _connect_and_run(self):
+        # connection process died, reconnect is not set
+        self._stop = False
+        return super(_LostConnectionAppMock, self)._connect_and_run()
+
+    def connect(self):
+        pass
+
+    def run(self):
+        _marker = os.path.join(self.workdir, str(self.worker_index))
+
+        if not os.path.exists(_marker):
+            open(_marker, 'w').close()
+            return
+
+        self.stop()
+
+    def disconnect(self):
+        pass
+
+
+class QueueSupervisorTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.signals = dict((_s, signal.getsignal(_s)) for _s in (signal.SIGTERM, signal.SIGINT))
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+        for _s, _handler in self.signals.items():
+            signal.signal(_s, _handler)
+
+    def __supervisor(self, app_class, processes, start_method='fork'):
+        _factory = AppFactory(app_class, ['--amqp-url', 'amqp://127.0.0.1'], args=(self.workdir,))
+        _supervisor = QueueSupervisor(_factory, processes, context=multiprocessing.get_context(start_method))
+        _supervisor.check_interval = 0.05
+        _supervisor.shutdown_timeout = 5
+        return _supervisor
+
+    def test_processes_wrong(self):
+        with self.assertRaises(ValueError):
+            QueueSupervisor(AppFactory(QueueApplication, list()), 0)
+
+    def test_restart(self):
+        _supervisor = self.__supervisor(_FailingOnceAppMock, 2)
+        self.assertEqual(0, _supervisor.run())
+        # every worker died once and finished normally after restart
+        self.assertEqual(2, _supervisor.counter_restarts)
+        self.assertEqual(sorted(os.listdir(self.workdir)), ['0', '1'])
+
+        _stats = _supervisor.get_stats()
+        self.assertEqual(_stats['messages'], 10)
+        self.assertEqual(_stats['consuming_paused'], 2)
+        self.assertNotIn('worker', _stats)
+        self.assertEqual(_stats['restarts'], 2)
+        self.assertEqual(_stats['workers'][1]['worker'], 'w1')
+
+    def test_shutdown(self):
+        _supervisor = self.__supervisor(_WaitingAppMock, 3)
+
+        def _shutdown_started():
+            # all workers are running
+            if len(os.listdir(self.workdir)) < 3:
+                threading.Timer(0.05, _shutdown_started).start()
+                return
+
+            os.kill(os.getpid(), signal.SIGTERM)
+
+        threading.Timer(0.05, _shutdown_started).start()
+        self.assertEqual(0, _supervisor.run())
+        self.assertEqual(0, _supervisor.counter_restarts)
+        # workers stopped gracefully and reported stats on exit
+        self.assertEqual(_supervisor.get_stats()['messages'], 15)
+        self.assertTrue(all(_worker is None for _worker in _supervisor._workers))
+
+    def test_restart_spawn(self):
+        # application is built in worker, nothing is pickled but its class and command line
+        _supervisor = self.__supervisor(_FailingOnceAppMock, 1, start_method='spawn')
+        self.assertEqual(0, _supervisor.run())
+        self.assertEqual(1, _supervisor.counter_restarts)
+
+    def test_restart_lost_connection(self):
+        # worker exits with error when connection is lost without reconnect
+        _supervisor = self.__supervisor(_LostConnectionAppMock, 2)
+        self.assertEqual(0, _supervisor.run())
+        self.assertEqual(2, _supervisor.counter_restarts)
+
+    def test_app_main(self):
+        class _SupervisorMock(object):
+            def __init__(self, factory, processes, context=None):
+                self.factory = factory
+                self.processes = processes
+                self.context = context
+                _SupervisorMock.created = self
+
+            def run(self):
+                return 7
+
+        class _MockAppMain(QueueApplication):
+            _QueueSupervisor = _SupervisorMock
+
+            def _main(self):
+                raise AssertionError("Not to be called by supervisor process")
+
+        _app = _MockAppMain()
+        self.assertEqual(7, _app.main(['--amqp-url', 'amqp://127.0.0.1', '--processes', '3', '--start-method', 'spawn']))
+        self.assertIs(_SupervisorMock.created.factory.app_class, _MockAppMain)
+        self.assertEqual(_SupervisorMock.created.factory.cmdline,
+                         ['--amqp-url', 'amqp://127.0.0.1', '--processes', '3', '--start-method', 'spawn'])
+        self.assertEqual(_SupervisorMock.created.processes, 3)
+        self.assertEqual(_SupervisorMock.created.context.get_start_method(), 'spawn')
+
+    def test_app_main_factory(self):
+        class _SupervisorMock(object):
+            def __init__(self, factory, processes, context=None):
+                _SupervisorMock.factory = factory
+
+            def run(self):
+                return 0
+
+        class _MockAppMain(_AppMock):
+            _QueueSupervisor = _SupervisorMock
+
+        # application needs constructor arguments: factory is to be given
+        _app = _MockAppMain(self.workdir)
+        _cmdline = ['--amqp-url', 'amqp://127.0.0.1', '--processes', '2']
+        self.assertEqual(2, _app.main(_cmdline))
+        _factory = AppFactory(_MockAppMain, _cmdline, args=(self.workdir,))
+        self.assertEqual(0, _app.main(_cmdline, factory=_factory))
+        self.assertIs(_SupervisorMock.factory, _factory)
+        self.assertEqual(_factory().workdir, self.workdir)